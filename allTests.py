@@ -9,9 +9,13 @@ import os
 from cactus.setup.cactus_setupTest import TestCase as setupTest
 from cactus.blast.blastTest import TestCase as blastTest
 from cactus.blast.cactus_coverageTest import TestCase as coverageTest
+from cactus.blast.binaryAlignmentsTest import TestCase as binaryAlignmentsTest
 from cactus.blast.trimSequencesTest import TestCase as trimSequencesTest
 from cactus.blast.mappingQualityRescoringAndFilteringTest import TestCase as mappingQualityTest
 from cactus.pipeline.cactus_workflowTest import TestCase as workflowTest
+from cactus.pipeline.ktserverControlTest import TestCase as ktserverControlTest
+from cactus.pipeline.ktserverShardsTest import TestCase as ktserverShardsTest
+from cactus.pipeline.ktserverSnapshotsTest import TestCase as ktserverSnapshotsTest
 from cactus.pipeline.cactus_evolverTest import TestCase as evolverTest
 from cactus.bar.cactus_barTest import TestCase as barTest
 from cactus.phylogeny.cactus_phylogenyTest import TestCase as phylogenyTest
@@ -24,6 +28,10 @@ from cactus.normalisation.cactus_normalisationTest import TestCase as normalisat
 from cactus.progressive.allTests import allSuites as progressiveSuite
 from cactus.shared.commonTest import TestCase as commonTest
 from cactus.shared.experimentWrapperTest import TestCase as experimentWrapperTest
+from cactus.shared.resourceModelTest import TestCase as resourceModelTest
+from cactus.shared.flowerGroupingTest import TestCase as flowerGroupingTest
+from cactus.shared.packedFastaTest import TestCase as packedFastaTest
+from cactus.shared.fastaChunksTest import TestCase as fastaChunksTest
 from cactus.faces.cactus_fillAdjacenciesTest import TestCase as fillAdjacenciesTest
 from cactus.preprocessor.allTests import allSuites as preprocessorTest
 from cactus.preprocessor.lastzRepeatMasking.cactus_lastzRepeatMaskTest import TestCase as lastzRepeatMaskTest
@@ -37,6 +45,9 @@ def getSuite():
                     [setupTest,
                      cafTest,
                      workflowTest,
+                     ktserverControlTest,
+                     ktserverShardsTest,
+                     ktserverSnapshotsTest,
                      evolverTest,
                      barTest,
                      phylogenyTest,
@@ -46,9 +57,14 @@ def getSuite():
                      normalisationTest,
                      halTest,
                      coverageTest,
+                     binaryAlignmentsTest,
                      trimSequencesTest,
                      experimentWrapperTest,
+                     packedFastaTest,
+                     fastaChunksTest,
                      fillAdjacenciesTest,
+                     resourceModelTest,
+                     flowerGroupingTest,
                      commonTest]] + [progressiveSuite()]
 
     combinedTests = unittest.TestSuite()
@@ -15,8 +15,251 @@
 #define CACTUS_DISK_NAME_INCREMENT 16384
 #define CACTUS_DISK_BUCKET_NUMBER 65536
 #define CACTUS_DISK_PARAMETER_KEY -100000
+#define CACTUS_DISK_SHARD_TABLE_KEY -100001
+#define CACTUS_DISK_SHARD_RING_POINTS 64
+#define CACTUS_DISK_JOURNAL_COUNT_KEY -100002
+#define CACTUS_DISK_JOURNAL_KEY_BASE -200000
 #define CACTUS_DISK_SEQUENCE_CHUNK_SIZE 500
 
+/*
+ * Functions on the shards of the database.
+ *
+ * The database may be split over several servers. If so, the record
+ * CACTUS_DISK_SHARD_TABLE_KEY of the database the cactus disk is constructed
+ * from lists the conf strings of the shards, one per line, starting with that
+ * database itself. Names are spread over the shards by consistent hashing,
+ * while the non-positive keys (the parameters, the shard table and the
+ * unique ID buckets) all stay in the first shard. The hashing must match
+ * that of src/cactus/pipeline/ktserverShards.py, which writes the table.
+ */
+
+struct _shardRingPoint {
+    uint64_t point;
+    int64_t shard;
+};
+
+static uint64_t mix64(uint64_t x) {
+    /*
+     * The splitmix64 finalizer.
+     */
+    x += 0x9E3779B97F4A7C15ULL;
+    x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9ULL;
+    x = (x ^ (x >> 27)) * 0x94D049BB133111EBULL;
+    return x ^ (x >> 31);
+}
+
+static int shardRingPoint_cmp(const void *a, const void *b) {
+    const struct _shardRingPoint *point1 = a, *point2 = b;
+    if (point1->point != point2->point) {
+        return point1->point < point2->point ? -1 : 1;
+    }
+    return point1->shard < point2->shard ? -1 : (point1->shard > point2->shard ? 1 : 0);
+}
+
+static int64_t getShardIndex(CactusDisk *cactusDisk, int64_t key) {
+    if (cactusDisk->shardRingSize == 0 || key <= 0) {
+        return 0;
+    }
+    // The shard of the first point on the ring at or after the key's hash.
+    uint64_t hash = mix64((uint64_t) key);
+    int64_t low = 0, high = cactusDisk->shardRingSize;
+    while (low < high) {
+        int64_t mid = low + (high - low) / 2;
+        if (cactusDisk->shardRing[mid].point < hash) {
+            low = mid + 1;
+        } else {
+            high = mid;
+        }
+    }
+    return cactusDisk->shardRing[low == cactusDisk->shardRingSize ? 0 : low].shard;
+}
+
+static stKVDatabase *getShard(CactusDisk *cactusDisk, int64_t key) {
+    return stList_get(cactusDisk->shards, getShardIndex(cactusDisk, key));
+}
+
+static void openShards(CactusDisk *cactusDisk, bool create) {
+    /*
+     * Opens the other shards listed in the shard table, if there is one.
+     */
+    cactusDisk->shards = stList_construct3(0, (void (*)(void *)) stKVDatabase_destruct);
+    stList_append(cactusDisk->shards, cactusDisk->database);
+    cactusDisk->shardRing = NULL;
+    cactusDisk->shardRingSize = 0;
+    int64_t recordSize;
+    char *record = stKVDatabase_getRecord2(cactusDisk->database, CACTUS_DISK_SHARD_TABLE_KEY, &recordSize);
+    if (record == NULL) {
+        return;
+    }
+    char *table = st_malloc(recordSize + 1);
+    memcpy(table, record, recordSize);
+    table[recordSize] = '\0';
+    free(record);
+    char *savePtr = NULL;
+    char *confString = strtok_r(table, "\n", &savePtr);
+    assert(confString != NULL); // The first line is the database itself.
+    while ((confString = strtok_r(NULL, "\n", &savePtr)) != NULL) {
+        stKVDatabaseConf *conf = stKVDatabaseConf_constructFromString(confString);
+        stList_append(cactusDisk->shards, stKVDatabase_construct(conf, create));
+        stKVDatabaseConf_destruct(conf);
+    }
+    free(table);
+    int64_t shardNumber = stList_length(cactusDisk->shards);
+    st_logDebug("The cactus disk is split over %" PRIi64 " shards\n", shardNumber);
+    if (shardNumber == 1) {
+        return;
+    }
+    cactusDisk->shardRingSize = shardNumber * CACTUS_DISK_SHARD_RING_POINTS;
+    cactusDisk->shardRing = st_malloc(cactusDisk->shardRingSize * sizeof(struct _shardRingPoint));
+    for (int64_t i = 0; i < shardNumber; i++) {
+        for (int64_t j = 0; j < CACTUS_DISK_SHARD_RING_POINTS; j++) {
+            struct _shardRingPoint *point = &cactusDisk->shardRing[i * CACTUS_DISK_SHARD_RING_POINTS + j];
+            point->point = mix64(((uint64_t) i << 32) | (uint64_t) j);
+            point->shard = i;
+        }
+    }
+    qsort(cactusDisk->shardRing, cactusDisk->shardRingSize, sizeof(struct _shardRingPoint), shardRingPoint_cmp);
+}
+
+static void closeShards(CactusDisk *cactusDisk) {
+    stList_destruct(cactusDisk->shards);
+    free(cactusDisk->shardRing);
+}
+
+/*
+ * Functions on the journal of changed keys.
+ *
+ * If the database has a CACTUS_DISK_JOURNAL_COUNT_KEY record, the keys of
+ * all the records the cactus disk changes are journaled, so that the changes
+ * can be saved as a delta to the last snapshot of the database (see
+ * src/cactus/pipeline/ktserverSnapshots.py). Each batch of keys is written,
+ * before the records themselves, as an array of int64s to the record
+ * CACTUS_DISK_JOURNAL_KEY_BASE - i, where i is the count after incrementing
+ * it.
+ */
+
+static void journalKey(CactusDisk *cactusDisk, int64_t key) {
+    if (cactusDisk->journalKeys != NULL) {
+        stList_append(cactusDisk->journalKeys, stIntTuple_construct1(key));
+    }
+}
+
+static void writeJournal(CactusDisk *cactusDisk) {
+    if (cactusDisk->journalKeys == NULL || stList_length(cactusDisk->journalKeys) == 0) {
+        return;
+    }
+    int64_t keyNumber = stList_length(cactusDisk->journalKeys);
+    int64_t *keys = st_malloc(keyNumber * sizeof(int64_t));
+    for (int64_t i = 0; i < keyNumber; i++) {
+        keys[i] = stIntTuple_get(stList_get(cactusDisk->journalKeys, i), 0);
+    }
+    int64_t entry = stKVDatabase_incrementInt64(cactusDisk->database, CACTUS_DISK_JOURNAL_COUNT_KEY, 1);
+    stList *requests = stList_construct3(0, (void (*)(void *)) stKVDatabaseBulkRequest_destruct);
+    stList_append(requests, stKVDatabaseBulkRequest_constructInsertRequest(CACTUS_DISK_JOURNAL_KEY_BASE - entry, keys,
+                                                                           keyNumber * sizeof(int64_t)));
+    stKVDatabase_bulkSetRecords(cactusDisk->database, requests);
+    stList_destruct(requests);
+    free(keys);
+    stList_destruct(cactusDisk->journalKeys);
+    cactusDisk->journalKeys = stList_construct3(0, (void (*)(void *)) stIntTuple_destruct);
+}
+
+static stList *constructShardRequests(CactusDisk *cactusDisk) {
+    /*
+     * Makes a list of bulk requests for each shard.
+     */
+    stList *shardRequests = stList_construct3(0, (void (*)(void *)) stList_destruct);
+    for (int64_t i = 0; i < stList_length(cactusDisk->shards); i++) {
+        stList_append(shardRequests, stList_construct3(0, (void (*)(void *)) stKVDatabaseBulkRequest_destruct));
+    }
+    return shardRequests;
+}
+
+static void addShardRequest(CactusDisk *cactusDisk, stList *shardRequests, int64_t key,
+                            stKVDatabaseBulkRequest *request) {
+    stList_append(stList_get(shardRequests, getShardIndex(cactusDisk, key)), request);
+    journalKey(cactusDisk, key);
+}
+
+static int64_t shardRequestsLength(stList *shardRequests) {
+    int64_t length = 0;
+    for (int64_t i = 0; i < stList_length(shardRequests); i++) {
+        length += stList_length(stList_get(shardRequests, i));
+    }
+    return length;
+}
+
+static void bulkSetRecords(CactusDisk *cactusDisk, stList *shardRequests) {
+    writeJournal(cactusDisk);
+    for (int64_t i = 0; i < stList_length(shardRequests); i++) {
+        stList *requests = stList_get(shardRequests, i);
+        if (stList_length(requests) > 0) {
+            stKVDatabase_bulkSetRecords(stList_get(cactusDisk->shards, i), requests);
+        }
+    }
+}
+
+static void bulkRemoveRecords(CactusDisk *cactusDisk, stList *removeRequests) {
+    /*
+     * Removes the records with the keys given as a list of stIntTuples.
+     */
+    for (int64_t i = 0; i < stList_length(removeRequests); i++) {
+        journalKey(cactusDisk, stIntTuple_get(stList_get(removeRequests, i), 0));
+    }
+    writeJournal(cactusDisk);
+    for (int64_t i = 0; i < stList_length(cactusDisk->shards); i++) {
+        stList *requests = stList_construct();
+        for (int64_t j = 0; j < stList_length(removeRequests); j++) {
+            stIntTuple *key = stList_get(removeRequests, j);
+            if (getShardIndex(cactusDisk, stIntTuple_get(key, 0)) == i) {
+                stList_append(requests, key);
+            }
+        }
+        if (stList_length(requests) > 0) {
+            stKVDatabase_bulkRemoveRecords(stList_get(cactusDisk->shards, i), requests);
+        }
+        stList_destruct(requests);
+    }
+}
+
+static stList *bulkGetRecords(CactusDisk *cactusDisk, stList *keys) {
+    /*
+     * Gets the records of the given list of keys (int64_t pointers) from
+     * their shards, returning their stKVDatabaseBulkResults in the order of the keys.
+     */
+    int64_t shardNumber = stList_length(cactusDisk->shards);
+    if (shardNumber == 1) {
+        return stKVDatabase_bulkGetRecords(cactusDisk->database, keys);
+    }
+    stList *shardKeys = stList_construct3(0, (void (*)(void *)) stList_destruct);
+    for (int64_t i = 0; i < shardNumber; i++) {
+        stList_append(shardKeys, stList_construct());
+    }
+    for (int64_t i = 0; i < stList_length(keys); i++) {
+        int64_t *key = stList_get(keys, i);
+        stList_append(stList_get(shardKeys, getShardIndex(cactusDisk, *key)), key);
+    }
+    stList *shardResults = stList_construct3(0, (void (*)(void *)) stList_destruct);
+    for (int64_t i = 0; i < shardNumber; i++) {
+        stList *keys2 = stList_get(shardKeys, i);
+        stList *results = stList_length(keys2) > 0 ?
+            stKVDatabase_bulkGetRecords(stList_get(cactusDisk->shards, i), keys2) : stList_construct();
+        assert(stList_length(results) == stList_length(keys2));
+        stList_setDestructor(results, NULL);
+        stList_append(shardResults, results);
+    }
+    int64_t *nextResult = st_calloc(shardNumber, sizeof(int64_t));
+    stList *records = stList_construct3(0, (void (*)(void *)) stKVDatabaseBulkResult_destruct);
+    for (int64_t i = 0; i < stList_length(keys); i++) {
+        int64_t shard = getShardIndex(cactusDisk, *((int64_t *) stList_get(keys, i)));
+        stList_append(records, stList_get(stList_get(shardResults, shard), nextResult[shard]++));
+    }
+    free(nextResult);
+    stList_destruct(shardResults);
+    stList_destruct(shardKeys);
+    return records;
+}
+
 /*
  * Functions on meta sequences.
  */
@@ -42,18 +285,19 @@ Name cactusDisk_addString(CactusDisk *cactusDisk, const char *string) {
     int64_t stringSize = strlen(string);
     int64_t intervalSize = ceil((double) stringSize / CACTUS_DISK_SEQUENCE_CHUNK_SIZE);
     Name name = cactusDisk_getUniqueIDInterval(cactusDisk, intervalSize);
-    stList *insertRequests = stList_construct3(0, (void (*)(void *)) stKVDatabaseBulkRequest_destruct);
+    stList *insertRequests = constructShardRequests(cactusDisk);
     for (int64_t i = 0; i * CACTUS_DISK_SEQUENCE_CHUNK_SIZE < stringSize; i++) {
         int64_t j =
             (i + 1) * CACTUS_DISK_SEQUENCE_CHUNK_SIZE < stringSize ?
             CACTUS_DISK_SEQUENCE_CHUNK_SIZE : stringSize - i * CACTUS_DISK_SEQUENCE_CHUNK_SIZE;
         char *subString = stString_getSubString(string, i * CACTUS_DISK_SEQUENCE_CHUNK_SIZE, j);
-        stList_append(insertRequests, stKVDatabaseBulkRequest_constructInsertRequest(name + i, subString, j + 1));
+        addShardRequest(cactusDisk, insertRequests, name + i,
+                        stKVDatabaseBulkRequest_constructInsertRequest(name + i, subString, j + 1));
         free(subString);
     }
     stTry
     {
-        stKVDatabase_bulkSetRecords(cactusDisk->database, insertRequests);
+        bulkSetRecords(cactusDisk, insertRequests);
     }
     stCatch(except)
     {
@@ -163,7 +407,7 @@ static void cacheSubstringsFromDB(CactusDisk *cactusDisk, stList *substrings) {
     stList *records = NULL;
     stTry
     {
-        records = stKVDatabase_bulkGetRecords(cactusDisk->database, getRequests);
+        records = bulkGetRecords(cactusDisk, getRequests);
     }
     stCatch(except)
     {
@@ -423,7 +667,7 @@ static stList *getRecords(CactusDisk *cactusDisk, stList *objectNames, char *typ
     stList *records = NULL;
     stTry
         {
-            records = stKVDatabase_bulkGetRecords(cactusDisk->database, objectNames);
+            records = bulkGetRecords(cactusDisk, objectNames);
         }
         stCatch(except)
             {
@@ -469,7 +713,7 @@ static void *getRecord(CactusDisk *cactusDisk, Name objectName, char *type, int6
     } else {
         stTry
             {
-                cA = stKVDatabase_getRecord2(cactusDisk->database, objectName, &recordSize);
+                cA = stKVDatabase_getRecord2(getShard(cactusDisk, objectName), objectName, &recordSize);
             }
             stCatch(except)
                 {
@@ -499,7 +743,7 @@ static void *getRecord(CactusDisk *cactusDisk, Name objectName, char *type, int6
 static bool containsRecord(CactusDisk *cactusDisk, Name objectName) {
     return (cactusDisk->cache != NULL
             && stCache_containsRecord(cactusDisk->cache, objectName, 0, INT64_MAX))
-        || stKVDatabase_containsRecord(cactusDisk->database, objectName);
+        || stKVDatabase_containsRecord(getShard(cactusDisk, objectName), objectName);
 }
 
 static CactusDisk *cactusDisk_constructPrivate(stKVDatabaseConf *conf, bool create, bool cache) {
@@ -510,12 +754,14 @@ static CactusDisk *cactusDisk_constructPrivate(stKVDatabaseConf *conf, bool crea
     cactusDisk->flowers = stSortedSet_construct3(cactusDisk_constructFlowersP, NULL);
     cactusDisk->flowerNamesMarkedForDeletion = stSortedSet_construct3((int (*)(const void *, const void *)) strcmp,
             free);
-    cactusDisk->updateRequests = stList_construct3(0, (void (*)(void *)) stKVDatabaseBulkRequest_destruct);
-
     cactusDisk->eventTree = NULL;
 
     //Now open the database
     cactusDisk->database = stKVDatabase_construct(conf, create);
+    openShards(cactusDisk, create);
+    cactusDisk->journalKeys = stKVDatabase_containsRecord(cactusDisk->database, CACTUS_DISK_JOURNAL_COUNT_KEY) ?
+        stList_construct3(0, (void (*)(void *)) stIntTuple_destruct) : NULL;
+    cactusDisk->updateRequests = constructShardRequests(cactusDisk);
     if (cache) {
         // 10MB for general DB responses
         cactusDisk->cache = stCache_construct2(10000000);
@@ -566,8 +812,13 @@ void cactusDisk_destruct(CactusDisk *cactusDisk) {
     }
     stSortedSet_destruct(cactusDisk->metaSequences);
 
-    //close DB
-    stKVDatabase_destruct(cactusDisk->database);
+    stList_destruct(cactusDisk->updateRequests);
+    if (cactusDisk->journalKeys != NULL) {
+        stList_destruct(cactusDisk->journalKeys);
+    }
+
+    //close DB, including any other shards
+    closeShards(cactusDisk);
 
     if (cactusDisk->cache != NULL) {
         stCache_destruct(cactusDisk->cache);
@@ -576,8 +827,6 @@ void cactusDisk_destruct(CactusDisk *cactusDisk) {
         stCache_destruct(cactusDisk->stringCache);
     }
 
-    stList_destruct(cactusDisk->updateRequests);
-
     free(cactusDisk);
 }
 
@@ -594,12 +843,12 @@ void cactusDisk_addUpdateRequest(CactusDisk *cactusDisk, Flower *flower) {
         int64_t recordSize2;
         void *vA2 = getRecord(cactusDisk, flower_getName(flower), "flower", &recordSize2);
         if (!stCache_recordsIdentical(vA, recordSize, vA2, recordSize2)) { //Only rewrite if we actually did something
-            stList_append(cactusDisk->updateRequests,
+            addShardRequest(cactusDisk, cactusDisk->updateRequests, flower_getName(flower),
                     stKVDatabaseBulkRequest_constructUpdateRequest(flower_getName(flower), compressed, compressedSize));
         }
         free(vA2);
     } else {
-        stList_append(cactusDisk->updateRequests,
+        addShardRequest(cactusDisk, cactusDisk->updateRequests, flower_getName(flower),
                 stKVDatabaseBulkRequest_constructInsertRequest(flower_getName(flower), compressed, compressedSize));
     }
     free(vA);
@@ -615,11 +864,11 @@ void cactusDisk_forceParameterUpdate(CactusDisk *cactusDisk, bool keyAlreadyExis
     //Compression
     cactusDiskParameters = compress(cactusDiskParameters, &recordSize);
     if (keyAlreadyExists) {
-        stList_append(cactusDisk->updateRequests,
+        addShardRequest(cactusDisk, cactusDisk->updateRequests, CACTUS_DISK_PARAMETER_KEY,
                       stKVDatabaseBulkRequest_constructUpdateRequest(CACTUS_DISK_PARAMETER_KEY, cactusDiskParameters,
                                                                      recordSize));
     } else {
-        stList_append(cactusDisk->updateRequests,
+        addShardRequest(cactusDisk, cactusDisk->updateRequests, CACTUS_DISK_PARAMETER_KEY,
                       stKVDatabaseBulkRequest_constructInsertRequest(CACTUS_DISK_PARAMETER_KEY, cactusDiskParameters,
                                                                      recordSize));
     }
@@ -649,7 +898,8 @@ void cactusDisk_write(CactusDisk *cactusDisk) {
     while ((nameString = stSortedSet_getNext(it)) != NULL) {
         Name name = cactusMisc_stringToName(nameString);
         if (containsRecord(cactusDisk, name)) {
-            stList_append(cactusDisk->updateRequests, stKVDatabaseBulkRequest_constructUpdateRequest(name, &name, 0)); //We set it to null in the first atomic operation.
+            addShardRequest(cactusDisk, cactusDisk->updateRequests, name,
+                            stKVDatabaseBulkRequest_constructUpdateRequest(name, &name, 0)); //We set it to null in the first atomic operation.
             stList_append(removeRequests, stIntTuple_construct1(name));
         }
     }
@@ -668,10 +918,10 @@ void cactusDisk_write(CactusDisk *cactusDisk) {
         //Compression
         vA = compress(vA, &recordSize);
         if (!containsRecord(cactusDisk, metaSequence_getName(metaSequence))) {
-            stList_append(cactusDisk->updateRequests,
+            addShardRequest(cactusDisk, cactusDisk->updateRequests, metaSequence_getName(metaSequence),
                     stKVDatabaseBulkRequest_constructInsertRequest(metaSequence_getName(metaSequence), vA, recordSize));
         } else {
-            stList_append(cactusDisk->updateRequests,
+            addShardRequest(cactusDisk, cactusDisk->updateRequests, metaSequence_getName(metaSequence),
                     stKVDatabaseBulkRequest_constructUpdateRequest(metaSequence_getName(metaSequence), vA, recordSize));
         }
         free(vA);
@@ -686,13 +936,13 @@ void cactusDisk_write(CactusDisk *cactusDisk) {
 
     st_logDebug("Checked if need to write the initial parameters\n");
 
-    if (stList_length(cactusDisk->updateRequests) > 0) {
-        st_logDebug("Going to write %" PRIi64 " updates\n", stList_length(cactusDisk->updateRequests));
+    if (shardRequestsLength(cactusDisk->updateRequests) > 0) {
+        st_logDebug("Going to write %" PRIi64 " updates\n", shardRequestsLength(cactusDisk->updateRequests));
         stTry
             {
-                st_logDebug("Writing %" PRIi64 " updates\n", stList_length(cactusDisk->updateRequests));
-                assert(stList_length(cactusDisk->updateRequests) > 0);
-                stKVDatabase_bulkSetRecords(cactusDisk->database, cactusDisk->updateRequests);
+                st_logDebug("Writing %" PRIi64 " updates\n", shardRequestsLength(cactusDisk->updateRequests));
+                assert(shardRequestsLength(cactusDisk->updateRequests) > 0);
+                bulkSetRecords(cactusDisk, cactusDisk->updateRequests);
             }
             stCatch(except)
                 {
@@ -707,7 +957,7 @@ void cactusDisk_write(CactusDisk *cactusDisk) {
     if (stList_length(removeRequests) > 0) {
         stTry
             {
-                stKVDatabase_bulkRemoveRecords(cactusDisk->database, removeRequests);
+                bulkRemoveRecords(cactusDisk, removeRequests);
             }
             stCatch(except)
                 {
@@ -720,7 +970,7 @@ void cactusDisk_write(CactusDisk *cactusDisk) {
     st_logDebug("Now removed flowers we don't need\n");
 
     stList_destruct(cactusDisk->updateRequests);
-    cactusDisk->updateRequests = stList_construct3(0, (void (*)(void *)) stKVDatabaseBulkRequest_destruct);
+    cactusDisk->updateRequests = constructShardRequests(cactusDisk);
     stList_destruct(removeRequests);
 
     st_logDebug("Finished writing to the database\n");
@@ -837,6 +1087,8 @@ void cactusDisk_getBlockOfUniqueIDs(CactusDisk *cactusDisk, int64_t intervalSize
                 assert(maximumValue <= INT64_MAX);
                 assert(minimumValue < maximumValue);
                 if (stKVDatabase_containsRecord(cactusDisk->database, keyName)) {
+                    journalKey(cactusDisk, keyName);
+                    writeJournal(cactusDisk);
                     cactusDisk->maxUniqueNumber = stKVDatabase_incrementInt64(cactusDisk->database, keyName,
                             intervalSize);
                     cactusDisk->uniqueNumber = cactusDisk->maxUniqueNumber - intervalSize;
@@ -851,6 +1103,8 @@ void cactusDisk_getBlockOfUniqueIDs(CactusDisk *cactusDisk, int64_t intervalSize
                 } else {
                     stTry
                         {
+                            journalKey(cactusDisk, keyName);
+                            writeJournal(cactusDisk);
                             stKVDatabase_insertInt64(cactusDisk->database, keyName, minimumValue);
                         }
                         stCatch(except)
@@ -11,10 +11,14 @@
 
 struct _cactusDisk {
     stKVDatabase *database;
+    stList *shards;
+    struct _shardRingPoint *shardRing;
+    int64_t shardRingSize;
     stSortedSet *metaSequences;
     stSortedSet *flowers;
     stSortedSet *flowerNamesMarkedForDeletion;
-    stList *updateRequests;
+    stList *updateRequests; // A list of bulk requests for each shard.
+    stList *journalKeys; // The changed keys yet to be journaled, or NULL if not journaling.
     stCache *cache;
     stCache *stringCache;
     EventTree *eventTree;
@@ -16,15 +16,19 @@
 #include "avl.h"
 #include "pairwiseAlignment.h"
 #include "blastAlignmentLib.h"
+#include "binaryAlignments.h"
 
 int main(int argc, char *argv[]) {
     /*
      * For each cigar in file, update the coordinates and write to the second file.
+     * The input can be binary or text cigars, and with --binaryOutput the
+     * output is written as binary alignments.
      */
     struct option opts[] = { {"onlyContig1", no_argument, NULL, '1'},
                              {"onlyContig2", no_argument, NULL, '2'},
+                             {"binaryOutput", no_argument, NULL, 'b'},
                              {0, 0, 0, 0} };
-    int convertContig1 = TRUE, convertContig2 = TRUE, flag;
+    int convertContig1 = TRUE, convertContig2 = TRUE, binaryOutput = FALSE, flag;
     while((flag = getopt_long(argc, argv, "", opts, NULL)) != -1) {
         switch(flag) {
         case '1':
@@ -33,6 +37,9 @@ int main(int argc, char *argv[]) {
         case '2':
             convertContig1 = FALSE;
             break;
+        case 'b':
+            binaryOutput = TRUE;
+            break;
         }
     }
     if(!(convertContig1 || convertContig2)) {
@@ -48,17 +55,21 @@ int main(int argc, char *argv[]) {
     (void)i;
     assert(i == 1);
     assert(roundsOfConversion >= 1);
+    AlignmentReader *reader = alignmentReader_construct(fileHandleIn);
+    AlignmentWriter *writer = alignmentWriter_construct(fileHandleOut, binaryOutput);
     struct PairwiseAlignment *pairwiseAlignment;
-    while ((pairwiseAlignment = cigarRead(fileHandleIn)) != NULL) {
+    while ((pairwiseAlignment = alignmentReader_next(reader)) != NULL) {
         //Correct coordinates
         for(int64_t j=0; j<roundsOfConversion; j++) {
             convertCoordinatesOfPairwiseAlignment(pairwiseAlignment,
                                                   convertContig1,
                                                   convertContig2);
         }
-        cigarWrite(fileHandleOut, pairwiseAlignment, 0);
+        alignmentWriter_write(writer, pairwiseAlignment);
         destructPairwiseAlignment(pairwiseAlignment);
     }
+    alignmentReader_destruct(reader);
+    alignmentWriter_destruct(writer);
     fclose(fileHandleIn);
     fclose(fileHandleOut);
     return 0;
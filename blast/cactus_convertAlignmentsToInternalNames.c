@@ -9,6 +9,7 @@
 #include "sonLib.h"
 #include "pairwiseAlignment.h"
 #include "bioioC.h"
+#include "binaryAlignments.h"
 
 static void usage(void)
 {
@@ -205,11 +206,12 @@ int main(int argc, char *argv[])
         fclose(tempFile);
         stFile_rmrf(tempPath);
     } else {
-        // Input is a cigar file.
+        // Input is a binary or text cigar file.
         // Scan over the given alignment file and convert the headers to
-        // cactus Names.
+        // cactus Names. The output is always text, for cactus_caf.
+        AlignmentReader *reader = alignmentReader_construct(inputFile);
         for (;;) {
-            struct PairwiseAlignment *pA = cigarRead(inputFile);
+            struct PairwiseAlignment *pA = alignmentReader_next(reader);
             if (pA == NULL) {
                 // Signals end of cigar file.
                 break;
@@ -218,6 +220,7 @@ int main(int argc, char *argv[])
             checkPairwiseAlignment(pA);
             cigarWrite(outputFile, pA, TRUE);
         }
+        alignmentReader_destruct(reader);
     }
 
     // Cleanup.
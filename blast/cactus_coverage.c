@@ -3,6 +3,7 @@
 #include "sonLib.h"
 #include "bioioC.h"
 #include "pairwiseAlignment.h"
+#include "binaryAlignments.h"
 
 // For blocks on the same contig.
 struct block {
@@ -279,9 +280,10 @@ int main(int argc, char *argv[])
 
     // Fill coverage arrays with the alignments
     FILE *alignmentsHandle = fopen(argv[optind + 1], "r");
+    AlignmentReader *alignmentReader = alignmentReader_construct(alignmentsHandle);
     for(;;) {
         int64_t *lengthPtr;
-        struct PairwiseAlignment *pA = cigarRead(alignmentsHandle);
+        struct PairwiseAlignment *pA = alignmentReader_next(alignmentReader);
         if(pA == NULL) {
             // Reached end of alignment file
             break;
@@ -302,6 +304,7 @@ int main(int argc, char *argv[])
         }
         destructPairwiseAlignment(pA);
     }
+    alignmentReader_destruct(alignmentReader);
     fclose(alignmentsHandle);
 
     if (depthById) {
@@ -6,6 +6,7 @@
 
 #include "sonLib.h"
 #include "pairwiseAlignment.h"
+#include "binaryAlignments.h"
 
 /*
  * Script takes a set of pairwise alignments using the lastz cigar format and returns a modified
@@ -92,9 +93,11 @@ int main(int argc, char *argv[]) {
 		assert(argc == 2);
 	}
 
+    // The input can be binary or text cigars, the output is text.
+    AlignmentReader *reader = alignmentReader_construct(fileHandleIn);
     struct PairwiseAlignment *pairwiseAlignment;
 
-    while ((pairwiseAlignment = cigarRead(fileHandleIn)) != NULL) {
+    while ((pairwiseAlignment = alignmentReader_next(reader)) != NULL) {
 
         // Write out original cigar
     	if(!pairwiseAlignment->strand1) {
@@ -114,6 +117,7 @@ int main(int argc, char *argv[]) {
         // Cleanup
         destructPairwiseAlignment(pairwiseAlignment);
     }
+    alignmentReader_destruct(reader);
     fclose(fileHandleIn);
     fclose(fileHandleOut);
 
@@ -0,0 +1,299 @@
+/*
+ * binaryAlignments.c
+ *
+ * Reading and writing pairwise alignments in the block-compressed
+ * binary format of src/cactus/blast/binaryAlignments.py.
+ *
+ * Released under the MIT license, see LICENSE.txt
+ */
+
+#include <stdlib.h>
+#include <string.h>
+#include <zlib.h>
+
+#include "bioioC.h"
+#include "sonLib.h"
+#include "pairwiseAlignment.h"
+#include "binaryAlignments.h"
+
+static const char blockMagic[] = "\x89" "CAL";
+#define BLOCK_MAGIC_SIZE 4
+#define BLOCK_HEADER_SIZE 12
+#define BLOCK_SIZE (1 << 16)
+
+struct _alignmentReader {
+    FILE *fileHandle;
+    bool binary;
+    unsigned char *block; // The records of the current block
+    uint64_t blockSize;
+    uint64_t offset; // The next record in the block
+};
+
+struct _alignmentWriter {
+    FILE *fileHandle;
+    bool binary;
+    unsigned char *records; // The records of the block being written
+    uint64_t recordsSize;
+    uint64_t recordsCapacity;
+};
+
+/*
+ * Little-endian numbers, whatever the byte order of the machine.
+ */
+
+static uint64_t decodeUint(const unsigned char *bytes, int64_t size) {
+    uint64_t i = 0;
+    for (int64_t j = size - 1; j >= 0; j--) {
+        i = (i << 8) | bytes[j];
+    }
+    return i;
+}
+
+static void encodeUint(unsigned char *bytes, uint64_t i, int64_t size) {
+    for (int64_t j = 0; j < size; j++) {
+        bytes[j] = (unsigned char) (i & 0xff);
+        i >>= 8;
+    }
+}
+
+static double decodeDouble(const unsigned char *bytes) {
+    uint64_t i = decodeUint(bytes, 8);
+    double d;
+    memcpy(&d, &i, sizeof(double));
+    return d;
+}
+
+static void encodeDouble(unsigned char *bytes, double d) {
+    uint64_t i;
+    memcpy(&i, &d, sizeof(double));
+    encodeUint(bytes, i, 8);
+}
+
+/*
+ * Reading
+ */
+
+AlignmentReader *alignmentReader_construct(FILE *fileHandle) {
+    AlignmentReader *reader = st_calloc(1, sizeof(AlignmentReader));
+    reader->fileHandle = fileHandle;
+    int c = getc(fileHandle);
+    if (c != EOF) {
+        ungetc(c, fileHandle);
+    }
+    reader->binary = c == (unsigned char) blockMagic[0];
+    return reader;
+}
+
+bool alignmentReader_isBinary(AlignmentReader *reader) {
+    return reader->binary;
+}
+
+/*
+ * Reads the next block into the reader, returning false at the end of
+ * the file.
+ */
+static bool readBlock(AlignmentReader *reader) {
+    unsigned char header[BLOCK_HEADER_SIZE];
+    size_t read = fread(header, 1, BLOCK_HEADER_SIZE, reader->fileHandle);
+    if (read == 0) {
+        return false;
+    }
+    if (read < BLOCK_HEADER_SIZE) {
+        st_errAbort("Truncated binary alignment file");
+    }
+    if (memcmp(header, blockMagic, BLOCK_MAGIC_SIZE) != 0) {
+        st_errAbort("Not a binary alignment block");
+    }
+    uint64_t compressedSize = decodeUint(header + 4, 4);
+    uLongf size = decodeUint(header + 8, 4);
+    unsigned char *compressed = st_malloc(compressedSize);
+    if (fread(compressed, 1, compressedSize, reader->fileHandle) < compressedSize) {
+        st_errAbort("Truncated binary alignment file");
+    }
+    free(reader->block);
+    reader->block = st_malloc(size > 0 ? size : 1);
+    uLongf blockSize = size;
+    if (uncompress(reader->block, &blockSize, compressed, compressedSize) != Z_OK || blockSize != size) {
+        st_errAbort("Corrupt binary alignment block");
+    }
+    free(compressed);
+    reader->blockSize = size;
+    reader->offset = 0;
+    return true;
+}
+
+/*
+ * Reads the next size bytes of the block's records.
+ */
+static const unsigned char *readRecordBytes(AlignmentReader *reader, uint64_t size) {
+    if (reader->offset + size > reader->blockSize) {
+        st_errAbort("Corrupt binary alignment block");
+    }
+    const unsigned char *bytes = reader->block + reader->offset;
+    reader->offset += size;
+    return bytes;
+}
+
+static char *readSegment(AlignmentReader *reader, int64_t *start, int64_t *end, int64_t *strand) {
+    uint64_t nameSize = decodeUint(readRecordBytes(reader, 2), 2);
+    const unsigned char *nameBytes = readRecordBytes(reader, nameSize);
+    char *name = st_malloc(nameSize + 1);
+    memcpy(name, nameBytes, nameSize);
+    name[nameSize] = '\0';
+    const unsigned char *bytes = readRecordBytes(reader, 17);
+    *start = (int64_t) decodeUint(bytes, 8);
+    *end = (int64_t) decodeUint(bytes + 8, 8);
+    *strand = bytes[16] == '+';
+    return name;
+}
+
+static struct PairwiseAlignment *readBinaryAlignment(AlignmentReader *reader) {
+    while (reader->block == NULL || reader->offset >= reader->blockSize) {
+        if (!readBlock(reader)) {
+            return NULL;
+        }
+    }
+    // The contig1 of a PairwiseAlignment is the second sequence of a
+    // cigar line
+    int64_t start1, end1, strand1, start2, end2, strand2;
+    char *contig2 = readSegment(reader, &start2, &end2, &strand2);
+    char *contig1 = readSegment(reader, &start1, &end1, &strand1);
+    const unsigned char *bytes = readRecordBytes(reader, 12);
+    double score = decodeDouble(bytes);
+    uint64_t numOps = decodeUint(bytes + 8, 4);
+    struct List *operationList = constructEmptyList(0, (void (*)(void *)) destructAlignmentOperation);
+    for (uint64_t i = 0; i < numOps; i++) {
+        bytes = readRecordBytes(reader, 5);
+        int64_t type;
+        switch (bytes[0]) {
+            case 'M':
+                type = PAIRWISE_MATCH;
+                break;
+            case 'I':
+                type = PAIRWISE_INDEL_Y;
+                break;
+            case 'D':
+                type = PAIRWISE_INDEL_X;
+                break;
+            default:
+                st_errAbort("Unknown operation %c in binary alignment", bytes[0]);
+        }
+        listAppend(operationList, constructAlignmentOperation(type, decodeUint(bytes + 1, 4), 0.0));
+    }
+    struct PairwiseAlignment *pA = constructPairwiseAlignment(contig1, start1, end1, strand1,
+                                                              contig2, start2, end2, strand2,
+                                                              score, operationList);
+    free(contig1);
+    free(contig2);
+    return pA;
+}
+
+struct PairwiseAlignment *alignmentReader_next(AlignmentReader *reader) {
+    return reader->binary ? readBinaryAlignment(reader) : cigarRead(reader->fileHandle);
+}
+
+void alignmentReader_destruct(AlignmentReader *reader) {
+    free(reader->block);
+    free(reader);
+}
+
+/*
+ * Writing
+ */
+
+AlignmentWriter *alignmentWriter_construct(FILE *fileHandle, bool binary) {
+    AlignmentWriter *writer = st_calloc(1, sizeof(AlignmentWriter));
+    writer->fileHandle = fileHandle;
+    writer->binary = binary;
+    return writer;
+}
+
+static void writeBlock(AlignmentWriter *writer) {
+    if (writer->recordsSize == 0) {
+        return;
+    }
+    uLongf compressedSize = compressBound(writer->recordsSize);
+    unsigned char *compressed = st_malloc(compressedSize);
+    if (compress(compressed, &compressedSize, writer->records, writer->recordsSize) != Z_OK) {
+        st_errAbort("Failed to compress binary alignment block");
+    }
+    unsigned char header[BLOCK_HEADER_SIZE];
+    memcpy(header, blockMagic, BLOCK_MAGIC_SIZE);
+    encodeUint(header + 4, compressedSize, 4);
+    encodeUint(header + 8, writer->recordsSize, 4);
+    if (fwrite(header, 1, BLOCK_HEADER_SIZE, writer->fileHandle) < BLOCK_HEADER_SIZE
+        || fwrite(compressed, 1, compressedSize, writer->fileHandle) < compressedSize) {
+        st_errAbort("Failed to write binary alignment block");
+    }
+    free(compressed);
+    writer->recordsSize = 0;
+}
+
+/*
+ * Makes room for size more bytes of records, returning where they go.
+ */
+static unsigned char *writeRecordBytes(AlignmentWriter *writer, uint64_t size) {
+    if (writer->recordsSize + size > writer->recordsCapacity) {
+        writer->recordsCapacity = 2 * (writer->recordsSize + size);
+        writer->records = realloc(writer->records, writer->recordsCapacity);
+        if (writer->records == NULL) {
+            st_errAbort("Out of memory writing binary alignments");
+        }
+    }
+    unsigned char *bytes = writer->records + writer->recordsSize;
+    writer->recordsSize += size;
+    return bytes;
+}
+
+static void writeSegment(AlignmentWriter *writer, const char *name, int64_t start, int64_t end, int64_t strand) {
+    uint64_t nameSize = strlen(name);
+    if (nameSize > 0xffff) {
+        st_errAbort("Sequence name %s is too long for a binary alignment", name);
+    }
+    encodeUint(writeRecordBytes(writer, 2), nameSize, 2);
+    memcpy(writeRecordBytes(writer, nameSize), name, nameSize);
+    unsigned char *bytes = writeRecordBytes(writer, 17);
+    encodeUint(bytes, (uint64_t) start, 8);
+    encodeUint(bytes + 8, (uint64_t) end, 8);
+    bytes[16] = strand ? '+' : '-';
+}
+
+static void writeBinaryAlignment(AlignmentWriter *writer, struct PairwiseAlignment *pA) {
+    uint64_t recordStart = writer->recordsSize;
+    writeSegment(writer, pA->contig2, pA->start2, pA->end2, pA->strand2);
+    writeSegment(writer, pA->contig1, pA->start1, pA->end1, pA->strand1);
+    unsigned char *bytes = writeRecordBytes(writer, 12);
+    encodeDouble(bytes, pA->score);
+    encodeUint(bytes + 8, pA->operationList->length, 4);
+    for (int64_t i = 0; i < pA->operationList->length; i++) {
+        struct AlignmentOperation *op = pA->operationList->list[i];
+        bytes = writeRecordBytes(writer, 5);
+        bytes[0] = op->opType == PAIRWISE_MATCH ? 'M' : (op->opType == PAIRWISE_INDEL_Y ? 'I' : 'D');
+        encodeUint(bytes + 1, op->length, 4);
+    }
+    // Records don't span blocks, so if this one doesn't fit, the block
+    // is written without it and it starts the next one.
+    if (recordStart > 0 && writer->recordsSize > BLOCK_SIZE) {
+        uint64_t recordSize = writer->recordsSize - recordStart;
+        unsigned char *record = st_malloc(recordSize);
+        memcpy(record, writer->records + recordStart, recordSize);
+        writer->recordsSize = recordStart;
+        writeBlock(writer);
+        memcpy(writeRecordBytes(writer, recordSize), record, recordSize);
+        free(record);
+    }
+}
+
+void alignmentWriter_write(AlignmentWriter *writer, struct PairwiseAlignment *pA) {
+    if (writer->binary) {
+        writeBinaryAlignment(writer, pA);
+    } else {
+        cigarWrite(writer->fileHandle, pA, 0);
+    }
+}
+
+void alignmentWriter_destruct(AlignmentWriter *writer) {
+    writeBlock(writer);
+    free(writer->records);
+    free(writer);
+}
@@ -0,0 +1,58 @@
+/*
+ * binaryAlignments.h
+ *
+ * Reading and writing pairwise alignments in the block-compressed
+ * binary format of src/cactus/blast/binaryAlignments.py, which
+ * describes the format. Readers take text cigar files as well.
+ *
+ * Released under the MIT license, see LICENSE.txt
+ */
+
+#ifndef BINARYALIGNMENTS_H_
+#define BINARYALIGNMENTS_H_
+
+#include <stdio.h>
+#include <stdbool.h>
+#include "sonLib.h"
+#include "pairwiseAlignment.h"
+
+typedef struct _alignmentReader AlignmentReader;
+
+typedef struct _alignmentWriter AlignmentWriter;
+
+/*
+ * Reads the alignments of a binary or text cigar file, telling which
+ * from the first byte.
+ */
+AlignmentReader *alignmentReader_construct(FILE *fileHandle);
+
+/*
+ * Is the file being read a binary alignment file?
+ */
+bool alignmentReader_isBinary(AlignmentReader *reader);
+
+/*
+ * Gets the next alignment, or NULL if there are no more.
+ */
+struct PairwiseAlignment *alignmentReader_next(AlignmentReader *reader);
+
+/*
+ * Destructs the reader, leaving the file open.
+ */
+void alignmentReader_destruct(AlignmentReader *reader);
+
+/*
+ * Writes alignments to a file as binary or text cigars (without
+ * operation scores).
+ */
+AlignmentWriter *alignmentWriter_construct(FILE *fileHandle, bool binary);
+
+void alignmentWriter_write(AlignmentWriter *writer, struct PairwiseAlignment *pA);
+
+/*
+ * Writes out the last block and destructs the writer, leaving the file
+ * open.
+ */
+void alignmentWriter_destruct(AlignmentWriter *writer);
+
+#endif /* BINARYALIGNMENTS_H_ */
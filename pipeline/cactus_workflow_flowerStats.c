@@ -11,16 +11,7 @@
  * Prints info about a flower.
  */
 
-int main(int argc, char *argv[]) {
-    st_setLogLevelFromString(argv[1]);
-    st_logDebug("Set up logging\n");
-
-    stKVDatabaseConf *kvDatabaseConf = stKVDatabaseConf_constructFromString(argv[2]);
-    CactusDisk *cactusDisk = cactusDisk_construct(kvDatabaseConf, false, true);
-    stKVDatabaseConf_destruct(kvDatabaseConf);
-    st_logDebug("Set up the flower disk\n");
-
-    Name flowerName = cactusMisc_stringToName(argv[3]);
+static void printFlowerStats(CactusDisk *cactusDisk, Name flowerName) {
     Flower *flower = cactusDisk_getFlower(cactusDisk, flowerName);
 
     int64_t totalBases = flower_getTotalBaseLength(flower);
@@ -99,6 +90,26 @@ int main(int argc, char *argv[]) {
 
     printf("flower name: %" PRIi64 " total bases: %" PRIi64 " total-ends: %" PRIi64 " total-caps: %" PRIi64 " max-end-degree: %" PRIi64 " max-adjacency-length: %" PRIi64 " total-blocks: %" PRIi64 " total-groups: %" PRIi64 " total-edges: %" PRIi64 " total-free-ends: %" PRIi64 " total-attached-ends: %" PRIi64 " total-chains: %" PRIi64 " total-link groups: %" PRIi64 "\n",
             flower_getName(flower), totalBases, totalEnds, totalCaps, maxEndDegree, maxAdjacencyLength, totalBlocks, totalGroups, totalEdges/2, totalFreeEnds, totalAttachedEnds, totalChains, totalLinkGroups);
+}
+
+/*
+ * Prints info about each of the flowers given, so that the stats for a
+ * whole batch of flowers can be had from one connection to the database.
+ */
+
+int main(int argc, char *argv[]) {
+    assert(argc >= 4);
+    st_setLogLevelFromString(argv[1]);
+    st_logDebug("Set up logging\n");
+
+    stKVDatabaseConf *kvDatabaseConf = stKVDatabaseConf_constructFromString(argv[2]);
+    CactusDisk *cactusDisk = cactusDisk_construct(kvDatabaseConf, false, true);
+    stKVDatabaseConf_destruct(kvDatabaseConf);
+    st_logDebug("Set up the flower disk\n");
+
+    for (int64_t i = 3; i < argc; i++) {
+        printFlowerStats(cactusDisk, cactusMisc_stringToName(argv[i]));
+    }
 
     return 0;
 }
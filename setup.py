@@ -32,4 +32,5 @@ setup(
 
     entry_points={
         'console_scripts': ['cactus = cactus.progressive.cactus_progressive:main',
-                            'cactus_preprocess = cactus.preprocessor.cactus_preprocessor:main']},)
+                            'cactus_preprocess = cactus.preprocessor.cactus_preprocessor:main',
+                            'cactus_fitResourceModel = cactus.shared.resourceModel:main']},)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""A compact, block-compressed binary format for pairwise alignments.
+
+Text cigar lines repeat each sequence name in full and spell out every
+number, and each stage of the blast pipeline parses them all again.
+With binaryAlignments="1" in the caf tag of the config, the blast
+stages instead pass alignments on in this format, which the C blast
+tools read and write through blastLib/binaryAlignments.h. Text cigars
+are only written where the alignments leave the blast pipeline: by
+cactus_mirrorAndOrientAlignments at the start of the mapping quality
+rescoring, and by cactus_convertAlignmentsToInternalNames for CAF.
+
+A file is a series of blocks, each of which is:
+    - BLOCK_MAGIC (4 bytes)
+    - the size of the compressed records (uint32)
+    - the size of the records once decompressed (uint32)
+    - the records, compressed as a zlib stream.
+Blocks hold about BLOCK_SIZE bytes of records, and records never
+span blocks, so files can be concatenated as they are, like text cigar
+files. Each record holds, in the order of a cigar line:
+    - the first sequence: name length (uint16), name, start (int64),
+      end (int64) and strand ('+' or '-')
+    - the same for the second sequence
+    - the score (float64)
+    - the number of operations (uint32), then for each the letter
+      of the cigar operation ('M', 'I' or 'D') and its length (uint32).
+All numbers are little-endian. Operation scores aren't kept, as the
+blast stages write their cigars without them.
+
+Readers tell the format of a file from its first byte, which can't
+start a text cigar file, so they take text cigar files as well.
+"""
+
+import struct
+import zlib
+
+from sonLib.bioio import cigarRead, cigarWrite, PairwiseAlignment, AlignmentOperation
+
+BLOCK_MAGIC = "\x89CAL"
+BLOCK_HEADER = struct.Struct("<4sII")
+BLOCK_SIZE = 1 << 16
+
+NAME_SIZE = struct.Struct("<H")
+SEGMENT = struct.Struct("<qqc")
+SCORE_AND_OPS = struct.Struct("<dI")
+OPERATION = struct.Struct("<cI")
+
+# The operation type of each cigar letter, as sonLib's cigarRead
+# gives them.
+OPERATION_TYPES = { 'M': PairwiseAlignment.PAIRWISE_MATCH,
+                    'I': PairwiseAlignment.PAIRWISE_INDEL_Y,
+                    'D': PairwiseAlignment.PAIRWISE_INDEL_X }
+OPERATION_LETTERS = dict((opType, letter) for letter, opType in OPERATION_TYPES.items())
+
+def isBinaryAlignmentFile(fileHandle):
+    """Does the (seekable) file hold binary alignments? Leaves the file
+    where it was."""
+    position = fileHandle.tell()
+    firstByte = fileHandle.read(1)
+    fileHandle.seek(position)
+    return firstByte == BLOCK_MAGIC[0]
+
+class BinaryAlignmentWriter(object):
+    """Writes alignments to a file in the binary format, a block at a
+    time. Use as a context manager, or call close(), to write out the
+    last block; the file itself is left open."""
+    def __init__(self, fileHandle, blockSize=BLOCK_SIZE):
+        self.fileHandle = fileHandle
+        self.blockSize = blockSize
+        self.records = []
+        self.recordsSize = 0
+
+    def writeRecord(self, record):
+        """Write an alignment given as a tuple (name1, start1, end1,
+        strand1, name2, start2, end2, strand2, score, ops), in the
+        order of a cigar line, where the strands are '+' or '-' and ops
+        is a list of (cigar letter, length)."""
+        name1, start1, end1, strand1, name2, start2, end2, strand2, score, ops = record
+        parts = [NAME_SIZE.pack(len(name1)), name1, SEGMENT.pack(start1, end1, strand1),
+                 NAME_SIZE.pack(len(name2)), name2, SEGMENT.pack(start2, end2, strand2),
+                 SCORE_AND_OPS.pack(score, len(ops))]
+        parts.extend(OPERATION.pack(letter, length) for letter, length in ops)
+        data = "".join(parts)
+        if self.recordsSize > 0 and self.recordsSize + len(data) > self.blockSize:
+            self.flush()
+        self.records.append(data)
+        self.recordsSize += len(data)
+
+    def write(self, pairwiseAlignment):
+        """Write a sonLib PairwiseAlignment."""
+        pA = pairwiseAlignment
+        self.writeRecord((pA.contig2, pA.start2, pA.end2, '+' if pA.strand2 else '-',
+                          pA.contig1, pA.start1, pA.end1, '+' if pA.strand1 else '-',
+                          pA.score, [(OPERATION_LETTERS[op.type], op.length) for op in pA.operationList]))
+
+    def flush(self):
+        if self.recordsSize == 0:
+            return
+        data = zlib.compress("".join(self.records))
+        self.fileHandle.write(BLOCK_HEADER.pack(BLOCK_MAGIC, len(data), self.recordsSize))
+        self.fileHandle.write(data)
+        self.records = []
+        self.recordsSize = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+
+def readBinaryRecords(fileHandle):
+    """Yield the alignments of a binary alignment file as tuples, as
+    BinaryAlignmentWriter.writeRecord takes them."""
+    while True:
+        header = fileHandle.read(BLOCK_HEADER.size)
+        if header == "":
+            return
+        if len(header) < BLOCK_HEADER.size:
+            raise RuntimeError("Truncated binary alignment file")
+        magic, compressedSize, size = BLOCK_HEADER.unpack(header)
+        if magic != BLOCK_MAGIC:
+            raise RuntimeError("Not a binary alignment block")
+        compressed = fileHandle.read(compressedSize)
+        if len(compressed) < compressedSize:
+            raise RuntimeError("Truncated binary alignment file")
+        data = zlib.decompress(compressed)
+        if len(data) != size:
+            raise RuntimeError("Corrupt binary alignment block")
+        offset = 0
+        while offset < size:
+            segments = []
+            for i in xrange(2):
+                nameSize = NAME_SIZE.unpack_from(data, offset)[0]
+                offset += NAME_SIZE.size
+                name = data[offset:offset + nameSize]
+                offset += nameSize
+                segments.append((name,) + SEGMENT.unpack_from(data, offset))
+                offset += SEGMENT.size
+            score, numOps = SCORE_AND_OPS.unpack_from(data, offset)
+            offset += SCORE_AND_OPS.size
+            ops = [OPERATION.unpack_from(data, offset + i * OPERATION.size) for i in xrange(numOps)]
+            offset += numOps * OPERATION.size
+            yield segments[0] + segments[1] + (score, ops)
+
+def readAlignments(fileHandle):
+    """Yield the alignments of a binary or text cigar file as sonLib
+    PairwiseAlignments."""
+    if not isBinaryAlignmentFile(fileHandle):
+        for pairwiseAlignment in cigarRead(fileHandle):
+            yield pairwiseAlignment
+        return
+    for name1, start1, end1, strand1, name2, start2, end2, strand2, score, ops in readBinaryRecords(fileHandle):
+        # sonLib's contig1 is the second sequence of a cigar line
+        yield PairwiseAlignment(name2, start2, end2, strand2 == '+',
+                                name1, start1, end1, strand1 == '+', score,
+                                [AlignmentOperation(OPERATION_TYPES[letter], length, 0.0) for letter, length in ops])
+
+class AlignmentWriter(object):
+    """Writes sonLib PairwiseAlignments as binary or text cigars."""
+    def __init__(self, fileHandle, binary):
+        self.fileHandle = fileHandle
+        self.binaryWriter = BinaryAlignmentWriter(fileHandle) if binary else None
+
+    def write(self, pairwiseAlignment):
+        if self.binaryWriter is not None:
+            self.binaryWriter.write(pairwiseAlignment)
+        else:
+            cigarWrite(self.fileHandle, pairwiseAlignment, False)
+
+    def close(self):
+        if self.binaryWriter is not None:
+            self.binaryWriter.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+
+def convertAlignments(inputFile, outputFile, binary):
+    """Convert a file of alignments, in either format, to binary or
+    text cigars."""
+    with open(inputFile) as inputFileHandle, open(outputFile, 'w') as outputFileHandle:
+        with AlignmentWriter(outputFileHandle, binary) as writer:
+            for pairwiseAlignment in readAlignments(inputFileHandle):
+                writer.write(pairwiseAlignment)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+#Released under the MIT license, see LICENSE.txt
+import unittest
+import os
+import random
+from StringIO import StringIO
+
+from sonLib.bioio import TestStatus, getTempFile, cigarRead, cigarWrite, \
+    PairwiseAlignment, AlignmentOperation
+from cactus.shared.common import cactus_call
+from cactus.blast.binaryAlignments import BinaryAlignmentWriter, readBinaryRecords, \
+    readAlignments, isBinaryAlignmentFile, convertAlignments, AlignmentWriter
+
+def randomSegment(length):
+    name = "id=%i|chr%i" % (random.randint(0, 3), random.randint(0, 100))
+    start = random.randint(0, 10000)
+    if random.choice((True, False)):
+        return (name, start, start + length, True)
+    return (name, start + length, start, False)
+
+def randomAlignment():
+    ops = [AlignmentOperation(random.choice((PairwiseAlignment.PAIRWISE_MATCH,
+                                             PairwiseAlignment.PAIRWISE_INDEL_X,
+                                             PairwiseAlignment.PAIRWISE_INDEL_Y)),
+                              random.randint(1, 1000), 0.0) for _ in xrange(random.randint(1, 20))]
+    length1 = sum(op.length for op in ops if op.type != PairwiseAlignment.PAIRWISE_INDEL_Y)
+    length2 = sum(op.length for op in ops if op.type != PairwiseAlignment.PAIRWISE_INDEL_X)
+    return PairwiseAlignment(*(randomSegment(length1) + randomSegment(length2) +
+                               (float(random.randint(0, 100000)), ops)))
+
+def chunkAlignment(pA):
+    """Move an alignment onto chunks of its sequences, named as
+    cactus_blast_convertCoordinates expects, which converts it back."""
+    offset1 = random.randint(0, min(pA.start1, pA.end1))
+    offset2 = random.randint(0, min(pA.start2, pA.end2))
+    return PairwiseAlignment("%s|%i" % (pA.contig1, offset1), pA.start1 - offset1, pA.end1 - offset1, pA.strand1,
+                             "%s|%i" % (pA.contig2, offset2), pA.start2 - offset2, pA.end2 - offset2, pA.strand2,
+                             pA.score, pA.operationList)
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tempFiles = []
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        for tempFile in self.tempFiles:
+            if os.path.exists(tempFile):
+                os.remove(tempFile)
+
+    def testRecordFormat(self):
+        records = [("a", 0, 10, '+', "b", 20, 5, '-', 12.5, [('M', 5), ('I', 2), ('D', 3)]),
+                   ("", 0, 0, '-', "x" * 1000, 1 << 40, 0, '+', 0.0, [])]
+        records += [("seq%i" % i, i, i + 10, '+', "other%i" % i, i + 10, i, '-', float(i), [('M', 10)])
+                    for i in xrange(1000)]
+        binaryFile = StringIO()
+        # A small block size, so the records take several blocks
+        with BinaryAlignmentWriter(binaryFile, blockSize=1000) as writer:
+            for record in records:
+                writer.writeRecord(record)
+        data = binaryFile.getvalue()
+        self.assertTrue(data.count("\x89CAL") > 10)
+        self.assertEquals(list(readBinaryRecords(StringIO(data))), records)
+        # Concatenated files hold the records of both
+        self.assertEquals(list(readBinaryRecords(StringIO(data + data))), records + records)
+        self.assertRaises(RuntimeError, list, readBinaryRecords(StringIO(data[:-20])))
+        self.assertEquals(list(readBinaryRecords(StringIO(""))), [])
+
+    def testReadAlignments(self):
+        """Binary and text files give the same alignments, which
+        convertAlignments converts between."""
+        for test in xrange(TestStatus.getTestSetup(shortTestNo=5, mediumTestNo=20)):
+            alignments = [randomAlignment() for _ in xrange(random.randint(0, 1000))]
+            textFile = getTempFile()
+            binaryFile = getTempFile()
+            roundTripFile = getTempFile()
+            self.tempFiles += [textFile, binaryFile, roundTripFile]
+            with open(textFile, 'w') as fh:
+                for alignment in alignments:
+                    cigarWrite(fh, alignment, False)
+            convertAlignments(textFile, binaryFile, True)
+            convertAlignments(binaryFile, roundTripFile, False)
+            with open(textFile) as fh:
+                expected = list(cigarRead(fh))
+            with open(binaryFile) as fh:
+                self.assertEquals(isBinaryAlignmentFile(fh), len(alignments) > 0)
+                self.assertEquals(list(readAlignments(fh)), expected)
+            with open(textFile) as fh:
+                self.assertFalse(isBinaryAlignmentFile(fh))
+                self.assertEquals(list(readAlignments(fh)), expected)
+            self.assertEquals(open(roundTripFile).read(), open(textFile).read())
+            self.assertTrue(os.path.getsize(binaryFile) <= os.path.getsize(textFile))
+
+    def testCRoundTrip(self):
+        """The C tools (through blastLib/binaryAlignments.h) read the
+        binary alignments written here, and write binary alignments that
+        are read here, giving the same alignments as text cigars."""
+        for test in xrange(TestStatus.getTestSetup(shortTestNo=2, mediumTestNo=5)):
+            # Enough alignments to take several blocks
+            alignments = [randomAlignment() for _ in xrange(random.randint(1, 2000))]
+            chunkFiles = {}
+            for binary in (True, False):
+                chunkFiles[binary] = getTempFile()
+                with open(chunkFiles[binary], 'w') as fh:
+                    with AlignmentWriter(fh, binary) as writer:
+                        for alignment in alignments:
+                            writer.write(chunkAlignment(alignment))
+            self.tempFiles += chunkFiles.values()
+            with open(chunkFiles[True]) as fh:
+                self.assertTrue(isBinaryAlignmentFile(fh))
+            for inputBinary, outputBinary in ((True, True), (True, False), (False, True)):
+                outputFile = getTempFile()
+                self.tempFiles.append(outputFile)
+                cactus_call(parameters=["cactus_blast_convertCoordinates"] +
+                            (["--binaryOutput"] if outputBinary else []) +
+                            [chunkFiles[inputBinary], outputFile, "1"])
+                with open(outputFile) as fh:
+                    self.assertEquals(isBinaryAlignmentFile(fh), outputBinary)
+                    self.assertEquals(list(readAlignments(fh) if outputBinary else cigarRead(fh)), alignments)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,25 +7,31 @@
 sequences. Uses the toil framework to parallelise the blasts.
 """
 import os
+import copy
 import shutil
+import time
 from toil.lib.bioio import logger
 from toil.lib.bioio import system
 
-from sonLib.bioio import catFiles, nameValue, popenCatch, getTempDirectory
+from sonLib.bioio import nameValue, getTempDirectory
 
 from cactus.shared.common import RoundedJob
 from cactus.shared.common import cactus_call
 from cactus.shared.common import runLastz, runSelfLastz
 from cactus.shared.common import runCactusRealign, runCactusSelfRealign
 from cactus.shared.common import runGetChunks
-from cactus.shared.common import readGlobalFileWithoutCache
 from cactus.shared.common import ChildTreeJob
+from cactus.shared.packedFasta import writeFastaGlobalFile
+from cactus.shared.fastaChunks import getChunks, readChunk, chunkFileSize
 from cactus.blast.upconvertCoordinates import upconvertCoords
 from cactus.blast.trimSequences import trimSequences
+from cactus.blast.blastCache import getBlastCache
+from cactus.blast.chunkSketch import sketchChunk, estimateSharedSeeds
+from cactus.blast.coverage import CoverageMap, addCigarFile
 
 class BlastOptions(object):
     def __init__(self, chunkSize=10000000, overlapSize=10000, 
-                 lastzArguments="", compressFiles=True, realign=False, realignArguments="",
+                 lastzArguments="", compressFiles=False, realign=False, realignArguments="",
                  minimumSequenceLength=1, memory=None,
                  smallDisk = None,
                  largeDisk = None,
@@ -40,7 +46,39 @@ class BlastOptions(object):
                  # default because it's needed for the tests (which
                  # don't use realign.)
                  trimOutgroupFlanking=2000,
-                 keepParalogs=False):
+                 keepParalogs=False,
+                 # Directory of previously computed chunk-pair
+                 # alignments to reuse, and its maximum size in bytes
+                 cacheDir=None, cacheMaxSize=None,
+                 # Maximum number of result files merged by any one
+                 # collation job
+                 collateFanIn=100,
+                 # Minimum estimated number of k-mers two chunks must
+                 # share for lastz to be run on them (no filtering if
+                 # None), and the k-mer size and sampling rate of the
+                 # chunk sketches used to estimate it
+                 sketchThreshold=None, sketchKmerSize=16, sketchScale=1000,
+                 # Number of outgroups after the current one to blast
+                 # the trimmed ingroups against at the same time,
+                 # before knowing how they will be trimmed, and the
+                 # most extra ingroup sequence this may blast, as a
+                 # fraction of what blasting one outgroup at a time
+                 # would
+                 speculativeOutgroups=0, speculativeMaxExtraWork=0.5,
+                 # Pass the alignments between the blast stages in the
+                 # binary format of binaryAlignments.py rather than as
+                 # text cigars
+                 binaryAlignments=False,
+                 # Describe the chunks as ranges of the input fasta
+                 # files (see fastaChunks.py) rather than writing them
+                 # out
+                 virtualChunks=False,
+                 # Seconds after which lastz is stopped, and the
+                 # number of times a chunk (or chunk pair) whose lastz
+                 # is stopped may be split in half and its parts
+                 # blasted again (if 0, the partial alignments are
+                 # kept)
+                 lastzSoftTimeout=5400, maxTimeoutSplits=2):
         """Class defining options for blast
         """
         self.chunkSize = chunkSize
@@ -62,6 +100,18 @@ class BlastOptions(object):
         self.trimOutgroupDepth = trimOutgroupDepth
         self.trimOutgroupFlanking = trimOutgroupFlanking
         self.keepParalogs = keepParalogs
+        self.cacheDir = cacheDir
+        self.cacheMaxSize = cacheMaxSize
+        self.collateFanIn = collateFanIn
+        self.sketchThreshold = sketchThreshold
+        self.sketchKmerSize = sketchKmerSize
+        self.sketchScale = sketchScale
+        self.speculativeOutgroups = speculativeOutgroups
+        self.speculativeMaxExtraWork = speculativeMaxExtraWork
+        self.binaryAlignments = binaryAlignments
+        self.virtualChunks = virtualChunks
+        self.lastzSoftTimeout = lastzSoftTimeout
+        self.maxTimeoutSplits = maxTimeoutSplits
 
 class BlastSequencesAllAgainstAll(RoundedJob):
     """Take a set of sequences, chunks them up and blasts them.
@@ -74,20 +124,20 @@ class BlastSequencesAllAgainstAll(RoundedJob):
         super(BlastSequencesAllAgainstAll, self).__init__(disk=disk, cores=cores, memory=memory, preemptable=True)
         self.sequenceFileIDs1 = sequenceFileIDs1
         self.blastOptions = blastOptions
-        self.blastOptions.compressFiles = False
         self.blastOptions.roundsOfCoordinateConversion = 1
 
     def run(self, fileStore):
-        sequenceFiles1 = [fileStore.readGlobalFile(fileID) for fileID in self.sequenceFileIDs1]
-        chunks = runGetChunks(sequenceFiles=sequenceFiles1, chunksDir=getTempDirectory(rootDir=fileStore.getLocalTempDir()), chunkSize = self.blastOptions.chunkSize, overlapSize=self.blastOptions.overlapSize)
-        assert len(chunks) > 0
+        chunkIDs = getChunks(fileStore, self.sequenceFileIDs1, chunkSize=self.blastOptions.chunkSize,
+                             overlapSize=self.blastOptions.overlapSize, pack=self.blastOptions.compressFiles,
+                             virtual=self.blastOptions.virtualChunks)
+        assert len(chunkIDs) > 0
         logger.info("Broken up the sequence files into individual 'chunk' files")
-        chunkIDs = [fileStore.writeGlobalFile(chunk, cleanup=True) for chunk in chunks]
 
         diagonalResultsID = self.addChild(MakeSelfBlasts(self.blastOptions, chunkIDs)).rv()
         offDiagonalResultsID = self.addChild(MakeOffDiagonalBlasts(self.blastOptions, chunkIDs)).rv()
         logger.debug("Collating the blasts after blasting all-against-all")
-        return self.addFollowOn(CollateBlasts(self.blastOptions, [diagonalResultsID, offDiagonalResultsID])).rv()
+        return reportBlastCacheLookups(self.addFollowOn(CollateBlasts(self.blastOptions, [diagonalResultsID, offDiagonalResultsID])),
+                                       self.blastOptions)
         
 class MakeSelfBlasts(ChildTreeJob):
     """Breaks up the inputs into bits and builds a bunch of alignment jobs.
@@ -99,8 +149,6 @@ class MakeSelfBlasts(ChildTreeJob):
 
     def run(self, fileStore):
         logger.info("Chunk IDs: %s" % self.chunkIDs)
-        #Avoid compression if just one chunk
-        self.blastOptions.compressFiles = self.blastOptions.compressFiles and len(self.chunkIDs) > 2
         resultsIDs = []
         for i in xrange(len(self.chunkIDs)):
             resultsIDs.append(self.addChild(RunSelfBlast(self.blastOptions, self.chunkIDs[i])).rv())
@@ -115,9 +163,13 @@ class MakeOffDiagonalBlasts(ChildTreeJob):
             super(MakeOffDiagonalBlasts, self).__init__(preemptable=True)
             self.chunkIDs = chunkIDs
             self.blastOptions = blastOptions
-            self.blastOptions.compressFiles = False
 
         def run(self, fileStore):
+            if getattr(self.blastOptions, 'sketchThreshold', None) is not None:
+                sketchJobs = [self.addChild(SketchChunk(self.blastOptions, chunkID)) for chunkID in self.chunkIDs]
+                return self.addFollowOn(MakeSketchFilteredBlasts(self.blastOptions, self.chunkIDs,
+                                                                 [job.rv(0) for job in sketchJobs],
+                                                                 sketchTimes=[job.rv(1) for job in sketchJobs])).rv()
             resultsIDs = []
             #Make the list of blast jobs.
             for i in xrange(0, len(self.chunkIDs)):
@@ -141,23 +193,149 @@ class BlastSequencesAgainstEachOther(ChildTreeJob):
         self.blastOptions.roundsOfCoordinateConversion = 1
 
     def run(self, fileStore):
-        sequenceFiles1 = [fileStore.readGlobalFile(fileID) for fileID in self.sequenceFileIDs1]
-        sequenceFiles2 = [fileStore.readGlobalFile(fileID) for fileID in self.sequenceFileIDs2]
-        chunks1 = runGetChunks(sequenceFiles=sequenceFiles1, chunksDir=getTempDirectory(rootDir=fileStore.getLocalTempDir()), chunkSize=self.blastOptions.chunkSize, overlapSize=self.blastOptions.overlapSize)
-        chunks2 = runGetChunks(sequenceFiles=sequenceFiles2, chunksDir=getTempDirectory(rootDir=fileStore.getLocalTempDir()), chunkSize=self.blastOptions.chunkSize, overlapSize=self.blastOptions.overlapSize)
-        chunkIDs1 = [fileStore.writeGlobalFile(chunk, cleanup=True) for chunk in chunks1]
-        chunkIDs2 = [fileStore.writeGlobalFile(chunk, cleanup=True) for chunk in chunks2]
+        chunkIDs1 = getChunks(fileStore, self.sequenceFileIDs1, chunkSize=self.blastOptions.chunkSize,
+                              overlapSize=self.blastOptions.overlapSize, pack=self.blastOptions.compressFiles,
+                              virtual=self.blastOptions.virtualChunks)
+        chunkIDs2 = getChunks(fileStore, self.sequenceFileIDs2, chunkSize=self.blastOptions.chunkSize,
+                              overlapSize=self.blastOptions.overlapSize, pack=self.blastOptions.compressFiles,
+                              virtual=self.blastOptions.virtualChunks)
+        if getattr(self.blastOptions, 'sketchThreshold', None) is not None:
+            sketchJobs1 = [self.addChild(SketchChunk(self.blastOptions, chunkID)) for chunkID in chunkIDs1]
+            sketchJobs2 = [self.addChild(SketchChunk(self.blastOptions, chunkID)) for chunkID in chunkIDs2]
+            return reportBlastCacheLookups(self.addFollowOn(MakeSketchFilteredBlasts(self.blastOptions, chunkIDs1, [job.rv(0) for job in sketchJobs1],
+                                                                                     chunkIDs2, [job.rv(0) for job in sketchJobs2],
+                                                                                     sketchTimes=[job.rv(1) for job in sketchJobs1 + sketchJobs2])),
+                                           self.blastOptions)
         resultsIDs = []
         #Make the list of blast jobs.
         for chunkID1 in chunkIDs1:
             for chunkID2 in chunkIDs2:
-                #TODO: Make the compression work
-                self.blastOptions.compressFiles = False
                 resultsIDs.append(self.addChild(RunBlast(self.blastOptions, chunkID1, chunkID2)).rv())
         logger.info("Made the list of blasts")
         #Set up the job to collate all the results
+        return reportBlastCacheLookups(self.addFollowOn(CollateBlasts(self.blastOptions, resultsIDs)),
+                                       self.blastOptions)
+
+class SketchChunk(RoundedJob):
+    """Computes the k-mer sketch of a chunk, for MakeSketchFilteredBlasts,
+    returning it along with how long sketching took in seconds.
+    """
+    def __init__(self, blastOptions, chunkID):
+        disk = chunkFileSize(chunkID) if hasattr(chunkID, "size") else None
+        super(SketchChunk, self).__init__(disk=disk, preemptable=True)
+        self.blastOptions = blastOptions
+        self.chunkID = chunkID
+
+    def run(self, fileStore):
+        chunkFile = readChunk(fileStore, self.chunkID)
+        startTime = time.time()
+        sketch = sketchChunk(chunkFile,
+                             kmerSize=self.blastOptions.sketchKmerSize,
+                             scale=self.blastOptions.sketchScale)
+        return sketch, time.time() - startTime
+
+class MakeSketchFilteredBlasts(ChildTreeJob):
+    """Runs lastz on only those chunk pairs whose sketches estimate they
+    share at least blastOptions.sketchThreshold k-mers, and reports how
+    many lastz runs that avoided.
+
+    Pairs are taken from chunkIDs1 against chunkIDs2 or, if chunkIDs2
+    isn't given, between every two distinct chunks in chunkIDs1.
+    sketchTimes are the seconds taken to sketch the chunks, which are
+    reported against the savings.
+    """
+    def __init__(self, blastOptions, chunkIDs1, sketches1, chunkIDs2=None, sketches2=None, sketchTimes=None):
+        super(MakeSketchFilteredBlasts, self).__init__(preemptable=True)
+        self.blastOptions = blastOptions
+        self.chunkIDs1 = chunkIDs1
+        self.sketches1 = sketches1
+        self.chunkIDs2 = chunkIDs2
+        self.sketches2 = sketches2
+        self.sketchTimes = sketchTimes if sketchTimes is not None else []
+
+    def run(self, fileStore):
+        if self.chunkIDs2 is None:
+            pairs = [(i, j) for i in xrange(len(self.chunkIDs1)) for j in xrange(i + 1, len(self.chunkIDs1))]
+            chunkIDs2, sketches2 = self.chunkIDs1, self.sketches1
+        else:
+            pairs = [(i, j) for i in xrange(len(self.chunkIDs1)) for j in xrange(len(self.chunkIDs2))]
+            chunkIDs2, sketches2 = self.chunkIDs2, self.sketches2
+        resultsIDs = []
+        runTimes = []
+        for i, j in pairs:
+            sharedSeeds = estimateSharedSeeds(self.sketches1[i], sketches2[j],
+                                              scale=self.blastOptions.sketchScale)
+            if sharedSeeds < self.blastOptions.sketchThreshold:
+                logger.debug("Skipping blast of %s vs. %s, with an estimated %d shared seeds" % (self.chunkIDs1[i], chunkIDs2[j], sharedSeeds))
+                continue
+            blastJob = self.addChild(TimedRunBlast(self.blastOptions, self.chunkIDs1[i], chunkIDs2[j]))
+            resultsIDs.append(blastJob.rv(0))
+            runTimes.append(blastJob.rv(1))
+        self.addFollowOnJobFn(logSketchFilterSavings, len(pairs) - len(resultsIDs), len(pairs), runTimes,
+                              self.sketchTimes)
         return self.addFollowOn(CollateBlasts(self.blastOptions, resultsIDs)).rv()
 
+class BlastResultsID(object):
+    """The file store ID of a set of blast results, along with the
+    numbers of blast cache hits and misses of the lookups made getting
+    them. The blast jobs only return these while the cache is on.
+    """
+    def __init__(self, fileID, cacheHits=0, cacheMisses=0):
+        self.fileID = fileID
+        self.cacheHits = cacheHits
+        self.cacheMisses = cacheMisses
+
+    @property
+    def size(self):
+        return self.fileID.size
+
+    def __str__(self):
+        return str(self.fileID)
+
+    def __repr__(self):
+        return "BlastResultsID(%r, %d, %d)" % (self.fileID, self.cacheHits, self.cacheMisses)
+
+def getResultsFileID(resultsID):
+    """Get the plain file store ID of a set of blast results."""
+    return resultsID.fileID if isinstance(resultsID, BlastResultsID) else resultsID
+
+def getCacheLookups(resultsID):
+    """Get the blast cache hits and misses, as a pair, of the lookups made
+    getting a set of blast results."""
+    if isinstance(resultsID, BlastResultsID):
+        return resultsID.cacheHits, resultsID.cacheMisses
+    return 0, 0
+
+def reportBlastCacheLookups(resultsJob, blastOptions):
+    """Get the promise of the plain file store ID of the results of
+    resultsJob, which, if the blast cache is on, is found by a follow-on
+    that first reports the cache hits and misses of the blasts that made
+    them."""
+    if getattr(blastOptions, 'cacheDir', None) is None:
+        return resultsJob.rv()
+    return resultsJob.addFollowOnJobFn(logBlastCacheLookups, resultsJob.rv()).rv()
+
+def logBlastCacheLookups(job, resultsID):
+    """Report the blast cache hits and misses counted with a set of blast
+    results, returning their plain file store ID."""
+    hits, misses = getCacheLookups(resultsID)
+    job.fileStore.logToMaster("Blast cache: %d hits and %d misses of %d lookups" % (hits, misses, hits + misses))
+    return getResultsFileID(resultsID)
+
+def logSketchFilterSavings(job, numSkipped, numPairs, runTimes, sketchTimes=()):
+    """Report the lastz runs skipped by the sketch filter, and estimate
+    the CPU time saved from the runs that weren't skipped, against the
+    CPU time spent sketching the chunks. Runs served from the blast cache
+    have no time, and are left out of the estimate."""
+    runTimes = [runTime for runTime in runTimes if runTime is not None]
+    if len(runTimes) > 0:
+        cpuHours = numSkipped * sum(runTimes) / len(runTimes) / 3600
+        saving = "an estimated %.2f CPU-hours" % cpuHours
+    else:
+        saving = "an unknown amount of CPU time"
+    job.fileStore.logToMaster("Sketch filter skipped %d of %d lastz runs, saving %s for %.2f CPU-hours of sketching" %
+                              (numSkipped, numPairs, saving, sum(sketchTimes) / 3600))
+
 class BlastIngroupsAndOutgroups(RoundedJob):
     """Blast ingroup sequences against each other, and against the given
     outgroup sequences in succession. The next outgroup is only
@@ -192,7 +370,9 @@ class BlastIngroupsAndOutgroups(RoundedJob):
                 outgroupResultsID=None,
                 blastOptions=self.blastOptions,
                 outgroupNumber=1,
-                ingroupCoverageIDs=[]))
+                ingroupCoverageIDs=[],
+                numSpeculative=min(self.blastOptions.speculativeOutgroups,
+                                   len(self.outgroupSequenceIDs) - 1)))
             outgroupAlignmentsID = blastFirstOutgroupJob.rv(0)
             outgroupFragmentIDs = blastFirstOutgroupJob.rv(1)
             ingroupCoverageIDs = blastFirstOutgroupJob.rv(2)
@@ -208,11 +388,16 @@ class BlastFirstOutgroup(RoundedJob):
     """Blast the given sequence(s) against the first of a succession of
     outgroups, only aligning fragments that haven't aligned to the
     previous outgroups. Then recurse on the other outgroups.
+
+    If numSpeculative is set, the sequences are also blasted against
+    that many of the following outgroups at the same time. Those
+    alignments are later restricted to what is left of the sequences
+    after trimming, rather than waiting for the trimming to blast.
     """
     def __init__(self, ingroupNames, untrimmedSequenceIDs, sequenceIDs,
                  outgroupNames, outgroupSequenceIDs, outgroupFragmentIDs,
                  outgroupResultsID, blastOptions, outgroupNumber,
-                 ingroupCoverageIDs):
+                 ingroupCoverageIDs, numSpeculative=0, speculationStats=None):
         super(BlastFirstOutgroup, self).__init__(memory=blastOptions.memory, preemptable=True)
         self.ingroupNames = ingroupNames
         self.untrimmedSequenceIDs = untrimmedSequenceIDs
@@ -224,6 +409,8 @@ class BlastFirstOutgroup(RoundedJob):
         self.blastOptions = blastOptions
         self.outgroupNumber = outgroupNumber
         self.ingroupCoverageIDs = ingroupCoverageIDs
+        self.numSpeculative = numSpeculative
+        self.speculationStats = speculationStats
 
     def run(self, fileStore):
         logger.info("Blasting ingroup sequences to outgroup %s",
@@ -232,6 +419,15 @@ class BlastFirstOutgroup(RoundedJob):
             self.sequenceIDs,
             [self.outgroupSequenceIDs[0]],
             self.blastOptions)).rv()
+        speculativeResultsIDs = []
+        for outgroupSequenceID in self.outgroupSequenceIDs[1:self.numSpeculative + 1]:
+            speculativeResultsIDs.append(self.addChild(BlastSequencesAgainstEachOther(
+                self.sequenceIDs,
+                [outgroupSequenceID],
+                self.blastOptions)).rv())
+        if len(speculativeResultsIDs) > 0:
+            logger.info("Speculatively blasting the same sequences to outgroups %s",
+                        ", ".join(self.outgroupNames[self.outgroupNumber:self.outgroupNumber + len(speculativeResultsIDs)]))
         trimRecurseJob = self.addFollowOn(TrimAndRecurseOnOutgroups(
             ingroupNames=self.ingroupNames,
             untrimmedSequenceIDs=self.untrimmedSequenceIDs,
@@ -243,17 +439,31 @@ class BlastFirstOutgroup(RoundedJob):
             outgroupResultsID=self.outgroupResultsID,
             blastOptions=self.blastOptions,
             outgroupNumber=self.outgroupNumber,
-            ingroupCoverageIDs=self.ingroupCoverageIDs))
+            ingroupCoverageIDs=self.ingroupCoverageIDs,
+            speculativeResultsIDs=speculativeResultsIDs,
+            speculativeSourceIDs=self.sequenceIDs,
+            speculationStats=self.speculationStats))
         outgroupAlignmentsID = trimRecurseJob.rv(0)
         outgroupFragmentIDs = trimRecurseJob.rv(1)
         ingroupCoverageIDs = trimRecurseJob.rv(2)
         return (outgroupAlignmentsID, outgroupFragmentIDs, ingroupCoverageIDs)
 
 class TrimAndRecurseOnOutgroups(RoundedJob):
+    """Trim the outgroup that was just blasted and the ingroups, using the
+    alignments to it, then recurse on the next outgroup.
+
+    speculativeResultsIDs are the alignments of the (larger) ingroup
+    sequences speculativeSourceIDs against the following outgroups, if
+    they have already been blasted. speculationStats holds the total
+    length of the ingroup sequences that one-at-a-time blasting would
+    have aligned so far, and the extra length aligned by speculation.
+    """
     def __init__(self, ingroupNames, untrimmedSequenceIDs, sequenceIDs,
                  outgroupNames, outgroupSequenceIDs, outgroupFragmentIDs,
                  mostRecentResultsID, outgroupResultsID,
-                 blastOptions, outgroupNumber, ingroupCoverageIDs):
+                 blastOptions, outgroupNumber, ingroupCoverageIDs,
+                 speculativeResultsIDs=None, speculativeSourceIDs=None,
+                 speculativeSourceLength=None, speculationStats=None):
         memory = 7900000000
         super(TrimAndRecurseOnOutgroups, self).__init__(memory=memory, preemptable=True)    
         self.ingroupNames = ingroupNames
@@ -267,6 +477,31 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
         self.blastOptions = blastOptions
         self.outgroupNumber = outgroupNumber
         self.ingroupCoverageIDs = ingroupCoverageIDs
+        self.speculativeResultsIDs = speculativeResultsIDs or []
+        self.speculativeSourceIDs = speculativeSourceIDs
+        self.speculativeSourceLength = speculativeSourceLength
+        self.speculationStats = speculationStats
+
+    def reconcileSpeculativeResults(self, fileStore, resultsFile, trimmedSequenceFiles, outputFile):
+        """Convert speculative alignments of the source ingroup sequences to
+        coordinates on the newly trimmed ingroup sequences, clipping
+        them to the parts lying on those sequences."""
+        if self.speculativeSourceIDs != self.untrimmedSequenceIDs:
+            untrimmedResultsFile = fileStore.getLocalTempFile()
+            runConvertCoordinates(self.blastOptions, resultsFile, untrimmedResultsFile, 1,
+                                  onlyContig1=True)
+            resultsFile = untrimmedResultsFile
+        trimmedSequencesFile = fileStore.getLocalTempFile()
+        with open(trimmedSequencesFile, 'w') as output:
+            for trimmedSequenceFile in trimmedSequenceFiles:
+                with open(trimmedSequenceFile) as trimmedSequence:
+                    shutil.copyfileobj(trimmedSequence, output)
+        with open(outputFile, 'w') as output:
+            upconvertCoords(cigarPath=resultsFile,
+                            fastaPath=trimmedSequencesFile,
+                            contigNum=2,
+                            outputFile=output,
+                            clipUncontained=True)
 
     def run(self, fileStore):
         # Trim outgroup, convert outgroup coordinates, and add to
@@ -275,13 +510,12 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
         outgroupSequenceFiles = [fileStore.readGlobalFile(fileID) for fileID in self.outgroupSequenceIDs]
         mostRecentResultsFile = fileStore.readGlobalFile(self.mostRecentResultsID)
         trimmedOutgroup = fileStore.getLocalTempFile()
-        outgroupCoverage = fileStore.getLocalTempFile()
-        calculateCoverage(outgroupSequenceFiles[0],
-                          mostRecentResultsFile, outgroupCoverage)
+        outgroupCoverage = CoverageMap(outgroupSequenceFiles[0])
+        addCigarFile([outgroupCoverage], mostRecentResultsFile)
         # The windowSize and threshold are fixed at 1: anything more
         # and we will run into problems with alignments that aren't
         # covered in a matching trimmed sequence.
-        trimSequences(outgroupSequenceFiles[0], outgroupCoverage,
+        trimSequences(outgroupSequenceFiles[0], outgroupCoverage.getBedBlocks(),
                       trimmedOutgroup, flanking=self.blastOptions.trimOutgroupFlanking,
                       windowSize=1, threshold=1)
         outgroupConvertedResultsFile = fileStore.getLocalTempFile()
@@ -296,11 +530,15 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
         untrimmedSequenceFiles = [fileStore.readGlobalFile(path) for path in self.untrimmedSequenceIDs]
 
         # Report coverage of the latest outgroup on the trimmed ingroups.
-        for trimmedIngroupSequence, ingroupSequence, ingroupName in zip(sequenceFiles, untrimmedSequenceFiles, self.ingroupNames):
-            tmpIngroupCoverage = fileStore.getLocalTempFile()
-            calculateCoverage(trimmedIngroupSequence, mostRecentResultsFile,
-                              tmpIngroupCoverage)
-            fileStore.logToMaster("Coverage on %s from outgroup #%d, %s: %s%% (current ingroup length %d, untrimmed length %d). Outgroup trimmed to %d bp from %d" % (ingroupName, self.outgroupNumber, self.outgroupNames[self.outgroupNumber - 1], percentCoverage(trimmedIngroupSequence, tmpIngroupCoverage), sequenceLength(trimmedIngroupSequence), sequenceLength(ingroupSequence), sequenceLength(trimmedOutgroup), sequenceLength(outgroupSequenceFiles[0])))
+        trimmedIngroupCoverages = [CoverageMap(path) for path in sequenceFiles]
+        addCigarFile(trimmedIngroupCoverages, mostRecentResultsFile)
+        ingroupCoverages = [CoverageMap(path, depthById=self.blastOptions.trimOutgroupDepth > 1)
+                            for path in untrimmedSequenceFiles]
+        sequencesLength = sum(coverage.totalLength() for coverage in trimmedIngroupCoverages)
+        neededWork, extraWork = self.speculationStats or (0, 0)
+        neededWork += sequencesLength
+        for trimmedIngroupCoverage, ingroupCoverage, ingroupName in zip(trimmedIngroupCoverages, ingroupCoverages, self.ingroupNames):
+            fileStore.logToMaster("Coverage on %s from outgroup #%d, %s: %s%% (current ingroup length %d, untrimmed length %d). Outgroup trimmed to %d bp from %d" % (ingroupName, self.outgroupNumber, self.outgroupNames[self.outgroupNumber - 1], trimmedIngroupCoverage.percentCoverage(), trimmedIngroupCoverage.totalLength(), ingroupCoverage.totalLength(), sequenceLength(trimmedOutgroup), outgroupCoverage.totalLength()))
 
         # Convert the alignments' ingroup coordinates.
         ingroupConvertedResultsFile = fileStore.getLocalTempFile()
@@ -309,11 +547,8 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
             shutil.copy(outgroupConvertedResultsFile,
                         ingroupConvertedResultsFile)
         else:
-            cactus_call(parameters=["cactus_blast_convertCoordinates",
-                                    "--onlyContig1",
-                                    outgroupConvertedResultsFile,
-                                    ingroupConvertedResultsFile,
-                                    "1"])
+            runConvertCoordinates(self.blastOptions, outgroupConvertedResultsFile,
+                                  ingroupConvertedResultsFile, 1, onlyContig1=True)
         # Append the latest results to the accumulated outgroup coverage file
         if self.outgroupResultsID:
             outgroupResultsFile = fileStore.readGlobalFile(self.outgroupResultsID, mutable=True)
@@ -325,33 +560,34 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
 
         self.outgroupResultsID = fileStore.writeGlobalFile(outgroupResultsFile)
 
-        # Report coverage of the all outgroup alignments so far on the ingroups.
-        ingroupCoverageFiles = []
+        # Report coverage of the all outgroup alignments so far on the
+        # ingroups. Rather than recomputing it from all the results,
+        # the latest results are added to the coverage from the
+        # previous outgroups. Each outgroup is a separate genome, so
+        # this is exact even when counting depth by ID.
+        if self.ingroupCoverageIDs:
+            for ingroupCoverage, ingroupCoverageID in zip(ingroupCoverages, self.ingroupCoverageIDs):
+                with fileStore.readGlobalFileStream(ingroupCoverageID) as bedFile:
+                    ingroupCoverage.addBed(bedFile)
+            addCigarFile(ingroupCoverages, ingroupConvertedResultsFile)
+        else:
+            addCigarFile(ingroupCoverages, outgroupResultsFile)
         self.ingroupCoverageIDs = []
-        for ingroupSequence, ingroupName in zip(untrimmedSequenceFiles, self.ingroupNames):
+        for ingroupCoverage, ingroupName in zip(ingroupCoverages, self.ingroupNames):
             ingroupCoverageFile = fileStore.getLocalTempFile()
-            calculateCoverage(sequenceFile=ingroupSequence, cigarFile=outgroupResultsFile,
-                              outputFile=ingroupCoverageFile, depthById=self.blastOptions.trimOutgroupDepth > 1)
-            ingroupCoverageFiles.append(ingroupCoverageFile)
+            with open(ingroupCoverageFile, 'w') as f:
+                ingroupCoverage.writeBed(f)
             self.ingroupCoverageIDs.append(fileStore.writeGlobalFile(ingroupCoverageFile))
-            fileStore.logToMaster("Cumulative coverage of %d outgroups on ingroup %s: %s" % (self.outgroupNumber, ingroupName, percentCoverage(ingroupSequence, ingroupCoverageFile)))
+            fileStore.logToMaster("Cumulative coverage of %d outgroups on ingroup %s: %s" % (self.outgroupNumber, ingroupName, ingroupCoverage.percentCoverage()))
 
         if len(self.outgroupSequenceIDs) > 1:
             # Trim ingroup seqs and recurse on the next outgroup.
             trimmedSeqs = []
             # Use the accumulated results so far to trim away the
             # aligned parts of the ingroups.
-            for i, sequenceFile in enumerate(untrimmedSequenceFiles):
-                outgroupCoverageFile = ingroupCoverageFiles[i]
-                selfCoverageFile = fileStore.getLocalTempFile()
-                coverageFile = fileStore.getLocalTempFile()
-                if self.blastOptions.keepParalogs:
-                    subtractBed(outgroupCoverageFile, selfCoverageFile, coverageFile)
-                else:
-                    coverageFile = outgroupCoverageFile
-
+            for sequenceFile, ingroupCoverage in zip(untrimmedSequenceFiles, ingroupCoverages):
                 trimmed = fileStore.getLocalTempFile()
-                trimSequences(sequenceFile, coverageFile, trimmed,
+                trimSequences(sequenceFile, ingroupCoverage.getBedBlocks(), trimmed,
                               complement=True, flanking=self.blastOptions.trimFlanking,
                               minSize=self.blastOptions.trimMinSize,
                               threshold=self.blastOptions.trimThreshold,
@@ -359,6 +595,43 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
                               depth=self.blastOptions.trimOutgroupDepth)
                 trimmedSeqs.append(trimmed)
             trimmedSeqIDs = [fileStore.writeGlobalFile(path, cleanup=True) for path in trimmedSeqs]
+            trimmedLength = sum(sequenceLength(path) for path in trimmedSeqs)
+            if len(self.speculativeResultsIDs) > 0:
+                # The next outgroup has already been blasted against a
+                # superset of the trimmed sequences, so the alignments
+                # just need to be restricted to them.
+                sourceLength = self.speculativeSourceLength
+                if sourceLength is None:
+                    sourceLength = sequencesLength
+                extraWork += sourceLength - trimmedLength
+                fileStore.logToMaster("Using speculative alignments of %d bp of ingroup sequence to outgroup #%d, %s, of which %d bp are left after trimming. Speculation has blasted %d extra bp so far, on top of %d bp" % (sourceLength, self.outgroupNumber + 1, self.outgroupNames[self.outgroupNumber], trimmedLength, extraWork, neededWork + trimmedLength))
+                speculativeResultsFile = fileStore.readGlobalFile(self.speculativeResultsIDs[0])
+                reconciledResultsFile = fileStore.getLocalTempFile()
+                self.reconcileSpeculativeResults(fileStore, speculativeResultsFile, trimmedSeqs, reconciledResultsFile)
+                return self.addChild(TrimAndRecurseOnOutgroups(
+                    ingroupNames=self.ingroupNames,
+                    untrimmedSequenceIDs=self.untrimmedSequenceIDs,
+                    sequenceIDs=trimmedSeqIDs,
+                    outgroupNames=self.outgroupNames,
+                    outgroupSequenceIDs=self.outgroupSequenceIDs[1:],
+                    outgroupFragmentIDs=self.outgroupFragmentIDs,
+                    mostRecentResultsID=fileStore.writeGlobalFile(reconciledResultsFile),
+                    outgroupResultsID=self.outgroupResultsID,
+                    blastOptions=self.blastOptions,
+                    outgroupNumber=self.outgroupNumber + 1,
+                    ingroupCoverageIDs=self.ingroupCoverageIDs,
+                    speculativeResultsIDs=self.speculativeResultsIDs[1:],
+                    speculativeSourceIDs=self.speculativeSourceIDs,
+                    speculativeSourceLength=sourceLength,
+                    speculationStats=(neededWork, extraWork))).rv()
+            # Only start speculating on the next outgroups if the
+            # extra sequence blasted so far is within the limit.
+            numSpeculative = 0
+            if extraWork <= self.blastOptions.speculativeMaxExtraWork * neededWork:
+                numSpeculative = min(self.blastOptions.speculativeOutgroups,
+                                     len(self.outgroupSequenceIDs) - 2)
+            elif self.blastOptions.speculativeOutgroups > 0:
+                fileStore.logToMaster("Not blasting speculatively against the outgroups after #%d: %d extra bp blasted so far is over the limit" % (self.outgroupNumber + 1, extraWork))
             return self.addChild(BlastFirstOutgroup(
                 ingroupNames=self.ingroupNames,
                 untrimmedSequenceIDs=self.untrimmedSequenceIDs,
@@ -369,38 +642,84 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
                 outgroupResultsID=self.outgroupResultsID,
                 blastOptions=self.blastOptions,
                 outgroupNumber=self.outgroupNumber + 1,
-                ingroupCoverageIDs=self.ingroupCoverageIDs)).rv()
+                ingroupCoverageIDs=self.ingroupCoverageIDs,
+                numSpeculative=numSpeculative,
+                speculationStats=(neededWork, extraWork))).rv()
         else:
             # Finally, put the ingroups and outgroups results together
             return (self.outgroupResultsID, self.outgroupFragmentIDs, self.ingroupCoverageIDs)
 
-def compressFastaFile(fileName):
-    """Compress a fasta file.
-    """
-    system("bzip2 --keep --fast %s" % fileName)
-    return fileName + ".bz2"
+def runConvertCoordinates(blastOptions, inputFile, outputFile, roundsOfConversion, onlyContig1=False):
+    """Convert the coordinates of alignments on chunks back to the
+    sequences the chunks came from, writing binary alignments if
+    blastOptions.binaryAlignments is set."""
+    parameters = ["cactus_blast_convertCoordinates"]
+    if onlyContig1:
+        parameters.append("--onlyContig1")
+    if blastOptions.binaryAlignments:
+        parameters.append("--binaryOutput")
+    cactus_call(parameters=parameters + [inputFile, outputFile, str(roundsOfConversion)])
+
+def canSplitAfterTimeout(blastOptions):
+    """Can a chunk whose lastz hit the soft timeout be split up again?"""
+    return getattr(blastOptions, 'timeoutSplits', 0) < getattr(blastOptions, 'maxTimeoutSplits', 2)
+
+def getTimeoutSplitOptions(blastOptions):
+    """Get the options for blasting the sub-chunks of a chunk split up
+    after a timeout, whose alignments need a further round of coordinate
+    conversion."""
+    subOptions = copy.copy(blastOptions)
+    subOptions.timeoutSplits = getattr(blastOptions, 'timeoutSplits', 0) + 1
+    subOptions.roundsOfCoordinateConversion = blastOptions.roundsOfCoordinateConversion + 1
+    return subOptions
+
+def splitChunk(fileStore, blastOptions, seqFile):
+    """Split a chunk in half, with the usual overlap between the halves,
+    returning the IDs of the sub-chunks."""
+    subChunkSize = sequenceLength(seqFile) / 2 + 1
+    subChunks = runGetChunks(sequenceFiles=[seqFile],
+                             chunksDir=getTempDirectory(rootDir=fileStore.getLocalTempDir()),
+                             chunkSize=subChunkSize,
+                             overlapSize=min(blastOptions.overlapSize, subChunkSize))
+    return [writeFastaGlobalFile(fileStore, subChunk, blastOptions.compressFiles, cleanup=True)
+            for subChunk in subChunks]
 
-def decompressFastaFile(fileName, tempFileName):
-    """Copies the file from the central dir to a temporary file, returning the temp file name.
-    """
-    system("bunzip2 --stdout %s > %s" % (fileName, tempFileName))
-    return tempFileName
-        
 class RunSelfBlast(RoundedJob):
     """Runs blast as a job.
     """
     def __init__(self, blastOptions, seqFileID):
-        disk = 3*seqFileID.size
-        memory = 5*3*seqFileID.size
+        seqFileSize = chunkFileSize(seqFileID)
+        disk = 3*seqFileSize
+        memory = 5*3*seqFileSize
         
         super(RunSelfBlast, self).__init__(memory=memory, disk=disk, preemptable=True)
         self.blastOptions = blastOptions
         self.seqFileID = seqFileID
     
     def run(self, fileStore):   
+        seqFile = readChunk(fileStore, self.seqFileID)
+        cache = getBlastCache(self.blastOptions)
+        if cache is not None:
+            cacheKey = cache.getKey([seqFile], "self", self.blastOptions.lastzArguments,
+                                    self.blastOptions.realign, self.blastOptions.realignArguments,
+                                    self.blastOptions.roundsOfCoordinateConversion,
+                                    self.blastOptions.binaryAlignments)
+            resultsFile = fileStore.getLocalTempFile()
+            if cache.get(cacheKey, resultsFile):
+                logger.info("Blast cache hit for self blast of %s" % self.seqFileID)
+                return BlastResultsID(fileStore.writeGlobalFile(resultsFile), cacheHits=1)
+            logger.info("Blast cache miss for self blast of %s" % self.seqFileID)
         blastResultsFile = fileStore.getLocalTempFile()
-        seqFile = fileStore.readGlobalFile(self.seqFileID)
-        runSelfLastz(seqFile, blastResultsFile, lastzArguments=self.blastOptions.lastzArguments)
+        finished = runSelfLastz(seqFile, blastResultsFile, lastzArguments=self.blastOptions.lastzArguments,
+                                soft_timeout=getattr(self.blastOptions, 'lastzSoftTimeout', 5400))
+        if not finished and canSplitAfterTimeout(self.blastOptions):
+            fileStore.logToMaster("Self blast of %s timed out, splitting it up" % self.seqFileID)
+            subOptions = getTimeoutSplitOptions(self.blastOptions)
+            subChunkIDs = splitChunk(fileStore, subOptions, seqFile)
+            diagonalResultsID = self.addChild(MakeSelfBlasts(subOptions, subChunkIDs)).rv()
+            offDiagonalResultsID = self.addChild(MakeOffDiagonalBlasts(subOptions, subChunkIDs)).rv()
+            return self.addFollowOn(CollateBlasts(subOptions, [diagonalResultsID, offDiagonalResultsID],
+                                                  cacheLookups=(0, 1 if cache is not None else 0))).rv()
         if self.blastOptions.realign:
             realignResultsFile = fileStore.getLocalTempFile()
             runCactusSelfRealign(seqFile, inputAlignmentsFile=blastResultsFile,
@@ -408,23 +727,25 @@ class RunSelfBlast(RoundedJob):
                                  realignArguments=self.blastOptions.realignArguments)
             blastResultsFile = realignResultsFile
         resultsFile = fileStore.getLocalTempFile()
-        cactus_call(parameters=["cactus_blast_convertCoordinates",
-                                blastResultsFile,
-                                resultsFile,
-                                str(self.blastOptions.roundsOfCoordinateConversion)])
-        if self.blastOptions.compressFiles:
-            #TODO: This throws away the compressed file
-            seqFile = compressFastaFile(seqFile)
+        runConvertCoordinates(self.blastOptions, blastResultsFile, resultsFile,
+                              self.blastOptions.roundsOfCoordinateConversion)
+        # The partial alignments of a lastz stopped by the soft timeout
+        # are kept, but not cached as if they were complete
+        if cache is not None and finished:
+            cache.put(cacheKey, resultsFile)
         logger.info("Ran the self blast okay")
-        return fileStore.writeGlobalFile(resultsFile)
+        resultsID = fileStore.writeGlobalFile(resultsFile)
+        return BlastResultsID(resultsID, cacheMisses=1) if cache is not None else resultsID
     
 class RunBlast(RoundedJob):
     """Runs blast as a job.
     """
     def __init__(self, blastOptions, seqFileID1, seqFileID2):
         if hasattr(seqFileID1, "size") and hasattr(seqFileID2, "size"):
-            disk = 10*2*(seqFileID1.size + seqFileID2.size)
-            memory = 7*2*(seqFileID1.size + seqFileID2.size)
+            seqFilesSize = chunkFileSize(seqFileID1) + \
+                           chunkFileSize(seqFileID2)
+            disk = 10*2*seqFilesSize
+            memory = 7*2*seqFilesSize
         else:
             disk = 2589934592
             memory = 2589934592
@@ -434,14 +755,32 @@ class RunBlast(RoundedJob):
         self.seqFileID2 = seqFileID2
     
     def run(self, fileStore):
-        seqFile1 = fileStore.readGlobalFile(self.seqFileID1)
-        seqFile2 = fileStore.readGlobalFile(self.seqFileID2)
-        if self.blastOptions.compressFiles:
-            seqFile1 = decompressFastaFile(seqFile1, fileStore.getLocalTempFile())
-            seqFile2 = decompressFastaFile(seqFile2, fileStore.getLocalTempFile())
+        seqFile1 = readChunk(fileStore, self.seqFileID1)
+        seqFile2 = readChunk(fileStore, self.seqFileID2)
+        cache = getBlastCache(self.blastOptions)
+        if cache is not None:
+            cacheKey = cache.getKey([seqFile1, seqFile2], self.blastOptions.lastzArguments,
+                                    self.blastOptions.realign, self.blastOptions.realignArguments,
+                                    self.blastOptions.roundsOfCoordinateConversion,
+                                    self.blastOptions.binaryAlignments)
+            resultsFile = fileStore.getLocalTempFile()
+            if cache.get(cacheKey, resultsFile):
+                logger.info("Blast cache hit for %s vs. %s" % (self.seqFileID1, self.seqFileID2))
+                return BlastResultsID(fileStore.writeGlobalFile(resultsFile), cacheHits=1)
+            logger.info("Blast cache miss for %s vs. %s" % (self.seqFileID1, self.seqFileID2))
         blastResultsFile = fileStore.getLocalTempFile()
 
-        runLastz(seqFile1, seqFile2, blastResultsFile, lastzArguments = self.blastOptions.lastzArguments)
+        finished = runLastz(seqFile1, seqFile2, blastResultsFile, lastzArguments = self.blastOptions.lastzArguments,
+                            soft_timeout=getattr(self.blastOptions, 'lastzSoftTimeout', 5400))
+        if not finished and canSplitAfterTimeout(self.blastOptions):
+            fileStore.logToMaster("Blast of %s vs. %s timed out, splitting it up" % (self.seqFileID1, self.seqFileID2))
+            subOptions = getTimeoutSplitOptions(self.blastOptions)
+            subChunkIDs1 = splitChunk(fileStore, subOptions, seqFile1)
+            subChunkIDs2 = splitChunk(fileStore, subOptions, seqFile2)
+            resultsIDs = [self.addChild(RunBlast(subOptions, subChunkID1, subChunkID2)).rv()
+                          for subChunkID1 in subChunkIDs1 for subChunkID2 in subChunkIDs2]
+            return self.addFollowOn(CollateBlasts(subOptions, resultsIDs,
+                                                  cacheLookups=(0, 1 if cache is not None else 0))).rv()
         if self.blastOptions.realign:
             realignResultsFile = fileStore.getLocalTempFile()
             runCactusRealign(seqFile1, seqFile2, inputAlignmentsFile=blastResultsFile,
@@ -450,41 +789,79 @@ class RunBlast(RoundedJob):
             blastResultsFile = realignResultsFile
             
         resultsFile = fileStore.getLocalTempFile()
-        cactus_call(parameters=["cactus_blast_convertCoordinates",
-                                blastResultsFile,
-                                resultsFile,
-                                str(self.blastOptions.roundsOfCoordinateConversion)])
+        runConvertCoordinates(self.blastOptions, blastResultsFile, resultsFile,
+                              self.blastOptions.roundsOfCoordinateConversion)
+        # The partial alignments of a lastz stopped by the soft timeout
+        # are kept, but not cached as if they were complete
+        if cache is not None and finished:
+            cache.put(cacheKey, resultsFile)
         logger.info("Ran the blast okay")
-        return fileStore.writeGlobalFile(resultsFile)
+        resultsID = fileStore.writeGlobalFile(resultsFile)
+        return BlastResultsID(resultsID, cacheMisses=1) if cache is not None else resultsID
+
+class TimedRunBlast(RunBlast):
+    """Runs blast as a job, returning the results along with how long
+    the job took in seconds, or None if they came from the blast cache.
+    """
+    def run(self, fileStore):
+        startTime = time.time()
+        resultsID = super(TimedRunBlast, self).run(fileStore)
+        if getCacheLookups(resultsID) == (1, 0):
+            return resultsID, None
+        return resultsID, time.time() - startTime
 
 class CollateBlasts(RoundedJob):
-    def __init__(self, blastOptions, resultsFileIDs):
+    """Collates a set of blast results into a single alignments file.
+
+    The results are merged in a tree of jobs, none of which merges more
+    than blastOptions.collateFanIn files, so no single job has to pull
+    every result file through its own disk and network link.
+
+    The blast cache hits and misses counted with the results (see
+    BlastResultsID) are added up, along with cacheLookups, and counted
+    with the collated results.
+    """
+    def __init__(self, blastOptions, resultsFileIDs, cacheLookups=(0, 0)):
         super(CollateBlasts, self).__init__(preemptable=True)
         self.blastOptions = blastOptions
         self.resultsFileIDs = resultsFileIDs
+        self.cacheLookups = cacheLookups
 
     def run(self, fileStore):
-        return self.addFollowOn(CollateBlasts2(self.blastOptions, self.resultsFileIDs)).rv()
+        fanIn = max(getattr(self.blastOptions, 'collateFanIn', 100), 2)
+        if len(self.resultsFileIDs) <= fanIn:
+            return self.addFollowOn(CollateBlasts2(self.blastOptions, self.resultsFileIDs, self.cacheLookups)).rv()
+        groupResultsIDs = [self.addChild(CollateBlasts(self.blastOptions, self.resultsFileIDs[i:i + fanIn])).rv()
+                           for i in xrange(0, len(self.resultsFileIDs), fanIn)]
+        return self.addFollowOn(CollateBlasts(self.blastOptions, groupResultsIDs, self.cacheLookups)).rv()
 
 class CollateBlasts2(RoundedJob):
-    """Collates all the blasts into a single alignments file.
+    """Concatenates a group of blast results into a single alignments file,
+    streaming each one from the file store straight into the output.
     """
-    def __init__(self, blastOptions, resultsFileIDs):
-        disk = 8*sum([alignmentID.size for alignmentID in resultsFileIDs])
-        memory = blastOptions.memory
-        super(CollateBlasts2, self).__init__(memory=memory, disk=disk, preemptable=True)
+    def __init__(self, blastOptions, resultsFileIDs, cacheLookups=(0, 0)):
+        super(CollateBlasts2, self).__init__(preemptable=True)
         self.resultsFileIDs = resultsFileIDs
+        self.cacheLookups = cacheLookups
     
     def run(self, fileStore):
         logger.info("Results IDs: %s" % self.resultsFileIDs)
-        resultsFiles = [readGlobalFileWithoutCache(fileStore, fileID) for fileID in self.resultsFileIDs]
-        collatedResultsFile = fileStore.getLocalTempFile()
-        catFiles(resultsFiles, collatedResultsFile)
-        logger.info("Collated the alignments to the file: %s",  collatedResultsFile)
-        collatedResultsID = fileStore.writeGlobalFile(collatedResultsFile)
+        with fileStore.writeGlobalFileStream() as (collatedResults, collatedResultsID):
+            for resultsFileID in self.resultsFileIDs:
+                with fileStore.readGlobalFileStream(getResultsFileID(resultsFileID)) as results:
+                    shutil.copyfileobj(results, collatedResults)
+        logger.info("Collated the alignments to the file: %s",  collatedResultsID)
         for resultsFileID in self.resultsFileIDs:
-            fileStore.deleteGlobalFile(resultsFileID)
+            fileStore.deleteGlobalFile(getResultsFileID(resultsFileID))
+        return collateBlastResultsIDs(collatedResultsID, self.resultsFileIDs, self.cacheLookups)
+
+def collateBlastResultsIDs(collatedResultsID, resultsIDs, cacheLookups=(0, 0)):
+    """Get the ID of results collated from resultsIDs, counting the blast
+    cache lookups of them all, and cacheLookups, if any were counted."""
+    lookups = [cacheLookups] + map(getCacheLookups, resultsIDs)
+    if not any(isinstance(resultsID, BlastResultsID) for resultsID in resultsIDs) and cacheLookups == (0, 0):
         return collatedResultsID
+    return BlastResultsID(collatedResultsID, sum(hits for hits, _ in lookups), sum(misses for _, misses in lookups))
 
 def sequenceLength(sequenceFile):
     """Get the total # of bp from a fasta file."""
@@ -495,37 +872,3 @@ def sequenceLength(sequenceFile):
             continue
         seqLength += len(line)
     return seqLength
-
-def percentCoverage(sequenceFile, coverageFile):
-    """Get the % coverage of a sequence from a coverage file."""
-    sequenceLen = sequenceLength(sequenceFile)
-    if sequenceLen == 0:
-        return 0
-    coverage = popenCatch("awk '{ total += $3 - $2 } END { print total }' %s" % coverageFile)
-    if coverage.strip() == '': # No coverage lines
-        return 0
-    return 100*float(coverage)/sequenceLen
-
-def calculateCoverage(sequenceFile, cigarFile, outputFile, fromGenome=None, depthById=False, work_dir=None):
-    logger.info("Calculating coverage of cigar file %s on %s, writing to %s" % (
-        cigarFile, sequenceFile, outputFile))
-    args = [sequenceFile, cigarFile]
-    if fromGenome is not None:
-        args += ["--from", fromGenome]
-    if depthById:
-        args += ["--depthById"]
-    cactus_call(outfile=outputFile, work_dir=work_dir,
-                parameters=["cactus_coverage"] + args)
-
-def subtractBed(bed1, bed2, destBed):
-    """Subtract two non-bed12 beds"""
-    # tmp. don't really want to use bedtools
-    if os.path.getsize(bed1) == 0 or os.path.getsize(bed2) == 0:
-        # bedtools will complain on zero-size beds
-        os.rename(bed1, destBed)
-    else:
-        cactus_call(outfile=destBed,
-                    parameters=["subtract",
-                                "-a", bed1,
-                                "-b", bed2])
-
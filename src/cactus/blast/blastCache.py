@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""Persistent, content-addressed cache of chunk-pair alignment results.
+
+A result is keyed by a hash of the contents of the chunks that were
+aligned and of everything else that determines the output (the lastz
+and realign arguments and the version of the binaries), so reruns of a
+project, or new projects sharing genomes with an old one, can reuse
+earlier lastz runs without recomputing them.
+"""
+import os
+import errno
+import shutil
+import hashlib
+import uuid
+
+from toil.lib.bioio import logger
+
+from cactus.shared.version import cactus_commit
+
+def hashFile(path, hasher):
+    """Feed the contents of a file into a hashlib object."""
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1024*1024)
+            if not data:
+                break
+            hasher.update(data)
+
+class BlastCache(object):
+    """A directory of alignment results, addressed by the hash of their
+    inputs and limited in total size.
+
+    When the cache grows past maxSize bytes, the least recently used
+    results are removed until it fits. Writes are atomic renames, so a
+    cache directory can be safely shared between concurrent jobs.
+    """
+    def __init__(self, cacheDir, maxSize=None):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+
+    def getKey(self, seqFiles, *arguments):
+        """Get the cache key for aligning the given chunk files with the
+        given arguments."""
+        hasher = hashlib.sha1()
+        hasher.update(cactus_commit)
+        hasher.update(os.environ.get("CACTUS_BINARIES_MODE", "docker"))
+        for seqFile in seqFiles:
+            hasher.update('\0chunk\0')
+            hashFile(seqFile, hasher)
+        for argument in arguments:
+            hasher.update('\0%s' % (argument,))
+        return hasher.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cacheDir, key[:2], key)
+
+    def get(self, key, outputFile):
+        """Copy the cached results for key to outputFile. Returns False if
+        they aren't in the cache."""
+        path = self._path(key)
+        try:
+            shutil.copyfile(path, outputFile)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        # Mark the entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return True
+
+    def put(self, key, resultsFile):
+        """Add the results in resultsFile to the cache under key."""
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tempPath = "%s.tmp-%s" % (path, uuid.uuid4())
+        shutil.copyfile(resultsFile, tempPath)
+        os.rename(tempPath, path)
+        if self.maxSize is not None:
+            self.evict(self.maxSize)
+
+    def entries(self):
+        """Get (last use time, size, path) for every entry in the cache."""
+        ret = []
+        if not os.path.isdir(self.cacheDir):
+            return ret
+        for subDir in os.listdir(self.cacheDir):
+            subDir = os.path.join(self.cacheDir, subDir)
+            if not os.path.isdir(subDir):
+                continue
+            for name in os.listdir(subDir):
+                if '.tmp-' in name:
+                    continue
+                path = os.path.join(subDir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Evicted by someone else in the meantime
+                    continue
+                ret.append((stat.st_mtime, stat.st_size, path))
+        return ret
+
+    def evict(self, maxSize):
+        """Remove the least recently used entries until the cache takes
+        up no more than maxSize bytes."""
+        entries = sorted(self.entries())
+        totalSize = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if totalSize <= maxSize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            totalSize -= size
+            logger.debug("Evicted %s from the blast cache" % path)
+
+def getBlastCache(blastOptions):
+    """Get the BlastCache configured in blastOptions, or None if caching
+    is off."""
+    cacheDir = getattr(blastOptions, 'cacheDir', None)
+    if cacheDir is None:
+        return None
+    return BlastCache(cacheDir, maxSize=getattr(blastOptions, 'cacheMaxSize', None))
@@ -10,6 +10,7 @@ import random
 import time
 import shutil
 import filecmp
+import pickle
 
 from sonLib.bioio import system
 from sonLib.bioio import logger
@@ -27,16 +28,21 @@ from sonLib.bioio import catFiles
 from sonLib.bioio import popenCatch
 
 from cactus.shared.test import checkCigar
-from cactus.blast.blast import decompressFastaFile, compressFastaFile
+from cactus.blast.binaryAlignments import readAlignments
+from cactus.shared.packedFasta import packFasta, unpackFasta
 
 from cactus.shared.common import runLastz
+from cactus.shared.common import cactus_call
 from cactus.shared.common import makeURL
 
 from cactus.blast.blast import BlastOptions
 from cactus.blast.blast import BlastIngroupsAndOutgroups
 from cactus.blast.blast import BlastSequencesAllAgainstAll
 from cactus.blast.blast import BlastSequencesAgainstEachOther
-from cactus.blast.blast import calculateCoverage
+from cactus.blast.blast import canSplitAfterTimeout, getTimeoutSplitOptions, logSketchFilterSavings
+from cactus.blast.blast import BlastResultsID, collateBlastResultsIDs, getCacheLookups, getResultsFileID
+from cactus.blast.blastCache import BlastCache
+from cactus.blast.chunkSketch import sketchChunk, estimateSharedSeeds
 
 from toil.job import Job
 from toil.common import Toil
@@ -163,6 +169,43 @@ class TestCase(unittest.TestCase):
         for subResult in results:
             os.remove(subResult)
 
+    def testSpeculativeOutgroups(self):
+        """Blasting against the outgroups speculatively should give (very
+        nearly) the same alignments as blasting against them one at a
+        time."""
+        encodeRegion = "ENm001"
+        ingroups = ["human", "macaque"]
+        outgroups = ["rabbit", "dog", "rat"]
+        regionPath = os.path.join(self.encodePath, encodeRegion)
+        ingroupPaths = map(lambda x: os.path.join(regionPath, x + "." + encodeRegion + ".fa"), ingroups)
+        outgroupPaths = map(lambda x: os.path.join(regionPath, x + "." + encodeRegion + ".fa"), outgroups)
+        sequentialToil = os.path.join(self.tempDir, "sequentialToil")
+        runCactusBlastIngroupsAndOutgroups(ingroupPaths, outgroupPaths, alignmentsFile=self.tempOutputFile, toilDir=sequentialToil)
+        speculativeToil = os.path.join(self.tempDir, "speculativeToil")
+        runCactusBlastIngroupsAndOutgroups(ingroupPaths, outgroupPaths, alignmentsFile=self.tempOutputFile2, toilDir=speculativeToil,
+                                           speculativeOutgroups=2)
+        comparator = ResultComparator(loadResults(self.tempOutputFile), loadResults(self.tempOutputFile2))
+        print comparator
+        self.assertTrue(comparator.sensitivity >= 0.95)
+        self.assertTrue(comparator.specificity >= 0.95)
+
+    def testBinaryAlignments(self):
+        """Passing the alignments between the blast stages as binary
+        alignments should give the same alignments as text cigars."""
+        encodeRegion = "ENm001"
+        ingroups = ["human", "macaque"]
+        outgroups = ["rabbit", "dog"]
+        regionPath = os.path.join(self.encodePath, encodeRegion)
+        ingroupPaths = map(lambda x: os.path.join(regionPath, x + "." + encodeRegion + ".fa"), ingroups)
+        outgroupPaths = map(lambda x: os.path.join(regionPath, x + "." + encodeRegion + ".fa"), outgroups)
+        runCactusBlastIngroupsAndOutgroups(ingroupPaths, outgroupPaths, alignmentsFile=self.tempOutputFile,
+                                           toilDir=os.path.join(self.tempDir, "textToil"))
+        runCactusBlastIngroupsAndOutgroups(ingroupPaths, outgroupPaths, alignmentsFile=self.tempOutputFile2,
+                                           toilDir=os.path.join(self.tempDir, "binaryToil"),
+                                           binaryAlignments=True)
+        self.assertEquals(open(self.tempOutputFile2).read(1), "\x89")
+        self.assertEquals(loadResults(self.tempOutputFile), loadResults(self.tempOutputFile2))
+
     def testKeepingCoverageOnIngroups(self):
         """Tests whether the --ingroupCoverageDir option works as
         advertised."""
@@ -304,32 +347,167 @@ class TestCase(unittest.TestCase):
                 system("cat %s" % self.tempOutputFile)
             system("rm -rf %s " % toilDir)
 
+    def testBlastCache(self):
+        """Check that a rerun served from the blast cache gives the same
+        results as the first run, and that the cache respects its size
+        limit."""
+        tempSeqFile = os.path.join(self.tempDir, "tempSeq.fa")
+        self.tempFiles.append(tempSeqFile)
+        seq = getRandomSequence(8000)[1]
+        with open(tempSeqFile, 'w') as fileHandle:
+            for i in xrange(4):
+                fastaWrite(fileHandle, str(i), mutateSequence(seq, 0.1))
+        cacheDir = getTempDirectory(self.tempDir)
+        toilDir = os.path.join(getTempDirectory(self.tempDir), "toil")
+        runCactusBlast([ tempSeqFile ], self.tempOutputFile, toilDir, 5000, 10, cacheDir=cacheDir)
+        entries = BlastCache(cacheDir).entries()
+        self.assertTrue(len(entries) > 0)
+        toilDir = os.path.join(getTempDirectory(self.tempDir), "toil")
+        runCactusBlast([ tempSeqFile ], self.tempOutputFile2, toilDir, 5000, 10, cacheDir=cacheDir)
+        self.assertEquals(sorted(open(self.tempOutputFile).readlines()),
+                          sorted(open(self.tempOutputFile2).readlines()))
+        self.assertEquals(len(BlastCache(cacheDir).entries()), len(entries))
+
+        maxSize = sum(size for _, size, _ in entries) / 2
+        BlastCache(cacheDir).evict(maxSize)
+        self.assertTrue(sum(size for _, size, _ in BlastCache(cacheDir).entries()) <= maxSize)
+
+    def testBlastCacheLookupCounts(self):
+        """The blast cache hits and misses should be summed as blast results
+        are collated, while results blasted without the cache stay plain
+        file store IDs."""
+        self.assertEquals(collateBlastResultsIDs("c", ["a", "b"]), "c")
+        collated = collateBlastResultsIDs("c", [BlastResultsID("a", cacheHits=1),
+                                                BlastResultsID("b", cacheMisses=1), "d"], (0, 1))
+        self.assertEquals(getCacheLookups(collated), (1, 2))
+        self.assertEquals(getResultsFileID(collated), "c")
+        self.assertEquals(str(collated), "c")
+        collated = pickle.loads(pickle.dumps(collateBlastResultsIDs("e", [collated, BlastResultsID("f", cacheHits=2)])))
+        self.assertEquals(getCacheLookups(collated), (3, 2))
+        self.assertEquals(getResultsFileID(collated), "e")
+        self.assertEquals(getCacheLookups("e"), (0, 0))
+        self.assertEquals(getResultsFileID("e"), "e")
+
+    def testVirtualChunks(self):
+        """Blasting virtual chunks, read as ranges of the input files,
+        should give the same alignments as blasting chunk files."""
+        tempSeqFile = os.path.join(self.tempDir, "tempSeq.fa")
+        tempSeqFile2 = os.path.join(self.tempDir, "tempSeq2.fa")
+        self.tempFiles.append(tempSeqFile)
+        self.tempFiles.append(tempSeqFile2)
+        seq = getRandomSequence(8000)[1]
+        for seqFile in (tempSeqFile, tempSeqFile2):
+            with open(seqFile, 'w') as fileHandle:
+                for i in xrange(3):
+                    fastaWrite(fileHandle, "%s%i" % (os.path.basename(seqFile), i), mutateSequence(seq, 0.1))
+        for targetSequenceFiles in (None, [tempSeqFile2]):
+            toilDir = os.path.join(getTempDirectory(self.tempDir), "toil")
+            runCactusBlast([ tempSeqFile ], self.tempOutputFile, toilDir, 5000, 100,
+                           targetSequenceFiles=targetSequenceFiles)
+            toilDir = os.path.join(getTempDirectory(self.tempDir), "toil")
+            runCactusBlast([ tempSeqFile ], self.tempOutputFile2, toilDir, 5000, 100,
+                           targetSequenceFiles=targetSequenceFiles, virtualChunks=True)
+            self.assertEquals(sorted(open(self.tempOutputFile).readlines()),
+                              sorted(open(self.tempOutputFile2).readlines()))
+
+    def testTimeoutSplitOptions(self):
+        """A chunk whose lastz times out can be split up maxTimeoutSplits
+        times, each split adding a round of coordinate conversion."""
+        blastOptions = BlastOptions()
+        self.assertEquals(blastOptions.maxTimeoutSplits, 2)
+        blastOptions.roundsOfCoordinateConversion = 1
+        self.assertTrue(canSplitAfterTimeout(blastOptions))
+        subOptions = getTimeoutSplitOptions(blastOptions)
+        self.assertEquals(subOptions.roundsOfCoordinateConversion, 2)
+        self.assertTrue(canSplitAfterTimeout(subOptions))
+        subOptions = getTimeoutSplitOptions(subOptions)
+        self.assertEquals(subOptions.roundsOfCoordinateConversion, 3)
+        self.assertFalse(canSplitAfterTimeout(subOptions))
+        self.assertEquals(blastOptions.roundsOfCoordinateConversion, 1)
+        self.assertFalse(canSplitAfterTimeout(BlastOptions(maxTimeoutSplits=0)))
+
+    def testCollationTree(self):
+        """Check that merging the results in a deep tree of collation jobs
+        gives the same alignments as merging them all at once."""
+        tempSeqFile = os.path.join(self.tempDir, "tempSeq.fa")
+        self.tempFiles.append(tempSeqFile)
+        seq = getRandomSequence(8000)[1]
+        with open(tempSeqFile, 'w') as fileHandle:
+            for i in xrange(5):
+                fastaWrite(fileHandle, str(i), mutateSequence(seq, 0.1))
+        toilDir = os.path.join(getTempDirectory(self.tempDir), "toil")
+        runCactusBlast([ tempSeqFile ], self.tempOutputFile, toilDir, 3000, 10)
+        toilDir = os.path.join(getTempDirectory(self.tempDir), "toil")
+        runCactusBlast([ tempSeqFile ], self.tempOutputFile2, toilDir, 3000, 10, collateFanIn=2)
+        self.assertEquals(sorted(open(self.tempOutputFile).readlines()),
+                          sorted(open(self.tempOutputFile2).readlines()))
+
+    def testSketchFilter(self):
+        """Check that skipping chunk pairs that share no k-mers doesn't
+        lose any alignments."""
+        tempSeqFile = os.path.join(self.tempDir, "tempSeq.fa")
+        self.tempFiles.append(tempSeqFile)
+        seq = getRandomSequence(8000)[1]
+        with open(tempSeqFile, 'w') as fileHandle:
+            for i in xrange(3):
+                fastaWrite(fileHandle, str(i), mutateSequence(seq, 0.1))
+            # Sequences that share nothing with the others
+            for i in xrange(3, 6):
+                fastaWrite(fileHandle, str(i), getRandomSequence(8000)[1])
+        toilDir = os.path.join(getTempDirectory(self.tempDir), "toil")
+        runCactusBlast([ tempSeqFile ], self.tempOutputFile, toilDir, 8000, 10)
+        toilDir = os.path.join(getTempDirectory(self.tempDir), "toil")
+        runCactusBlast([ tempSeqFile ], self.tempOutputFile2, toilDir, 8000, 10,
+                       sketchThreshold=1, sketchScale=1)
+        self.assertEquals(sorted(open(self.tempOutputFile).readlines()),
+                          sorted(open(self.tempOutputFile2).readlines()))
+
+        unrelatedSeqFile = os.path.join(self.tempDir, "unrelated.fa")
+        self.tempFiles.append(unrelatedSeqFile)
+        with open(unrelatedSeqFile, 'w') as fileHandle:
+            fastaWrite(fileHandle, "unrelated", getRandomSequence(8000)[1])
+        self.assertTrue(estimateSharedSeeds(sketchChunk(tempSeqFile, scale=1),
+                                            sketchChunk(tempSeqFile, scale=1), scale=1) > 0)
+        self.assertEquals(estimateSharedSeeds(sketchChunk(tempSeqFile, scale=1),
+                                              sketchChunk(unrelatedSeqFile, scale=1), scale=1), 0)
+
+    def testSketchFilterSavings(self):
+        """The estimated savings of the sketch filter should only be taken
+        from the lastz runs that weren't served from the blast cache, and
+        be reported next to the time spent sketching."""
+        class FakeFileStore(object):
+            def __init__(self):
+                self.messages = []
+            def logToMaster(self, message):
+                self.messages.append(message)
+        class FakeJob(object):
+            fileStore = FakeFileStore()
+        job = FakeJob()
+        logSketchFilterSavings(job, 3, 5, [3600.0, None], [1800.0, 1800.0])
+        logSketchFilterSavings(job, 4, 5, [None])
+        self.assertEquals(job.fileStore.messages,
+                          ["Sketch filter skipped 3 of 5 lastz runs, saving an estimated 3.00 CPU-hours for 1.00 CPU-hours of sketching",
+                           "Sketch filter skipped 4 of 5 lastz runs, saving an unknown amount of CPU time for 0.00 CPU-hours of sketching"])
+
     def testCompression(self):
         tempSeqFile = os.path.join(self.tempDir, "tempSeq.fa")
         tempSeqFile2 = os.path.join(self.tempDir, "tempSeq2.fa")
+        tempPackedFile = os.path.join(self.tempDir, "tempSeq.packed")
         self.tempFiles.append(tempSeqFile)
         self.tempFiles.append(tempSeqFile2)
+        self.tempFiles.append(tempPackedFile)
         self.encodePath = os.path.join(self.encodePath, "ENm001")
         catFiles([ os.path.join(self.encodePath, fileName) for fileName in os.listdir(self.encodePath) ], tempSeqFile)
         startTime = time.time()
-        compressFastaFile(tempSeqFile)
-        logger.critical("It took %s seconds to compress the fasta file" % (time.time() - startTime))
-        startTime = time.time()
-        system("rm %s" % tempSeqFile + ".bz2")
-        system("bzip2 --keep --fast %s" % tempSeqFile)
-        logger.critical("It took %s seconds to compress the fasta file by system functions" % (time.time() - startTime))
+        packFasta(tempSeqFile, tempPackedFile)
+        logger.critical("It took %s seconds to pack the fasta file" % (time.time() - startTime))
         startTime = time.time()
-        decompressFastaFile(tempSeqFile + ".bz2", tempSeqFile2)
-        logger.critical("It took %s seconds to decompress the fasta file" % (time.time() - startTime))
-        system("rm %s" % tempSeqFile2)
-        startTime = time.time()
-        system("bunzip2 --stdout %s > %s" % (tempSeqFile + ".bz2", tempSeqFile2))
-        logger.critical("It took %s seconds to decompress the fasta file using system function" % (time.time() - startTime))
-        logger.critical("File sizes, before: %s, compressed: %s, decompressed: %s" % (os.stat(tempSeqFile).st_size, os.stat(tempSeqFile + ".bz2").st_size, os.stat(tempSeqFile2).st_size))
-        #Above test justifies out use of compression to reduce network transfer!
-        #startTime = time.time()
-        #runNaiveBlast([ tempSeqFile ], self.tempOutputFile, self.tempDir, lastzOptions="--nogapped --step=3 --hspthresh=3000 --ambiguous=iupac")
-        #logger.critical("It took %s seconds to run blast" % (time.time() - startTime))
+        unpackFasta(tempPackedFile, tempSeqFile2)
+        logger.critical("It took %s seconds to unpack the fasta file" % (time.time() - startTime))
+        logger.critical("File sizes, before: %s, packed: %s, unpacked: %s" % (os.stat(tempSeqFile).st_size, os.stat(tempPackedFile).st_size, os.stat(tempSeqFile2).st_size))
+        self.assertEquals(open(tempSeqFile2).read(), open(tempSeqFile).read())
+        #Packed chunks are what cross the network between the blast jobs
+        self.assertTrue(os.stat(tempPackedFile).st_size < 0.5 * os.stat(tempSeqFile).st_size)
 
 
 def compareResultsFile(results1, results2, closeness=0.95):
@@ -388,7 +566,7 @@ def loadResults(resultsFile):
     pairsSet = set()
     fileHandle = open(resultsFile, 'r')
     totalHits = 0
-    for pairwiseAlignment in cigarRead(fileHandle):
+    for pairwiseAlignment in readAlignments(fileHandle):
         totalHits +=1
         i = pairwiseAlignment.start1
         s1 = 1
@@ -432,6 +610,14 @@ def loadResults(resultsFile):
     fileHandle.close()      
     return (pairsSet, totalHits)
 
+def calculateCoverage(sequenceFile, cigarFile, outputFile, fromGenome=None):
+    """Get the coverage of the alignments on the sequences with
+    cactus_coverage, independently of the coverage blast tracks."""
+    args = [sequenceFile, cigarFile]
+    if fromGenome is not None:
+        args += ["--from", fromGenome]
+    cactus_call(outfile=outputFile, parameters=["cactus_coverage"] + args)
+
 def runNaiveBlast(seqFile1, seqFile2, outputFile, tempDir, lastzArguments=""):
     """Runs the blast command in a very naive way (not splitting things up).
     """
@@ -448,13 +634,23 @@ def runCactusBlast(sequenceFiles, alignmentsFile, toilDir,
                    logLevel=None, 
                    compressFiles=None,
                    lastzMemory=None,
-                   targetSequenceFiles=None):
+                   targetSequenceFiles=None,
+                   cacheDir=None,
+                   collateFanIn=100,
+                   sketchThreshold=None,
+                   sketchScale=1000,
+                   virtualChunks=False):
     
     options = Job.Runner.getDefaultOptions(toilDir)
     options.logLevel = "CRITICAL"
     blastOptions = BlastOptions(chunkSize=chunkSize, overlapSize=overlapSize,
                                 compressFiles=compressFiles,
-                                memory=lastzMemory)
+                                memory=lastzMemory,
+                                cacheDir=cacheDir,
+                                collateFanIn=collateFanIn,
+                                sketchThreshold=sketchThreshold,
+                                sketchScale=sketchScale,
+                                virtualChunks=virtualChunks)
     with Toil(options) as toil:
         seqIDs = [toil.importFile(makeURL(seqFile)) for seqFile in sequenceFiles]
 
@@ -469,13 +665,18 @@ def runCactusBlast(sequenceFiles, alignmentsFile, toilDir,
 def runCactusBlastIngroupsAndOutgroups(ingroups, outgroups, alignmentsFile, toilDir, outgroupFragmentPaths=None, ingroupCoveragePaths=None, chunkSize=250000, overlapSize=10000, 
                    logLevel=None,
                    compressFiles=None,
-                   lastzMemory=None):
+                   lastzMemory=None,
+                   speculativeOutgroups=0,
+                   binaryAlignments=False):
     options = Job.Runner.getDefaultOptions(toilDir)
     options.disableCaching = True
     options.logLevel = "CRITICAL"
     blastOptions = BlastOptions(chunkSize=chunkSize, overlapSize=overlapSize,
                                 compressFiles=compressFiles,
-                                memory=lastzMemory)
+                                memory=lastzMemory,
+                                speculativeOutgroups=speculativeOutgroups,
+                                speculativeMaxExtraWork=float('inf'),
+                                binaryAlignments=binaryAlignments)
     with Toil(options) as toil:
         ingroupIDs = [toil.importFile(makeURL(ingroup)) for ingroup in ingroups]
         outgroupIDs = [toil.importFile(makeURL(outgroup)) for outgroup in outgroups]
@@ -3,6 +3,9 @@ from sonLib.bioio import getTempFile
 from textwrap import dedent
 from cactus.shared.common import cactus_call
 from cactus.shared.test import getCactusInputs_encode, silentOnSuccess
+from cactus.blast.coverage import CoverageMap, addCigarFile, readSequenceLengths
+from cactus.blast.binaryAlignments import convertAlignments
+from StringIO import StringIO
 
 class TestCase(unittest.TestCase):
     def setUp(self):
@@ -167,5 +170,88 @@ class TestCase(unittest.TestCase):
         '''))
         os.remove(deepCigarPath)
 
+    def inProcessCoverage(self, fastaPath, cigarPath, depthById=False, fromPath=None):
+        """Get the BED output of the in-process CoverageMap."""
+        coverageMap = CoverageMap(fastaPath, depthById=depthById)
+        fromSequences = None
+        if fromPath is not None:
+            fromSequences = set(name for name, _ in readSequenceLengths(fromPath))
+        addCigarFile([coverageMap], cigarPath, fromSequences=fromSequences)
+        bed = StringIO()
+        coverageMap.writeBed(bed)
+        return bed.getvalue()
+
+    def testInProcessCoverage(self):
+        """The in-process coverage should match cactus_coverage's output."""
+        self.assertEqual(self.inProcessCoverage(self.simpleFastaPathA, self.simpleCigarPath), dedent('''\
+        id=0|simpleSeqA1\t0\t1\t\t1
+        id=0|simpleSeqA1\t2\t7\t\t2
+        id=0|simpleSeqA1\t7\t10\t\t1
+        id=1|simpleSeqA2\t0\t3\t\t1
+        id=1|simpleSeqA2\t5\t6\t\t1
+        id=1|simpleSeqA2\t6\t7\t\t2
+        id=1|simpleSeqA2\t7\t8\t\t3
+        id=1|simpleSeqA2\t8\t9\t\t2
+        id=1|simpleSeqA2\t9\t10\t\t1
+        '''))
+        self.assertEqual(self.inProcessCoverage(self.simpleFastaPathB, self.simpleCigarPath), dedent('''\
+        id=2|simpleSeqB1\t0\t12\t\t1
+        id=2|simpleSeqB1\t17\t19\t\t1
+        id=2|simpleSeqB1\t21\t32\t\t1
+        '''))
+        self.assertEqual(self.inProcessCoverage(self.simpleFastaPathA, self.simpleCigarPath, depthById=True), dedent('''\
+        id=0|simpleSeqA1\t0\t1\t\t1
+        id=0|simpleSeqA1\t2\t6\t\t1
+        id=0|simpleSeqA1\t6\t7\t\t2
+        id=0|simpleSeqA1\t7\t10\t\t1
+        id=1|simpleSeqA2\t0\t3\t\t1
+        id=1|simpleSeqA2\t5\t10\t\t1
+        '''))
+        self.assertEqual(self.inProcessCoverage(self.simpleFastaPathC, self.simpleCigarPath,
+                                                fromPath=self.simpleFastaPathD), dedent('''\
+        id=3|simpleSeqC1\t0\t10\t\t1
+        '''))
+
+    def testInProcessCoverageIsIncremental(self):
+        """Adding alignments to the coverage from an earlier BED should
+        give the same coverage as computing it from all the alignments."""
+        cigarLines = open(self.simpleCigarPath).readlines()
+        firstCigarPath = getTempFile()
+        secondCigarPath = getTempFile()
+        open(firstCigarPath, 'w').write("".join(cigarLines[:3]))
+        open(secondCigarPath, 'w').write("".join(cigarLines[3:]))
+        firstBed = StringIO(self.inProcessCoverage(self.simpleFastaPathA, firstCigarPath))
+        coverageMap = CoverageMap(self.simpleFastaPathA)
+        coverageMap.addBed(firstBed)
+        addCigarFile([coverageMap], secondCigarPath)
+        bed = StringIO()
+        coverageMap.writeBed(bed)
+        self.assertEqual(bed.getvalue(), self.inProcessCoverage(self.simpleFastaPathA, self.simpleCigarPath))
+        self.assertAlmostEqual(coverageMap.percentCoverage(), 100.0 * 17 / 96)
+        os.remove(firstCigarPath)
+        os.remove(secondCigarPath)
+
+    def testInProcessCoverageOfBinaryAlignments(self):
+        binaryCigarPath = getTempFile()
+        convertAlignments(self.simpleCigarPath, binaryCigarPath, True)
+        for fastaPath in (self.simpleFastaPathA, self.simpleFastaPathB):
+            self.assertEqual(self.inProcessCoverage(fastaPath, binaryCigarPath),
+                             self.inProcessCoverage(fastaPath, self.simpleCigarPath))
+        self.assertEqual(self.inProcessCoverage(self.simpleFastaPathC, binaryCigarPath,
+                                                fromPath=self.simpleFastaPathD),
+                         self.inProcessCoverage(self.simpleFastaPathC, self.simpleCigarPath,
+                                                fromPath=self.simpleFastaPathD))
+        os.remove(binaryCigarPath)
+
+    def testInProcessCoverageCap(self):
+        deepCigarPath = getTempFile()
+        with open(deepCigarPath, 'w') as f:
+            for _ in xrange(65537):
+                f.write('cigar: id=2|simpleSeqB1 0 1 + id=0|simpleSeqA1 10 9 - 0 M 1\n')
+        self.assertEqual(self.inProcessCoverage(self.simpleFastaPathA, deepCigarPath), dedent('''\
+        id=0|simpleSeqA1\t9\t10\t\t65535
+        '''))
+        os.remove(deepCigarPath)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+"""Sampled k-mer sketches of chunk files, used to skip lastz runs on
+chunk pairs that can't share any seeds.
+
+A sketch holds the hashes of every canonical k-mer in a chunk whose
+hash falls below 1/scale of the hash space (a "FracMinHash"), so the
+number of hashes two sketches share, times scale, estimates the number
+of k-mers the chunks share. Only unmasked (upper-case ACGT) k-mers are
+sampled, since lastz doesn't seed in soft-masked sequence.
+"""
+import re
+import zlib
+import string
+
+from cactus.blast.trimSequences import readFastaContigs
+
+unmaskedRegex = re.compile("[ACGT]+")
+complementTable = string.maketrans("ACGT", "TGCA")
+
+def sketchSequence(seq, kmerSize, scale, hashes):
+    """Add the sampled hashes of the unmasked k-mers in seq to the set
+    hashes."""
+    maxHash = 2**32 / scale
+    for match in unmaskedRegex.finditer(seq):
+        run = match.group()
+        runLength = len(run)
+        if runLength < kmerSize:
+            continue
+        reverseComplement = run.translate(complementTable)[::-1]
+        for i in xrange(runLength - kmerSize + 1):
+            kmer = min(run[i:i + kmerSize],
+                       reverseComplement[runLength - i - kmerSize:runLength - i])
+            kmerHash = zlib.crc32(kmer) & 0xffffffff
+            if kmerHash < maxHash:
+                hashes.add(kmerHash)
+
+def sketchChunk(chunkFile, kmerSize=16, scale=1000):
+    """Get the sketch of a (fasta) chunk file, as a sorted list."""
+    hashes = set()
+    with open(chunkFile) as f:
+        for _, seq in readFastaContigs(f):
+            sketchSequence(seq, kmerSize, scale, hashes)
+    return sorted(hashes)
+
+def estimateSharedSeeds(sketch1, sketch2, scale=1000):
+    """Estimate the number of k-mers shared by the chunks that two
+    sketches were made from."""
+    if len(sketch1) > len(sketch2):
+        sketch1, sketch2 = sketch2, sketch1
+    return len(set(sketch1).intersection(sketch2)) * scale
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+"""In-process coverage of cigar alignments on the sequences of a genome.
+
+This reproduces the BED output of cactus_coverage, but keeps the
+coverage in memory as intervals, so that the outgroup recursion can
+compute coverage for all the ingroups in a single pass over the
+alignments, update it as each new outgroup is aligned, and hand it
+straight to trimSequences, without a container launch or a BED file
+per step.
+"""
+from collections import defaultdict
+
+from cactus.blast.binaryAlignments import isBinaryAlignmentFile, readBinaryRecords
+
+# cactus_coverage holds depths as uint16s, which saturate here.
+maxDepth = 65535
+
+# The cigar operations that the scored operations X, Y and Z stand for.
+scoredOperations = { 'X': 'M', 'Y': 'D', 'Z': 'I' }
+
+def readSequenceLengths(sequenceFile):
+    """Get a list of (name, length) for the sequences in a fasta file,
+    where name is the first token of the header (as lastz uses)."""
+    ret = []
+    name = None
+    length = 0
+    with open(sequenceFile) as f:
+        for line in f:
+            line = line.strip()
+            if line == '':
+                continue
+            if line[0] == '>':
+                if name is not None:
+                    ret.append((name, length))
+                name = line[1:].split()[0]
+                length = 0
+            else:
+                length += len(line)
+    if name is not None:
+        ret.append((name, length))
+    return ret
+
+def depthRuns(intervals):
+    """Get the depth of a list of weighted (start, end, weight)
+    intervals as sorted, non-overlapping (start, end, depth) runs of
+    non-zero depth."""
+    deltas = defaultdict(int)
+    for start, end, weight in intervals:
+        deltas[start] += weight
+        deltas[end] -= weight
+    runs = []
+    depth = 0
+    runStart = None
+    for position in sorted(deltas):
+        if deltas[position] == 0:
+            continue
+        if depth > 0:
+            runs.append((runStart, position, depth))
+        depth += deltas[position]
+        runStart = position
+    return runs
+
+def unionIntervals(intervals):
+    """Get the union of a list of weighted intervals as sorted,
+    non-overlapping intervals of weight 1."""
+    ret = []
+    for start, end, _ in depthRuns(intervals):
+        if ret and ret[-1][1] == start:
+            ret[-1] = (ret[-1][0], end, 1)
+        else:
+            ret.append((start, end, 1))
+    return ret
+
+def parseCigarMatches(line):
+    """Get (contig1, contig2, matches1, matches2) from a cigar line, where
+    matches1 and matches2 are the (start, end) intervals aligned to
+    the other sequence on each contig, or None if the line isn't a
+    cigar line."""
+    fields = line.split()
+    if len(fields) < 10 or fields[0] != 'cigar:':
+        return None
+    ops = []
+    i = 10
+    while i < len(fields):
+        op = fields[i]
+        # The X, Y and Z operations are M, D and I with a score
+        ops.append((scoredOperations.get(op, op), int(fields[i + 1])))
+        i += 3 if op in 'XYZ' else 2
+    return getAlignmentMatches(fields[1], int(fields[2]), fields[4] != '-',
+                               fields[5], int(fields[6]), fields[8] != '-', ops)
+
+def getAlignmentMatches(contig1, pos1, forward1, contig2, pos2, forward2, ops):
+    """Get (contig1, contig2, matches1, matches2), as parseCigarMatches
+    does, for an alignment starting at pos1 and pos2, where ops is a
+    list of (cigar operation, length)."""
+    matches1 = []
+    matches2 = []
+    for op, length in ops:
+        if op == 'M':
+            for matches, pos, forward in ((matches1, pos1, forward1),
+                                          (matches2, pos2, forward2)):
+                start, end = (pos, pos + length) if forward else (pos - length, pos)
+                if matches and (matches[-1][1] == start or matches[-1][0] == end):
+                    # Extend the previous match rather than starting
+                    # a new interval, if only the other sequence
+                    # was gapped in between.
+                    start, end = min(start, matches[-1][0]), max(end, matches[-1][1])
+                    matches[-1] = (start, end)
+                else:
+                    matches.append((start, end))
+        if op in 'MI':
+            pos1 += length if forward1 else -length
+        if op in 'MD':
+            pos2 += length if forward2 else -length
+    return contig1, contig2, matches1, matches2
+
+def readAlignmentMatches(cigarFile):
+    """Yield the (contig1, contig2, matches1, matches2) of every alignment
+    in a binary or text cigar file."""
+    with open(cigarFile) as f:
+        if isBinaryAlignmentFile(f):
+            for contig1, pos1, _, strand1, contig2, pos2, _, strand2, _, ops in readBinaryRecords(f):
+                yield getAlignmentMatches(contig1, pos1, strand1 != '-', contig2, pos2, strand2 != '-', ops)
+        else:
+            for line in f:
+                parsed = parseCigarMatches(line)
+                if parsed is not None:
+                    yield parsed
+
+def getSourceID(header):
+    """Get the 'id=N' prefix of a header, used to count depth by source
+    genome."""
+    sourceID = header.split('|')[0]
+    if not sourceID.startswith('id='):
+        raise RuntimeError("Counting depth by ID, but header %s does not have "
+                           "an 'id=N|' prefix" % header)
+    return sourceID
+
+class CoverageMap(object):
+    """The coverage of alignments on the sequences of one genome.
+
+    Coverage is kept per sequence as lists of weighted intervals, one
+    list per source. Normally everything shares one source and the
+    depth is the total number of alignments covering a base. With
+    depthById, the alignments are split by the 'id=N|' prefix of the
+    sequence they align to, and each ID adds at most 1 to the depth,
+    as with cactus_coverage --depthById. The lists are compacted into
+    depth runs (or unions, per ID) as they grow, so the memory used is
+    bounded by the complexity of the coverage rather than the number
+    of alignments.
+    """
+    def __init__(self, sequenceFile, depthById=False):
+        self.depthById = depthById
+        self.sequenceNames = []
+        self.sequenceLengths = {}
+        for name, length in readSequenceLengths(sequenceFile):
+            if name in self.sequenceLengths:
+                raise RuntimeError("Duplicate sequence identifier %s found in %s: make sure "
+                                   "the first tokens in the headers are unique" % (name, sequenceFile))
+            self.sequenceNames.append(name)
+            self.sequenceLengths[name] = length
+        # sequence -> source -> [(start, end, weight)]
+        self.intervals = defaultdict(dict)
+        # The length of each interval list when it was last compacted.
+        self.compactedLengths = {}
+
+    def __contains__(self, sequence):
+        return sequence in self.sequenceLengths
+
+    def totalLength(self):
+        """The total length of the genome's sequences."""
+        return sum(self.sequenceLengths.values())
+
+    def _addIntervals(self, sequence, source, intervals):
+        for start, end, _ in intervals:
+            if end > self.sequenceLengths[sequence] or start < 0:
+                raise RuntimeError("Alignment on %s:%d-%d is past the sequence end" % (sequence, start, end))
+        sourceIntervals = self.intervals[sequence].setdefault(source, [])
+        sourceIntervals.extend(intervals)
+        key = (sequence, source)
+        if len(sourceIntervals) > 2 * self.compactedLengths.get(key, 1024):
+            self.intervals[sequence][source] = self._compact(source, sourceIntervals)
+            self.compactedLengths[key] = max(len(self.intervals[sequence][source]), 1024)
+
+    def _compact(self, source, intervals):
+        if source is None:
+            return depthRuns(intervals)
+        return unionIntervals(intervals)
+
+    def addAlignment(self, sequence, otherSequence, matches):
+        """Add the (start, end) intervals of sequence that an alignment
+        matches to otherSequence."""
+        source = getSourceID(otherSequence) if self.depthById else None
+        self._addIntervals(sequence, source, [(start, end, 1) for start, end in matches])
+
+    def addBed(self, bedFile):
+        """Add the depths in a coverage BED file, e.g. from an earlier
+        CoverageMap or cactus_coverage run on a different set of
+        alignments. The depths are added as they are, so with
+        depthById the alignments added afterwards must not come from
+        IDs that the BED file already counts."""
+        for line in bedFile:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 5 or line[0] == '#':
+                continue
+            if fields[0] in self:
+                self._addIntervals(fields[0], None, [(int(fields[1]), int(fields[2]), int(fields[4]))])
+
+    def getDepthRuns(self, sequence):
+        """Get the coverage of a sequence as sorted, non-overlapping
+        (start, end, depth) runs, merging neighbouring runs of the same
+        depth."""
+        intervals = []
+        for source, sourceIntervals in self.intervals.get(sequence, {}).items():
+            intervals.extend(self._compact(source, sourceIntervals))
+        ret = []
+        for start, end, depth in depthRuns(intervals):
+            depth = min(depth, maxDepth)
+            if ret and ret[-1][1] == start and ret[-1][2] == depth:
+                ret[-1] = (ret[-1][0], end, depth)
+            else:
+                ret.append((start, end, depth))
+        return ret
+
+    def getBedBlocks(self):
+        """Get a dict of sequence -> [(start, end, depth)], in the form
+        that trimSequences takes."""
+        return dict((sequence, self.getDepthRuns(sequence)) for sequence in self.sequenceNames
+                    if sequence in self.intervals)
+
+    def coveredBases(self):
+        """The number of bases covered at least once."""
+        return sum(end - start for sequence in self.sequenceNames
+                   for start, end, _ in self.getDepthRuns(sequence))
+
+    def percentCoverage(self):
+        totalLength = self.totalLength()
+        if totalLength == 0:
+            return 0
+        return 100 * float(self.coveredBases()) / totalLength
+
+    def writeBed(self, outputFile):
+        """Write the coverage in the BED format of cactus_coverage."""
+        for sequence in self.sequenceNames:
+            for start, end, depth in self.getDepthRuns(sequence):
+                outputFile.write("%s\t%d\t%d\t\t%d\n" % (sequence, start, end, depth))
+
+def addCigarFile(coverageMaps, cigarFile, fromSequences=None):
+    """Add the alignments in a cigar file to every coverage map that holds
+    either of the sequences they align, reading the file only once.
+
+    If fromSequences is given, only alignments whose other sequence is
+    in that set are counted, as with cactus_coverage --from.
+    """
+    for contig1, contig2, matches1, matches2 in readAlignmentMatches(cigarFile):
+        for coverageMap in coverageMaps:
+            if contig1 in coverageMap and (fromSequences is None or contig2 in fromSequences):
+                coverageMap.addAlignment(contig1, contig2, matches1)
+            if contig2 in coverageMap and (fromSequences is None or contig1 in fromSequences):
+                coverageMap.addAlignment(contig2, contig1, matches2)
@@ -23,36 +23,206 @@ filtering the alignments to remove lower probability alignments.
         - Calculate mapping qualities for each alignments and optionally filter alignments, 
         for example to only keep the primary alignment: C subscript: cactus_calculateMappingQualities
 
+- The input can be binary alignments (see binaryAlignments.py), which the mirroring reads and writes
+  out as text cigars for the rest of the procedure.
+
+- Everything after the mirroring only ever looks at the alignments on one sequence of S at a time, so
+  with shards > 1 the mirrored alignments are written by sequence into that many shards as they are
+  mirrored, and the shards sorted and rescored in parallel, and the results concatenated. Each shard
+  holds a run of sequences that are consecutive in the order the sort puts them in, so the output is
+  the same as for a single shard.
+
 """
+import os
+from multiprocessing.pool import ThreadPool
+
 from cactus.shared.common import cactus_call
+from cactus.shared.common import catFiles
+from cactus.blast.binaryAlignments import isBinaryAlignmentFile, readBinaryRecords
+
+# The mirrored alignments, which are text cigars, take about this many times
+# the space of the input alignments, in either format
+TEXT_MIRRORED_SIZE_RATIO = 2
+BINARY_MIRRORED_SIZE_RATIO = 8
+
+# Memory for everything but the sorts, and the most memory to give the sorts,
+# beyond which they spill to disk
+BASE_MEMORY = 1024**3
+MAX_SORT_MEMORY = 16*1024**3
+MIN_SORT_MEMORY = 64*1024**2
 
 def countLines(inputFile):
     with open(inputFile, 'r') as f:
         return sum(1 for line in f)
 
+def getMirroredSize(alignmentsID, binaryAlignments):
+    """Estimate the size of the mirrored alignments of an alignments file."""
+    return alignmentsID.size * (BINARY_MIRRORED_SIZE_RATIO if binaryAlignments else TEXT_MIRRORED_SIZE_RATIO)
+
+def getMappingQualityRescoringMemory(alignmentsID, binaryAlignments):
+    """The memory mappingQualityRescoring needs for the alignments file,
+    enough for the sorts to hold all the mirrored alignments, up to
+    MAX_SORT_MEMORY. For use as a PromisedRequirement."""
+    return BASE_MEMORY + max(MIN_SORT_MEMORY, min(getMirroredSize(alignmentsID, binaryAlignments), MAX_SORT_MEMORY))
+
+def getMappingQualityRescoringDisk(alignmentsID, binaryAlignments):
+    """The disk mappingQualityRescoring needs for the alignments file: the
+    input, and up to three copies of the mirrored alignments at once (the
+    shards, the sorts' temporary files and the output). For use as a
+    PromisedRequirement."""
+    return 2 * alignmentsID.size + 3 * getMirroredSize(alignmentsID, binaryAlignments)
+
+def getTargetContig(cigarLine):
+    """The sequence of S a (mirrored and oriented) cigar line is on,
+    which is the 6th field the sort orders it by."""
+    return cigarLine.split(None, 6)[5]
+
+def countAlignmentsBySequence(alignmentsFile):
+    """
+    Count the alignments on each sequence of a file of binary or text cigar alignments, which is the
+    number of mirrored alignments each sequence will have.
+    """
+    alignmentCounts = {}
+    def count(name):
+        alignmentCounts[name] = alignmentCounts.get(name, 0) + 1
+    with open(alignmentsFile, 'r') as f:
+        if isBinaryAlignmentFile(f):
+            for record in readBinaryRecords(f):
+                count(record[0])
+                count(record[4])
+        else:
+            for line in f:
+                fields = line.split(None, 6)
+                if len(fields) > 5:
+                    count(fields[1])
+                    count(fields[5])
+    return alignmentCounts
+
+def shardAlignmentsByTargetContig(inputCommand, alignmentCounts, numShards, getTempFile):
+    """
+    Split the (mirrored and oriented) alignments the given command outputs into at most numShards
+    files as they are written, each holding all the alignments on a run of sequences of S that are
+    consecutive in the order "sort -k6,6" puts them in. alignmentCounts gives the number of
+    alignments on each sequence (see countAlignmentsBySequence), which are split to give about the
+    same number of alignments in each file.
+
+    Returns the files in that order, or None, without running the command, if the alignments can't
+    be sharded so, because sort treats some differently named sequences as equal.
+    """
+    # Order the sequences by sorting a line on each of them, the same way the alignments would be.
+    contigsFile = getTempFile()
+    with open(contigsFile, 'w') as f:
+        for contig in alignmentCounts:
+            f.write("cigar: - 0 0 + %s\n" % contig)
+    if len(cactus_call(parameters=["sort", "-u", "-k6,6", contigsFile], check_output=True).splitlines()) != len(alignmentCounts):
+        return None
+    contigs = [getTargetContig(line) for line in
+               cactus_call(parameters=["sort", "-k6,6", contigsFile], check_output=True).splitlines()]
+    os.remove(contigsFile)
+
+    # Cut the ordered sequences into runs holding about the same number of alignments
+    totalAlignments = sum(alignmentCounts.values())
+    contigShards = {}
+    shard = 0
+    alignmentsSoFar = 0
+    for contig in contigs:
+        contigShards[contig] = shard
+        alignmentsSoFar += alignmentCounts[contig]
+        if alignmentsSoFar * numShards >= (shard + 1) * totalAlignments and shard < numShards - 1:
+            shard += 1
+    shardFiles = [getTempFile() for i in xrange(max(contigShards.values()) + 1)] if len(contigShards) > 0 else []
+
+    shardFileHandles = [open(shardFile, 'w') for shardFile in shardFiles]
+    process = cactus_call(parameters=inputCommand, server=True, check_output=True)
+    try:
+        for line in process.stdout:
+            shardFileHandles[contigShards[getTargetContig(line)]].write(line)
+    finally:
+        for fileHandle in shardFileHandles:
+            fileHandle.close()
+        if process.poll() is None:
+            process.stdout.close()
+        process.wait()
+    if process.returncode != 0:
+        raise RuntimeError("Command %s failed with exit code %s" % (inputCommand, process.returncode))
+    return shardFiles
+
+def rescoreAlignments(inputCommand, outputFiles, minimumMapQValue, maxAlignmentsPerSite, alpha, logLevel,
+                      sortMemory, sortTempDir):
+    """
+    Sort, split overlaps and calculate mapping qualities for the mirrored alignments the given
+    command outputs, writing the alignments of each rank to the corresponding output file. The sort
+    uses sortMemory bytes of memory, and keeps any temporary files in sortTempDir.
+    """
+    cactus_call(parameters=inputCommand +
+                [["sort", "-S", "%ib" % sortMemory, "-T", sortTempDir,
+                  "-k6,6", "-k7,7n", "-k8,8n"], # This sorts by coordinate
+                 ["uniq"], # This eliminates any annoying duplicates if lastz reports the alignment in both orientations
+                 ["cactus_splitAlignmentOverlaps", logLevel],
+                 ["cactus_calculateMappingQualities", logLevel, str(maxAlignmentsPerSite),
+                  str(minimumMapQValue), str(alpha)] + outputFiles])
+
 def mappingQualityRescoring(job, inputAlignmentFileID, 
-                            minimumMapQValue, maxAlignmentsPerSite, alpha, logLevel):
+                            minimumMapQValue, maxAlignmentsPerSite, alpha, logLevel, shards=1):
     """
     Function to rescore and filter alignments by calculating the mapping quality of sub-alignments
     
     Returns primary alignments and secondary alignments in two separate files.
+
+    If shards > 1, the alignments are split by sequence into that many shards, which are rescored
+    in parallel, one per core of the job. The job's memory, less BASE_MEMORY, is shared between the
+    sorts (see getMappingQualityRescoringMemory and getMappingQualityRescoringDisk).
     """
-    inputAlignmentFile = job.fileStore.readGlobalFile(inputAlignmentFileID)
+    # A copy of our own, which can be deleted once it has been mirrored
+    inputAlignmentFile = job.fileStore.readGlobalFile(inputAlignmentFileID, mutable=True)
     
-    job.fileStore.logToMaster("Input cigar file has %s lines" % countLines(inputAlignmentFile))
+    with open(inputAlignmentFile) as f:
+        if isBinaryAlignmentFile(f):
+            job.fileStore.logToMaster("Input binary alignments file is %s bytes" % os.path.getsize(inputAlignmentFile))
+        else:
+            job.fileStore.logToMaster("Input cigar file has %s lines" % countLines(inputAlignmentFile))
     
     # Get temporary file
     assert maxAlignmentsPerSite >= 1
     tempAlignmentFiles = [job.fileStore.getLocalTempFile() for i in xrange(maxAlignmentsPerSite)]
+    sortMemory = max(MIN_SORT_MEMORY, job.memory - BASE_MEMORY)
     
     # Mirror and orient alignments, sort, split overlaps and calculate mapping qualities
-    cactus_call(parameters=[["cat", inputAlignmentFile],
-                            ["cactus_mirrorAndOrientAlignments", logLevel],
-                            ["sort", "-k6,6", "-k7,7n", "-k8,8n"], # This sorts by coordinate
-                            ["uniq"], # This eliminates any annoying duplicates if lastz reports the alignment in both orientations
-                            ["cactus_splitAlignmentOverlaps", logLevel],
-                            ["cactus_calculateMappingQualities", logLevel, str(maxAlignmentsPerSite),
-                             str(minimumMapQValue), str(alpha)] + tempAlignmentFiles])
+    mirrorCommand = [["cat", inputAlignmentFile],
+                     ["cactus_mirrorAndOrientAlignments", logLevel]]
+    shardFiles = None
+    if shards > 1:
+        shardFiles = shardAlignmentsByTargetContig(mirrorCommand, countAlignmentsBySequence(inputAlignmentFile),
+                                                   shards, job.fileStore.getLocalTempFile)
+        if shardFiles is None:
+            job.fileStore.logToMaster("Can't shard the alignments by sequence, so rescoring them in one go")
+    if shardFiles is None:
+        rescoreAlignments(mirrorCommand, tempAlignmentFiles,
+                          minimumMapQValue, maxAlignmentsPerSite, alpha, logLevel,
+                          sortMemory, job.fileStore.getLocalTempDir())
+        os.remove(inputAlignmentFile)
+    else:
+        os.remove(inputAlignmentFile)
+        job.fileStore.logToMaster("Rescoring the alignments in %s shards" % len(shardFiles))
+        shardAlignmentFiles = [[job.fileStore.getLocalTempFile() for i in xrange(maxAlignmentsPerSite)]
+                               for shardFile in shardFiles]
+        parallelShards = max(1, min(shards, len(shardFiles)))
+        def rescoreShard(i):
+            rescoreAlignments([["cat", shardFiles[i]]], shardAlignmentFiles[i],
+                              minimumMapQValue, maxAlignmentsPerSite, alpha, logLevel,
+                              max(MIN_SORT_MEMORY, sortMemory / parallelShards), job.fileStore.getLocalTempDir())
+            os.remove(shardFiles[i])
+        pool = ThreadPool(parallelShards)
+        try:
+            pool.map(rescoreShard, xrange(len(shardFiles)))
+        finally:
+            pool.close()
+            pool.join()
+        # The shards are in sort order, so the alignments of each rank can be concatenated
+        for i in xrange(maxAlignmentsPerSite):
+            catFiles([outputFiles[i] for outputFiles in shardAlignmentFiles], tempAlignmentFiles[i])
+            for outputFiles in shardAlignmentFiles:
+                os.remove(outputFiles[i])
 
     # Merge together the output files in order
     secondaryTempAlignmentFile = job.fileStore.getLocalTempFile()
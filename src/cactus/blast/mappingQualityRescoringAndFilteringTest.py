@@ -7,7 +7,9 @@ from sonLib.bioio import getTempFile, getTempDirectory, system
 from textwrap import dedent
 from cactus.shared.common import cactus_call, runSelfLastz
 from cactus.shared.test import getCactusInputs_encode, silentOnSuccess
-from cactus.blast.mappingQualityRescoringAndFiltering import mappingQualityRescoring
+from cactus.blast.mappingQualityRescoringAndFiltering import mappingQualityRescoring, \
+    shardAlignmentsByTargetContig, getTargetContig, countLines, countAlignmentsBySequence
+from cactus.blast.binaryAlignments import convertAlignments
 from cactus.shared.common import makeURL
 
 from cactus.shared.test import getCactusInputs_evolverMammals
@@ -311,7 +313,56 @@ class TestCase(unittest.TestCase):
         
         self.assertEqual(self.filteredSortedNonOverlappingInputCigars, outputCigars)
         
-    def runToilPipeline(self, alignmentsFile, alpha=0.001):
+    def testShardAlignmentsByTargetContig(self):
+        """
+        Tests that sorting each shard and concatenating them gives the same as sorting the whole.
+        """
+        random.seed(1)
+        contigs = [ "seq%s" % i for i in xrange(20) ] + [ "Seq", "seq_1", "seq.1", "SEQ10" ]
+        cigars = []
+        for i in xrange(1000):
+            start = random.randint(0, 1000)
+            cigars.append(self.makeCigar((random.choice(contigs), start, start + 10, '+'),
+                                         (random.choice(contigs), 0, 10, '+'), random.randint(1, 100), ('M', 10)) + "\n")
+        with open(self.simpleInputCigarPath, 'w') as fH:
+            fH.writelines(cigars)
+
+        alignmentCounts = countAlignmentsBySequence(self.simpleInputCigarPath)
+        for numShards in [ 1, 3, 50 ]:
+            shardFiles = shardAlignmentsByTargetContig([["cat", self.simpleInputCigarPath]], alignmentCounts,
+                                                       numShards, lambda: getTempFile(rootDir=self.tempDir))
+            self.assertTrue(0 < len(shardFiles) <= numShards)
+            shardedCigars = []
+            shardContigs = []
+            for shardFile in shardFiles:
+                shardedCigars.append(cactus_call(parameters=["sort", "-k6,6", "-k7,7n", "-k8,8n", shardFile],
+                                                 check_output=True))
+                with open(shardFile, 'r') as fh:
+                    shardContigs.append(set(getTargetContig(cigar) for cigar in fh))
+            # Each sequence is in one shard
+            self.assertEqual(sum(map(len, shardContigs)), len(set.union(*shardContigs)))
+            self.assertEqual("".join(shardedCigars),
+                             cactus_call(parameters=["sort", "-k6,6", "-k7,7n", "-k8,8n", self.simpleInputCigarPath],
+                                         check_output=True))
+        # The shards are about the same size
+        self.assertTrue(all(200 < countLines(shardFile) < 500 for shardFile in
+                            shardAlignmentsByTargetContig([["cat", self.simpleInputCigarPath]], alignmentCounts, 3,
+                                                          lambda: getTempFile(rootDir=self.tempDir))))
+
+    def testCountAlignmentsBySequence(self):
+        """
+        Tests that each alignment is counted on both its sequences, whether in text or binary cigars.
+        """
+        expectedCounts = {}
+        for cigar in self.inputCigars:
+            for name in (cigar.split()[1], cigar.split()[5]):
+                expectedCounts[name] = expectedCounts.get(name, 0) + 1
+        self.assertEqual(countAlignmentsBySequence(self.simpleInputCigarPath), expectedCounts)
+        binaryAlignmentsPath = os.path.join(self.tempDir, "alignments.bin")
+        convertAlignments(self.simpleInputCigarPath, binaryAlignmentsPath, True)
+        self.assertEqual(countAlignmentsBySequence(binaryAlignmentsPath), expectedCounts)
+
+    def runToilPipeline(self, alignmentsFile, alpha=0.001, shards=1):
         # Tests the toil pipeline        
         options = Job.Runner.getDefaultOptions(os.path.join(self.tempDir, "toil"))
         options.logLevel = self.logLevelString
@@ -321,7 +372,8 @@ class TestCase(unittest.TestCase):
             inputAlignmentFileID = toil.importFile(makeURL(alignmentsFile))
             
             rootJob = Job.wrapJobFn(mappingQualityRescoring, inputAlignmentFileID,
-                                    minimumMapQValue=0, maxAlignmentsPerSite=1, alpha=alpha, logLevel=self.logLevelString)
+                                    minimumMapQValue=0, maxAlignmentsPerSite=1, alpha=alpha, logLevel=self.logLevelString,
+                                    shards=shards)
             
             primaryOutputAlignmentsFileID, secondaryOutputAlignmentsFileID = toil.start(rootJob)
             toil.exportFile(primaryOutputAlignmentsFileID, makeURL(self.simpleOutputCigarPath))
@@ -344,6 +396,15 @@ class TestCase(unittest.TestCase):
         outputCigars = self.runToilPipeline(self.simpleInputCigarPath, alpha=1.0)
         
         self.assertEqual(self.filteredSortedNonOverlappingInputCigars, outputCigars)
+
+    @silentOnSuccess
+    def testShardedMappingQualityRescoringAndFiltering(self):
+        """
+        Tests that the complete pipeline gives the same output with the alignments split into shards.
+        """
+        for shards in [ 2, 3, 100 ]:
+            outputCigars = self.runToilPipeline(self.simpleInputCigarPath, alpha=1.0, shards=shards)
+            self.assertEqual(self.filteredSortedNonOverlappingInputCigars, outputCigars)
     
     def alignAndRunPipeline(self, concatenatedSequenceFile):
         # Run lastz
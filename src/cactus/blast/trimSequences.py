@@ -1,56 +1,133 @@
 #!/usr/bin/env python
+from bisect import bisect_right
 from collections import defaultdict
 from operator import itemgetter
 
+def _depthSteps(blocks):
+    """Get the step function giving the number of covering blocks at
+    each base as two parallel lists (positions, cumulativeCoverage,
+    depths): depths[k] is the depth on [positions[k],
+    positions[k+1]) and cumulativeCoverage[k] is the summed depth of
+    all bases before positions[k]."""
+    deltas = defaultdict(int)
+    for block in blocks:
+        if block[2] >= 1 and block[1] > block[0]:
+            deltas[block[0]] += 1
+            deltas[block[1]] -= 1
+    positions = [0]
+    cumulativeCoverage = [0]
+    depths = [0]
+    for position in sorted(deltas):
+        if deltas[position] == 0:
+            continue
+        cumulativeCoverage.append(cumulativeCoverage[-1] + depths[-1] * (position - positions[-1]))
+        positions.append(position)
+        depths.append(depths[-1] + deltas[position])
+    return positions, cumulativeCoverage, depths
+
+def _windowThreshold(windowSize, threshold):
+    """Get the smallest summed depth that a window must have for
+    (depth / float(windowSize)) >= threshold to hold, so that the
+    window test can be done in integer arithmetic."""
+    minScore = max(int(threshold * windowSize), 0)
+    while minScore > 0 and (minScore - 1) / float(windowSize) >= threshold:
+        minScore -= 1
+    while minScore / float(windowSize) < threshold:
+        minScore += 1
+    return minScore
+
+def windowFilterContig(windowSize, threshold, blocks, seqLength):
+    """Get the regions of a single contig in which the fraction of a
+    sliding window covered by blocks is at least threshold.
+
+    The window score is piecewise linear in the window position, only
+    changing slope where either edge of the window crosses a block
+    boundary, so rather than scanning every base this walks the
+    O(len(blocks)) breakpoints and solves for the crossings directly.
+    """
+    positions, cumulativeCoverage, depths = _depthSteps(blocks)
+
+    def depth(x):
+        return depths[bisect_right(positions, x) - 1]
+
+    def coverage(x):
+        # Summed depth of bases [0, x)
+        k = bisect_right(positions, x) - 1
+        return cumulativeCoverage[k] + depths[k] * (x - positions[k])
+
+    minScore = _windowThreshold(windowSize, threshold)
+    breakpoints = set([0, seqLength])
+    for position in positions:
+        for i in (position, position - windowSize):
+            if 0 < i < seqLength:
+                breakpoints.add(i)
+    breakpoints = sorted(breakpoints)
+
+    ret = []
+    inRegion = False
+    regionStart = 0
+    for start, end in zip(breakpoints, breakpoints[1:]):
+        # The window score is score + slope * (i - start) for i in [start, end).
+        score = coverage(start + windowSize) - coverage(start)
+        slope = depth(start + windowSize) - depth(start)
+        i = start
+        while i < end:
+            # Find the next position in the segment at which the
+            # window crosses the threshold, if any.
+            current = score + slope * (i - start)
+            if not inRegion:
+                if current < minScore:
+                    if slope <= 0:
+                        break
+                    i += (minScore - current + slope - 1) // slope
+                    if i >= end:
+                        break
+                regionStart = i
+                inRegion = True
+            else:
+                if current >= minScore:
+                    if slope >= 0:
+                        break
+                    i += (current - minScore) // -slope + 1
+                    if i >= end:
+                        break
+                ret.append((regionStart, i + windowSize - 1))
+                inRegion = False
+    return ret
+
 def windowFilter(windowSize, threshold, blockDict, seqLengths):
     if windowSize == 1 and threshold == 1:
         # Don't need to do expensive window-filtering
         return blockDict
     ret = defaultdict(list)
     for seq, blocks in blockDict.items():
-        curBlock = 0
-        inRegion = False
-        regionStart = 0
-        for i in xrange(seqLengths[seq]):
-            score = 0
-            while curBlock < len(blocks) and blocks[curBlock][1] < i:
-                curBlock += 1
-            for blockNum in xrange(curBlock, len(blocks)):
-                block = blocks[blockNum]
-                if block[0] > i + windowSize:
-                    break
-                size = min(block[1], i + windowSize) - max(i, block[0])
-                if block[2] >= 1:
-                    score += size
-            score /= float(windowSize)
-            if score >= threshold and not inRegion:
-                regionStart = i
-                inRegion = True
-            elif score < threshold and inRegion:
-                ret[seq].append((regionStart, i + windowSize - 1))
-                inRegion = False
+        ret[seq] = windowFilterContig(windowSize, threshold, blocks, seqLengths[seq])
     return ret
 
-def uniquifyBlocks(blocksDict, mergeDistance):
+def uniquifyContigBlocks(blocks, mergeDistance):
     """Take list of blocks and return sorted list of non-overlapping and
     blocks (merging blocks that are mergeDistance or less apart)."""
-    ret = defaultdict(list)
-    for chr, blocks in blocksDict.items():
-        blocks = sorted(blocks, key=itemgetter(0))
-        newBlocks = []
-        prevBlock = None
-        for block in blocks:
-            if prevBlock is None:
+    blocks = sorted(blocks, key=itemgetter(0))
+    newBlocks = []
+    prevBlock = None
+    for block in blocks:
+        if prevBlock is None:
+            prevBlock = block
+        else:
+            if prevBlock[1] < block[0] - mergeDistance:
+                newBlocks.append(prevBlock)
                 prevBlock = block
             else:
-                if prevBlock[1] < block[0] - mergeDistance:
-                    newBlocks.append(prevBlock)
-                    prevBlock = block
-                else:
-                    prevBlock = (prevBlock[0], block[1])
-        if prevBlock is not None:
-            newBlocks.append(prevBlock)
-        ret[chr] = newBlocks
+                prevBlock = (prevBlock[0], block[1])
+    if prevBlock is not None:
+        newBlocks.append(prevBlock)
+    return newBlocks
+
+def uniquifyBlocks(blocksDict, mergeDistance):
+    """Apply uniquifyContigBlocks to every sequence in a block-dict."""
+    ret = defaultdict(list)
+    for chr, blocks in blocksDict.items():
+        ret[chr] = uniquifyContigBlocks(blocks, mergeDistance)
     return ret
 
 def getSeparateBedBlocks(bedFile, depth=1):
@@ -100,71 +177,102 @@ def getSeqLengths(fastaFile):
             ret[chr] += len(line)
     return ret
 
+def complementContigBlocks(blocks, seqLength):
+    """Complement a sorted list of blocks on a single sequence."""
+    ret = []
+    start = 0
+    for block in blocks:
+        ret.append((start, block[0]))
+        start = block[1]
+    if start != seqLength:
+        ret.append((start, seqLength))
+    return ret
+
 def complementBlocks(blocksDict, seqLengths):
     """Complement a sorted block-dict."""
     ret = defaultdict(list)
     for chr, blocks in blocksDict.items():
-        len = seqLengths[chr]
-        start = 0
-        for block in blocks:
-            ret[chr].append((start, block[0]))
-            start = block[1]
-        if start != len:
-            ret[chr].append((start, len))
+        ret[chr] = complementContigBlocks(blocks, seqLengths[chr])
     # Add in blocks for the sequences that aren't covered at all.
     for chr, len in seqLengths.items():
         if chr not in ret: # This still works with defaultdicts
             ret[chr].append((0, len))
     return ret
 
-def printTrimmedSeq(header, seq, blocks, outFile):
-    for block in blocks:
-        outFile.write(">%s|%d\n" % (header, block[0]))
-        outFile.write(seq[block[0]:block[1]])
-        outFile.write("\n")
-
-def printTrimmedFasta(fastaFile, toTrim, outFile):
+def readFastaContigs(fastaFile):
+    """Iterate over (header, sequence) pairs in a fasta file, holding
+    only one sequence in memory at a time."""
     header = None
-    seq = None
+    lines = []
     for line in fastaFile:
         line = line.strip()
         if len(line) == 0:
             # Blank line
             continue
         if line[0] == '>':
-            if seq is not None:
-                printTrimmedSeq(header, seq, toTrim[header], outFile)
-            seq = ""
+            if header is not None:
+                yield header, "".join(lines)
             header = line[1:].split()[0]
+            lines = []
             continue
-        seq += line
-    if seq is not None:
+        lines.append(line)
+    if header is not None:
+        yield header, "".join(lines)
+
+def printTrimmedSeq(header, seq, blocks, outFile):
+    for block in blocks:
+        outFile.write(">%s|%d\n" % (header, block[0]))
+        outFile.write(seq[block[0]:block[1]])
+        outFile.write("\n")
+
+def printTrimmedFasta(fastaFile, toTrim, outFile):
+    for header, seq in readFastaContigs(fastaFile):
         printTrimmedSeq(header, seq, toTrim[header], outFile)
 
-def trimSequences(fastaPath, bedPath, outputPathOrFile, flanking=0, minSize=0,
-                  windowSize=10, threshold=0.8, depth=1, complement=False):
-    fastaFile = open(fastaPath)
-    seqLengths = getSeqLengths(fastaFile)
-    with open(bedPath) as bedFile:
-        toTrim = windowFilter(windowSize, threshold,
-                              getSeparateBedBlocks(bedFile, depth), seqLengths)
+def trimContig(blocks, seqLength, flanking=0, minSize=0, windowSize=10,
+               threshold=0.8, complement=False):
+    """Get the regions of a single sequence to keep, given the (start,
+    stop, score) blocks from the bed file that lie on it."""
+    if windowSize != 1 or threshold != 1:
+        blocks = windowFilterContig(windowSize, threshold, blocks, seqLength)
     if complement:
-        toTrim = complementBlocks(toTrim, seqLengths)
-    toTrim = uniquifyBlocks(toTrim, 2*flanking)
+        blocks = complementContigBlocks(blocks, seqLength)
+    blocks = uniquifyContigBlocks(blocks, 2*flanking)
     # filter based on size
-    toTrim.update((k, filter(lambda x: (x[1] - x[0]) >= minSize, v))
-                  for k, v in toTrim.items())
+    blocks = filter(lambda x: (x[1] - x[0]) >= minSize, blocks)
     # extend blocks to include flanking regions
-    toTrim.update((k, map(lambda x: (max(x[0] - flanking, 0),
-                                     min(x[1] + flanking, seqLengths[k])),
-                          v))
-                  for k, v in toTrim.items())
+    return map(lambda x: (max(x[0] - flanking, 0),
+                          min(x[1] + flanking, seqLength)),
+               blocks)
+
+def trimSequences(fastaPath, bedPath, outputPathOrFile, flanking=0, minSize=0,
+                  windowSize=10, threshold=0.8, depth=1, complement=False):
+    """Write the regions of the sequences in fastaPath that are covered
+    (or, if complement is set, not covered) by the bed file.
 
-    fastaFile.seek(0)
+    The fasta is streamed through a sequence at a time, so only the
+    bed blocks and the largest single sequence are ever held in
+    memory. bedPath can also be a dict of sequence -> [(start, stop,
+    score)] blocks already in memory, such as from a CoverageMap.
+    """
+    if isinstance(bedPath, dict):
+        blockDict = dict((chr, [block for block in blocks if block[2] >= depth])
+                         for chr, blocks in bedPath.items())
+    else:
+        with open(bedPath) as bedFile:
+            blockDict = getSeparateBedBlocks(bedFile, depth)
     try:
         outputPathOrFile.write('')
         outputFile = outputPathOrFile
     except:
         # Not a file
         outputFile = open(outputPathOrFile, 'w')
-    printTrimmedFasta(fastaFile, toTrim, outputFile)
+    with open(fastaPath) as fastaFile:
+        for header, seq in readFastaContigs(fastaFile):
+            if header not in blockDict and not complement:
+                continue
+            toTrim = trimContig(blockDict.get(header, []), len(seq),
+                                flanking=flanking, minSize=minSize,
+                                windowSize=windowSize, threshold=threshold,
+                                complement=complement)
+            printTrimmedSeq(header, seq, toTrim, outputFile)
@@ -1,9 +1,10 @@
 import unittest
+import random
 from StringIO import StringIO
 from textwrap import dedent
 from sonLib.bioio import getTempFile
 from cactus.shared.test import silentOnSuccess
-from cactus.blast.trimSequences import trimSequences
+from cactus.blast.trimSequences import trimSequences, windowFilterContig
 import os
 
 class TestCase(unittest.TestCase):
@@ -109,5 +110,44 @@ class TestCase(unittest.TestCase):
         >seq1|15
         G''') in output.getvalue())
 
+    @silentOnSuccess
+    def testWindowing(self):
+        output = StringIO()
+        trimSequences(self.faPath, self.bedPath, output, flanking=0, minSize=0, windowSize=10, threshold=0.5)
+        # Only the first two blocks are dense enough to pass the
+        # window filter.
+        self.assertTrue(dedent('''\
+        >seq1|0
+        CATGCATGCATGCA''') in output.getvalue())
+        self.assertTrue(">seq1|15" not in output.getvalue())
+
+    @silentOnSuccess
+    def testWindowFilterMatchesNaiveScan(self):
+        def naiveWindowFilter(windowSize, threshold, blocks, seqLength):
+            ret = []
+            inRegion = False
+            for i in xrange(seqLength):
+                score = 0
+                for start, end, _ in blocks:
+                    score += max(0, min(end, i + windowSize) - max(start, i))
+                if score / float(windowSize) >= threshold and not inRegion:
+                    regionStart = i
+                    inRegion = True
+                elif score / float(windowSize) < threshold and inRegion:
+                    ret.append((regionStart, i + windowSize - 1))
+                    inRegion = False
+            return ret
+        random.seed(0)
+        for _ in xrange(500):
+            seqLength = random.randint(1, 300)
+            blocks = []
+            for _ in xrange(random.randint(0, 10)):
+                start = random.randint(0, seqLength - 1)
+                blocks.append((start, min(seqLength, start + random.randint(1, 40)), 1))
+            windowSize = random.randint(1, 20)
+            threshold = random.choice([0.1, 0.5, 0.8, 1, 1.5])
+            self.assertEqual(windowFilterContig(windowSize, threshold, blocks, seqLength),
+                             naiveWindowFilter(windowSize, threshold, blocks, seqLength))
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 from argparse import ArgumentParser
+from bisect import bisect_right
 from collections import defaultdict
 import sys
 import os
-from sonLib.bioio import cigarRead, cigarWrite, getTempFile, system
+from sonLib.bioio import PairwiseAlignment, AlignmentOperation
+from cactus.blast.binaryAlignments import isBinaryAlignmentFile, readAlignments, AlignmentWriter
 
 def getSequenceRanges(fa):
     """Get dict of (untrimmed header) -> [(start, non-inclusive end)] mappings
@@ -53,58 +55,148 @@ def validateRanges(seqRanges):
                 range2 = ranges[i + 1]
                 assert start < range2[0]
 
-def sortCigarByContigAndPos(cigarPath, contigNum):
-    contigNameKey = 2 if contigNum == 1 else 6
-    startPosKey = 3 if contigNum == 1 else 7
-    tempFile = getTempFile()
-    system("sort -k %d,%d -k %d,%dn %s > %s" % (contigNameKey, contigNameKey, startPosKey, startPosKey, cigarPath, tempFile))
-    return tempFile
+def findRange(ranges, starts, pos):
+    """Get the range holding pos, given the sorted, non-overlapping
+    ranges of a sequence and their starts, or None if there isn't one."""
+    i = bisect_right(starts, pos) - 1
+    if i >= 0 and pos < ranges[i][1]:
+        return ranges[i]
+    return None
 
-def upconvertCoords(cigarPath, fastaPath, contigNum, outputFile):
+def findOverlappingRanges(ranges, starts, minPos, maxPos):
+    """Get the ranges overlapping [minPos, maxPos), given the sorted,
+    non-overlapping ranges of a sequence and their starts."""
+    i = max(bisect_right(starts, minPos) - 1, 0)
+    overlapping = []
+    while i < len(ranges) and ranges[i][0] < maxPos:
+        if ranges[i][1] > minPos:
+            overlapping.append(ranges[i])
+        i += 1
+    return overlapping
+
+def clipAlignment(alignment, contigNum, rangeStart, rangeEnd):
+    """Clip an alignment to the part of it lying on [rangeStart, rangeEnd)
+    of its contig given by contigNum (as upconvertCoords takes it), by
+    trimming the cigar operations to those on the range and dropping any
+    gaps left at either end. The score is scaled by the fraction of
+    matched bases kept. Returns None if no bases are aligned on the
+    range.
+    """
+    MATCH = PairwiseAlignment.PAIRWISE_MATCH
+    # contig1 and contig2 are reversed in python api!!
+    if contigNum == 1:
+        start, strand, otherStart, otherStrand = alignment.start2, alignment.strand2, alignment.start1, alignment.strand1
+        otherGap = PairwiseAlignment.PAIRWISE_INDEL_X
+    else:
+        start, strand, otherStart, otherStrand = alignment.start1, alignment.strand1, alignment.start2, alignment.strand2
+        otherGap = PairwiseAlignment.PAIRWISE_INDEL_Y
+    # The range, as offsets along the contig from the alignment's start
+    if strand:
+        lo, hi = rangeStart - start, rangeEnd - start
+    else:
+        lo, hi = start - rangeEnd, start - rangeStart
+
+    # The kept operations, as (type, length, offset on the contig,
+    # offset on the other contig)
+    kept = []
+    offset = otherOffset = 0
+    for op in alignment.operationList:
+        if op.type == otherGap:
+            if lo < offset < hi:
+                kept.append((op.type, op.length, offset, otherOffset))
+            otherOffset += op.length
+            continue
+        clipStart, clipEnd = max(offset, lo), min(offset + op.length, hi)
+        if clipStart < clipEnd:
+            kept.append((op.type, clipEnd - clipStart, clipStart,
+                         otherOffset + clipStart - offset if op.type == MATCH else otherOffset))
+        offset += op.length
+        if op.type == MATCH:
+            otherOffset += op.length
+    while len(kept) > 0 and kept[0][0] != MATCH:
+        kept.pop(0)
+    while len(kept) > 0 and kept[-1][0] != MATCH:
+        kept.pop()
+    if len(kept) == 0:
+        return None
+
+    def toPos(start, strand, offset):
+        return start + offset if strand else start - offset
+    newStart, newEnd = toPos(start, strand, kept[0][2]), toPos(start, strand, kept[-1][2] + kept[-1][1])
+    newOtherStart = toPos(otherStart, otherStrand, kept[0][3])
+    newOtherEnd = toPos(otherStart, otherStrand, kept[-1][3] + kept[-1][1])
+    matched = sum(op.length for op in alignment.operationList if op.type == MATCH)
+    score = alignment.score * sum(length for opType, length, _, _ in kept if opType == MATCH) / matched
+    ops = [AlignmentOperation(opType, length, 0.0) for opType, length, _, _ in kept]
+    if contigNum == 1:
+        return PairwiseAlignment(alignment.contig1, newOtherStart, newOtherEnd, alignment.strand1,
+                                 alignment.contig2, newStart, newEnd, alignment.strand2, score, ops)
+    return PairwiseAlignment(alignment.contig1, newStart, newEnd, alignment.strand1,
+                             alignment.contig2, newOtherStart, newOtherEnd, alignment.strand2, score, ops)
+
+def moveToRange(alignment, contigNum, contig, currentRange):
+    """Shift an alignment on contig onto the trimmed sequence of contig
+    starting at the given range."""
+    if contigNum == 1:
+        alignment.start2 -= currentRange[0]
+        alignment.end2 -= currentRange[0]
+        alignment.contig2 = contig + ("|%d" % currentRange[0])
+    else:
+        alignment.start1 -= currentRange[0]
+        alignment.end1 -= currentRange[0]
+        alignment.contig1 = contig + ("|%d" % currentRange[0])
+    return alignment
+
+def upconvertCoords(cigarPath, fastaPath, contigNum, outputFile,
+                    clipUncontained=False):
     """Convert the coordinates of the given alignment, so that the
     alignment refers to a set of trimmed sequences originating from a
-    contig rather than to the contig itself."""
+    contig rather than to the contig itself.
+
+    Normally every alignment must lie within a trimmed sequence. If
+    clipUncontained is set, alignments that don't are instead clipped
+    to each trimmed sequence they overlap (see clipAlignment), and left
+    out if they overlap none.
+
+    The alignments can be binary or text cigars, and are written in the
+    same format, in the order they were read.
+    """
     with open(fastaPath) as f:
         seqRanges = getSequenceRanges(f)
     validateRanges(seqRanges)
-    sortedCigarPath = sortCigarByContigAndPos(cigarPath, contigNum)
-    sortedCigarFile = open(sortedCigarPath)
+    rangeStarts = dict((contig, [start for start, _ in ranges]) for contig, ranges in seqRanges.items())
 
-    currentContig = None
-    currentRangeIdx = None
-    currentRange = None
-    for alignment in cigarRead(sortedCigarFile):
-        # contig1 and contig2 are reversed in python api!!
-        contig = alignment.contig2 if contigNum == 1 else alignment.contig1
-        minPos = min(alignment.start2, alignment.end2) if contigNum == 1 else min(alignment.start1, alignment.end1)
-        maxPos = max(alignment.start2, alignment.end2) if contigNum == 1 else max(alignment.start1, alignment.end1)
-        if contig in seqRanges:
-            if contig != currentContig:
-                currentContig = contig
-                currentRangeIdx = 0
-                currentRange = seqRanges[contig][0]
-            while (minPos >= currentRange[1] or minPos < currentRange[0]) and currentRangeIdx < len(seqRanges[contig]) - 1:
-                currentRangeIdx += 1
-                currentRange = seqRanges[contig][currentRangeIdx]
-            if currentRange[0] <= minPos < currentRange[1]:
-                if maxPos - 1 > currentRange[1]:
-                    raise RuntimeError("alignment on %s:%d-%d crosses "
-                                       "trimmed sequence boundary" %\
-                                       (contig,
-                                        minPos,
-                                        maxPos))
-                if contigNum == 1:
-                    alignment.start2 -= currentRange[0]
-                    alignment.end2 -= currentRange[0]
-                    alignment.contig2 = contig + ("|%d" % currentRange[0])
-                else:
-                    alignment.start1 -= currentRange[0]
-                    alignment.end1 -= currentRange[0]
-                    alignment.contig1 = contig + ("|%d" % currentRange[0])
-            else:
-                raise RuntimeError("No trimmed sequence containing alignment "
-                                   "on %s:%d-%d" % (contig,
-                                                    minPos,
-                                                    maxPos))
-        cigarWrite(outputFile, alignment, False)
-    os.remove(sortedCigarPath)
+    with open(cigarPath) as cigarFile:
+        binary = isBinaryAlignmentFile(cigarFile)
+        with AlignmentWriter(outputFile, binary) as writer:
+            for alignment in readAlignments(cigarFile):
+                # contig1 and contig2 are reversed in python api!!
+                contig = alignment.contig2 if contigNum == 1 else alignment.contig1
+                minPos = min(alignment.start2, alignment.end2) if contigNum == 1 else min(alignment.start1, alignment.end1)
+                maxPos = max(alignment.start2, alignment.end2) if contigNum == 1 else max(alignment.start1, alignment.end1)
+                if clipUncontained:
+                    for currentRange in findOverlappingRanges(seqRanges.get(contig, []), rangeStarts.get(contig, []),
+                                                              minPos, maxPos):
+                        if currentRange[0] <= minPos and maxPos <= currentRange[1]:
+                            clipped = alignment
+                        else:
+                            clipped = clipAlignment(alignment, contigNum, currentRange[0], currentRange[1])
+                        if clipped is not None:
+                            writer.write(moveToRange(clipped, contigNum, contig, currentRange))
+                    continue
+                if contig in seqRanges:
+                    currentRange = findRange(seqRanges[contig], rangeStarts[contig], minPos)
+                    if currentRange is not None:
+                        if maxPos - 1 > currentRange[1]:
+                            raise RuntimeError("alignment on %s:%d-%d crosses "
+                                               "trimmed sequence boundary" %\
+                                               (contig,
+                                                minPos,
+                                                maxPos))
+                        moveToRange(alignment, contigNum, contig, currentRange)
+                    else:
+                        raise RuntimeError("No trimmed sequence containing alignment "
+                                           "on %s:%d-%d" % (contig,
+                                                            minPos,
+                                                            maxPos))
+                writer.write(alignment)
@@ -0,0 +1,55 @@
+import unittest
+import os
+from StringIO import StringIO
+from textwrap import dedent
+from sonLib.bioio import getTempFile
+from cactus.shared.test import silentOnSuccess
+from cactus.blast.upconvertCoordinates import upconvertCoords
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.faPath = getTempFile()
+        open(self.faPath, 'w').write(dedent('''\
+        >seq|0
+        CATGCATGCA
+        >seq|20
+        ACTGACTGAC
+        '''))
+        self.cigarPath = getTempFile()
+
+    def tearDown(self):
+        os.remove(self.faPath)
+        os.remove(self.cigarPath)
+
+    def upconvert(self, cigars, clipUncontained=False):
+        open(self.cigarPath, 'w').write("\n".join(cigars) + "\n")
+        output = StringIO()
+        upconvertCoords(self.cigarPath, self.faPath, 2, output, clipUncontained=clipUncontained)
+        return output.getvalue().splitlines()
+
+    @silentOnSuccess
+    def testContainedAlignments(self):
+        self.assertEquals(self.upconvert(["cigar: other 0 5 + seq 2 7 + 5.000000 M 5",
+                                          "cigar: other 0 5 + seq 28 23 - 5.000000 M 5"]),
+                          ["cigar: other 0 5 + seq|0 2 7 + 5.000000 M 5",
+                           "cigar: other 0 5 + seq|20 8 3 - 5.000000 M 5"])
+        self.assertRaises(RuntimeError, self.upconvert, ["cigar: other 0 10 + seq 5 15 + 10.000000 M 10"])
+
+    @silentOnSuccess
+    def testClipUncontained(self):
+        # Alignments partly on the trimmed sequences are clipped to each
+        # of them, trimming the cigar operations and any gaps left at the
+        # ends, rather than dropped; those on neither are dropped.
+        self.assertEquals(self.upconvert(["cigar: other 100 120 + seq 5 25 + 18.000000 M 3 I 2 M 2 D 2 M 13",
+                                          "cigar: other 200 210 + seq 25 15 - 10.000000 M 10",
+                                          "cigar: other 300 305 + seq 12 17 + 5.000000 M 5",
+                                          "cigar: other 0 5 + seq 2 7 + 5.000000 M 5"],
+                                         clipUncontained=True),
+                          ["cigar: other 100 107 + seq|0 5 10 + 5.000000 M 3 I 2 M 2",
+                           "cigar: other 115 120 + seq|20 0 5 + 5.000000 M 5",
+                           "cigar: other 200 205 + seq|20 5 0 - 5.000000 M 5",
+                           "cigar: other 0 5 + seq|0 2 7 + 5.000000 M 5"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -18,6 +18,9 @@ import math
 import time
 import random
 import copy
+import traceback
+import threading
+from multiprocessing.pool import ThreadPool
 from argparse import ArgumentParser
 from operator import itemgetter
 
@@ -31,6 +34,7 @@ from sonLib.bioio import catFiles
 from sonLib.bioio import getLogLevelString
 
 from toil.job import Job
+from toil.job import PromisedRequirement
 from toil.common import Toil
 
 from cactus.shared.common import makeURL
@@ -44,6 +48,7 @@ from cactus.shared.common import runCactusExtendFlowers
 from cactus.shared.common import runCactusSplitFlowersBySecondaryGrouping
 from cactus.shared.common import encodeFlowerNames
 from cactus.shared.common import decodeFirstFlowerName
+from cactus.shared.common import decodeFlowerNames
 from cactus.shared.common import runCactusConvertAlignmentToCactus
 from cactus.shared.common import runCactusPhylogeny
 from cactus.shared.common import runCactusBar
@@ -53,17 +58,23 @@ from cactus.shared.common import runCactusAddReferenceCoordinates
 from cactus.shared.common import runCactusCheck
 from cactus.shared.common import runCactusHalGenerator
 from cactus.shared.common import runCactusFlowerStats
+from cactus.shared.common import addOverlargeFlowerStats
 from cactus.shared.common import runCactusSecondaryDatabase
 from cactus.shared.common import runCactusFastaGenerator
 from cactus.shared.common import findRequiredNode
 from cactus.shared.common import runConvertAlignmentsToInternalNames
 from cactus.shared.common import runStripUniqueIDs
+from cactus.shared.resourceModel import getFittedMemoryModel, evaluatePoly
+from cactus.shared.flowerGrouping import flowerGroupFeatures, packFlowers
 from cactus.shared.common import RoundedJob
 from cactus.shared.common import readGlobalFileWithoutCache
+from cactus.shared.common import exportFilesInBackground
 
 from cactus.blast.blast import BlastIngroupsAndOutgroups
 from cactus.blast.blast import BlastOptions
 from cactus.blast.mappingQualityRescoringAndFiltering import mappingQualityRescoring
+from cactus.blast.mappingQualityRescoringAndFiltering import getMappingQualityRescoringMemory
+from cactus.blast.mappingQualityRescoringAndFiltering import getMappingQualityRescoringDisk
 
 from cactus.preprocessor.cactus_preprocessor import CactusPreprocessor
 
@@ -71,7 +82,11 @@ from cactus.shared.experimentWrapper import ExperimentWrapper
 from cactus.shared.experimentWrapper import DbElemWrapper
 from cactus.shared.configWrapper import ConfigWrapper
 from cactus.pipeline.ktserverToil import KtServerService
-from cactus.pipeline.ktserverControl import stopKtserver
+from cactus.pipeline.ktserverControl import stopKtserver, blockUntil, applyKtserverTuning, KtClient
+from cactus.pipeline.ktserverLocal import localSnapshotDatabase, makeSnapshotDatabaseString, \
+    getSnapshotRequirements
+from cactus.pipeline.ktserverShards import getShardDbElems, connectShards
+from cactus.pipeline.ktserverSnapshots import SnapshotChain, captureDelta
 
 ############################################################
 ############################################################
@@ -94,9 +109,50 @@ def getJobNode(phaseNode, jobClass):
     assert className.isalnum()
     return phaseNode.find(className)
 
+def evaluateResourcePoly(jobClass, poly, features, feature=None):
+    """Evaluate a polynomial on the given feature of a job of the given
+    class, by default the job class's feature or else the total
+    sequence size."""
+    if feature is not None:
+        x = features[feature]
+    elif hasattr(jobClass, 'feature'):
+        x = features[jobClass.feature]
+    else:
+        x = features['totalSequenceSize']
+    resource = 0
+    for degree, coefficient in enumerate(reversed(poly)):
+        resource += coefficient * (x**degree)
+    return int(resource)
+
+def predictJobMemory(jobClass, features, configNode):
+    """Predict the memory a job of the given class (which must have a
+    memoryPoly) needs, given its resource features. Uses the model
+    fitted to previous runs by cactus_fitResourceModel if the config
+    has a usable one, and the job's hand-written memoryPoly otherwise.
+    """
+    fittedModel = getFittedMemoryModel(configNode, jobClass.__name__)
+    if fittedModel is not None and fittedModel[0] not in features:
+        # Fitted against a feature this job no longer reports
+        fittedModel = None
+    if fittedModel is not None:
+        feature, poly, safetyMargin = fittedModel
+        memory = (1 + safetyMargin)*evaluateResourcePoly(jobClass, poly, features, feature=feature)
+    else:
+        memory = 3*evaluateResourcePoly(jobClass, jobClass.memoryPoly, features)
+    if hasattr(jobClass, 'memoryCap'):
+        memory = int(min(memory, jobClass.memoryCap))
+    return memory
+
 class CactusJob(RoundedJob):
     """Base job for all cactus workflow jobs.
+
+    Jobs that set readsSnapshot read the DB snapshot of the workflow
+    arguments, if there is one (see getSnapshotDatabaseString), which
+    they open with localSnapshotDatabase. They also ask for the memory
+    and disk to serve their own copy of it.
     """
+    readsSnapshot = False
+
     def __init__(self, phaseNode, constantsNode, overlarge=False,
                  checkpoint=False, preemptable=True):
         self.phaseNode = phaseNode
@@ -110,10 +166,10 @@ class CactusJob(RoundedJob):
         cores = None
         if hasattr(self, 'memoryPoly'):
             # Memory should be determined by a polynomial fit on the
-            # input size
-            memory = 3*self.evaluateResourcePoly(self.memoryPoly)
-            if hasattr(self, 'memoryCap'):
-                memory = int(min(memory, self.memoryCap))
+            # input size, either learned from previous runs or the
+            # hand-written default.
+            memory = predictJobMemory(self.__class__, self.getResourceFeatures(),
+                                      self.cactusWorkflowArguments.configNode)
 
         disk = None
         if memory is None and overlarge:
@@ -126,22 +182,41 @@ class CactusJob(RoundedJob):
                                                default=getOptionalAttrib(self.constantsNode, "defaultMemory", int, default=sys.maxint))
             cores = self.getOptionalJobAttrib("cpu", typeFn=int,
                                               default=getOptionalAttrib(self.constantsNode, "defaultCpu", int, default=sys.maxint))
+        if self.readsSnapshot:
+            snapshotMemory, snapshotDisk = getSnapshotRequirements(self.getSnapshotDatabaseString())
+            if snapshotDisk > 0:
+                memory = min(sys.maxint, memory + snapshotMemory)
+                # On top of Toil's default 2G for the job's other files
+                disk = 2*1024**3 + snapshotDisk
         RoundedJob.__init__(self, memory=memory, cores=cores, disk=disk,
                             checkpoint=checkpoint, preemptable=preemptable)
 
-    def evaluateResourcePoly(self, poly):
-        """Evaluate a polynomial based on the total sequence size."""
+    def getCactusDiskDatabaseString(self):
+        """Get the conf string of the DB the job uses."""
+        if hasattr(self, 'cactusDiskDatabaseString'):
+            return self.cactusDiskDatabaseString
+        return self.cactusWorkflowArguments.cactusDiskDatabaseString
+
+    def getSnapshotDatabaseString(self):
+        """Get the conf string of the DB snapshot a job that sets
+        readsSnapshot reads, or else of the DB the job uses."""
+        snapshotDatabaseString = getattr(self.cactusWorkflowArguments, 'snapshotDatabaseString', None)
+        if self.readsSnapshot and snapshotDatabaseString is not None:
+            return snapshotDatabaseString
+        return self.getCactusDiskDatabaseString()
+
+    def getResourceFeatures(self):
+        """Get the features that the job's resource usage is predicted
+        from: the total sequence size, plus those from featuresFn."""
         features = {'totalSequenceSize': self.cactusWorkflowArguments.totalSequenceSize}
         if hasattr(self, 'featuresFn'):
             features.update(self.featuresFn())
-        if hasattr(self, 'feature'):
-            x = features[self.feature]
-        else:
-            x = features['totalSequenceSize']
-        resource = 0
-        for degree, coefficient in enumerate(reversed(poly)):
-            resource += coefficient * (x**degree)
-        return int(resource)
+        return features
+
+    def evaluateResourcePoly(self, poly, feature=None):
+        """Evaluate a polynomial based on the total sequence size, or on
+        the given feature."""
+        return evaluateResourcePoly(self.__class__, poly, self.getResourceFeatures(), feature=feature)
 
     def getOptionalPhaseAttrib(self, attribName, typeFn=None, default=None):
         """Gets an optional attribute of the phase node.
@@ -163,7 +238,7 @@ class CactusPhasesJob(CactusJob):
     """
     def __init__(self, cactusWorkflowArguments=None, phaseName=None, topFlowerName=0,
                  checkpoint=False, preemptable=True, halID=None,
-                 fastaID=None):
+                 fastaID=None, referenceID=None):
         self.phaseName = phaseName
         phaseNode = findRequiredNode(cactusWorkflowArguments.configNode, phaseName)
         constantsNode = findRequiredNode(cactusWorkflowArguments.configNode, "constants")
@@ -171,6 +246,7 @@ class CactusPhasesJob(CactusJob):
         self.topFlowerName = topFlowerName
         self.halID = halID
         self.fastaID = fastaID
+        self.referenceID = referenceID
         CactusJob.__init__(self, phaseNode=phaseNode, constantsNode=constantsNode, overlarge=False,
                            checkpoint=checkpoint, preemptable=preemptable)
 
@@ -185,9 +261,11 @@ class CactusPhasesJob(CactusJob):
 
         if launchSecondaryKtForRecursiveJob and ExperimentWrapper(self.cactusWorkflowArguments.experimentNode).getDbType() == "kyoto_tycoon":
             cw = ConfigWrapper(self.cactusWorkflowArguments.configNode)
-            memory = max(2500000000, 1.5*self.evaluateResourcePoly([4.10201882, 2.01324291e+08]))
             cpu = cw.getKtserverCpu(default=0.1)
             dbElem = ExperimentWrapper(self.cactusWorkflowArguments.scratchDbElemNode)
+            memory = applyKtserverTuning(dbElem, self.cactusWorkflowArguments.totalSequenceSize)
+            if memory is None:
+                memory = max(2500000000, 1.5*self.evaluateResourcePoly([4.10201882, 2.01324291e+08]))
             dbString = self.addService(KtServerService(dbElem=dbElem, isSecondary=True, memory=memory, cores=cpu)).rv(0)
             newChild.phaseNode.attrib["secondaryDatabaseString"] = dbString
             return self.addChild(newChild).rv()
@@ -196,7 +274,8 @@ class CactusPhasesJob(CactusJob):
 
     def makeFollowOnPhaseJob(self, job, phaseName):
         return self.addFollowOn(job(cactusWorkflowArguments=self.cactusWorkflowArguments, phaseName=phaseName, 
-                                    topFlowerName=self.topFlowerName, halID=self.halID, fastaID=self.fastaID)).rv()
+                                    topFlowerName=self.topFlowerName, halID=self.halID, fastaID=self.fastaID,
+                                    referenceID=self.referenceID)).rv()
 
     def runPhase(self, recursiveJob, nextPhaseJob, nextPhaseName, doRecursion=True, launchSecondaryKtForRecursiveJob=False):
         """
@@ -208,13 +287,24 @@ class CactusPhasesJob(CactusJob):
             self.makeRecursiveChildJob(recursiveJob, launchSecondaryKtForRecursiveJob)
         return self.makeFollowOnPhaseJob(job=nextPhaseJob, phaseName=nextPhaseName)
 
-    def makeFollowOnCheckpointJob(self, checkpointConstructor, phaseName, ktServerDump=None):
+    def makeFollowOnCheckpointJob(self, checkpointConstructor, phaseName, savedPrimaryDB=None):
         """Add a follow-on checkpoint phase."""
         return self.addFollowOn(checkpointConstructor(\
-                   phaseName=phaseName, ktServerDump=ktServerDump,
+                   phaseName=phaseName, savedPrimaryDB=savedPrimaryDB,
                    cactusWorkflowArguments=self.cactusWorkflowArguments,
                    topFlowerName=self.topFlowerName,
-                   halID=self.halID, fastaID=self.fastaID)).rv()
+                   halID=self.halID, fastaID=self.fastaID,
+                   referenceID=self.referenceID)).rv()
+
+    def useLocalSnapshots(self):
+        """Should the reference extraction and fasta generation read the DB
+        from job-local copies of its last snapshot (see ktserverLocal)
+        rather than the live server?"""
+        # A sharded DB has a snapshot per shard, which would need a
+        # local server each.
+        configWrapper = ConfigWrapper(self.cactusWorkflowArguments.configNode)
+        return configWrapper.getKtserverLocalSnapshots() and configWrapper.getKtserverShards() == 1 and \
+            ExperimentWrapper(self.cactusWorkflowArguments.experimentNode).getDbType() == "kyoto_tycoon"
 
     def getPhaseNumber(self):
         return len(self.cactusWorkflowArguments.configNode.findall(self.phaseNode.tag))
@@ -244,14 +334,31 @@ class CactusCheckpointJob(CactusPhasesJob):
     Meant to provide a restore point in case of pipeline failure. Note
     that the checkpointed job is technically this job's child, which
     starts the database.
+
+    savedPrimaryDB is what SavePrimaryDB returned at the end of the
+    previous phases: the DB snapshot, and the exports of it still to
+    be done.
     """
-    def __init__(self, ktServerDump=None, *args, **kwargs):
-        self.ktServerDump = ktServerDump
+    def __init__(self, savedPrimaryDB=None, *args, **kwargs):
+        self.savedPrimaryDB = savedPrimaryDB
         super(CactusCheckpointJob, self).__init__(*args, **kwargs)
 
+    @property
+    def ktServerDump(self):
+        if self.savedPrimaryDB is None:
+            return None
+        return self.savedPrimaryDB[0]
+
+    def exportSavedPrimaryDB(self):
+        """Export the snapshot of the previous phases to the intermediate
+        results URL in a side job, which runs alongside this phase."""
+        if self.savedPrimaryDB is not None:
+            exportFilesInBackground(self, self.savedPrimaryDB[1])
+
     def runPhaseWithPrimaryDB(self, jobConstructor):
         """Start and load a new primary DB before running the given phase.
         """
+        self.exportSavedPrimaryDB()
         job = jobConstructor(cactusWorkflowArguments=self.cactusWorkflowArguments,
                              phaseName=self.phaseName, topFlowerName=self.topFlowerName)
         startDBJob = StartPrimaryDB(job, ktServerDump=self.ktServerDump,
@@ -273,15 +380,34 @@ class StartPrimaryDB(CactusPhasesJob):
         cw = ConfigWrapper(self.cactusWorkflowArguments.configNode)
 
         if self.cactusWorkflowArguments.experimentWrapper.getDbType() == "kyoto_tycoon":
-            memory = max(2500000000, 1.5*self.evaluateResourcePoly([4.10201882, 2.01324291e+08]))
             cores = cw.getKtserverCpu(default=0.1)
             dbElem = ExperimentWrapper(self.cactusWorkflowArguments.experimentNode)
+            numShards = cw.getKtserverShards()
+            if numShards > 1:
+                return self.startShards(dbElem, numShards, cores)
+            # Size the DB by the snapshot from the previous phases too,
+            # if there is one.
+            memory = applyKtserverTuning(dbElem, self.cactusWorkflowArguments.totalSequenceSize,
+                                         snapshotSize=getattr(self.ktServerDump, 'size', None))
+            if memory is None:
+                memory = max(2500000000, 1.5*self.evaluateResourcePoly([4.10201882, 2.01324291e+08]))
+            ktServerDump = self.ktServerDump
+            incremental = cw.getKtserverIncrementalSnapshots() and not self.useLocalSnapshots()
+            if incremental and isinstance(ktServerDump, SnapshotChain) and \
+               len(ktServerDump.deltaIDs) < cw.getKtserverMaxSnapshotDeltas():
+                # Only the changes made from here on need saving
+                ktServerDump = ktServerDump.recordingDelta()
             service = self.addService(KtServerService(dbElem=dbElem,
-                                                      existingSnapshotID=self.ktServerDump,
+                                                      existingSnapshotID=ktServerDump,
                                                       isSecondary=False,
                                                       memory=memory, cores=cores))
             dbString = service.rv(0)
             snapshotID = service.rv(1)
+            if isinstance(ktServerDump, SnapshotChain) and ktServerDump.recording:
+                snapshotID = ktServerDump
+            elif incremental:
+                # A full snapshot, which starts a new chain
+                snapshotID = SnapshotChain(snapshotID)
             self.nextJob.cactusWorkflowArguments.cactusDiskDatabaseString = dbString
             # TODO: This part needs to be cleaned up
             self.nextJob.cactusWorkflowArguments.snapshotID = snapshotID
@@ -289,8 +415,56 @@ class StartPrimaryDB(CactusPhasesJob):
         else:
             return self.addFollowOn(self.nextJob).rv()
 
+    def startShards(self, dbElem, numShards, cores):
+        """Start a ktserver service for each shard of a sharded DB, which
+        all start at once, restoring each from its own snapshot if the
+        previous phases left one. The next job runs once they are joined
+        into one DB."""
+        ktServerDumps = self.ktServerDump
+        if ktServerDumps is None:
+            ktServerDumps = [None] * numShards
+        elif not isinstance(ktServerDumps, list) or len(ktServerDumps) != numShards:
+            raise RuntimeError("The DB snapshot from the previous phases doesn't have the %i shards "
+                               "the config asks for" % numShards)
+        # Each shard holds about 1/numShards of the DB.
+        snapshotSizes = [getattr(dump, 'size', None) for dump in ktServerDumps if dump is not None]
+        memory = applyKtserverTuning(dbElem, self.cactusWorkflowArguments.totalSequenceSize / numShards,
+                                     snapshotSize=max(snapshotSizes) if len(snapshotSizes) > 0 else None)
+        if memory is None:
+            memory = max(2500000000, 1.5*self.evaluateResourcePoly([4.10201882, 2.01324291e+08]) / numShards)
+        services = [self.addService(KtServerService(dbElem=DbElemWrapper(copy.deepcopy(dbElem.confElem)),
+                                                    existingSnapshotID=ktServerDump,
+                                                    isSecondary=False,
+                                                    memory=memory, cores=cores))
+                    for ktServerDump in ktServerDumps]
+        return self.addChild(ConnectPrimaryDBShards(self.nextJob,
+                                                    shardDatabaseStrings=[service.rv(0) for service in services],
+                                                    shardSnapshotIDs=[service.rv(1) for service in services],
+                                                    cactusWorkflowArguments=self.cactusWorkflowArguments,
+                                                    phaseName=self.phaseName,
+                                                    topFlowerName=self.topFlowerName)).rv()
+
+class ConnectPrimaryDBShards(CactusPhasesJob):
+    """Joins the running shards of a sharded primary DB into one DB,
+    then runs the next job on it."""
+    def __init__(self, nextJob, shardDatabaseStrings, shardSnapshotIDs, *args, **kwargs):
+        self.nextJob = nextJob
+        self.shardDatabaseStrings = shardDatabaseStrings
+        self.shardSnapshotIDs = shardSnapshotIDs
+        super(ConnectPrimaryDBShards, self).__init__(*args, **kwargs)
+
+    def run(self, fileStore):
+        dbElem = connectShards([DbElemWrapper(ET.fromstring(dbString)) for dbString in self.shardDatabaseStrings])
+        self.nextJob.cactusWorkflowArguments.cactusDiskDatabaseString = dbElem.getConfString()
+        self.nextJob.cactusWorkflowArguments.snapshotID = self.shardSnapshotIDs
+        return self.addChild(self.nextJob).rv()
+
 class SavePrimaryDB(CactusPhasesJob):
-    """Saves the DB to a file and clears the DB."""
+    """Saves the DB to a file and clears the DB.
+
+    Returns the snapshot, and the (file store ID, URL) pairs it is to be
+    exported as, which the next checkpoint exports in the background
+    rather than holding up the next phase while the files are copied."""
     def __init__(self, *args, **kwargs):
         super(SavePrimaryDB, self).__init__(*args, **kwargs)
 
@@ -299,29 +473,67 @@ class SavePrimaryDB(CactusPhasesJob):
                                      flowerName=0)
         fileStore.logToMaster("At end of %s phase, got stats %s" % (self.phaseName, stats))
         dbElem = DbElemWrapper(ET.fromstring(self.cactusWorkflowArguments.cactusDiskDatabaseString))
-        # Send the terminate message
-        stopKtserver(dbElem)
-        # Wait for the file to appear in the right place. This may take a while
-        while True:
-            with fileStore.readGlobalFileStream(self.cactusWorkflowArguments.snapshotID) as f:
-                if f.read(1) != '':
+        snapshotIDs = self.cactusWorkflowArguments.snapshotID
+        if isinstance(snapshotIDs, SnapshotChain):
+            if snapshotIDs.recording:
+                return self.saveDelta(fileStore, dbElem, snapshotIDs)
+            # The full snapshot starting a new chain
+            snapshotIDs = [snapshotIDs.baseID]
+        elif not isinstance(snapshotIDs, list):
+            snapshotIDs = [snapshotIDs]
+        # Send the terminate message, to every shard if the DB is
+        # sharded, so that they all save their snapshots at once.
+        for shardDbElem in getShardDbElems(dbElem):
+            stopKtserver(shardDbElem)
+        # Wait for the files to appear in the right place. This may take
+        # a while, but usually follows the servers' shutdown closely.
+        unwrittenSnapshotIDs = set(snapshotIDs)
+        def isSnapshotWritten():
+            for snapshotID in list(unwrittenSnapshotIDs):
+                with fileStore.readGlobalFileStream(snapshotID) as f:
                     # The file is no longer empty
-                    break
-            time.sleep(10)
-        # We have the file now
+                    if f.read(1) != '':
+                        unwrittenSnapshotIDs.remove(snapshotID)
+            return len(unwrittenSnapshotIDs) == 0
+        blockUntil(isSnapshotWritten, maxInterval=10)
+        # We have the files now
+        exports = []
         intermediateResultsUrl = getattr(self.cactusWorkflowArguments, 'intermediateResultsUrl', None)
         if intermediateResultsUrl is not None:
-            # The user requested to keep the DB dumps in a separate place. Export it there.
+            # The user requested to keep the DB dumps in a separate place. Export them there.
             url = intermediateResultsUrl + "-dump-" + self.phaseName
-            fileStore.exportFile(self.cactusWorkflowArguments.snapshotID, url)
-        return self.cactusWorkflowArguments.snapshotID
+            if len(snapshotIDs) == 1:
+                exports.append((snapshotIDs[0], url))
+            else:
+                for i, snapshotID in enumerate(snapshotIDs):
+                    exports.append((snapshotID, url + "-shard%i" % i))
+        return self.cactusWorkflowArguments.snapshotID, exports
+
+    def saveDelta(self, fileStore, dbElem, snapshotChain):
+        """Save the records changed since the DB was started as a delta
+        on the snapshot chain it was started from, and shut the DB down."""
+        deltaPath = fileStore.getLocalTempFile()
+        client = KtClient(dbElem)
+        try:
+            with open(deltaPath, "w") as deltaFile:
+                changedRecords = captureDelta(client, deltaFile)
+        finally:
+            client.close()
+        deltaID = fileStore.writeGlobalFile(deltaPath)
+        fileStore.logToMaster("Saved %i changed DB records as delta %i of the snapshot chain" % \
+                              (changedRecords, len(snapshotChain.deltaIDs) + 1))
+        # The server's own snapshot isn't needed
+        stopKtserver(dbElem)
+        exports = []
+        intermediateResultsUrl = getattr(self.cactusWorkflowArguments, 'intermediateResultsUrl', None)
+        if intermediateResultsUrl is not None:
+            exports.append((deltaID, intermediateResultsUrl + "-dump-" + self.phaseName + "-delta"))
+        return snapshotChain.withDelta(deltaID), exports
 
 class CactusRecursionJob(CactusJob):
     """Base recursive job for traversals up and down the cactus tree.
     """
-    flowerFeatures = lambda self: {'flowerGroupSize': sum(self.flowerSizes),
-                                   'maxFlowerSize': max(self.flowerSizes),
-                                   'numFlowers': len(self.flowerSizes)}
+    flowerFeatures = lambda self: flowerGroupFeatures(self.flowerSizes)
     featuresFn = flowerFeatures
     feature = 'flowerGroupSize'
     maxSequenceSizeOfFlowerGroupingDefault = 1000000
@@ -368,7 +580,10 @@ class CactusRecursionJob(CactusJob):
 
     def makeChildJobs(self, flowersAndSizes, job, overlargeJob=None, 
                       phaseNode=None):
-        """Make a set of child jobs for a given set of flowers and chosen child job
+        """Make a set of child jobs for a given set of flowers and chosen child job.
+        flowersAndSizes holds (overlarge, flowerNames, flowerSizes, stats)
+        groups, with the stats of the overlarge flowers already fetched
+        (see addOverlargeFlowerStats).
         """
         if overlargeJob == None:
             overlargeJob = job
@@ -376,12 +591,13 @@ class CactusRecursionJob(CactusJob):
             phaseNode = self.phaseNode
         
         logger.info("Make wrapper jobs: There are %i flowers" % len(flowersAndSizes))
-        for overlarge, flowerNames, flowerSizes in flowersAndSizes:
+        jobNode = getJobNode(phaseNode, job)
+        poolCores = getOptionalAttrib(jobNode, "poolCores", int, 1)
+        pooledJobs = []
+        for overlarge, flowerNames, flowerSizes, flowerStats in flowersAndSizes:
             if overlarge: #Make sure large flowers are on their own, in their own job
-                flowerStatsString = runCactusFlowerStats(cactusDiskDatabaseString=self.cactusDiskDatabaseString,
-                                                         flowerName=decodeFirstFlowerName(flowerNames))
                 self._fileStore.logToMaster("Adding an oversize flower for job class %s and stats %s" \
-                                 % (overlargeJob, flowerStatsString))
+                                 % (overlargeJob, flowerStats[1]))
                 self.addChild(overlargeJob(cactusDiskDatabaseString=
                                            self.cactusDiskDatabaseString,
                                            phaseNode=phaseNode, 
@@ -391,13 +607,66 @@ class CactusRecursionJob(CactusJob):
                                            overlarge=True,
                                            cactusWorkflowArguments=self.cactusWorkflowArguments)).rv()
             else:
-                logger.info("Adding recursive flower job")
-                self.addChild(job(cactusDiskDatabaseString=self.cactusDiskDatabaseString, 
-                                  phaseNode=phaseNode, constantsNode=self.constantsNode,
-                                  flowerNames=flowerNames,
-                                  flowerSizes=flowerSizes,
-                                  overlarge=False,
-                                  cactusWorkflowArguments=self.cactusWorkflowArguments)).rv()
+                childJob = job(cactusDiskDatabaseString=self.cactusDiskDatabaseString, 
+                               phaseNode=phaseNode, constantsNode=self.constantsNode,
+                               flowerNames=flowerNames,
+                               flowerSizes=flowerSizes,
+                               overlarge=False,
+                               cactusWorkflowArguments=self.cactusWorkflowArguments)
+                if poolCores > 1 and getattr(job, 'poolable', False):
+                    pooledJobs.append(childJob)
+                else:
+                    logger.info("Adding recursive flower job")
+                    self.addChild(childJob).rv()
+        # Hand out the pooled jobs in batches to worker-pool jobs, each
+        # running up to poolCores of them at once.
+        poolSize = getOptionalAttrib(jobNode, "poolSize", int, 4*poolCores)
+        for i in xrange(0, len(pooledJobs), poolSize):
+            batch = pooledJobs[i:i + poolSize]
+            logger.info("Adding worker-pool job for %i flower groups" % len(batch))
+            self.addChild(CactusFlowerPoolJob(phaseNode=phaseNode, constantsNode=self.constantsNode,
+                                              cactusDiskDatabaseString=self.cactusDiskDatabaseString,
+                                              wrapperJobs=batch, cores=poolCores,
+                                              cactusWorkflowArguments=self.cactusWorkflowArguments))
+
+    def packFlowerGroups(self, flowersAndSizes, job):
+        """Regroup the flowers that aren't overlarge by their predicted
+        cost, if the config node of the given (wrapper) job sets a
+        targetRuntime. The cost of a flower is given by runtimePoly on
+        its size, plus jobOverhead for each group, and if
+        maxGroupMemory is set, the groups are also kept to what the job
+        is predicted to fit in that much memory. Overlarge flowers
+        stay on their own.
+        """
+        jobNode = getJobNode(self.phaseNode, job)
+        targetRuntime = getOptionalAttrib(jobNode, "targetRuntime", float)
+        if targetRuntime is None:
+            return flowersAndSizes
+        runtimePoly = map(float, getOptionalAttrib(jobNode, "runtimePoly", default="1e-05 0").split())
+        maxGroupMemory = getOptionalAttrib(jobNode, "maxGroupMemory", int)
+        memoryFn = None
+        if maxGroupMemory is not None and hasattr(job, 'memoryPoly') and \
+           getattr(job.featuresFn, '__func__', None) is CactusRecursionJob.flowerFeatures.__func__:
+            totalSequenceSize = self.cactusWorkflowArguments.totalSequenceSize
+            configNode = self.cactusWorkflowArguments.configNode
+            memoryFn = lambda features: predictJobMemory(job, dict(features, totalSequenceSize=totalSequenceSize),
+                                                         configNode)
+        packedFlowersAndSizes = []
+        flowers = []
+        for overlarge, flowerNames, flowerSizes, flowerStats in flowersAndSizes:
+            if overlarge:
+                packedFlowersAndSizes.append((overlarge, flowerNames, flowerSizes, flowerStats))
+            else:
+                flowers += zip(decodeFlowerNames(flowerNames), flowerSizes)
+        groups = packFlowers(flowers, costFn=lambda size: evaluatePoly(runtimePoly, size),
+                             maxCost=targetRuntime,
+                             jobOverhead=getOptionalAttrib(jobNode, "jobOverhead", float, 0.0),
+                             memoryFn=memoryFn, maxMemory=maxGroupMemory)
+        for group in groups:
+            packedFlowersAndSizes.append((False, encodeFlowerNames([name for name, _ in group]),
+                                          [size for _, size in group], None))
+        logger.info("Packed %i flowers into %i groups for %s" % (len(flowers), len(groups), job.__name__))
+        return packedFlowersAndSizes
 
     def makeRecursiveJobs(self, fileStore=None, job=None, phaseNode=None):
         """Make a set of child jobs for a given set of parent flowers.
@@ -414,7 +683,8 @@ class CactusRecursionJob(CactusJob):
                                             maxSequenceSizeOfFlowerGrouping=getOptionalAttrib(jobNode, "maxFlowerGroupSize", int, 
                                             default=CactusRecursionJob.maxSequenceSizeOfFlowerGroupingDefault),
                                             maxSequenceSizeOfSecondaryFlowerGrouping=getOptionalAttrib(jobNode, "maxFlowerWrapperGroupSize", int, 
-                                            default=CactusRecursionJob.maxSequenceSizeOfFlowerGroupingDefault))
+                                            default=CactusRecursionJob.maxSequenceSizeOfFlowerGroupingDefault),
+                                            flowerStats=True)
         return self.makeChildJobs(flowersAndSizes=flowersAndSizes, 
                               job=job, phaseNode=phaseNode)
     
@@ -430,7 +700,9 @@ class CactusRecursionJob(CactusJob):
                                               flowerNames=self.flowerNames, 
                                               minSequenceSizeOfFlower=getOptionalAttrib(jobNode, "minFlowerSize", int, 0),
                                               maxSequenceSizeOfFlowerGrouping=getOptionalAttrib(jobNode, "maxFlowerGroupSize", int,
-                                              default=CactusRecursionJob.maxSequenceSizeOfFlowerGroupingDefault))
+                                              default=CactusRecursionJob.maxSequenceSizeOfFlowerGroupingDefault),
+                                              flowerStats=True)
+        flowersAndSizes = self.packFlowerGroups(flowersAndSizes, job)
         return self.makeChildJobs(flowersAndSizes=flowersAndSizes, 
                                   job=job, overlargeJob=overlargeJob,
                                   phaseNode=phaseNode)
@@ -452,10 +724,117 @@ class CactusRecursionJob(CactusJob):
         totalFlowers = int(self.flowerNames.split()[0])
         assert flowersSoFar == totalFlowers, \
                "Didn't process all flowers while going through a secondary grouping."
+        flowersAndSizes = addOverlargeFlowerStats(self.cactusDiskDatabaseString, flowersAndSizes)
+        flowersAndSizes = self.packFlowerGroups(flowersAndSizes, job)
         return self.makeChildJobs(flowersAndSizes=flowersAndSizes,
                                   job=job, overlargeJob=overlargeJob,
                                   phaseNode=phaseNode)
 
+class LockedFileStore(object):
+    """Wraps a Toil file store, which isn't thread-safe, so that only
+    one thread at a time can use it. Streams opened through it hold
+    the lock until they're closed.
+    """
+    def __init__(self, fileStore):
+        self.fileStore = fileStore
+        self.lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.fileStore, name)
+        if not callable(attr):
+            return attr
+        def lockedCall(*args, **kwargs):
+            with self.lock:
+                result = attr(*args, **kwargs)
+            if hasattr(result, "__enter__") and hasattr(result, "__exit__"):
+                return LockedContext(self.lock, result)
+            return result
+        return lockedCall
+
+class LockedContext(object):
+    """A context manager that holds a lock while it's entered."""
+    def __init__(self, lock, context):
+        self.lock = lock
+        self.context = context
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            return self.context.__enter__()
+        except:
+            self.lock.release()
+            raise
+
+    def __exit__(self, *args):
+        try:
+            return self.context.__exit__(*args)
+        finally:
+            self.lock.release()
+
+class CactusFlowerPoolJob(CactusRecursionJob):
+    """Runs the wrapper jobs of many flower groups in a pool of local
+    worker threads, one per core, instead of as separate Toil jobs, to
+    save on the scheduling and start-up overhead of each.
+
+    The wrappers run the cactus binaries in subprocesses, so threads
+    suffice. The threads share the job's file store through a
+    LockedFileStore, so only one of them uses it at a time. Idle workers take the next group as soon as they finish
+    one, so long and short groups balance out, and a group that fails
+    is retried in the pool "poolRetries" times before being handed
+    back to Toil as an ordinary child job, to be retried like any other.
+    """
+    def __init__(self, phaseNode, constantsNode, cactusDiskDatabaseString, wrapperJobs,
+                 cores, cactusWorkflowArguments):
+        self.wrapperJob = wrapperJobs[0].__class__
+        self.flowerGroups = [(wrapperJob.flowerNames, wrapperJob.flowerSizes) for wrapperJob in wrapperJobs]
+        # At most "cores" wrappers run at once, so we need enough
+        # memory for the largest "cores" of them.
+        cores = min(cores, len(wrapperJobs))
+        memory = sum(sorted([wrapperJob.memory for wrapperJob in wrapperJobs], reverse=True)[:cores])
+        self.phaseNode = phaseNode
+        self.constantsNode = constantsNode
+        self.overlarge = False
+        self.jobNode = getJobNode(self.phaseNode, self.__class__)
+        self.cactusDiskDatabaseString = cactusDiskDatabaseString
+        self.flowerNames = encodeFlowerNames(())
+        self.flowerSizes = [size for _, flowerSizes in self.flowerGroups for size in flowerSizes]
+        self.cactusWorkflowArguments = cactusWorkflowArguments
+        self.precomputedAlignmentIDs = None
+        RoundedJob.__init__(self, memory=memory, cores=cores, preemptable=True)
+
+    def makeWrapperJob(self, flowerNames, flowerSizes):
+        return self.wrapperJob(cactusDiskDatabaseString=self.cactusDiskDatabaseString,
+                               phaseNode=self.phaseNode, constantsNode=self.constantsNode,
+                               flowerNames=flowerNames, flowerSizes=flowerSizes, overlarge=False,
+                               cactusWorkflowArguments=self.cactusWorkflowArguments)
+
+    def runFlowerGroup(self, fileStore, flowerGroup, retries):
+        """Run the wrapper on a flower group, returning whether it
+        succeeded."""
+        for attempt in xrange(retries + 1):
+            try:
+                self.makeWrapperJob(*flowerGroup).run(fileStore)
+                return True
+            except Exception:
+                fileStore.logToMaster("%s failed on flowers %s (attempt %i of %i):\n%s" % \
+                                      (self.wrapperJob.__name__, flowerGroup[0], attempt + 1,
+                                       retries + 1, traceback.format_exc()))
+        return False
+
+    def run(self, fileStore):
+        retries = getOptionalAttrib(getJobNode(self.phaseNode, self.wrapperJob), "poolRetries", int, 1)
+        lockedFileStore = LockedFileStore(fileStore)
+        pool = ThreadPool(int(self.cores))
+        try:
+            succeeded = pool.map(lambda flowerGroup: self.runFlowerGroup(lockedFileStore, flowerGroup, retries),
+                                 self.flowerGroups, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        for flowerGroup, groupSucceeded in zip(self.flowerGroups, succeeded):
+            if not groupSucceeded:
+                self.addChild(self.makeWrapperJob(*flowerGroup))
+
 ############################################################
 ############################################################
 ############################################################
@@ -552,7 +931,19 @@ class CactusTrimmingBlastPhase(CactusPhasesJob):
                          trimWindowSize=self.getOptionalPhaseAttrib("trimWindowSize", int, 10),
                          trimOutgroupFlanking=self.getOptionalPhaseAttrib("trimOutgroupFlanking", int, 100),
                          trimOutgroupDepth=self.getOptionalPhaseAttrib("trimOutgroupDepth", int, 1),
-                         keepParalogs=self.getOptionalPhaseAttrib("keepParalogs", bool, False)),
+                         keepParalogs=self.getOptionalPhaseAttrib("keepParalogs", bool, False),
+                         speculativeOutgroups=self.getOptionalPhaseAttrib("speculativeOutgroups", int, 0),
+                         speculativeMaxExtraWork=self.getOptionalPhaseAttrib("speculativeMaxExtraWork", float, 0.5),
+                         cacheDir=getOptionalAttrib(cafNode, "blastCacheDir"),
+                         cacheMaxSize=getOptionalAttrib(cafNode, "blastCacheMaxSize", int),
+                         collateFanIn=getOptionalAttrib(cafNode, "collateFanIn", int, 100),
+                         sketchThreshold=getOptionalAttrib(cafNode, "sketchThreshold", int),
+                         sketchKmerSize=getOptionalAttrib(cafNode, "sketchKmerSize", int, 16),
+                         sketchScale=getOptionalAttrib(cafNode, "sketchScale", int, 1000),
+                         binaryAlignments=getOptionalAttrib(cafNode, "binaryAlignments", bool, False),
+                         virtualChunks=getOptionalAttrib(cafNode, "virtualChunks", bool, False),
+                         lastzSoftTimeout=getOptionalAttrib(cafNode, "lastzSoftTimeout", int, 5400),
+                         maxTimeoutSplits=getOptionalAttrib(cafNode, "maxTimeoutSplits", int, 2)),
             map(itemgetter(0), ingroupItems), map(itemgetter(1), ingroupItems),
             map(itemgetter(0), outgroupItems), map(itemgetter(1), outgroupItems)))
         
@@ -561,8 +952,10 @@ class CactusTrimmingBlastPhase(CactusPhasesJob):
             minimumMapQValue=getOptionalAttrib(cafNode, "minimumMapQValue", float, 0.0)
             maxAlignmentsPerSite=getOptionalAttrib(cafNode, "maxAlignmentsPerSite", int, 1)
             alpha=getOptionalAttrib(cafNode, "alpha", float, 1.0)
-            fileStore.logToMaster("Running mapQ uniquifying with parameters, minimumMapQValue: %s, maxAlignmentsPerSite %s, alpha: %s" %
-                                  (minimumMapQValue, maxAlignmentsPerSite, alpha))
+            mapQShards=getOptionalAttrib(cafNode, "mapQShards", int, 1)
+            binaryAlignments=getOptionalAttrib(cafNode, "binaryAlignments", bool, False)
+            fileStore.logToMaster("Running mapQ uniquifying with parameters, minimumMapQValue: %s, maxAlignmentsPerSite %s, alpha: %s, shards: %s" %
+                                  (minimumMapQValue, maxAlignmentsPerSite, alpha, mapQShards))
             blastJob = blastJob.encapsulate() # Encapsulate to ensure that blast Job and all its successors
             # run before mapQ
             mapQJob = blastJob.addFollowOnJobFn(mappingQualityRescoring, blastJob.rv(0), 
@@ -570,6 +963,12 @@ class CactusTrimmingBlastPhase(CactusPhasesJob):
                                                 maxAlignmentsPerSite=maxAlignmentsPerSite,
                                                 alpha=alpha,
                                                 logLevel=getLogLevelString(),
+                                                shards=mapQShards,
+                                                cores=mapQShards,
+                                                memory=PromisedRequirement(getMappingQualityRescoringMemory,
+                                                                           blastJob.rv(0), binaryAlignments),
+                                                disk=PromisedRequirement(getMappingQualityRescoringDisk,
+                                                                         blastJob.rv(0), binaryAlignments),
                                                 preemptable=True)
             self.cactusWorkflowArguments.alignmentsID = mapQJob.rv(0)
             self.cactusWorkflowArguments.secondaryAlignmentsID = mapQJob.rv(1)
@@ -604,8 +1003,8 @@ def getLongestPath(node, distance=0.0):
 class CactusSetupCheckpoint(CactusCheckpointJob):
     """Start a new DB, run the setup and CAF phases, save the DB, then launch the BAR checkpoint."""
     def run(self, fileStore):
-        ktServerDump = self.runPhaseWithPrimaryDB(CactusSetupPhase).rv()
-        return self.makeFollowOnCheckpointJob(CactusBarCheckpoint, "bar", ktServerDump=ktServerDump)
+        savedPrimaryDB = self.runPhaseWithPrimaryDB(CactusSetupPhase).rv()
+        return self.makeFollowOnCheckpointJob(CactusBarCheckpoint, "bar", savedPrimaryDB=savedPrimaryDB)
 
 class CactusSetupPhase(CactusPhasesJob):   
     """Initialises the cactus database and adapts the config file for the run."""
@@ -815,8 +1214,8 @@ class CactusCafWrapper(CactusRecursionJob):
 class CactusBarCheckpoint(CactusCheckpointJob):
     """Load the DB, run the BAR, AVG, and normalization phases, save the DB, then run the reference checkpoint."""
     def run(self, fileStore):
-        ktServerDump = self.runPhaseWithPrimaryDB(CactusBarPhase).rv()
-        return self.makeFollowOnCheckpointJob(CactusReferenceCheckpoint, "reference", ktServerDump=ktServerDump)
+        savedPrimaryDB = self.runPhaseWithPrimaryDB(CactusBarPhase).rv()
+        return self.makeFollowOnCheckpointJob(CactusReferenceCheckpoint, "reference", savedPrimaryDB=savedPrimaryDB)
 
 class CactusBarPhase(CactusPhasesJob):
     """Runs bar algorithm."""
@@ -866,6 +1265,7 @@ class CactusBarWrapper(CactusRecursionJob):
     """Runs the BAR algorithm implementation.
     """
     memoryPoly = [2.81473430e-01, 2.96245523e+09]
+    poolable = True
 
     def run(self, fileStore):
         messages = runBarForJob(self, features=self.featuresFn(), fileStore=fileStore)
@@ -1064,10 +1464,10 @@ class CactusReferenceCheckpoint(CactusCheckpointJob):
     def run(self, fileStore):
         child = self.runPhaseWithPrimaryDB(CactusReferencePhase)
         experiment = child.rv(0)
-        ktServerDump = child.rv(1)
+        savedPrimaryDB = child.rv(1)
         self.cactusWorkflowArguments = copy.deepcopy(self.cactusWorkflowArguments)
         self.cactusWorkflowArguments.experimentWrapper = experiment
-        return self.makeFollowOnCheckpointJob(CactusHalCheckpoint, "hal", ktServerDump=ktServerDump)
+        return self.makeFollowOnCheckpointJob(CactusHalCheckpoint, "hal", savedPrimaryDB=savedPrimaryDB)
 
 class CactusReferencePhase(CactusPhasesJob):
     """Runs the reference problem algorithm"""
@@ -1093,6 +1493,7 @@ class CactusReferenceWrapper(CactusRecursionJob):
     """
     memoryPoly = [0.71709110685129696, 141266641]
     feature = 'maxFlowerSize'
+    poolable = True
 
     def run(self, fileStore):
         runCactusReference(fileStore=fileStore,
@@ -1131,6 +1532,7 @@ class CactusSetReferenceCoordinatesUpWrapper(CactusRecursionJob):
     """
     memoryPoly = [1.3030742924744299, 180741939.947]
     feature = 'maxFlowerSize'
+    poolable = True
 
     def run(self, fileStore):
         runCactusAddReferenceCoordinates(fileStore=fileStore, jobName=self.__class__.__name__,
@@ -1170,6 +1572,7 @@ class CactusSetReferenceCoordinatesDownWrapper(CactusRecursionJob):
     """
     memoryPoly = [0.52844015396914878, 116287385]
     feature = 'maxFlowerSize'
+    poolable = True
 
     def run(self, fileStore):
         runCactusAddReferenceCoordinates(fileStore=fileStore, features=self.featuresFn(),
@@ -1180,6 +1583,22 @@ class CactusSetReferenceCoordinatesDownWrapper(CactusRecursionJob):
                                          outgroupEventString=self.getOptionalPhaseAttrib("outgroup"), 
                                          bottomUpPhase=False)
 
+def extractReference(fileStore, cactusWorkflowArguments, cactusDiskDatabaseString, eventName):
+    """Extract the reference sequence from the DB, returning its file
+    store ID."""
+    referencePath = fileStore.getLocalTempFile()
+    cactus_call(parameters=["cactus_getReferenceSeq", "--cactusDisk",
+                            cactusDiskDatabaseString, "--flowerName", "0",
+                            "--referenceEventString", eventName, "--outputFile",
+                            os.path.basename(referencePath), "--logLevel", getLogLevelString()])
+    referenceID = fileStore.writeGlobalFile(referencePath)
+    intermediateResultsUrl = getattr(cactusWorkflowArguments, 'intermediateResultsUrl', None)
+    if intermediateResultsUrl is not None:
+        # The user requested to keep the hal fasta files in a separate place. Export it there.
+        url = intermediateResultsUrl + ".reference.fa"
+        fileStore.exportFile(referenceID, url)
+    return referenceID
+
 class CactusExtractReferencePhase(CactusPhasesJob):
     memoryPoly = [2.24519561e+00, 4.70479486e+08]
 
@@ -1187,20 +1606,14 @@ class CactusExtractReferencePhase(CactusPhasesJob):
         experiment = ExperimentWrapper(self.cactusWorkflowArguments.experimentNode)
         if hasattr(self.cactusWorkflowArguments, 'buildReference') and\
                self.cactusWorkflowArguments.buildReference:
-            fileStore.logToMaster("Starting Reference Extract Phase")
-            eventName = self.getOptionalPhaseAttrib("reference")
-            referencePath = fileStore.getLocalTempFile()
-            cactus_call(parameters=["cactus_getReferenceSeq", "--cactusDisk",
-                                    self.cactusWorkflowArguments.cactusDiskDatabaseString, "--flowerName", "0",
-                                    "--referenceEventString", eventName, "--outputFile",
-                                    os.path.basename(referencePath), "--logLevel", getLogLevelString()])
-            referenceID = fileStore.writeGlobalFile(referencePath)
-            experiment.setReferenceID(referenceID)
-            intermediateResultsUrl = getattr(self.cactusWorkflowArguments, 'intermediateResultsUrl', None)
-            if intermediateResultsUrl is not None:
-                # The user requested to keep the hal fasta files in a separate place. Export it there.
-                url = intermediateResultsUrl + ".reference.fa"
-                fileStore.exportFile(referenceID, url)
+            if self.useLocalSnapshots():
+                # Done from the DB snapshot by the HAL checkpoint instead
+                fileStore.logToMaster("Deferring Reference Extract Phase to the local DB snapshots")
+            else:
+                fileStore.logToMaster("Starting Reference Extract Phase")
+                experiment.setReferenceID(extractReference(fileStore, self.cactusWorkflowArguments,
+                                                           self.cactusWorkflowArguments.cactusDiskDatabaseString,
+                                                           self.getOptionalPhaseAttrib("reference")))
         self.cactusWorkflowArguments.experimentWrapper = experiment
         return experiment, self.makeFollowOnPhaseJob(CactusCheckPhase, "check")
 
@@ -1244,13 +1657,41 @@ class CactusCheckWrapper(CactusRecursionJob):
 class CactusHalCheckpoint(CactusCheckpointJob):
     """Load the DB and run the final reference and HAL phases."""
     def run(self, fileStore):
+        if self.useLocalSnapshots() and self.ktServerDump is not None:
+            # The reference and fasta are each read from the whole DB
+            # by a single job, which can serve its own copy of the
+            # snapshot. The many small jobs of the HAL generation still
+            # share the primary DB, which is only started for them.
+            self.cactusWorkflowArguments.snapshotDatabaseString = \
+                makeSnapshotDatabaseString(self.cactusWorkflowArguments.cactusDiskDatabaseString,
+                                           self.ktServerDump, self.ktServerDump.size)
+            if not self.getOptionalPhaseAttrib("buildHal", bool, default=False):
+                self.exportSavedPrimaryDB()
+                return self.addChild(CactusHalGeneratorPhase(cactusWorkflowArguments=self.cactusWorkflowArguments,
+                                                             phaseName=self.phaseName,
+                                                             topFlowerName=self.topFlowerName)).rv()
         return self.runPhaseWithPrimaryDB(CactusHalGeneratorPhase).rv()
 
+class CactusExtractReferenceFromSnapshot(CactusPhasesJob):
+    """Extract the reference sequence from a local copy of the DB snapshot."""
+    memoryPoly = [2.24519561e+00, 4.70479486e+08]
+    readsSnapshot = True
+
+    def run(self, fileStore):
+        with localSnapshotDatabase(fileStore, self.getSnapshotDatabaseString()) as cactusDiskDatabaseString:
+            return extractReference(fileStore, self.cactusWorkflowArguments, cactusDiskDatabaseString,
+                                    self.getOptionalPhaseAttrib("reference"))
+
 class CactusHalGeneratorPhase(CactusPhasesJob):
     def run(self, fileStore):
         referenceNode = findRequiredNode(self.cactusWorkflowArguments.configNode, "reference")
         if referenceNode.attrib.has_key("reference"):
             self.phaseNode.attrib["reference"] = referenceNode.attrib["reference"]
+        if getattr(self.cactusWorkflowArguments, 'snapshotDatabaseString', None) is not None and \
+           getattr(self.cactusWorkflowArguments, 'buildReference', False):
+            self.referenceID = self.addChild(CactusExtractReferenceFromSnapshot(
+                cactusWorkflowArguments=self.cactusWorkflowArguments, phaseName="reference",
+                topFlowerName=self.topFlowerName)).rv()
         if self.getOptionalPhaseAttrib("buildFasta", bool, default=False):
             self.fastaID = self.makeRecursiveChildJob(CactusFastaGenerator)
         return self.makeFollowOnPhaseJob(CactusHalGeneratorPhase2, "hal")
@@ -1271,18 +1712,22 @@ class CactusHalGeneratorPhase3(CactusPhasesJob):
     def run(self, fileStore):
         self.cactusWorkflowArguments.experimentWrapper.setHalID(self.halID)
         self.cactusWorkflowArguments.experimentWrapper.setHalFastaID(self.fastaID)
+        if self.referenceID is not None:
+            self.cactusWorkflowArguments.experimentWrapper.setReferenceID(self.referenceID)
         return self.cactusWorkflowArguments.experimentWrapper
 
 class CactusFastaGenerator(CactusRecursionJob):
     memoryPoly = [2.99160856e+00, 4.48507512e+08]
     feature = 'totalSequenceSize'
+    readsSnapshot = True
 
     def run(self, fileStore):
         tmpFasta = fileStore.getLocalTempFile()
-        runCactusFastaGenerator(cactusDiskDatabaseString=self.cactusDiskDatabaseString, 
-                                flowerName=decodeFirstFlowerName(self.flowerNames),
-                                outputFile=tmpFasta,
-                                referenceEventString=self.getOptionalPhaseAttrib("reference"))
+        with localSnapshotDatabase(fileStore, self.getSnapshotDatabaseString()) as cactusDiskDatabaseString:
+            runCactusFastaGenerator(cactusDiskDatabaseString=cactusDiskDatabaseString, 
+                                    flowerName=decodeFirstFlowerName(self.flowerNames),
+                                    outputFile=tmpFasta,
+                                    referenceEventString=self.getOptionalPhaseAttrib("reference"))
         intermediateResultsUrl = getattr(self.cactusWorkflowArguments, 'intermediateResultsUrl', None)
         fastaID = fileStore.writeGlobalFile(tmpFasta)
         if intermediateResultsUrl is not None:
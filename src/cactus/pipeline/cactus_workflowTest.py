@@ -9,6 +9,8 @@
 import unittest
 import os
 import shutil
+import time
+import threading
 import xml.etree.ElementTree as ET
 from tempfile import mkdtemp, NamedTemporaryFile
 from textwrap import dedent
@@ -29,7 +31,8 @@ from cactus.shared.common import cactusRootPath
 
 from cactus.pipeline.cactus_workflow import getOptionalAttrib, extractNode, findRequiredNode, \
     getJobNode, CactusJob, getLongestPath, inverseJukesCantor, \
-    CactusSetReferenceCoordinatesDownRecursion, prependUniqueIDs
+    CactusSetReferenceCoordinatesDownRecursion, prependUniqueIDs, CactusRecursionJob, \
+    CactusFlowerPoolJob, LockedFileStore
 
 class TestCase(unittest.TestCase):
     def setUp(self):
@@ -156,6 +159,72 @@ class TestCase(unittest.TestCase):
         self.assertEquals(job.getOptionalJobAttrib("cpu", typeFn=int, default=1), 2)
         self.assertEquals(job.getOptionalJobAttrib("overlargeCpu", typeFn=int, default=-1), -1)
 
+    def testCactusFlowerPoolJob(self):
+        ranFlowers = []
+        class CactusTestWrapper(CactusRecursionJob):
+            poolable = True
+            def run(self, fileStore):
+                ranFlowers.append(self.flowerNames)
+                fileStore.logToMaster("Running flowers %s" % self.flowerNames)
+                # Fails on its first run for flower 2, and always for flower 3
+                if self.flowerNames == "1 3" or \
+                   (self.flowerNames == "1 2" and ranFlowers.count("1 2") == 1):
+                    raise RuntimeError("Failed on flowers %s" % self.flowerNames)
+        class FakeFileStore(object):
+            """Records whether two threads ever used it at once."""
+            def __init__(self):
+                self.messages = []
+                self.inUse = False
+                self.overlapped = False
+            def logToMaster(self, message):
+                if self.inUse:
+                    self.overlapped = True
+                self.inUse = True
+                time.sleep(0.01)
+                self.messages.append(message)
+                self.inUse = False
+        ET.SubElement(self.barNode, "CactusTestWrapper", attrib={ "memory":"1000000000", "poolRetries":"1" })
+        wrappers = [CactusTestWrapper(self.barNode, self.barNode, "", "1 %i" % i, [i])
+                    for i in xrange(1, 6)]
+        job = CactusFlowerPoolJob(self.barNode, self.barNode, "", wrappers, cores=2,
+                                  cactusWorkflowArguments=None)
+        self.assertEquals(job.cores, 2)
+        self.assertEquals(job.memory, 2*wrappers[0].memory)
+        addedJobs = []
+        job.addChild = addedJobs.append
+        fileStore = FakeFileStore()
+        job.run(fileStore)
+        self.assertFalse(fileStore.overlapped)
+        self.assertEquals(len(fileStore.messages), 7 + 3)
+        self.assertEquals(sorted(ranFlowers), ["1 1", "1 2", "1 2", "1 3", "1 3", "1 4", "1 5"])
+        # Only the group that kept failing is handed back to Toil
+        self.assertEquals([(childJob.__class__, childJob.flowerNames) for childJob in addedJobs],
+                          [(CactusTestWrapper, "1 3")])
+
+    def testLockedFileStore(self):
+        class FakeFileStore(object):
+            jobStore = "jobStore"
+            def __init__(self):
+                self.streamLocked = []
+            def readGlobalFileStream(self, fileID):
+                return open(fileID)
+        fakeFileStore = FakeFileStore()
+        lockedFileStore = LockedFileStore(fakeFileStore)
+        self.assertEquals(lockedFileStore.jobStore, "jobStore")
+        with NamedTemporaryFile() as tempFile:
+            tempFile.write("data")
+            tempFile.flush()
+            with lockedFileStore.readGlobalFileStream(tempFile.name) as stream:
+                self.assertEquals(stream.read(), "data")
+                # Other threads can't use the file store while the stream is open
+                otherThread = threading.Thread(target=lambda: fakeFileStore.streamLocked.append(
+                    lockedFileStore.lock.acquire(False)))
+                otherThread.start()
+                otherThread.join()
+                self.assertEquals(fakeFileStore.streamLocked, [False])
+        self.assertTrue(lockedFileStore.lock.acquire(False))
+        lockedFileStore.lock.release()
+
     def testGetLongestPath(self):
         self.assertAlmostEquals(getLongestPath(newickTreeParser("(b(a:0.5):0.5,b(a:1.5):0.5)")), 2.0)
         self.assertAlmostEquals(getLongestPath(newickTreeParser("(b(a:0.5):0.5,b(a:1.5,c:10):0.5)")), 10.5)
@@ -4,16 +4,20 @@ Functions to launch and manage KyotoTycoon servers.
 """
 
 import os
+import base64
+import httplib
+import quopri
 import platform
 import random
 import socket
 import signal
 import sys
 import traceback
+import urllib
 from contextlib import closing
 from glob import glob
 from multiprocessing import Process, Queue
-from time import sleep
+from time import sleep, time
 
 from toil.lib.bioio import logger
 from cactus.shared.common import cactus_call
@@ -24,6 +28,155 @@ MAX_KTSERVER_PORT = 32767
 # The name of the snapshot that KT outputs.
 KTSERVER_SNAPSHOT_NAME = "00000000.ktss"
 
+# The key (and condition variable) used to signal a ktserver to shut down.
+TERMINATE_KEY = "TERMINATE"
+
+def blockUntil(condition, timeout=None, initialInterval=0.05, maxInterval=1.0):
+    """Wait until condition() is true, checking at intervals that start
+    short and back off to maxInterval, so that quick transitions are
+    noticed at once without busy-waiting on slow ones.
+
+    Returns True if the condition became true, False if the timeout
+    (in seconds, or None for no limit) expired first."""
+    start = time()
+    interval = initialInterval
+    while not condition():
+        if timeout is not None and time() - start >= timeout:
+            return False
+        sleep(interval)
+        interval = min(2 * interval, maxInterval)
+    return True
+
+class KtClient(object):
+    """A persistent connection to a ktserver, speaking its HTTP RPC protocol.
+
+    Unlike ktremotemgr, this needs no new process (or container) per
+    request, and a request can block on a condition variable in the
+    server (the WAIT/SIGNAL parameters of the protocol) until another
+    client signals it, rather than polling the key.
+    """
+    def __init__(self, dbElem, timeout=60):
+        self.host = dbElem.getDbHost() or 'localhost'
+        self.port = dbElem.getDbPort()
+        self.timeout = timeout
+        self.connection = None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def call(self, procedure, params):
+        """Call an RPC procedure with the given (name, value) parameters,
+        returning the status and a dict of the output.
+
+        The parameters are URL-encoded, so keys and values may be
+        arbitrary binary strings."""
+        body = "".join("%s\t%s\n" % (urllib.quote(name), urllib.quote(str(value)))
+                       for name, value in params if value is not None)
+        headers = {"Content-Type": "text/tab-separated-values; colenc=U"}
+        for attempt in xrange(2):
+            if self.connection is None:
+                self.connection = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.connection.request("POST", "/rpc/" + procedure, body, headers)
+                response = self.connection.getresponse()
+                output = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                # The server may have closed an idle keep-alive
+                # connection, so retry once on a new one.
+                self.close()
+                if attempt == 1:
+                    raise
+        # The server chooses the encoding of its output.
+        decode = lambda column: column
+        contentType = response.getheader("Content-Type", "")
+        if "colenc=U" in contentType:
+            decode = urllib.unquote
+        elif "colenc=B" in contentType:
+            decode = base64.b64decode
+        elif "colenc=Q" in contentType:
+            decode = quopri.decodestring
+        return response.status, dict(map(decode, line.split("\t", 1))
+                                     for line in output.splitlines() if "\t" in line)
+
+    def isReachable(self):
+        """Check if the server is accepting requests."""
+        try:
+            status, _ = self.call("void", [])
+        except (httplib.HTTPException, socket.error):
+            return False
+        return status == 200
+
+    def get(self, key, wait=None, waitTime=None):
+        """Get the value of a key, or None if it isn't set. If wait is
+        given, first block until the condition variable of that name is
+        signalled, for at most waitTime seconds; None is also returned
+        if that times out."""
+        status, output = self.call("get", [("key", key), ("WAIT", wait), ("WAITTIME", waitTime)])
+        if status == 200:
+            return output["value"]
+        if status == 450 or wait is not None:
+            return None
+        raise RuntimeError("ktserver get of %s failed with status %i: %s" % (key, status, output))
+
+    def set(self, key, value, signal=None):
+        """Set the value of a key, then if signal is given wake up every
+        client waiting on the condition variable of that name."""
+        params = [("key", key), ("value", value), ("SIGNAL", signal)]
+        if signal is not None:
+            params.append(("SIGNALBROAD", "1"))
+        status, output = self.call("set", params)
+        if status != 200:
+            raise RuntimeError("ktserver set of %s failed with status %i: %s" % (key, status, output))
+
+    def remove(self, key):
+        """Remove a key, if it is set."""
+        status, output = self.call("remove", [("key", key)])
+        if status not in (200, 450):
+            raise RuntimeError("ktserver remove of %s failed with status %i: %s" % (key, status, output))
+
+    def getBulk(self, keys):
+        """Get the values of several keys at once, as a dict leaving out
+        the keys that aren't set."""
+        status, output = self.call("get_bulk", [("_" + key, "") for key in keys])
+        if status != 200:
+            raise RuntimeError("ktserver get_bulk failed with status %i: %s" % (status, output))
+        return dict((name[1:], value) for name, value in output.iteritems() if name.startswith("_"))
+
+    def setBulk(self, records):
+        """Set the values of several (key, value) records at once."""
+        status, output = self.call("set_bulk", [("_" + key, value) for key, value in records])
+        if status != 200:
+            raise RuntimeError("ktserver set_bulk failed with status %i: %s" % (status, output))
+
+    def removeBulk(self, keys):
+        """Remove several keys at once, if they are set."""
+        status, output = self.call("remove_bulk", [("_" + key, "") for key in keys])
+        if status != 200:
+            raise RuntimeError("ktserver remove_bulk failed with status %i: %s" % (status, output))
+
+    def waitForKey(self, key, waitTime=10, checkFn=None):
+        """Block until the key is set (by a set() that signals the
+        condition variable of the same name), returning its value.
+        Every waitTime seconds without a signal, checkFn (if given) is
+        called, e.g. to check the server is still alive. The key is
+        also re-read then, in case it was set just before the wait
+        started."""
+        value = self.get(key)
+        while value is None:
+            try:
+                value = self.get(key, wait=key, waitTime=waitTime)
+                if value is None:
+                    value = self.get(key)
+            except (httplib.HTTPException, socket.error):
+                # The server is gone, which checkFn should find out.
+                sleep(1)
+            if value is None and checkFn is not None:
+                checkFn()
+        return value
+
 def runKtserver(dbElem, fileStore, existingSnapshotID=None, snapshotExportID=None):
     """
     Run a KTServer. This function launches a separate python process that manages the server.
@@ -37,23 +190,13 @@ def runKtserver(dbElem, fileStore, existingSnapshotID=None, snapshotExportID=Non
     """
     logPath = fileStore.getLocalTempFile()
     dbElem.setDbHost(getHostName())
-
-    # Find a suitable port to run on.
-    try:
-        occupiedPorts = findOccupiedPorts()
-        unoccupiedPorts = set(xrange(1025,MAX_KTSERVER_PORT)) - occupiedPorts
-        port = random.choice(list(unoccupiedPorts))
-    except:
-        logger.warning("Can't find which ports are occupied--likely netstat is not installed."
-                       " Choosing a random port to start the DB on, good luck!")
-        port = random.randint(1025,MAX_KTSERVER_PORT)
-    dbElem.setDbPort(port)
+    dbElem.setDbPort(chooseKtserverPort())
 
     process = ServerProcess(dbElem, logPath, fileStore, existingSnapshotID, snapshotExportID)
     process.daemon = True
     process.start()
 
-    if not blockUntilKtserverIsRunning(logPath):
+    if not blockUntilKtserverIsRunning(logPath, dbElem=dbElem):
         try:
             with open(logPath) as f:
                 log = f.read()
@@ -63,6 +206,17 @@ def runKtserver(dbElem, fileStore, existingSnapshotID=None, snapshotExportID=Non
 
     return process, dbElem, logPath
 
+def chooseKtserverPort():
+    """Find a suitable port to run a ktserver on."""
+    try:
+        occupiedPorts = findOccupiedPorts()
+        unoccupiedPorts = set(xrange(1025,MAX_KTSERVER_PORT)) - occupiedPorts
+        return random.choice(list(unoccupiedPorts))
+    except:
+        logger.warning("Can't find which ports are occupied--likely netstat is not installed."
+                       " Choosing a random port to start the DB on, good luck!")
+        return random.randint(1025,MAX_KTSERVER_PORT)
+
 class ServerProcess(Process):
     """Independent process that babysits the ktserver process.
 
@@ -96,27 +250,20 @@ class ServerProcess(Process):
                               parameters=getKtserverCommand(dbElem, logPath, snapshotDir),
                               port=dbElem.getDbPort())
 
-        blockUntilKtserverIsRunning(logPath)
+        blockUntilKtserverIsRunning(logPath, dbElem=dbElem)
+        client = KtClient(dbElem)
         if existingSnapshotID is not None:
             # Clear the termination flag from the snapshot
-            cactus_call(parameters=["ktremotemgr", "remove"] + getRemoteParams(dbElem) + ["TERMINATE"])
+            client.remove(TERMINATE_KEY)
 
-        while True:
-            # Check for the termination signal
-            try:
-                cactus_call(parameters=["ktremotemgr", "get"] + getRemoteParams(dbElem) + ["TERMINATE"],
-                            swallowStdErr=True)
-            except:
-                # No terminate signal sent yet
-                pass
-            else:
-                # Terminate signal received
-                break
-            # Check that the DB is still alive
+        def checkAlive():
             if process.poll() is not None or isKtServerFailed(logPath):
                 with open(logPath) as f:
                     raise RuntimeError("KTServer failed. Log: %s" % f.read())
-            sleep(60)
+        # Block until stopKtserver signals us, checking that the DB is
+        # still alive in the meantime.
+        client.waitForKey(TERMINATE_KEY, checkFn=checkAlive)
+        client.close()
         process.send_signal(signal.SIGINT)
         process.wait()
         blockUntilKtserverIsFinished(logPath)
@@ -135,34 +282,42 @@ class ServerProcess(Process):
             # Export the snapshot file to the file store
             fileStore.jobStore.updateFile(snapshotExportID, snapshotPath)
 
-def blockUntilKtserverIsRunning(logPath, createTimeout=1800):
+def blockUntilKtserverIsRunning(logPath, createTimeout=1800, dbElem=None):
     """Check status until it's successful, an error is found, or we timeout.
 
+    If dbElem is given, the server counts as running once it answers
+    requests, rather than once its log says it is listening.
+
     Returns True if the ktserver is now running, False if something went wrong."""
-    success = False
-    for i in xrange(createTimeout):
+    client = KtClient(dbElem, timeout=5) if dbElem is not None else None
+    status = {}
+    def isDone():
         if isKtServerFailed(logPath):
-            logger.critical('Error starting ktserver.')
-            success = False
-            break
-        if isKtServerRunning(logPath):
-            logger.info('Ktserver running.')
-            success = True
-            break
-        sleep(1)
-    return success
+            status['success'] = False
+        elif client.isReachable() if client is not None else isKtServerRunning(logPath):
+            status['success'] = True
+        return 'success' in status
+    if not blockUntil(isDone, timeout=createTimeout):
+        return False
+    if client is not None:
+        client.close()
+    if status['success']:
+        logger.info('Ktserver running.')
+    else:
+        logger.critical('Error starting ktserver.')
+    return status['success']
 
 def blockUntilKtserverIsFinished(logPath, timeout=1800,
                                  timeStep=10):
-    """Wait for the ktserver log to indicate that it shut down properly.
+    """Wait for the ktserver log to indicate that it shut down properly,
+    checking it at most timeStep seconds apart.
 
-    Returns True if the server shut down, False if the timeout expired."""
-    for i in xrange(0, timeout, timeStep):
+    Returns True if the server shut down, raises if the timeout expired."""
+    def isFinished():
         with open(logPath) as f:
-            log = f.read()
-            if '[FINISH]' in log:
-                return True
-        sleep(timeStep)
+            return '[FINISH]' in f.read()
+    if blockUntil(isFinished, timeout=timeout, maxInterval=timeStep):
+        return True
     raise RuntimeError("Timeout reached while waiting for ktserver.")
 
 def isKtServerRunning(logPath):
@@ -184,6 +339,58 @@ def isKtServerFailed(logPath):
                 break
     return isFailed
 
+def planKtserverTuning(totalSequenceSize, snapshotSize=None):
+    """Choose the bucket count (bnum), mapped memory size (msiz), worker
+    thread count and memory request of a ktserver for a project of the
+    given total sequence size, and, if an earlier snapshot of the DB
+    exists, its size.
+
+    The DB size is predicted from the sequence size, or from the
+    snapshot (which is compressed) if that predicts more. Kyoto
+    Tycoon wants about two buckets per record to keep the hash chains
+    short, and each bucket costs 8 bytes on top of the records. The
+    threads needed grow with the number of jobs hitting the DB at once,
+    which grows with the project.
+
+    Returns a dict with keys bnum, msiz, threads and memory.
+    """
+    dbSize = 4.10201882 * totalSequenceSize + 2.01324291e+08
+    if snapshotSize is not None:
+        dbSize = max(dbSize, 4 * snapshotSize)
+    # Cactus DB records average a few hundred bytes.
+    bnum = max(1000000, int(2 * dbSize / 256))
+    msiz = int(1.5 * dbSize)
+    threads = min(64, max(8, int(totalSequenceSize / 2e7)))
+    memory = int(max(2500000000, 1.5 * dbSize + 8 * bnum))
+    return { 'bnum': bnum, 'msiz': msiz, 'threads': threads, 'memory': memory }
+
+def applyKtserverTuning(dbElem, totalSequenceSize, snapshotSize=None):
+    """Set the tuning options, server options and memory of a ktserver
+    DB element from planKtserverTuning, recording them in the
+    experiment XML so that reruns use the same settings, and return the
+    memory to request.
+
+    Settings the user gave in the XML are kept as they are. Planned
+    settings are only replaced by a plan that needs more memory, e.g.
+    once the DB has grown past what was predicted for it.
+    """
+    planned = dbElem.getDbTuningPlanned()
+    if not planned and (dbElem.getDbTuningOptions() is not None or
+                        dbElem.getDbCreateTuningOptions() is not None or
+                        dbElem.getDbServerOptions() is not None or
+                        dbElem.getDbMemory() is not None):
+        return dbElem.getDbMemory()
+    plan = planKtserverTuning(totalSequenceSize, snapshotSize)
+    if planned and dbElem.getDbMemory() >= plan['memory']:
+        return dbElem.getDbMemory()
+    dbElem.setDbTuningOptions("#opts=ls#bnum=%d#msiz=%d#ktopts=p" % (plan['bnum'], plan['msiz']))
+    dbElem.setDbServerOptions("-ls -tout 200000 -th %d" % plan['threads'])
+    dbElem.setDbMemory(plan['memory'])
+    dbElem.setDbTuningPlanned(True)
+    logger.info("Planned ktserver tuning for %i bases (snapshot size %s): %s" % \
+                (totalSequenceSize, snapshotSize, plan))
+    return plan['memory']
+
 def getKtTuningOptions(dbElem):
     """Get the appropriate KTServer tuning parameters (bucket size, etc.)"""
     # these are some hardcoded defaults.  should think about moving to config
@@ -203,12 +410,16 @@ def getKtServerOptions(dbElem):
         serverOptions = dbElem.getDbServerOptions()
     return serverOptions
 
-def getKtserverCommand(dbElem, logPath, snapshotDir):
-    """Get a ktserver command line with the proper options (in popen-type list format)."""
+def getKtserverCommand(dbElem, logPath, snapshotDir, readOnly=False):
+    """Get a ktserver command line with the proper options (in popen-type list format).
+
+    With readOnly, the server loads the snapshot but refuses writes."""
     serverOptions = getKtServerOptions(dbElem)
     tuning = getKtTuningOptions(dbElem)
     cmd = ["ktserver", "-port", str(dbElem.getDbPort())]
     cmd += serverOptions.split()
+    if readOnly:
+        cmd += ["-ord"]
     # Configure background snapshots, but set the interval between
     # snapshots to ~ 10 days so it'll never trigger. We are only
     # interested in the snapshot that the DB creates on termination.
@@ -217,15 +428,13 @@ def getKtserverCommand(dbElem, logPath, snapshotDir):
     cmd += [":" + tuning]
     return cmd
 
-def getRemoteParams(dbElem):
-    """Get parameters to supply to ktremotemgr to connect to the right DB."""
-    host = dbElem.getDbHost() or 'localhost'
-    return ['-port', str(dbElem.getDbPort()),
-            '-host', host]
-
 def stopKtserver(dbElem):
     """Attempt to send the terminate signal to a ktserver."""
-    cactus_call(parameters=['ktremotemgr', 'set'] + getRemoteParams(dbElem) + ['TERMINATE', '1'])
+    client = KtClient(dbElem)
+    try:
+        client.set(TERMINATE_KEY, '1', signal=TERMINATE_KEY)
+    finally:
+        client.close()
 
 def getHostName():
     if platform.system() == 'Darwin':
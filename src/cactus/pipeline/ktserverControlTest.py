@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+#Released under the MIT license, see LICENSE.txt
+import os
+import shutil
+import signal
+import unittest
+import threading
+import time
+import urllib
+import xml.etree.ElementTree as ET
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from sonLib.bioio import getTempDirectory
+from sonLib.bioio import getTempFile
+from cactus.shared.common import cactus_call
+from cactus.shared.experimentWrapper import DbElemWrapper
+from cactus.pipeline.ktserverControl import KtClient, blockUntil, stopKtserver, TERMINATE_KEY, \
+    planKtserverTuning, applyKtserverTuning, getKtTuningOptions, getKtServerOptions, \
+    chooseKtserverPort, getKtserverCommand, blockUntilKtserverIsRunning, blockUntilKtserverIsFinished, \
+    KTSERVER_SNAPSHOT_NAME
+from cactus.pipeline.ktserverLocal import makeSnapshotDatabaseString, getSnapshotID, getSnapshotSize, \
+    getSnapshotRequirements, localSnapshotDatabase
+
+class FakeKtserver(ThreadingMixIn, HTTPServer):
+    """Just enough of the ktserver RPC protocol to test the client."""
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('localhost', 0), FakeKtserverHandler)
+        self.records = {}
+        self.condition = threading.Condition()
+
+class FakeKtserverHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Don't let the small writes of a response wait on delayed ACKs.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        params = dict(map(urllib.unquote, line.split("\t", 1)) for line in body.splitlines())
+        server = self.server
+        status, output = 200, ""
+        with server.condition:
+            if "WAIT" in params:
+                server.condition.wait(float(params["WAITTIME"]))
+            procedure = self.path.split("/")[-1]
+            if procedure == "get":
+                if params["key"] in server.records:
+                    output = "value\t%s\n" % urllib.quote(server.records[params["key"]])
+                else:
+                    status = 450
+            elif procedure == "set":
+                server.records[params["key"]] = params["value"]
+            elif procedure == "remove":
+                if server.records.pop(params["key"], None) is None:
+                    status = 450
+            elif procedure == "get_bulk":
+                output = "".join("%s\t%s\n" % (urllib.quote(name), urllib.quote(server.records[name[1:]]))
+                                 for name in params if name.startswith("_") and name[1:] in server.records)
+            elif procedure == "set_bulk":
+                server.records.update((name[1:], value) for name, value in params.items() if name.startswith("_"))
+            elif procedure == "remove_bulk":
+                for name in params:
+                    if name.startswith("_"):
+                        server.records.pop(name[1:], None)
+            if "SIGNAL" in params:
+                server.condition.notify_all()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/tab-separated-values; colenc=U")
+        self.send_header("Content-Length", str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+class LocalFileStore(object):
+    """Just enough of a file store, kept in a local directory, for
+    localSnapshotDatabase."""
+    def __init__(self, tempDir):
+        self.tempDir = tempDir
+        self.files = {}
+
+    def getLocalTempDir(self):
+        return getTempDirectory(self.tempDir)
+
+    def getLocalTempFile(self):
+        return getTempFile(rootDir=self.tempDir)
+
+    def readGlobalFile(self, fileID, userPath=None, mutable=False):
+        shutil.copyfile(self.files[fileID], userPath)
+        return userPath
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = FakeKtserver()
+        self.serverThread = threading.Thread(target=self.server.serve_forever)
+        self.serverThread.daemon = True
+        self.serverThread.start()
+        self.dbElem = DbElemWrapper(ET.fromstring('<st_kv_database_conf type="kyoto_tycoon">'
+                                                  '<kyoto_tycoon host="localhost" port="%i"/>'
+                                                  '</st_kv_database_conf>' % self.server.server_port))
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testKtClient(self):
+        client = KtClient(self.dbElem)
+        self.assertTrue(client.isReachable())
+        self.assertEquals(client.get("foo"), None)
+        client.set("foo", "bar")
+        self.assertEquals(client.get("foo"), "bar")
+        client.remove("foo")
+        client.remove("foo")
+        self.assertEquals(client.get("foo"), None)
+        # Keys and values can be binary
+        client.set("\x00\t\n", "\xff\n")
+        self.assertEquals(client.get("\x00\t\n"), "\xff\n")
+        client.setBulk([("a", "1"), ("b", "2")])
+        self.assertEquals(client.getBulk(["a", "b", "c"]), {"a": "1", "b": "2"})
+        client.removeBulk(["a", "c"])
+        self.assertEquals(client.getBulk(["a", "b"]), {"b": "2"})
+        client.close()
+
+    def testWaitForTerminate(self):
+        # A waiting client should wake up as soon as the terminate key
+        # is set, rather than on its next check.
+        client = KtClient(self.dbElem)
+        checks = []
+        def terminate():
+            time.sleep(0.5)
+            stopKtserver(self.dbElem)
+        threading.Thread(target=terminate).start()
+        start = time.time()
+        self.assertEquals(client.waitForKey(TERMINATE_KEY, waitTime=30, checkFn=lambda: checks.append(1)), "1")
+        self.assertTrue(time.time() - start < 10)
+        self.assertEquals(checks, [])
+        client.close()
+
+    def testBlockUntil(self):
+        start = time.time()
+        self.assertTrue(blockUntil(lambda: time.time() - start > 0.2, timeout=5))
+        self.assertFalse(blockUntil(lambda: False, timeout=0.2))
+
+    def testPlanKtserverTuning(self):
+        small = planKtserverTuning(10**7)
+        large = planKtserverTuning(10**10)
+        for key in ('bnum', 'msiz', 'threads', 'memory'):
+            self.assertTrue(small[key] < large[key])
+        self.assertEquals(small['threads'], 8)
+        self.assertEquals(large['threads'], 64)
+        self.assertEquals(small['memory'], 2500000000)
+        # A snapshot bigger than predicted grows the DB
+        self.assertTrue(planKtserverTuning(10**7, snapshotSize=10**10)['memory'] > small['memory'])
+        self.assertEquals(planKtserverTuning(10**7, snapshotSize=10**3), small)
+
+    def testApplyKtserverTuning(self):
+        plan = planKtserverTuning(10**9)
+        self.assertEquals(applyKtserverTuning(self.dbElem, 10**9), plan['memory'])
+        self.assertTrue(self.dbElem.getDbTuningPlanned())
+        self.assertEquals(getKtTuningOptions(self.dbElem),
+                          "#opts=ls#bnum=%i#msiz=%i#ktopts=p" % (plan['bnum'], plan['msiz']))
+        self.assertEquals(getKtServerOptions(self.dbElem), "-ls -tout 200000 -th %i" % plan['threads'])
+        # Rerunning from the recorded XML gives the same settings
+        rerunDbElem = DbElemWrapper(ET.fromstring(self.dbElem.getConfString()))
+        self.assertEquals(applyKtserverTuning(rerunDbElem, 10**9), plan['memory'])
+        self.assertEquals(rerunDbElem.getConfString(), self.dbElem.getConfString())
+        # The plan grows with the snapshot, but never shrinks
+        self.assertEquals(applyKtserverTuning(self.dbElem, 10**9, snapshotSize=10**3), plan['memory'])
+        self.assertTrue(applyKtserverTuning(self.dbElem, 10**9, snapshotSize=10**11) > plan['memory'])
+        # Settings given by the user are left alone
+        self.dbElem.setDbTuningPlanned(False)
+        self.dbElem.setDbTuningOptions("#bnum=1")
+        self.assertEquals(applyKtserverTuning(self.dbElem, 10**11), self.dbElem.getDbMemory())
+        self.assertEquals(getKtTuningOptions(self.dbElem), "#bnum=1")
+
+    def testSnapshotDatabaseString(self):
+        confString = self.dbElem.getConfString()
+        self.assertEquals(getSnapshotID(confString), None)
+        # Ordinary DBs are used as they are
+        with localSnapshotDatabase(None, confString) as localConfString:
+            self.assertEquals(localConfString, confString)
+        self.assertEquals(getSnapshotRequirements(confString), (0, 0))
+        snapshotConfString = makeSnapshotDatabaseString(confString, "snapshot-1", 10**10)
+        self.assertEquals(getSnapshotID(snapshotConfString), "snapshot-1")
+        self.assertEquals(getSnapshotSize(snapshotConfString), 10**10)
+        self.assertEquals(getSnapshotRequirements(snapshotConfString),
+                          (planKtserverTuning(0, 10**10)['memory'], 2*10**10))
+        snapshotDbElem = DbElemWrapper(ET.fromstring(snapshotConfString))
+        self.assertEquals(snapshotDbElem.getDbPort(), self.dbElem.getDbPort())
+        self.assertEquals(snapshotDbElem.getDbType(), "kyoto_tycoon")
+
+    def testServeSnapshot(self):
+        """A job should be able to read, but not write, its own copy of a
+        snapshot, which is no longer served once the job is done with it."""
+        tempDir = getTempDirectory(os.getcwd())
+        try:
+            # Make a snapshot of a DB with a record in it
+            dbElem = DbElemWrapper(ET.fromstring('<st_kv_database_conf type="kyoto_tycoon">'
+                                                 '<kyoto_tycoon host="127.0.0.1" port="%i"/>'
+                                                 '</st_kv_database_conf>' % chooseKtserverPort()))
+            snapshotDir = getTempDirectory(tempDir)
+            logPath = getTempFile(rootDir=tempDir)
+            process = cactus_call(server=True, shell=False, port=dbElem.getDbPort(),
+                                  parameters=getKtserverCommand(dbElem, logPath, snapshotDir))
+            self.assertTrue(blockUntilKtserverIsRunning(logPath, dbElem=dbElem))
+            client = KtClient(dbElem)
+            client.set("foo", "bar")
+            client.close()
+            process.send_signal(signal.SIGINT)
+            process.wait()
+            blockUntilKtserverIsFinished(logPath)
+            fileStore = LocalFileStore(tempDir)
+            fileStore.files["snapshot-1"] = os.path.join(snapshotDir, KTSERVER_SNAPSHOT_NAME)
+
+            snapshotConfString = makeSnapshotDatabaseString(dbElem.getConfString(), "snapshot-1",
+                                                            os.path.getsize(fileStore.files["snapshot-1"]))
+            with localSnapshotDatabase(fileStore, snapshotConfString) as localConfString:
+                self.assertEquals(getSnapshotID(localConfString), "snapshot-1")
+                localDbElem = DbElemWrapper(ET.fromstring(localConfString))
+                self.assertEquals(localDbElem.getDbHost(), "127.0.0.1")
+                client = KtClient(localDbElem)
+                self.assertEquals(client.get("foo"), "bar")
+                self.assertRaises(RuntimeError, client.set, "foo", "baz")
+                client.close()
+            self.assertFalse(KtClient(localDbElem, timeout=5).isReachable())
+        finally:
+            shutil.rmtree(tempDir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Job-local, read-only copies of a cactus DB snapshot.
+
+The reference extraction and fasta generation each read the whole of
+the primary DB in a single job. Rather than sending all their requests
+to the central ktserver, which the many jobs of the HAL generation
+share, those jobs can serve their own copy of the last snapshot. The
+snapshot is fetched from the file store into the job's work dir and
+loaded by a read-only ktserver bound to the loopback interface, which is
+stopped again before the job ends. The copy costs a job as much memory
+and disk as the DB itself, so it is only worth it for a few such coarse
+jobs: any job reading a snapshot has its own copy, charged to it.
+
+A DB conf string can be marked as standing for a snapshot with
+makeSnapshotDatabaseString. Jobs then open it with
+localSnapshotDatabase, which gives a conf string for the job's copy.
+Jobs that open a snapshot should add getSnapshotRequirements to their
+memory and disk requests.
+"""
+
+import os
+import signal
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+
+from toil.lib.bioio import logger
+from cactus.shared.common import cactus_call
+from cactus.shared.experimentWrapper import DbElemWrapper
+from cactus.pipeline.ktserverControl import KTSERVER_SNAPSHOT_NAME, blockUntilKtserverIsRunning, \
+    chooseKtserverPort, getKtserverCommand, planKtserverTuning
+
+def makeSnapshotDatabaseString(cactusDiskDatabaseString, snapshotID, snapshotSize):
+    """Mark a (kyoto_tycoon) DB conf string as standing for a read-only
+    local copy of the given snapshot, of snapshotSize bytes."""
+    confElem = ET.fromstring(cactusDiskDatabaseString)
+    dbElem = DbElemWrapper(confElem).getDbElem()
+    dbElem.attrib["snapshot_id"] = snapshotID
+    dbElem.attrib["snapshot_size"] = str(snapshotSize)
+    return ET.tostring(confElem)
+
+def getSnapshotID(cactusDiskDatabaseString):
+    """Get the snapshot a DB conf string stands for, or None if it is
+    an ordinary DB conf string."""
+    confElem = ET.fromstring(cactusDiskDatabaseString)
+    return DbElemWrapper(confElem).getDbElem().attrib.get("snapshot_id")
+
+def getSnapshotSize(cactusDiskDatabaseString):
+    """Get the size of the snapshot a DB conf string stands for, or None
+    if it is an ordinary DB conf string."""
+    confElem = ET.fromstring(cactusDiskDatabaseString)
+    snapshotSize = DbElemWrapper(confElem).getDbElem().attrib.get("snapshot_size")
+    return int(snapshotSize) if snapshotSize is not None else None
+
+def getSnapshotRequirements(cactusDiskDatabaseString):
+    """Get the extra memory and disk, as a (memory, disk) pair, that a
+    job needs to serve its own copy of the snapshot a DB conf string
+    stands for, or (0, 0) for an ordinary DB conf string.
+
+    The server holds the whole DB in memory, and the disk has to hold
+    both the copy of the snapshot and the snapshot the server writes as
+    it shuts down."""
+    snapshotSize = getSnapshotSize(cactusDiskDatabaseString)
+    if snapshotSize is None:
+        return 0, 0
+    return planKtserverTuning(0, snapshotSize)['memory'], 2 * snapshotSize
+
+@contextmanager
+def localSnapshotDatabase(fileStore, cactusDiskDatabaseString):
+    """Open the DB conf string for reading in this job, giving the conf
+    string to pass to the cactus tools.
+
+    Ordinary conf strings are given back as they are. For a snapshot
+    conf string, the snapshot is fetched into the job's work dir and
+    served until the block exits, when the server is stopped.
+    """
+    snapshotID = getSnapshotID(cactusDiskDatabaseString)
+    if snapshotID is None:
+        yield cactusDiskDatabaseString
+        return
+    snapshotDir = os.path.join(fileStore.getLocalTempDir(), "snapshot")
+    os.mkdir(snapshotDir)
+    # The server writes a new snapshot over this one as it shuts down,
+    # so it mustn't be shared with the file store's cache.
+    fileStore.readGlobalFile(snapshotID, userPath=os.path.join(snapshotDir, KTSERVER_SNAPSHOT_NAME),
+                             mutable=True)
+    logPath = fileStore.getLocalTempFile()
+    confElem = ET.fromstring(cactusDiskDatabaseString)
+    dbElem = DbElemWrapper(confElem)
+    dbElem.setDbHost("127.0.0.1")
+    dbElem.setDbPort(chooseKtserverPort())
+    process = cactus_call(server=True, shell=False,
+                          parameters=getKtserverCommand(dbElem, logPath, snapshotDir, readOnly=True),
+                          port=dbElem.getDbPort())
+    try:
+        if not blockUntilKtserverIsRunning(logPath, dbElem=dbElem):
+            with open(logPath) as f:
+                raise RuntimeError("Unable to launch local ktserver for snapshot %s. Log: %s" % (snapshotID, f.read()))
+        logger.info("Using local read-only ktserver on port %i for snapshot %s" % (dbElem.getDbPort(), snapshotID))
+        yield dbElem.getConfString()
+    finally:
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+            process.wait()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+A cactus DB split over several ktservers.
+
+The memory and request throughput of a single ktserver cap how many
+jobs can usefully use the primary DB at once. With shards="N" in the
+ktserver tag of the config, the primary DB is instead served by N
+ktservers ("shards"), each started, and later snapshotted, by a
+service of its own.
+
+The DB conf string given to the cactus tools is that of the first
+shard, with the endpoints of all the shards in its shard_endpoints
+attribute. The first shard also holds a table of the conf strings of
+all the shards, under a reserved key, from which cactusDisk (in
+api/impl/cactusDisk.c) opens the others. cactusDisk spreads records
+over the shards by consistent hashing of their keys, which ShardRing
+mirrors, so the two must be kept in step.
+"""
+
+import bisect
+import copy
+import struct
+
+from cactus.shared.experimentWrapper import DbElemWrapper
+from cactus.pipeline.ktserverControl import KtClient
+
+# The key of the shard table, CACTUS_DISK_SHARD_TABLE_KEY in cactusDisk.c.
+SHARD_TABLE_KEY = -100001
+
+# The number of points each shard has on the ring.
+SHARD_RING_POINTS = 64
+
+MASK64 = (1 << 64) - 1
+
+def mix64(x):
+    """The splitmix64 finalizer, on unsigned 64 bit ints."""
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+def encodeKey(key):
+    """The ktserver key of a cactus DB record, which cactusDisk stores
+    as a raw int64."""
+    return struct.pack("=q", key)
+
+class ShardRing(object):
+    """Consistent hashing of cactus DB keys onto shards.
+
+    Each shard has SHARD_RING_POINTS points on a ring of 64 bit hashes,
+    and a key belongs to the shard of the first point at or after the
+    key's hash. Adding a shard so only moves the keys that the new
+    shard takes over. Non-positive keys, which cactusDisk uses for the
+    parameters, the shard table and the unique ID counters, always
+    belong to the first shard.
+    """
+    def __init__(self, numShards):
+        self.numShards = numShards
+        ring = sorted((mix64((shard << 32) | i), shard)
+                      for shard in xrange(numShards) for i in xrange(SHARD_RING_POINTS))
+        self.points = [point for point, _ in ring]
+        self.shards = [shard for _, shard in ring]
+
+    def getShard(self, key):
+        if self.numShards == 1 or key <= 0:
+            return 0
+        index = bisect.bisect_left(self.points, mix64(key & MASK64))
+        return self.shards[index % len(self.shards)]
+
+def getShardDbElems(dbElem):
+    """Get a DB element for each shard of the DB, or just the DB's own
+    if it isn't split."""
+    endpoints = dbElem.getDbShardEndpoints()
+    if endpoints is None:
+        return [dbElem]
+    shardDbElems = []
+    for host, port in endpoints:
+        shardDbElem = DbElemWrapper(copy.deepcopy(dbElem.confElem))
+        del shardDbElem.getDbElem().attrib["shard_endpoints"]
+        shardDbElem.setDbHost(host)
+        shardDbElem.setDbPort(port)
+        shardDbElems.append(shardDbElem)
+    return shardDbElems
+
+def connectShards(shardDbElems):
+    """Join running shards into one DB, writing the shard table to the
+    first, and return the DB element of the whole DB.
+
+    This has to be done each time the shards are started, as they
+    won't have the same endpoints as when they were snapshotted."""
+    dbElem = DbElemWrapper(copy.deepcopy(shardDbElems[0].confElem))
+    if len(shardDbElems) > 1:
+        dbElem.setDbShardEndpoints([(shardDbElem.getDbHost(), shardDbElem.getDbPort())
+                                    for shardDbElem in shardDbElems])
+    client = KtClient(shardDbElems[0])
+    try:
+        client.set(encodeKey(SHARD_TABLE_KEY),
+                   "\n".join(shardDbElem.getConfString() for shardDbElem in shardDbElems))
+    finally:
+        client.close()
+    return dbElem
+
+class ShardedKtClient(object):
+    """KtClients for every shard of a DB, which send each cactus DB
+    record to the shard cactusDisk would."""
+    def __init__(self, dbElem, timeout=60):
+        self.clients = [KtClient(shardDbElem, timeout=timeout) for shardDbElem in getShardDbElems(dbElem)]
+        self.ring = ShardRing(len(self.clients))
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+    def getClient(self, key):
+        return self.clients[self.ring.getShard(key)]
+
+    def get(self, key):
+        return self.getClient(key).get(encodeKey(key))
+
+    def set(self, key, value):
+        self.getClient(key).set(encodeKey(key), value)
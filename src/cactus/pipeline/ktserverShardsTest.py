@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+#Released under the MIT license, see LICENSE.txt
+import unittest
+import threading
+import time
+import xml.etree.ElementTree as ET
+from multiprocessing import Process, Queue
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+
+from cactus.shared.experimentWrapper import DbElemWrapper
+from cactus.pipeline.ktserverControlTest import FakeKtserver, FakeKtserverHandler
+from cactus.pipeline.ktserverShards import mix64, encodeKey, ShardRing, SHARD_TABLE_KEY, \
+    getShardDbElems, connectShards, ShardedKtClient
+
+def makeDbElem(port):
+    return DbElemWrapper(ET.fromstring('<st_kv_database_conf type="kyoto_tycoon">'
+                                       '<kyoto_tycoon host="localhost" port="%i"/>'
+                                       '</st_kv_database_conf>' % port))
+
+class SlowKtserver(ThreadingMixIn, HTTPServer):
+    """A fake ktserver that is already as busy as it can be: requests
+    take a while and are served one at a time."""
+    daemon_threads = True
+
+    def __init__(self, latency):
+        HTTPServer.__init__(self, ('localhost', 0), SlowKtserverHandler)
+        self.records = {}
+        self.condition = threading.Condition()
+        self.latency = latency
+
+class SlowKtserverHandler(FakeKtserverHandler):
+    def do_POST(self):
+        with self.server.condition:
+            time.sleep(self.server.latency)
+        FakeKtserverHandler.do_POST(self)
+
+def runSlowKtserver(latency, ports):
+    server = SlowKtserver(latency)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+def runClient(dbElem, keys):
+    client = ShardedKtClient(dbElem)
+    for key in keys:
+        client.set(key, str(key))
+    client.close()
+
+class TestCase(unittest.TestCase):
+    def testMix64(self):
+        # The first output of splitmix64 seeded with 0, which cactusDisk.c
+        # must agree with.
+        self.assertEquals(mix64(0), 0xE220A8397B1DCDAF)
+        self.assertEquals(encodeKey(SHARD_TABLE_KEY), "\x5f\x79\xfe\xff\xff\xff\xff\xff")
+
+    def testShardRing(self):
+        keys = xrange(1, 20001)
+        ring = ShardRing(4)
+        counts = [0] * 4
+        for key in keys:
+            counts[ring.getShard(key)] += 1
+        for count in counts:
+            self.assertTrue(abs(count - 5000) < 1500)
+        # The reserved keys stay in the first shard
+        for key in (0, -1, -65536, -100000, SHARD_TABLE_KEY):
+            self.assertEquals(ring.getShard(key), 0)
+        # A new shard only takes keys from the others
+        biggerRing = ShardRing(5)
+        moved = [key for key in keys if biggerRing.getShard(key) != ring.getShard(key)]
+        self.assertTrue(all(biggerRing.getShard(key) == 4 for key in moved))
+        self.assertTrue(len(moved) < 0.3 * len(keys))
+        self.assertTrue(all(ShardRing(1).getShard(key) == 0 for key in keys))
+
+    def testConnectShards(self):
+        servers = [FakeKtserver() for _ in xrange(3)]
+        for server in servers:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        try:
+            shardDbElems = [makeDbElem(server.server_port) for server in servers]
+            dbElem = connectShards(shardDbElems)
+            self.assertEquals(dbElem.getDbPort(), servers[0].server_port)
+            self.assertEquals(dbElem.getDbShardEndpoints(),
+                              [("localhost", server.server_port) for server in servers])
+            # The table in the first shard lists every shard
+            self.assertEquals(servers[0].records[encodeKey(SHARD_TABLE_KEY)],
+                              "\n".join(shardDbElem.getConfString() for shardDbElem in shardDbElems))
+            self.assertEquals([e.getConfString() for e in getShardDbElems(DbElemWrapper(ET.fromstring(dbElem.getConfString())))],
+                              [e.getConfString() for e in shardDbElems])
+            # Records go to the shard the ring gives
+            client = ShardedKtClient(dbElem)
+            ring = ShardRing(3)
+            for key in xrange(1, 100):
+                client.set(key, str(key))
+                self.assertTrue(encodeKey(key) in servers[ring.getShard(key)].records)
+                self.assertEquals(client.get(key), str(key))
+            client.close()
+        finally:
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+
+    def timeLoad(self, numShards, numClients=8, requestsPerClient=100, latency=0.005):
+        """Time several client processes writing to a DB of numShards
+        busy servers, each in a process of its own."""
+        ports = Queue()
+        servers = [Process(target=runSlowKtserver, args=(latency, ports)) for _ in xrange(numShards)]
+        for server in servers:
+            server.daemon = True
+            server.start()
+        try:
+            dbElem = connectShards([makeDbElem(ports.get(timeout=10)) for _ in servers])
+            clients = [Process(target=runClient,
+                               args=(dbElem, range(i * requestsPerClient + 1, (i + 1) * requestsPerClient + 1)))
+                       for i in xrange(numClients)]
+            start = time.time()
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+                self.assertEquals(client.exitcode, 0)
+            return time.time() - start
+        finally:
+            for server in servers:
+                server.terminate()
+                server.join()
+
+    def testThroughputScalesWithShards(self):
+        oneShard = self.timeLoad(1)
+        fourShards = self.timeLoad(4)
+        self.assertTrue(oneShard > 2 * fourShards, "1 shard took %fs, 4 shards %fs" % (oneShard, fourShards))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Incremental snapshots of the primary cactus DB.
+
+Saving a full snapshot of the DB at every checkpoint costs a lot of I/O
+on large alignments, even though a phase may only change a small part
+of the DB. With incrementalSnapshots="1" in the ktserver tag of the
+config, the DB is instead saved as a chain: a full snapshot (the base)
+followed by deltas, each holding just the records changed by a phase.
+Restoring the DB loads the base, then applies the deltas in order.
+Once the chain has maxSnapshotDeltas deltas, the next checkpoint saves
+a full snapshot again, which starts a new chain.
+
+While the DB is recording a delta, cactusDisk (see api/impl/cactusDisk.c)
+journals the keys of all the records it changes, which captureDelta
+then reads back together with the current values of those records.
+"""
+
+import copy
+import struct
+import zlib
+
+from cactus.pipeline.ktserverShards import encodeKey
+
+# The keys of the journal, as in cactusDisk.c: the number of entries
+# written, and the base that each entry's number is subtracted from.
+JOURNAL_COUNT_KEY = -100002
+JOURNAL_KEY_BASE = -200000
+
+DELTA_MAGIC = "CACTUSDELTA1\n"
+
+class SnapshotChain(object):
+    """A base snapshot of the DB and the deltas on top of it, all file
+    store IDs.
+
+    If recording is set, the running DB is journaling its changes, to
+    be saved as the next delta of the chain."""
+    def __init__(self, baseID, deltaIDs=(), recording=False):
+        self.baseID = baseID
+        self.deltaIDs = list(deltaIDs)
+        self.recording = recording
+
+    @property
+    def size(self):
+        return sum(getattr(fileID, 'size', 0) for fileID in [self.baseID] + self.deltaIDs)
+
+    def recordingDelta(self):
+        """This chain, with the running DB recording the next delta."""
+        chain = copy.copy(self)
+        chain.recording = True
+        return chain
+
+    def withDelta(self, deltaID):
+        """This chain with a new delta added."""
+        return SnapshotChain(self.baseID, self.deltaIDs + [deltaID])
+
+def enableJournal(client):
+    """Start journaling the changes cactusDisk makes to the DB."""
+    client.set(encodeKey(JOURNAL_COUNT_KEY), struct.pack(">q", 0))
+
+def writeDelta(outputFile, records):
+    """Write (key, value) records to a delta file, where a value of None
+    means that the record was removed."""
+    compressor = zlib.compressobj()
+    outputFile.write(DELTA_MAGIC)
+    for key, value in records:
+        outputFile.write(compressor.compress(struct.pack("=qq", key, -1 if value is None else len(value))))
+        if value is not None:
+            outputFile.write(compressor.compress(value))
+    outputFile.write(compressor.flush())
+
+def readDelta(inputFile, bufferSize=1 << 20):
+    """Yield the (key, value) records of a delta file."""
+    if inputFile.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+        raise RuntimeError("Not a cactus DB delta snapshot")
+    decompressor = zlib.decompressobj()
+    headerSize = struct.calcsize("=qq")
+    data = ""
+    offset = 0
+    finished = False
+    while True:
+        available = len(data) - offset
+        recordSize = headerSize
+        if available >= headerSize:
+            recordSize += max(0, struct.unpack_from("=qq", data, offset)[1])
+        if available < recordSize:
+            # Read on until the buffer holds the whole record
+            if finished:
+                if available == 0:
+                    return
+                raise RuntimeError("Truncated cactus DB delta snapshot")
+            chunk = inputFile.read(bufferSize)
+            finished = chunk == ""
+            data = data[offset:] + (decompressor.flush() if finished else decompressor.decompress(chunk))
+            offset = 0
+            continue
+        key, valueSize = struct.unpack_from("=qq", data, offset)
+        offset += headerSize
+        if valueSize < 0:
+            yield key, None
+        else:
+            yield key, data[offset:offset + valueSize]
+            offset += valueSize
+
+def captureDelta(client, outputFile, batchSize=1000):
+    """Write the records changed since the journal was enabled to a
+    delta file, returning how many there are."""
+    count = struct.unpack(">q", client.get(encodeKey(JOURNAL_COUNT_KEY)))[0]
+    changedKeys = set()
+    for start in xrange(1, count + 1, batchSize):
+        entries = client.getBulk([encodeKey(JOURNAL_KEY_BASE - i)
+                                  for i in xrange(start, min(start + batchSize, count + 1))])
+        for entry in entries.itervalues():
+            changedKeys.update(struct.unpack("=%iq" % (len(entry) / 8), entry))
+    changedKeys = sorted(changedKeys)
+    def records():
+        for start in xrange(0, len(changedKeys), batchSize):
+            keys = changedKeys[start:start + batchSize]
+            values = client.getBulk([encodeKey(key) for key in keys])
+            for key in keys:
+                yield key, values.get(encodeKey(key))
+    writeDelta(outputFile, records())
+    return len(changedKeys)
+
+def applyDelta(client, inputFile, batchSize=1000):
+    """Apply the records of a delta file to the DB."""
+    toSet = []
+    toRemove = []
+    for key, value in readDelta(inputFile):
+        if value is None:
+            toRemove.append(encodeKey(key))
+        else:
+            toSet.append((encodeKey(key), value))
+        if len(toSet) >= batchSize:
+            client.setBulk(toSet)
+            toSet = []
+        if len(toRemove) >= batchSize:
+            client.removeBulk(toRemove)
+            toRemove = []
+    if len(toSet) > 0:
+        client.setBulk(toSet)
+    if len(toRemove) > 0:
+        client.removeBulk(toRemove)
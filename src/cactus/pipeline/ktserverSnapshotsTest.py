@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+#Released under the MIT license, see LICENSE.txt
+import unittest
+import threading
+import random
+import struct
+from StringIO import StringIO
+
+from cactus.pipeline.ktserverControl import KtClient
+from cactus.pipeline.ktserverControlTest import FakeKtserver
+from cactus.pipeline.ktserverShards import encodeKey
+from cactus.pipeline.ktserverShardsTest import makeDbElem
+from cactus.pipeline.ktserverSnapshots import SnapshotChain, writeDelta, readDelta, \
+    enableJournal, captureDelta, applyDelta, JOURNAL_COUNT_KEY, JOURNAL_KEY_BASE
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.servers = [FakeKtserver() for _ in xrange(2)]
+        for server in self.servers:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        self.clients = [KtClient(makeDbElem(server.server_port)) for server in self.servers]
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        for client in self.clients:
+            client.close()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def testDeltaFormat(self):
+        records = [(1, "foo"), (-5, None), (2, ""), (3, "\x00" * 100000),
+                   (4, "".join(chr(random.randint(0, 255)) for _ in xrange(5000)))]
+        deltaFile = StringIO()
+        writeDelta(deltaFile, records)
+        self.assertEquals(list(readDelta(StringIO(deltaFile.getvalue()), bufferSize=7)), records)
+        self.assertEquals(list(readDelta(StringIO(deltaFile.getvalue()))), records)
+        self.assertRaises(RuntimeError, list, readDelta(StringIO(deltaFile.getvalue()[:-20])))
+
+    def writeJournaled(self, client, records):
+        """Change records as cactusDisk does with the journal on."""
+        keys = [key for key, _ in records]
+        entry = struct.unpack(">q", client.get(encodeKey(JOURNAL_COUNT_KEY)))[0] + 1
+        client.set(encodeKey(JOURNAL_COUNT_KEY), struct.pack(">q", entry))
+        client.set(encodeKey(JOURNAL_KEY_BASE - entry), struct.pack("=%iq" % len(keys), *keys))
+        for key, value in records:
+            if value is None:
+                client.remove(encodeKey(key))
+            else:
+                client.set(encodeKey(key), value)
+
+    def testCaptureAndApplyDelta(self):
+        # Both DBs start from the same base
+        base = [(encodeKey(key), "base%i" % key) for key in xrange(-10, 200)]
+        for client in self.clients:
+            client.setBulk(base)
+        enableJournal(self.clients[0])
+        self.writeJournaled(self.clients[0], [(5, "changed"), (300, "new"), (7, None)])
+        self.writeJournaled(self.clients[0], [(5, "changed again"), (-3, "counter"), (8, None)])
+        deltaFile = StringIO()
+        self.assertEquals(captureDelta(self.clients[0], deltaFile, batchSize=2), 5)
+        self.assertEquals(list(readDelta(StringIO(deltaFile.getvalue()))),
+                          [(-3, "counter"), (5, "changed again"), (7, None), (8, None), (300, "new")])
+        # Applying the delta to the base gives the changed DB, apart
+        # from the journal
+        applyDelta(self.clients[1], StringIO(deltaFile.getvalue()), batchSize=2)
+        records = self.servers[0].records
+        for key in records.keys():
+            if struct.unpack("=q", key)[0] <= JOURNAL_KEY_BASE or key == encodeKey(JOURNAL_COUNT_KEY):
+                del records[key]
+        self.assertEquals(self.servers[1].records, records)
+
+    def testSnapshotChain(self):
+        chain = SnapshotChain("base")
+        recordingChain = chain.recordingDelta()
+        self.assertTrue(recordingChain.recording)
+        self.assertFalse(chain.recording)
+        chain = recordingChain.withDelta("delta1").recordingDelta().withDelta("delta2")
+        self.assertFalse(chain.recording)
+        self.assertEquals(chain.baseID, "base")
+        self.assertEquals(chain.deltaIDs, ["delta1", "delta2"])
+        self.assertEquals(recordingChain.deltaIDs, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,7 +8,8 @@ import os
 import stat
 from toil.job import Job
 from cactus.pipeline.ktserverControl import runKtserver, blockUntilKtserverIsRunning, stopKtserver, \
-    blockUntilKtserverIsFinished
+    blockUntilKtserverIsFinished, KtClient
+from cactus.pipeline.ktserverSnapshots import SnapshotChain, applyDelta, enableJournal
 
 class KtServerService(Job.Service):
     def __init__(self, dbElem, isSecondary, existingSnapshotID=None,
@@ -21,18 +22,34 @@ class KtServerService(Job.Service):
         self.process = None
 
     def start(self, job):
-        snapshotExportID = job.fileStore.jobStore.getEmptyFileStoreID()
-        # We need to run this garbage in case we are on a file-based
-        # jobStore with caching enabled. The caching jobStore sets
-        # this empty file to be unwritable for some reason. Since we
-        # need to write something to it, obviously that won't do.
-        path = job.fileStore.readGlobalFile(snapshotExportID)
-        os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH)
+        # The existing snapshot may be a chain of a base snapshot and
+        # deltas (see ktserverSnapshots)
+        chain = self.existingSnapshotID if isinstance(self.existingSnapshotID, SnapshotChain) else None
+        existingSnapshotID = chain.baseID if chain is not None else self.existingSnapshotID
+        snapshotExportID = None
+        if chain is None or not chain.recording:
+            snapshotExportID = job.fileStore.jobStore.getEmptyFileStoreID()
+            # We need to run this garbage in case we are on a file-based
+            # jobStore with caching enabled. The caching jobStore sets
+            # this empty file to be unwritable for some reason. Since we
+            # need to write something to it, obviously that won't do.
+            path = job.fileStore.readGlobalFile(snapshotExportID)
+            os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH)
         self.process, self.dbElem, self.logPath = runKtserver(self.dbElem, fileStore=job.fileStore,
-                                                              existingSnapshotID=self.existingSnapshotID,
+                                                              existingSnapshotID=existingSnapshotID,
                                                               snapshotExportID=snapshotExportID)
         assert self.dbElem.getDbHost() != None
-        blockUntilKtserverIsRunning(self.logPath)
+        blockUntilKtserverIsRunning(self.logPath, dbElem=self.dbElem)
+        if chain is not None:
+            client = KtClient(self.dbElem)
+            for deltaID in chain.deltaIDs:
+                with job.fileStore.readGlobalFileStream(deltaID) as f:
+                    applyDelta(client, f)
+            if chain.recording:
+                # The changes will be saved as a delta rather than a
+                # full snapshot.
+                enableJournal(client)
+            client.close()
         self.check()
         return self.dbElem.getConfString(), snapshotExportID
 
@@ -44,6 +61,10 @@ class KtServerService(Job.Service):
             # Server is probably already terminated
             pass
         if not self.failed:
+            # The babysitting process exits once the server has shut
+            # down and its snapshot has been exported.
+            self.process.join(1200)
+            self.check()
             blockUntilKtserverIsFinished(self.logPath, timeout=1200)
 
     def check(self):
@@ -14,17 +14,16 @@ import xml.etree.ElementTree as ET
 
 from toil.lib.bioio import logger
 
-from sonLib.bioio import getTempDirectory
 from toil.common import Toil
 from toil.job import Job
 from cactus.shared.common import cactus_call
 from cactus.shared.common import RoundedJob
 from cactus.shared.common import getOptionalAttrib
-from cactus.shared.common import runGetChunks
 from cactus.shared.common import makeURL
 from cactus.shared.common import readGlobalFileWithoutCache
 from cactus.shared.common import cactusRootPath
 from cactus.shared.configWrapper import ConfigWrapper
+from cactus.shared.fastaChunks import getChunks, readChunk, chunkFileSize
 
 from toil.lib.bioio import setLoggingFromOptions
 
@@ -34,7 +33,8 @@ from cactus.preprocessor.lastzRepeatMasking.cactus_lastzRepeatMask import Repeat
 
 class PreprocessorOptions:
     def __init__(self, chunkSize, memory, cpu, check, proportionToSample, unmask,
-                 preprocessJob, checkAssemblyHub=None, lastzOptions=None, minPeriod=None):
+                 preprocessJob, checkAssemblyHub=None, lastzOptions=None, minPeriod=None,
+                 compressFiles=False, virtualChunks=False):
         self.chunkSize = chunkSize
         self.memory = memory
         self.cpu = cpu
@@ -45,20 +45,22 @@ class PreprocessorOptions:
         self.checkAssemblyHub = checkAssemblyHub
         self.lastzOptions = lastzOptions
         self.minPeriod = minPeriod
+        self.compressFiles = compressFiles
+        self.virtualChunks = virtualChunks
 
 class CheckUniqueHeaders(RoundedJob):
     """
     Check that the headers of the input file meet certain naming requirements.
     """
     def __init__(self, prepOptions, inChunkID):
-        disk = inChunkID.size
+        disk = 2*chunkFileSize(inChunkID)
         RoundedJob.__init__(self, memory=prepOptions.memory, cores=prepOptions.cpu, disk=disk,
                      preemptable=True)
         self.prepOptions = prepOptions 
         self.inChunkID = inChunkID
 
     def run(self, fileStore):
-        inChunk = fileStore.readGlobalFile(self.inChunkID)
+        inChunk = readChunk(fileStore, self.inChunkID)
         with open(inChunk) as inFile:
             checkUniqueHeaders(inFile, checkAssemblyHub=self.prepOptions.checkAssemblyHub)
         # We re-write the file here so that the output's lifecycle
@@ -124,31 +126,29 @@ class PreprocessSequence(RoundedJob):
     def run(self, fileStore):
         logger.info("Preparing sequence for preprocessing")
 
-        inSequence = fileStore.readGlobalFile(self.inSequenceID)
-
         if self.prepOptions.chunkSize <= 0:
             # In this first case we don't need to break up the sequence
             chunked = False
-            inChunkList = [inSequence]
+            inSequence = fileStore.readGlobalFile(self.inSequenceID)
+            inChunkIDList = [fileStore.writeGlobalFile(inSequence, cleanup=True)]
         else:
-            # chunk it up
+            # chunk it up. Only the chunks are packed, as the merged
+            # output is a plain fasta file
             chunked = True
-            inChunkDirectory = getTempDirectory(rootDir=fileStore.getLocalTempDir())
-            inChunkList = runGetChunks(sequenceFiles=[inSequence], chunksDir=inChunkDirectory,
-                                       chunkSize=self.prepOptions.chunkSize,
-                                       overlapSize=0)
-            inChunkList = [os.path.abspath(path) for path in inChunkList]
-        logger.info("Chunks = %s" % inChunkList)
-
-        inChunkIDList = [fileStore.writeGlobalFile(chunk, cleanup=True) for chunk in inChunkList]
+            inChunkIDList = getChunks(fileStore, [self.inSequenceID],
+                                      chunkSize=self.prepOptions.chunkSize, overlapSize=0,
+                                      pack=self.prepOptions.compressFiles,
+                                      virtual=self.prepOptions.virtualChunks)
+        logger.info("Chunks = %s" % inChunkIDList)
+
         outChunkIDList = []
         #For each input chunk we create an output chunk, it is the output chunks that get concatenated together.
         if not self.chunksToCompute:
-            self.chunksToCompute = range(len(inChunkList))
+            self.chunksToCompute = range(len(inChunkIDList))
         for i in self.chunksToCompute:
             #Calculate the number of chunks to use
-            inChunkNumber = int(max(1, math.ceil(len(inChunkList) * self.prepOptions.proportionToSample)))
-            assert inChunkNumber <= len(inChunkList) and inChunkNumber > 0
+            inChunkNumber = int(max(1, math.ceil(len(inChunkIDList) * self.prepOptions.proportionToSample)))
+            assert inChunkNumber <= len(inChunkIDList) and inChunkNumber > 0
             #Now get the list of chunks flanking and including the current chunk
             j = max(0, i - inChunkNumber/2)
             inChunkIDs = inChunkIDList[j:j+inChunkNumber]
@@ -194,7 +194,9 @@ class BatchPreprocessor(RoundedJob):
                                           unmask = getOptionalAttrib(prepNode, "unmask", typeFn=bool, default=False),
                                           lastzOptions = getOptionalAttrib(prepNode, "lastzOpts", default=""),
                                           minPeriod = getOptionalAttrib(prepNode, "minPeriod", typeFn=int, default="0"),
-                                          checkAssemblyHub = getOptionalAttrib(prepNode, "checkAssemblyHub", typeFn=bool, default=False))
+                                          checkAssemblyHub = getOptionalAttrib(prepNode, "checkAssemblyHub", typeFn=bool, default=False),
+                                          compressFiles = getOptionalAttrib(prepNode, "compressFiles", typeFn=bool, default=False),
+                                          virtualChunks = getOptionalAttrib(prepNode, "virtualChunks", typeFn=bool, default=False))
         
         lastIteration = self.iteration == len(self.prepXmlElems) - 1
 
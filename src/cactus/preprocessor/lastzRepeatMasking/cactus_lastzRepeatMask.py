@@ -8,6 +8,7 @@ from sonLib.bioio import catFiles
 
 from cactus.shared.common import cactus_call
 from cactus.shared.common import RoundedJob
+from cactus.shared.fastaChunks import readChunk, chunkFileSize
 
 class RepeatMaskOptions:
     def __init__(self, 
@@ -33,9 +34,9 @@ class RepeatMaskOptions:
 
 class LastzRepeatMaskJob(RoundedJob):
     def __init__(self, repeatMaskOptions, queryID, targetIDs):
-        targetsSize = sum(targetID.size for targetID in targetIDs)
+        targetsSize = sum(chunkFileSize(targetID) for targetID in targetIDs)
         memory = 4*1024*1024*1024
-        disk = 2*(queryID.size + targetsSize)
+        disk = 2*(chunkFileSize(queryID) + targetsSize)
         RoundedJob.__init__(self, memory=memory, disk=disk, preemptable=True)
         self.repeatMaskOptions = repeatMaskOptions
         self.queryID = queryID
@@ -106,8 +107,8 @@ class LastzRepeatMaskJob(RoundedJob):
         """
         assert len(self.targetIDs) >= 1
         assert self.repeatMaskOptions.fragment > 1
-        queryFile = fileStore.readGlobalFile(self.queryID)
-        targetFiles = [fileStore.readGlobalFile(fileID) for fileID in self.targetIDs]
+        queryFile = readChunk(fileStore, self.queryID)
+        targetFiles = [readChunk(fileStore, fileID) for fileID in self.targetIDs]
 
         fragments = self.getFragments(fileStore, queryFile)
         alignment = self.alignFastaFragments(fileStore, targetFiles, fragments)
@@ -29,7 +29,10 @@ from cactus.shared.common import catFiles
 from cactus.shared.common import cactus_call
 from cactus.shared.common import RoundedJob
 from cactus.shared.common import getDockerImage
+from cactus.shared.common import exportFilesInBackground
 from cactus.shared.version import cactus_commit
+from cactus.shared.resourceModel import ResourceModelStore
+from cactus.shared.resourceModel import addResourceModelToConfig
 
 from toil.job import Job
 from toil.common import Toil
@@ -256,11 +259,11 @@ class RunCactusPreprocessorThenProgressiveDown2(RoundedJob):
         self.configWrapper = ConfigWrapper(self.configNode)
         self.configWrapper.substituteAllPredefinedConstantsWithLiterals()
 
-        # Save preprocessed sequences
+        # Save preprocessed sequences, alongside the alignment
         if self.options.intermediateResultsUrl is not None:
             preprocessedSequences = self.project.getOutputSequenceIDMap()
-            for genome, seqID in preprocessedSequences.items():
-                fileStore.exportFile(seqID, self.options.intermediateResultsUrl + '-preprocessed-' + genome)
+            exportFilesInBackground(self, [(seqID, self.options.intermediateResultsUrl + '-preprocessed-' + genome)
+                                           for genome, seqID in preprocessedSequences.items()])
 
         # Log the stats for the preprocessed assemblies
         for name, sequence in self.project.getOutputSequenceIDMap().items():
@@ -340,6 +343,8 @@ def setupBinaries(options):
         # case the default is to use Docker.
         mode = os.environ.get("CACTUS_BINARIES_MODE", "docker")
     os.environ["CACTUS_BINARIES_MODE"] = mode
+    if options.containerSession:
+        os.environ["CACTUS_CONTAINER_SESSION"] = "1"
     if mode == "docker":
         # Verify Docker exists on the target system
         from distutils.spawn import find_executable
@@ -444,6 +449,17 @@ def main():
                         "rather than pulling one from quay.io")
     parser.add_argument("--binariesMode", choices=["docker", "local", "singularity"],
                         help="The way to run the Cactus binaries", default=None)
+    parser.add_argument("--containerSession", action="store_true",
+                        help="Start one container per job and run all of that job's "
+                        "Cactus binaries inside it, rather than starting a new "
+                        "container for every binary", default=False)
+    parser.add_argument("--resourceModel", dest="resourceModel", default=None,
+                        help="Size job memory using the model fitted by "
+                        "cactus_fitResourceModel in this model store, rather "
+                        "than the memory polynomials in the config")
+    parser.add_argument("--resourceModelMargin", dest="resourceModelMargin", type=float,
+                        help="Fraction of extra memory to request on top of the "
+                        "fitted model's prediction", default=0.25)
 
     options = parser.parse_args()
 
@@ -505,9 +521,18 @@ def main():
 
             #import cactus config
             if options.configFile:
-                cactusConfigID = toil.importFile(makeURL(options.configFile))
+                configPath = options.configFile
             else:
-                cactusConfigID = toil.importFile(makeURL(project.getConfigPath()))
+                configPath = project.getConfigPath()
+            if options.resourceModel:
+                # Embed the fitted memory model in the config, so every
+                # job sees the same one
+                configXML = ET.parse(configPath)
+                addResourceModelToConfig(configXML.getroot(), ResourceModelStore(options.resourceModel),
+                                         options.resourceModelMargin)
+                configPath = os.path.join(options.cactusDir, "config_with_resource_model.xml")
+                configXML.write(configPath)
+            cactusConfigID = toil.importFile(makeURL(configPath))
             project.setConfigID(cactusConfigID)
 
             project.syncToFileStore(toil)
@@ -12,8 +12,6 @@ leaves as outgroups
 
 import os
 import math
-import copy
-import itertools
 import networkx as NX
 from collections import defaultdict, namedtuple
 from optparse import OptionParser
@@ -34,10 +32,7 @@ class GreedyOutgroup(object):
     # add edges from sonlib tree to self.dag
     # compute self.dm: an undirected distance matrix
     def importTree(self, mcTree, rootId = None):
-        self.mcTree = mcTree
-        self.dag = mcTree.nxDg.copy()
-        self.root = mcTree.rootId
-        self.stripNonEvents(self.root, mcTree.subtreeRoots)
+        self.importDag(mcTree)
         self.dmDirected = dict(NX.algorithms.shortest_paths.weighted.\
         all_pairs_dijkstra_path_length(self.dag))
         self.invalidSet = self.getInvalid(rootId)
@@ -46,6 +41,13 @@ class GreedyOutgroup(object):
         all_pairs_dijkstra_path_length(graph))
         self.ogMap = defaultdict(list)
 
+    # add edges from sonlib tree to self.dag
+    def importDag(self, mcTree):
+        self.mcTree = mcTree
+        self.dag = mcTree.nxDg.copy()
+        self.root = mcTree.rootId
+        self.stripNonEvents(self.root, mcTree.subtreeRoots)
+
     # return set of ancestral nodes that aren't below alignment root
     # they can't be outgroups as they are effective "out of project"
     def getInvalid(self, rootId):
@@ -258,7 +260,10 @@ class DynamicOutgroup(GreedyOutgroup):
     # for internal nodes, we store the stats of the max leaf underneath
     def importTree(self, mcTree, seqMap, rootId = None, candidateSet = None,
                    candidateBoost = 1.5):
-        super(DynamicOutgroup, self).importTree(mcTree, rootId)
+        # the all-pairs distance matrices used by the greedy
+        # algorithm aren't needed here, and are quadratic in the size
+        # of the tree
+        self.importDag(mcTree)
         self.candidateSet = candidateSet
         if candidateSet is not None and len(candidateSet) == 0:
             self.candidateSet = None
@@ -305,127 +310,138 @@ class DynamicOutgroup(GreedyOutgroup):
         self.lossFac = sequenceLossWeight
         self.numOG = maxNumOutgroups
         self.ogMap = dict()
+        self.DPEntry = namedtuple("DPEntry", "score solution")
+        # map (node id, parent id) to [(score, solution)] for the
+        # subtree hanging off node when the tree is rooted on the
+        # parent's side, where the list is for 0, 1, 2, ... k (ie best
+        # score for solution of size k).  these don't depend on which
+        # ancestor is the target, so are shared between all of them.
+        self.dpTable = dict()
 
         for node in self.mcTree.breadthFirstTraversal(self.root):
             if self.mcTree.isLeaf(node) or not self.mcTree.hasParent(node):
                 continue
-            self.__dpInit(node)
-            self.__dpRun(node)
+            # the tree is rerooted at the target ancestor with
+            # everything below it, ie invalid outgroups, cut out, so
+            # its only child is its parent
+            parent = self.mcTree.getParent(node)
+            nodeTable = self.__dpNode(node, [parent])
             nodeName = self.mcTree.getName(node)
             bestK = 0
             # we look for highest k with non-zero solution.
             # (can swap >= 0.0 with bestScore below to get the global best
             # not sure we'd want fewer outgroups..)
             for i in xrange(self.numOG + 1):
-                if self.dpTable[node][i].score > 0.0:
+                if nodeTable[i].score > 0.0:
                     bestK = i
 
             # we rank solution based on individual conservation score
             # of each outgroup vis-a-vis the target
-            #rankFn = lambda x : 1. - self.__computeBranchConservation(
-            #    x, self.dpTree.getRootId())
             # scratch that, we just use distance:
-            rankFn = self.__getOgDist
-            rankedSolution = sorted(self.dpTable[node][bestK].solution,
+            rankFn = lambda x: self.__getOgDist(x, node)
+            rankedSolution = sorted(nodeTable[bestK].solution,
                                     key = rankFn)
             # convert to EventName,Dist format.  Note that distance
             # here is not necessarily what we're ranking on, and we include
             # it for consistency only.  
-            self.ogMap[nodeName] = [(self.dpTree.getName(x),
-                                     self.__getOgDist(x))
+            self.ogMap[nodeName] = [(self.mcTree.getName(x),
+                                     self.__getOgDist(x, node))
                                      for x in rankedSolution]
             for og, dist in self.ogMap[nodeName]:
                 self.dag.add_edge(node, self.mcTree.getNodeId(og),
                                   weight=dist, info="outgroup")
-                #print self.dpTree.getName(node), "-->", og
-                
-    # initialize dynamic programming table
-    def __dpInit(self, ancestralNodeId):
-        self.dpTree = copy.deepcopy(self.mcTree)
-        self.rootSeqInfo = None
-        self.branchProbs = dict()
-        self.DPEntry = namedtuple("DPEntry", "score solution")
-        self.leafDistances = dict()
-        # map .node id to [(score, solution)]
-        # where list is for 0, 1, 2, ... k (ie best score for solution
-        # of size k)
-        self.dpTable = dict()
 
-        # make a new tree rooted at the target ancestor with everything
-        # below it, ie invalid outgroups, cut out
-        for child in self.dpTree.getChildren(ancestralNodeId):
-            self.dpTree.removeEdge(ancestralNodeId, child)
-        self.dpTree.reroot(ancestralNodeId)
-        self.rootSeqInfo = self.sequenceInfo[self.dpTree.getRootId()]
-
-        # compute all the branch conservation probabilities
-        for node in self.dpTree.preOrderTraversal():
-            if self.dpTree.hasParent(node):
-                self.branchProbs[node] = self.__computeBranchConservation(node)
-
-        # set table to 0
-        for node in self.dpTree.preOrderTraversal():
-            self.dpTable[node] = []
-            for i in xrange(self.numOG + 1):
-                self.dpTable[node].append(self.DPEntry(0.0, []))
-                
+    # children of node when the tree is rerooted so that parent is
+    # its parent (in the same order as getChildren would give)
+    def __dpChildren(self, node, parent):
+        neighbours = self.mcTree.getChildren(node)
+        if self.mcTree.hasParent(node):
+            neighbours.append(self.mcTree.getParent(node))
+        return sorted([x for x in neighbours if x != parent])
+
+    # fill in the dynamic programming table for the subtree hanging
+    # off node when the tree is rooted on parent's side.  done
+    # bottom-up with an explicit stack since the trees can be deeper
+    # than the recursion limit.
+    def __dpRun(self, node, parent):
+        stack = [(node, parent, False)]
+        while len(stack) > 0:
+            node, parent, childrenDone = stack.pop()
+            if (node, parent) in self.dpTable:
+                continue
+            children = self.__dpChildren(node, parent)
+            if childrenDone:
+                self.dpTable[(node, parent)] = self.__dpNode(node, children)
+            else:
+                stack.append((node, parent, True))
+                for child in children:
+                    if (child, node) not in self.dpTable:
+                        stack.append((child, node, False))
+
     # compute score for given node from its children using the dynamic
     # programming table
-    def __dpNode(self, node):
-        children = self.dpTree.getChildren(node)
-        numChildren = len(children)
+    def __dpNode(self, node, children):
+        table = [self.DPEntry(0.0, [])] * (self.numOG + 1)
         # special case for leaf
-        if numChildren == 0:
-            self.dpTable[node][1] = self.DPEntry(1.0, [node])
-        else:
-            # iterate all possible combinations of child solution sizes
-            # (very inefficeint since we only want unique solutions with
-            # sum <= numOG, but assume numbers are small enough so doesn't
-            # matter for now)
-            cset = [x for x in xrange(0, self.numOG + 1)]
-            if math.pow(len(cset), numChildren) > 1e6:
-                raise RuntimeError("Dynamic Outgroup selection error for"
-                                   " %s: degree limit exceeded.  Need to fix "
-                                   "this!!" % self.dpTree.getName(node))
-            for scoreAlloc in itertools.product(*[cset] * numChildren):
-                csetK = sum(scoreAlloc)
-                if  csetK > self.numOG:
+        if len(children) == 0:
+            if self.numOG > 0:
+                table[1] = self.DPEntry(1.0, [node])
+            return table
+        for child in children:
+            self.__dpRun(child, node)
+        # the probability that a base is lost along all the branches
+        # is a product of the complement of conservation along each
+        # branch, so the best allocation of outgroups to the children
+        # can be built up one child at a time, knapsack style.  we
+        # keep, for each total k, the lowest loss over the children
+        # so far, along with the allocation of k to each child
+        # (breaking ties in favour of the lexicographically smallest
+        # allocation) and the outgroups it picks.
+        best = [(1.0, (), [])] + [None] * self.numOG
+        for child in children:
+            branchProb = self.__computeBranchConservation(child, node)
+            childTable = self.dpTable[(child, node)]
+            merged = [None] * (self.numOG + 1)
+            for prevK, prev in enumerate(best):
+                if prev is None:
                     continue
-                # we compute the probability that a base is lost along
-                # all the branches (so will be a product of of complement
-                # of conservations along each branch)
-                lossProb = 1.0
-                solution = []
-                for childNo, childId in enumerate(children):
-                    childK = scoreAlloc[childNo]
-                    childCons = self.dpTable[childId][childK].score
-                    lossProb *= (1. - self.branchProbs[childId] * childCons)
-                    solution += self.dpTable[childId][childK].solution
-                # overall conservation is 1 - loss
-                consProb = 1. - lossProb
-                assert consProb >= 0. and consProb <= 1.
-                assert len(solution) <= csetK
-                if consProb > self.dpTable[node][csetK].score and \
-                  len(solution) == csetK:
-                    self.dpTable[node][csetK] = self.DPEntry(consProb, solution)
-                    
-    # get the dynamic programming solution (for a single ancestor set in
-    # __dpInit...)
-    def __dpRun(self, node):
-        for child in self.dpTree.getChildren(node):
-            self.__dpRun(child)
-        self.__dpNode(node)
-        
+                prevLoss, prevAlloc, prevSolution = prev
+                for childK in xrange(self.numOG + 1 - prevK):
+                    childEntry = childTable[childK]
+                    # skip child sizes with no solution
+                    if len(childEntry.solution) != childK:
+                        continue
+                    lossProb = prevLoss * (1. - branchProb * childEntry.score)
+                    alloc = prevAlloc + (childK,)
+                    k = prevK + childK
+                    # compare on conservation (as the final score is)
+                    # so that losses equal up to rounding count as ties
+                    if (merged[k] is None or 1. - lossProb > 1. - merged[k][0] or
+                        (1. - lossProb == 1. - merged[k][0] and alloc < merged[k][1])):
+                        merged[k] = (lossProb, alloc, prevSolution + childEntry.solution)
+            best = merged
+        for k, entry in enumerate(best):
+            if entry is None:
+                continue
+            # overall conservation is 1 - loss
+            consProb = 1. - entry[0]
+            assert consProb >= 0. and consProb <= 1.
+            if consProb > 0.0:
+                table[k] = self.DPEntry(consProb, entry[2])
+        return table
+
+    # get the length of the branch between two adjacent nodes,
+    # whichever way up the tree is
+    def __getBranchLength(self, node1, node2, defaultValue=None):
+        if self.mcTree.hasParent(node1) and self.mcTree.getParent(node1) == node2:
+            return self.mcTree.getWeight(node2, node1, defaultValue)
+        return self.mcTree.getWeight(node1, node2, defaultValue)
+
     # compute the probability that a base is not "lost" on a branch
-    # from given node to its parent
-    # ancestor parameter allows us to consider a path from the node
-    # to any ancestor in the tree as a single "branch" for purposes
-    # of computation.  if none, then the immediate parent is used. 
-    def __computeBranchConservation(self, node, ancestor=None):
-        if ancestor is None:
-            ancestor = self.dpTree.getParent(node)
+    # from given node to its (adjacent) parent in the rerooted tree
+    def __computeBranchConservation(self, node, parent):
         nodeInfo = self.sequenceInfo[node]
-        ancInfo = self.sequenceInfo[ancestor]
+        ancInfo = self.sequenceInfo[parent]
         
         # Loss probablity models alignment lost due to assembly quality.  We 
         # use proportion of N50 (minus Ns) as crude proxy
@@ -438,15 +454,11 @@ class DynamicOutgroup(GreedyOutgroup):
         # Mutation probability is proportional to branch length.  We use
         # Jukes-Cantor model
         branchLength = 0.
-        x = node
-        while x != ancestor:
-            weight = self.dpTree.getWeight(self.dpTree.getParent(x), x, None)
-            if weight is None or weight < 0 or weight >= 1:
-                # some kind of warning should happen here
-                weight = self.defaultBranchLength
-            branchLength += weight
-            x = self.dpTree.getParent(x)
-            assert x is not None
+        weight = self.__getBranchLength(parent, node)
+        if weight is None or weight < 0 or weight >= 1:
+            # some kind of warning should happen here
+            weight = self.defaultBranchLength
+        branchLength += weight
         jcMutProb = .75 - .75 * math.exp(-branchLength)
         jcMutProb *= self.mutFac
 
@@ -454,14 +466,20 @@ class DynamicOutgroup(GreedyOutgroup):
         assert conservationProb >= 0. and conservationProb <= 1.
         return conservationProb
 
-    def __getOgDist(self, node):
+    # distance from node to the target ancestor, walking up the tree
+    # rerooted at the target
+    def __getOgDist(self, node, target):
+        targetAncestors = [target]
+        while self.mcTree.hasParent(targetAncestors[-1]):
+            targetAncestors.append(self.mcTree.getParent(targetAncestors[-1]))
+        targetAncestorSet = set(targetAncestors)
+        path = [node]
+        while path[-1] not in targetAncestorSet:
+            path.append(self.mcTree.getParent(path[-1]))
+        path += reversed(targetAncestors[:targetAncestors.index(path[-1])])
         dist = 0.
-        x = node
-        while x != self.dpTree.getRootId():
-            dist += self.dpTree.getWeight(self.dpTree.getParent(x), x,
-                                          self.defaultBranchLength)
-            x = self.dpTree.getParent(x)
-            assert x != None
+        for x, y in zip(path, path[1:]):
+            dist += self.__getBranchLength(y, x, self.defaultBranchLength)
         return dist
 
     # use cactus_analyseAssembly to get some very basic stats about the
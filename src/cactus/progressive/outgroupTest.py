@@ -265,6 +265,22 @@ class TestCase(unittest.TestCase):
                                og.ogMap.values()))
                         
 
+    def testDynamicOutgroupsOnPolytomy(self):
+        """The dynamic outgroups shouldn't be limited by the degree of
+        the tree."""
+        leaves = ["A%d" % i for i in xrange(40)]
+        tree = "((%s)Anc1:0.1,(B0:0.1,B1:0.2)Anc2:0.1)Anc0;" % ",".join(["%s:0.1" % x for x in leaves])
+        mcTree = MultiCactusTree(NXNewick().parseString(tree, addImpliedRoots=False))
+        mcTree.computeSubtreeRoots()
+        seqMap = dict([(x, self.tempFa) for x in leaves + ["B0", "B1"]])
+        og = DynamicOutgroup()
+        og.edgeLen = 5
+        og.importTree(mcTree, seqMap)
+        og.compute(maxNumOutgroups=3)
+        self.assertEqual([x[0] for x in og.ogMap['Anc1']], ['B0', 'B1'])
+        self.assertEqual(len(og.ogMap['Anc2']), 3)
+        assert all([x[0] in leaves for x in og.ogMap['Anc2']])
+
     def testMultipleIdenticalRunsProduceSameResult(self):
         """The code now allows for multiple greedy() calls with different
         candidate sets, so that some outgroups can be 'preferred' over
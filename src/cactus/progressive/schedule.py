@@ -145,22 +145,44 @@ class Schedule:
         assert NX.is_directed_acyclic_graph(self.depTree)
         self.enforceMaxParallel()
 
-    # friday afternoon!
+    # remove every edge x->z for which there is another path x->y->z.
+    # reachability is kept as one bitset (python long) per node, filled
+    # in over the condensation of the graph in topological order, so
+    # this is linear in the number of edges (times the bitset width)
+    # rather than cubic in the number of nodes.
     def transitveReduction(self, digraph):
-        paths = dict(NX.all_pairs_shortest_path(digraph))
-        def hasPath(node1, node2):
-            if node1 == node2:
-                return False
-            return (node1 in paths and node2 in paths[node1] and
-                    len(paths[node1][node2]) > 0)
-        for x in digraph.nodes():
-            for y in digraph.nodes():
-                for z in digraph.nodes():
-                    if (x != z and digraph.has_edge(x, z) and hasPath(x, y) and
-                        hasPath(y, z)):
-                        digraph.remove_edge(x, z)
-                        
-                        
+        nodes = list(digraph.nodes())
+        index = dict((node, i) for i, node in enumerate(nodes))
+        # reach[i]: nodes reachable from node i by a non-empty path
+        reach = self.__reachability(digraph, index)
+        # reachedBy[i]: nodes that node i is reachable from
+        reachedBy = self.__reachability(digraph.reverse(copy=False), index)
+        for x, z in list(digraph.edges()):
+            bx, bz = 1 << index[x], 1 << index[z]
+            if x != z and reach[index[x]] & reachedBy[index[z]] & ~(bx | bz):
+                digraph.remove_edge(x, z)
+
+    def __reachability(self, digraph, index):
+        condensed = NX.condensation(digraph)
+        members = condensed.graph['mapping']
+        componentBits = dict((c, 0) for c in condensed.nodes())
+        for node, c in members.items():
+            componentBits[c] |= 1 << index[node]
+        componentReach = dict()
+        for c in reversed(list(NX.topological_sort(condensed))):
+            bits = 0
+            for d in condensed.successors(c):
+                bits |= componentBits[d] | componentReach[d]
+            componentNodes = condensed.node[c]['members']
+            if len(componentNodes) > 1 or any(digraph.has_edge(n, n) for n in componentNodes):
+                # nodes on a cycle can reach each other (and themselves)
+                bits |= componentBits[c]
+            componentReach[c] = bits
+        reach = [0] * len(index)
+        for node, c in members.items():
+            reach[index[node]] = componentReach[c]
+        return reach
+
     # add dependencies to ensure that more than self.maxParallelSubtrees
     # different jobs can never be scheduled at the same time
     def enforceMaxParallel(self):
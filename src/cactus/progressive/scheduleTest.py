@@ -36,7 +36,26 @@ class TestCase(unittest.TestCase):
                 sched.inGraph = dag
                 sched.maxParallel = 2
                 sched.compute()
-                
+
+    def testMatchesAllPairsSchedule(self):
+        """The schedule should be the same as the one built with the
+        original all-pairs transitive reduction."""
+        for tree in randomTreeSet():
+            if tree.size() < 120:
+                dag = self.__addDagEdges(tree)
+                for maxParallelSubtrees in (None, 2):
+                    depTrees = []
+                    for scheduleClass in (Schedule, AllPairsSchedule):
+                        sched = scheduleClass()
+                        sched.inGraph = dag.copy()
+                        sched.maxParallelSubtrees = maxParallelSubtrees
+                        sched.compute()
+                        depTrees.append(sched.depTree)
+                    self.assertEqual(list(depTrees[0].nodes(data=True)),
+                                     list(depTrees[1].nodes(data=True)))
+                    self.assertEqual(sorted(depTrees[0].edges(data=True)),
+                                     sorted(depTrees[1].edges(data=True)))
+
     def __addDagEdges(self, tree):
         count = tree.size() / random.randrange(1,10)
         tsort = list(NX.topological_sort(tree))
@@ -50,8 +69,25 @@ class TestCase(unittest.TestCase):
                 tree.add_edge(sourceNode, sinkNode)
         assert NX.is_directed_acyclic_graph(tree)
         return tree
-            
-            
+
+
+class AllPairsSchedule(Schedule):
+    """Schedule using the original transitive reduction, which checks
+    every triple of nodes against all-pairs shortest paths."""
+    def transitveReduction(self, digraph):
+        paths = dict(NX.all_pairs_shortest_path(digraph))
+        def hasPath(node1, node2):
+            if node1 == node2:
+                return False
+            return (node1 in paths and node2 in paths[node1] and
+                    len(paths[node1][node2]) > 0)
+        for x in digraph.nodes():
+            for y in digraph.nodes():
+                for z in digraph.nodes():
+                    if (x != z and digraph.has_edge(x, z) and hasPath(x, y) and
+                        hasPath(y, z)):
+                        digraph.remove_edge(x, z)
+
 def main():
     unittest.main()
     
@@ -17,6 +17,7 @@ import uuid
 import json
 import time
 import signal
+import threading
 
 from urlparse import urlparse
 
@@ -123,8 +124,11 @@ def runCactusGetFlowers(cactusDiskDatabaseString, flowerNames,
                         minSequenceSizeOfFlower=1,
                         maxSequenceSizeOfFlowerGrouping=-1, 
                         maxSequenceSizeOfSecondaryFlowerGrouping=-1, 
+                        flowerStats=False,
                         logLevel=None):
-    """Gets a list of flowers attached to the given flower. 
+    """Gets a list of flowers attached to the given flower. If
+    flowerStats is set, the stats of each overlarge flower are added
+    to its group (see addOverlargeFlowerStats).
     """
     logLevel = getLogLevelString2(logLevel)
     flowerStrings = cactus_call(check_output=True, stdin_string=flowerNames,
@@ -138,6 +142,8 @@ def runCactusGetFlowers(cactusDiskDatabaseString, flowerNames,
                                 fileStore=fileStore)
 
     l = readFlowerNames(flowerStrings)
+    if flowerStats:
+        l = addOverlargeFlowerStats(cactusDiskDatabaseString, l, logLevel=logLevel)
     return l
 
 def runCactusExtendFlowers(cactusDiskDatabaseString, flowerNames, 
@@ -145,10 +151,13 @@ def runCactusExtendFlowers(cactusDiskDatabaseString, flowerNames,
                         minSequenceSizeOfFlower=1,
                         maxSequenceSizeOfFlowerGrouping=-1, 
                         maxSequenceSizeOfSecondaryFlowerGrouping=-1, 
+                        flowerStats=False,
                         logLevel=None):
     """Extends the terminal groups in the cactus and returns the list
     of their child flowers with which to pass to core.
     The order of the flowers is by ascending depth first discovery time.
+    If flowerStats is set, the stats of each overlarge flower are added
+    to its group (see addOverlargeFlowerStats).
     """
     logLevel = getLogLevelString2(logLevel)
     flowerStrings = cactus_call(check_output=True, stdin_string=flowerNames,
@@ -162,6 +171,8 @@ def runCactusExtendFlowers(cactusDiskDatabaseString, flowerNames,
                                 fileStore=fileStore)
 
     l = readFlowerNames(flowerStrings)
+    if flowerStats:
+        l = addOverlargeFlowerStats(cactusDiskDatabaseString, l, logLevel=logLevel)
     return l
 
 def encodeFlowerNames(flowerNames):
@@ -177,6 +188,18 @@ def decodeFirstFlowerName(encodedFlowerNames):
         return int(tokens[2])
     return int(tokens[1])
 
+def decodeFlowerNames(encodedFlowerNames):
+    """Get the list of flower names in an encoded list of flowers,
+    ignoring any secondary grouping.
+    """
+    names = []
+    name = 0
+    for token in encodedFlowerNames.split()[1:]:
+        if token not in ('a', 'b'):
+            name += int(token)
+            names.append(name)
+    return names
+
 def runCactusSplitFlowersBySecondaryGrouping(flowerNames):
     """Splits a list of flowers into smaller lists.
     """
@@ -418,6 +441,47 @@ def runCactusFlowerStats(cactusDiskDatabaseString, flowerName, logLevel=None):
                                                 logLevel, cactusDiskDatabaseString, str(flowerName)])
     return flowerStatsString
 
+def readFlowerStats(flowerStatsString):
+    """Parse the output of cactus_workflow_flowerStats into a list of
+    (stats, summary) pairs, one per flower, where stats is a dict of the
+    flower's size features and summary is its one-line description.
+    """
+    ret = []
+    jsonLines = []
+    for line in flowerStatsString.split("\n"):
+        if line.startswith("flower name:"):
+            ret.append((json.loads("".join(jsonLines)), line))
+            jsonLines = []
+        elif line != '':
+            jsonLines.append(line)
+    return ret
+
+def runCactusBatchFlowerStats(cactusDiskDatabaseString, flowerNames, logLevel=None):
+    """Gets the (stats, summary) pairs for all the given flowers, in one
+    call to cactus_workflow_flowerStats.
+    """
+    if len(flowerNames) == 0:
+        return []
+    logLevel = getLogLevelString2(logLevel)
+    flowerStatsString = cactus_call(check_output=True,
+                                    parameters=["cactus_workflow_flowerStats",
+                                                logLevel, cactusDiskDatabaseString] + map(str, flowerNames))
+    stats = readFlowerStats(flowerStatsString)
+    assert len(stats) == len(flowerNames)
+    return stats
+
+def addOverlargeFlowerStats(cactusDiskDatabaseString, flowersAndSizes, logLevel=None):
+    """Takes the (overlarge, flowerNames, flowerSizes) groups returned by
+    readFlowerNames and adds the stats of the flower in each overlarge
+    group (None for the others), fetching them all at once.
+    """
+    overlargeFlowerNames = [decodeFirstFlowerName(flowerNames)
+                            for overlarge, flowerNames, _ in flowersAndSizes if overlarge]
+    stats = iter(runCactusBatchFlowerStats(cactusDiskDatabaseString, overlargeFlowerNames,
+                                           logLevel=logLevel))
+    return [(overlarge, flowerNames, flowerSizes, next(stats) if overlarge else None)
+            for overlarge, flowerNames, flowerSizes in flowersAndSizes]
+
 def runCactusMakeNormal(cactusDiskDatabaseString, flowerNames, maxNumberOfChains=0, logLevel=None):
     """Makes the given flowers normal (see normalisation for the various phases)
     """
@@ -745,28 +809,40 @@ def runToilStatusAndFailIfNotComplete(toilDir):
     command = "toil status %s --failIfNotComplete --verbose" % toilDir
     system(command)
 
-def runLastz(seq1, seq2, alignmentsFile, lastzArguments, work_dir=None):
+def _runLastzWithSoftTimeout(parameters, alignmentsFile, work_dir, soft_timeout):
+    returnCode = cactus_call(work_dir=work_dir, outfile=alignmentsFile,
+                             parameters=parameters, soft_timeout=soft_timeout,
+                             check_result=True)
+    if returnCode is None:
+        logger.warning("Lastz was stopped by the soft timeout of %s seconds, "
+                       "leaving partial alignments in %s" % (soft_timeout, alignmentsFile))
+        return False
+    if returnCode != 0:
+        raise RuntimeError("Command %s failed with exit code %s" % (parameters, returnCode))
+    return True
+
+def runLastz(seq1, seq2, alignmentsFile, lastzArguments, work_dir=None, soft_timeout=5400):
+    """Returns False if lastz was stopped by the soft timeout."""
     if work_dir is None:
         assert os.path.dirname(seq1) == os.path.dirname(seq2)
         work_dir = os.path.dirname(seq1)
-    cactus_call(work_dir=work_dir, outfile=alignmentsFile,
-                parameters=["cPecanLastz",
-                            "--format=cigar",
-                            "--notrivial"] + lastzArguments.split() +
-                           ["%s[multiple][nameparse=darkspace]" % seq1,
-                            "%s[nameparse=darkspace]" % seq2],
-                soft_timeout=5400)
-
-def runSelfLastz(seq, alignmentsFile, lastzArguments, work_dir=None):
+    return _runLastzWithSoftTimeout(["cPecanLastz",
+                                     "--format=cigar",
+                                     "--notrivial"] + lastzArguments.split() +
+                                    ["%s[multiple][nameparse=darkspace]" % seq1,
+                                     "%s[nameparse=darkspace]" % seq2],
+                                    alignmentsFile, work_dir, soft_timeout)
+
+def runSelfLastz(seq, alignmentsFile, lastzArguments, work_dir=None, soft_timeout=5400):
+    """Returns False if lastz was stopped by the soft timeout."""
     if work_dir is None:
         work_dir = os.path.dirname(seq)
-    cactus_call(work_dir=work_dir, outfile=alignmentsFile,
-                parameters=["cPecanLastz",
-                            "--format=cigar",
-                            "--notrivial"] + lastzArguments.split() +
-                           ["%s[multiple][nameparse=darkspace]" % seq,
-                            "%s[nameparse=darkspace]" % seq],
-                soft_timeout=5400)
+    return _runLastzWithSoftTimeout(["cPecanLastz",
+                                     "--format=cigar",
+                                     "--notrivial"] + lastzArguments.split() +
+                                    ["%s[multiple][nameparse=darkspace]" % seq,
+                                     "%s[nameparse=darkspace]" % seq],
+                                    alignmentsFile, work_dir, soft_timeout)
 
 def runCactusRealign(seq1, seq2, inputAlignmentsFile, outputAlignmentsFile, realignArguments, work_dir=None):
     cactus_call(infile=inputAlignmentsFile, outfile=outputAlignmentsFile, work_dir=work_dir,
@@ -893,6 +969,124 @@ def dockerCommand(tool=None,
     call = base_docker_call + [tool] + parameters
     return call, containerInfo
 
+class ContainerSession(object):
+    """A long-lived container that cactus_call invocations are exec'd
+    into, rather than starting a new container for every tool run.
+
+    The session's root directory is mounted at the same path inside
+    the container, so any work_dir beneath it can be used directly as
+    the working directory of the exec. Calls whose work_dir lies
+    outside the root fall back to a one-off container.
+
+    In local mode there is no container to start; the session just
+    runs each command from its work_dir in the same way, which lets
+    the path handling be tested without Docker or Singularity.
+    """
+    def __init__(self, rootDir, mode=None):
+        self.rootDir = os.path.abspath(rootDir)
+        self.mode = mode if mode is not None else os.environ.get("CACTUS_BINARIES_MODE", "docker")
+        self.name = "cactus-session-" + str(uuid.uuid4())
+        self.numExecs = 0
+        self.running = False
+        # Threads of one job (e.g. a flower pool) share its session, so
+        # starting and stopping it are serialised.
+        self.lock = threading.RLock()
+
+    def start(self):
+        with self.lock:
+            if not self.running:
+                self._start()
+
+    def _start(self):
+        if self.mode == "docker":
+            call = ['docker', 'run', '--detach',
+                    '--net=host',
+                    '--log-driver=none',
+                    '-u', '%s:%s' % (os.getuid(), os.getgid()),
+                    '-v', '{0}:{0}'.format(self.rootDir),
+                    '--name', self.name,
+                    '--rm',
+                    '--entrypoint', 'sleep',
+                    getDockerImage(), 'infinity']
+            subprocess32.check_call(call, stdout=open(os.devnull, 'w'))
+        elif self.mode == "singularity":
+            subprocess32.check_call(["singularity", "--silent", "instance", "start",
+                                     "-B", self.rootDir,
+                                     os.environ["CACTUS_SINGULARITY_IMG"], self.name])
+        else:
+            assert self.mode == "local"
+        self.running = True
+        _log.info("Started container session %s rooted at %s" % (self.name, self.rootDir))
+
+    def stop(self):
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            if self.mode == "docker":
+                subprocess32.call(['docker', 'kill', self.name], stdout=open(os.devnull, 'w'))
+            elif self.mode == "singularity":
+                subprocess32.call(["singularity", "--silent", "instance", "stop", self.name])
+            _log.info("Stopped container session %s after %d commands" % (self.name, self.numExecs))
+
+    def contains(self, work_dir):
+        """Check whether work_dir is visible from inside the session."""
+        work_dir = os.path.abspath(work_dir)
+        return work_dir == self.rootDir or work_dir.startswith(self.rootDir + '/')
+
+    def execCommand(self, work_dir, parameters, entrypoint=None):
+        """Get the command line that runs parameters inside the session,
+        from the (absolute) work_dir. The container is started on first
+        use, so jobs that never call a binary don't pay for one."""
+        with self.lock:
+            if not self.running:
+                self._start()
+            self.numExecs += 1
+        work_dir = os.path.abspath(work_dir)
+        if entrypoint is None:
+            # Go through the same wrapper as the image's entrypoint, so
+            # that signals and segfaults are handled identically.
+            command = ['bash', '/opt/cactus/wrapper.sh'] + parameters
+        else:
+            command = [entrypoint] + parameters
+        if self.mode == "docker":
+            return ['docker', 'exec', '--interactive', '--workdir', work_dir, self.name] + command
+        elif self.mode == "singularity":
+            return ["singularity", "--silent", "exec", "--pwd", work_dir,
+                    "instance://" + self.name] + command
+        else:
+            return ['bash', '-c', 'cd "$0" && exec "$@"', work_dir] + parameters
+
+_containerSession = None
+
+def getContainerSession():
+    """Get the session that cactus_call is currently exec'ing into, if any."""
+    return _containerSession
+
+class containerSession(object):
+    """Context manager that runs every cactus_call made inside it in a
+    single ContainerSession rooted at rootDir.
+    """
+    def __init__(self, rootDir, mode=None):
+        self.session = ContainerSession(rootDir, mode=mode)
+        self.previousSession = None
+
+    def __enter__(self):
+        global _containerSession
+        self.previousSession = _containerSession
+        _containerSession = self.session
+        return self.session
+
+    def __exit__(self, *args):
+        global _containerSession
+        _containerSession = self.previousSession
+        self.session.stop()
+
+def containerSessionsEnabled():
+    """Whether jobs should run their cactus_calls in a container session
+    (see --containerSession)."""
+    return os.environ.get("CACTUS_CONTAINER_SESSION") == "1"
+
 def prepareWorkDir(work_dir, parameters):
     if not work_dir:
     #Make sure all the paths we're accessing are in the same directory
@@ -957,6 +1151,14 @@ def cactus_call(tool=None,
         tool = "cactus"
 
     entrypoint = None
+    # Long-running servers, calls that need a port mapping, and calls
+    # that may have to be interrupted by the soft timeout get a
+    # container of their own rather than sharing the session.
+    session = getContainerSession()
+    if session is not None and (session.mode != mode or server or port is not None
+                                or soft_timeout is not None or not rm):
+        session = None
+
     if len(parameters) > 0 and type(parameters[0]) is list:
         # We have a list of lists, which is the convention for commands piped into one another.
         flattened = [i for sublist in parameters for i in sublist]
@@ -967,12 +1169,18 @@ def cactus_call(tool=None,
             # through the default cactus entrypoint.
             entrypoint = '/bin/bash'
             parameters = parameters[1:]
+        if mode == "docker" or session is not None:
             work_dir, _ = prepareWorkDir(work_dir, flattened)
 
-    if mode in ("docker", "singularity"):
+    if mode in ("docker", "singularity") or session is not None:
         work_dir, parameters = prepareWorkDir(work_dir, parameters)
 
-    if mode == "docker":
+    inSession = session is not None and session.contains(work_dir)
+    if inSession:
+        call = session.execCommand(work_dir=work_dir,
+                                   parameters=parameters,
+                                   entrypoint=entrypoint)
+    elif mode == "docker":
         call, containerInfo = dockerCommand(tool=tool,
                                             work_dir=work_dir,
                                             parameters=parameters,
@@ -1015,7 +1223,7 @@ def cactus_call(tool=None,
             # Wait a bit to see if the process is done
             output, nothing = process.communicate(stdin_string if first_run else None, timeout=10)
         except subprocess32.TimeoutExpired:
-            if mode == "docker":
+            if mode == "docker" and not inSession:
                 # Every so often, check the memory usage of the container
                 updatedMemUsage = maxMemUsageOfContainer(containerInfo)
                 if updatedMemUsage is not None:
@@ -1028,7 +1236,9 @@ def cactus_call(tool=None,
                 return None
         else:
             break
-    if mode == "docker" and job_name is not None and features is not None and fileStore is not None:
+    # A session container's memory usage covers every command run in
+    # it, so it can't be attributed to this one.
+    if mode == "docker" and not inSession and job_name is not None and features is not None and fileStore is not None:
         # Log a datapoint for the memory usage for these features.
         fileStore.logToMaster("Max memory used for job %s (tool %s) "
                               "on JSON features %s: %s" % (job_name, parameters[0],
@@ -1093,7 +1303,13 @@ class RoundedJob(Job):
     def _runner(self, jobGraph, jobStore, fileStore):
         if jobStore.config.workDir is not None:
             os.environ['TMPDIR'] = fileStore.getLocalTempDir()
-        super(RoundedJob, self)._runner(jobGraph=jobGraph, jobStore=jobStore, fileStore=fileStore)
+        if containerSessionsEnabled() and getContainerSession() is None:
+            # Run every tool this job calls in one container, rooted
+            # at the job's temporary directory.
+            with containerSession(os.path.dirname(fileStore.getLocalTempDir())):
+                super(RoundedJob, self)._runner(jobGraph=jobGraph, jobStore=jobStore, fileStore=fileStore)
+        else:
+            super(RoundedJob, self)._runner(jobGraph=jobGraph, jobStore=jobStore, fileStore=fileStore)
 
 def readGlobalFileWithoutCache(fileStore, jobStoreID):
     """Reads a jobStoreID into a file and returns it, without touching
@@ -1105,6 +1321,25 @@ def readGlobalFileWithoutCache(fileStore, jobStoreID):
     fileStore.jobStore.readFile(jobStoreID, f)
     return f
 
+def exportFiles(job, exports):
+    """Export each (file store ID, URL) pair of exports."""
+    for fileID, url in exports:
+        job.fileStore.exportFile(fileID, url)
+        job.fileStore.logToMaster("Exported %s to %s" % (fileID, url))
+
+def exportFilesInBackground(job, exports):
+    """Export (file store ID, URL) pairs in a child job of the given job,
+    rather than in the job itself.
+
+    The export then runs alongside the job's other children, rather
+    than holding them up. The workflow still doesn't finish until
+    every export is done, so the files are as sure to be there at the
+    end of it as if they had been exported inline."""
+    exports = list(exports)
+    if len(exports) == 0:
+        return None
+    return job.addChildJobFn(exportFiles, exports, cores=0.1, memory=100000000, preemptable=True)
+
 class ChildTreeJob(RoundedJob):
     """Spreads the child-job initialization work among multiple jobs.
 
@@ -1,6 +1,8 @@
 import os
 import shutil
 import unittest
+import time
+from multiprocessing.pool import ThreadPool
 
 from sonLib.bioio import TestStatus
 from sonLib.bioio import getTempFile
@@ -11,7 +13,9 @@ from toil.common import Toil
 from cactus.shared.test import silentOnSuccess
 from cactus.shared.common import encodeFlowerNames, decodeFirstFlowerName, \
                                  runCactusSplitFlowersBySecondaryGrouping, \
-                                 cactus_call, ChildTreeJob
+                                 cactus_call, ChildTreeJob, containerSession, ContainerSession, \
+                                 readFlowerStats, decodeFlowerNames, \
+                                 makeURL, exportFilesInBackground
 
 class TestCase(unittest.TestCase):
     def setUp(self):
@@ -40,6 +44,12 @@ class TestCase(unittest.TestCase):
         self.assertEquals(9, decodeFirstFlowerName("4 9 1 1 b 1"))
         self.assertEquals(13, decodeFirstFlowerName("1 b 13"))
 
+    def testDecodeFlowerNames(self):
+        self.assertEquals([], decodeFlowerNames("0"))
+        self.assertEquals([100, 5, 1000], decodeFlowerNames(encodeFlowerNames([100, 5, 1000])))
+        self.assertEquals([7, 8], decodeFlowerNames("2 b 7 a 1"))
+        self.assertEquals([9, 10, 11, 8, 12, 13, 20, 28], decodeFlowerNames("8 9 1 1 a -3 4 b 1 7 8"))
+
     def testRunCactusSplitFlowersBySecondaryGrouping(self):
         self.assertEquals([(True, "1 -1") ], runCactusSplitFlowersBySecondaryGrouping("1 b -1"))
         self.assertEquals([(False, "1 1"), (False, "1 2")], runCactusSplitFlowersBySecondaryGrouping("2 1 a 1"))
@@ -50,6 +60,16 @@ class TestCase(unittest.TestCase):
         self.assertEquals([(True, "1 13") ], runCactusSplitFlowersBySecondaryGrouping("1 b 13"))
         self.assertEquals([(False, "3 9 1 1"), (False, "2 8 4"), (True, "3 13 7 8")], runCactusSplitFlowersBySecondaryGrouping("8 9 1 1 a -3 4 b 1 7 8"))
 
+    def testReadFlowerStats(self):
+        flowerStatsString = "{\n  \"flowerName\": 3,\n  \"totalBases\": 100\n}\n" \
+                            "flower name: 3 total bases: 100\n" \
+                            "{\n  \"flowerName\": 12,\n  \"totalBases\": 5\n}\n" \
+                            "flower name: 12 total bases: 5\n"
+        self.assertEquals([({"flowerName": 3, "totalBases": 100}, "flower name: 3 total bases: 100"),
+                           ({"flowerName": 12, "totalBases": 5}, "flower name: 12 total bases: 5")],
+                          readFlowerStats(flowerStatsString))
+        self.assertEquals([], readFlowerStats(""))
+
     def testCactusCall(self):
         inputFile = getTempFile(rootDir=self.tempDir)
 
@@ -83,6 +103,61 @@ class TestCase(unittest.TestCase):
                              check_output=True)
         self.assertEquals(output, 'quuxbazbar\n')
 
+    def testCactusCallSession(self):
+        """Check that calls made in a container session behave the same
+        as one-off calls. Uses the local stand-in for the container so
+        it can run without Docker."""
+        oldMode = os.environ.get("CACTUS_BINARIES_MODE")
+        os.environ["CACTUS_BINARIES_MODE"] = "local"
+        try:
+            inputFile = getTempFile(rootDir=self.tempDir)
+            with open(inputFile, 'w') as f:
+                f.write('foobar\n')
+            outputFile = getTempFile(rootDir=self.tempDir)
+            with containerSession(self.tempDir) as session:
+                output = cactus_call(parameters=['cat', inputFile], check_output=True)
+                self.assertEquals(output, 'foobar\n')
+                output = cactus_call(parameters=[['cat', inputFile],
+                                                 ['sed', 's/foo/baz/g']],
+                                     check_output=True)
+                self.assertEquals(output, 'bazbar\n')
+                cactus_call(parameters=['cat'], stdin_string='quux\n', outfile=outputFile,
+                            work_dir=self.tempDir)
+                self.assertEquals(open(outputFile).read(), 'quux\n')
+                # The working directory is the one the paths are relative to
+                output = cactus_call(parameters=['pwd'], work_dir=self.tempDir, check_output=True)
+                self.assertEquals(output.strip(), os.path.abspath(self.tempDir))
+                self.assertEquals(session.numExecs, 4)
+                # Calls outside the session's directory fall back to
+                # running on their own.
+                cactus_call(parameters=['true'], work_dir='/')
+                self.assertEquals(session.numExecs, 4)
+        finally:
+            if oldMode is None:
+                del os.environ["CACTUS_BINARIES_MODE"]
+            else:
+                os.environ["CACTUS_BINARIES_MODE"] = oldMode
+
+    def testContainerSessionStartsOnce(self):
+        """Threads sharing a session should start its container only
+        once, however their first calls overlap."""
+        class SlowStartingSession(ContainerSession):
+            def _start(self):
+                self.starts = getattr(self, 'starts', 0) + 1
+                time.sleep(0.1)
+                ContainerSession._start(self)
+        session = SlowStartingSession(self.tempDir, mode="local")
+        pool = ThreadPool(10)
+        try:
+            pool.map(lambda i: session.execCommand(self.tempDir, ['true']), xrange(10))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEquals(session.starts, 1)
+        self.assertEquals(session.numExecs, 10)
+        session.stop()
+        self.assertFalse(session.running)
+
     @silentOnSuccess
     def testChildTreeJob(self):
         """Check that the ChildTreeJob class runs all children."""
@@ -100,6 +175,45 @@ class TestCase(unittest.TestCase):
             self.assertTrue(os.path.exists(os.path.join(flagDir, str(i))))
         shutil.rmtree(flagDir)
 
+    def testExportFilesInBackground(self):
+        """Check that files exported in the background are all at their
+        file:// URLs once the workflow is done."""
+        exportDir = getTempDirectory()
+        options = Job.Runner.getDefaultOptions(getTempDirectory())
+        shutil.rmtree(options.jobStore)
+
+        contents = ["file %i\n" % i * (i + 1) for i in xrange(5)]
+        with Toil(options) as toil:
+            fileIDs = []
+            for content in contents:
+                path = getTempFile(rootDir=self.tempDir)
+                with open(path, 'w') as f:
+                    f.write(content)
+                fileIDs.append(toil.importFile(makeURL(path)))
+            exports = [(fileID, makeURL(os.path.join(exportDir, str(i)))) for i, fileID in enumerate(fileIDs)]
+            toil.start(ExportTestParent(exports))
+
+        for i, content in enumerate(contents):
+            with open(os.path.join(exportDir, str(i))) as f:
+                self.assertEquals(f.read(), content)
+        shutil.rmtree(exportDir)
+
+class ExportTestParent(Job):
+    def __init__(self, exports):
+        self.exports = exports
+        super(ExportTestParent, self).__init__()
+
+    def run(self, fileStore):
+        # The exports run alongside the next phase
+        exportFilesInBackground(self, self.exports)
+        self.addChild(ExportTestNextPhase())
+        # Nothing to export, so no job to do it
+        assert exportFilesInBackground(self, []) is None
+
+class ExportTestNextPhase(Job):
+    def run(self, fileStore):
+        pass
+
 class CTTestParent(ChildTreeJob):
     def __init__(self, flagDir, numChildren):
         self.flagDir = flagDir
@@ -183,6 +183,32 @@ class ConfigWrapper:
             return int(ktServerElem.attrib["cpu"])
         return default           
 
+    def getKtserverLocalSnapshots(self):
+        """Should phases that only read the DB use node-local copies of
+        its snapshot?"""
+        ktServerElem = self.xmlRoot.find("ktserver")
+        return ktServerElem is not None and ktServerElem.attrib.get("localSnapshots", "0") == "1"
+
+    def getKtserverShards(self):
+        """The number of ktservers to split the primary DB over."""
+        ktServerElem = self.xmlRoot.find("ktserver")
+        if ktServerElem is not None and "shards" in ktServerElem.attrib:
+            return int(ktServerElem.attrib["shards"])
+        return 1
+
+    def getKtserverIncrementalSnapshots(self):
+        """Should the primary DB be saved as deltas to its last full
+        snapshot, rather than as a full snapshot every time?"""
+        ktServerElem = self.xmlRoot.find("ktserver")
+        return ktServerElem is not None and ktServerElem.attrib.get("incrementalSnapshots", "0") == "1"
+
+    def getKtserverMaxSnapshotDeltas(self):
+        """The number of deltas after which a full snapshot is saved again."""
+        ktServerElem = self.xmlRoot.find("ktserver")
+        if ktServerElem is not None and "maxSnapshotDeltas" in ktServerElem.attrib:
+            return int(ktServerElem.attrib["maxSnapshotDeltas"])
+        return 4
+
     def getDefaultMemory(self):
         constantsElem = self.xmlRoot.find("constants")
         return int(constantsElem.attrib["defaultMemory"])
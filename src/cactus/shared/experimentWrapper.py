@@ -113,6 +113,40 @@ class DbElemWrapper(object):
         assert self.getDbType() == "kyoto_tycoon"
         self.dbElem.attrib["read_tuning_options"] = str(options)
 
+    def getDbMemory(self):
+        assert self.getDbType() == "kyoto_tycoon"
+        if "memory" in self.dbElem.attrib:
+            return int(self.dbElem.attrib["memory"])
+        return None
+
+    def setDbMemory(self, memory):
+        assert self.getDbType() == "kyoto_tycoon"
+        self.dbElem.attrib["memory"] = str(int(memory))
+
+    def getDbTuningPlanned(self):
+        """Were the tuning options, server options and memory chosen
+        by planKtserverTuning, rather than by the user?"""
+        assert self.getDbType() == "kyoto_tycoon"
+        return self.dbElem.attrib.get("tuning_planned", "0") == "1"
+
+    def setDbTuningPlanned(self, planned):
+        assert self.getDbType() == "kyoto_tycoon"
+        self.dbElem.attrib["tuning_planned"] = str(int(planned))
+
+    def getDbShardEndpoints(self):
+        """The (host, port) of each shard of a DB split over several
+        ktservers (see ktserverShards), the first being this DB's own,
+        or None if the DB isn't split."""
+        assert self.getDbType() == "kyoto_tycoon"
+        if "shard_endpoints" in self.dbElem.attrib:
+            return [(host, int(port)) for host, port in
+                    (endpoint.rsplit(":", 1) for endpoint in self.dbElem.attrib["shard_endpoints"].split(","))]
+        return None
+
+    def setDbShardEndpoints(self, endpoints):
+        assert self.getDbType() == "kyoto_tycoon"
+        self.dbElem.attrib["shard_endpoints"] = ",".join("%s:%i" % (host, port) for host, port in endpoints)
+
     def getDbInMemory(self):
         assert self.getDbType() == "kyoto_tycoon"
         if "in_memory" in self.dbElem.attrib:
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+"""Chunks of fasta files described as ranges of the input files.
+
+cactus_blast_chunkSequences writes every input genome out again as
+overlapping chunk files before any alignment starts. A virtual chunk
+instead lists the ranges of the input fasta files it covers, found from
+an index of each file's records (like a samtools faidx index), and the
+job that uses a chunk seeks to and reads just those ranges from the file
+store. Job stores whose streams can't seek would have every job read
+each file from the start, so with those chunk files are written as
+before.
+
+Virtual chunks are laid out exactly as cactus_blast_chunkSequences lays
+out its chunk files, and are written out with the same "name|start"
+headers, so the jobs downstream can't tell them apart.
+"""
+import re
+import bisect
+from collections import namedtuple
+
+from toil.lib.bioio import logger
+
+from sonLib.bioio import getTempDirectory
+from cactus.shared.common import runGetChunks
+from cactus.shared.packedFasta import writeFastaGlobalFile, readFastaGlobalFile
+
+# A sequence of an indexed fasta file. The sequence starts at byte
+# offset of the file, with lineBases bases on each line, which takes
+# lineBytes bytes including the newline.
+FastaIndexEntry = namedtuple("FastaIndexEntry", ["name", "length", "offset", "lineBases", "lineBytes"])
+
+# The range [start, end) of a sequence of the fasta file fileID.
+ChunkSegment = namedtuple("ChunkSegment", ["fileID", "entry", "start", "end"])
+
+LINE_WIDTH = 80
+
+def indexFasta(fileHandle):
+    """Get a FastaIndexEntry for each sequence of a fasta file, or None if
+    the sequences aren't regularly laid out (all of a sequence's lines
+    but the last the same length, without spaces), so can't be indexed.
+    """
+    entries = []
+    offset = 0
+    header = None
+    for line in fileHandle:
+        lineOffset = offset
+        offset += len(line)
+        if line.startswith(">"):
+            if header is not None:
+                entries.append(FastaIndexEntry(header, length, sequenceOffset, lineBases, lineBytes))
+            # The chunk headers take the first word of the header
+            header = re.split("[ \t]", line[1:].rstrip("\n"), 1)[0]
+            sequenceOffset = offset
+            length = 0
+            lineBases = lineBytes = None
+            lastLine = False
+            continue
+        bases = len(line.rstrip("\n"))
+        if header is None:
+            if line.strip() != "":
+                return None
+            continue
+        if bases == 0:
+            lastLine = True
+            continue
+        if lastLine or re.search(r"\s", line.rstrip("\n")) or line.startswith("#"):
+            return None
+        if lineBases is None:
+            sequenceOffset = lineOffset
+            lineBases, lineBytes = bases, len(line)
+        elif bases > lineBases:
+            return None
+        if bases < lineBases or len(line) < lineBytes:
+            # Only the last line of a sequence may be shorter
+            lastLine = True
+        length += bases
+    if header is not None:
+        entries.append(FastaIndexEntry(header, length, sequenceOffset, lineBases, lineBytes))
+    return entries
+
+class VirtualChunk(object):
+    """A chunk made of ranges (ChunkSegments) of fasta files in the file
+    store.
+    """
+    def __init__(self):
+        self.segments = []
+
+    @property
+    def size(self):
+        """The size of the chunk once written out."""
+        return sum(len(segment.entry.name) + 24 + (segment.end - segment.start) * (LINE_WIDTH + 1) / LINE_WIDTH
+                   for segment in self.segments)
+
+    def __repr__(self):
+        return "VirtualChunk(%s)" % ", ".join("%s|%i-%i" % (segment.entry.name, segment.start, segment.end)
+                                              for segment in self.segments)
+
+def getVirtualChunks(indexedFiles, chunkSize, overlapSize):
+    """Lay out the chunks of a set of indexed fasta files, given as
+    (fileID, index) pairs, as cactus_blast_chunkSequences would.
+
+    Sequences are packed into chunks of chunkSize bases, and where a
+    sequence crosses from one chunk to the next, a further overlapSize
+    bases spanning the boundary are added, so that alignments across the
+    boundary aren't lost.
+    """
+    assert chunkSize > 0
+    assert 0 <= overlapSize <= chunkSize
+    chunks = []
+    # The chunk being filled, and the bases left to fill it
+    state = {"chunk": None, "remaining": chunkSize}
+
+    def addSegment(fileID, entry, start, maxLength):
+        if state["chunk"] is None:
+            state["chunk"] = VirtualChunk()
+            chunks.append(state["chunk"])
+        length = min(maxLength, entry.length - start)
+        assert length > 0
+        state["chunk"].segments.append(ChunkSegment(fileID, entry, start, start + length))
+        state["remaining"] -= length
+        if state["remaining"] <= 0:
+            state["chunk"] = None
+            state["remaining"] = chunkSize
+        return length
+
+    for fileID, index in indexedFiles:
+        for entry in index:
+            if entry.length == 0:
+                continue
+            covered = addSegment(fileID, entry, 0, state["remaining"])
+            while covered < entry.length:
+                following = addSegment(fileID, entry, covered, state["remaining"])
+                if overlapSize > 0:
+                    addSegment(fileID, entry, max(0, covered - overlapSize / 2), overlapSize)
+                covered += following
+    return chunks
+
+def _byteOffset(entry, position):
+    return entry.offset + (position / entry.lineBases) * entry.lineBytes + position % entry.lineBases
+
+def isSeekable(fileHandle):
+    """Can the file be read from anywhere, rather than only forward?"""
+    try:
+        fileHandle.seek(0, 2)
+        fileHandle.seek(0)
+    except (AttributeError, IOError, ValueError):
+        return False
+    return True
+
+def _readRange(fileHandle, position, start, end):
+    """Read bytes [start, end) of a file whose next byte is position,
+    seeking if the file allows it and reading forward otherwise. Returns
+    the bytes and the new position."""
+    if start != position:
+        try:
+            fileHandle.seek(start)
+            position = start
+        except (AttributeError, IOError, ValueError):
+            if start < position:
+                raise RuntimeError("Can't seek back in a file that doesn't support seeking")
+            while position < start:
+                skipped = len(fileHandle.read(min(start - position, 1 << 20)))
+                if skipped == 0:
+                    raise RuntimeError("Truncated fasta file")
+                position += skipped
+    data = fileHandle.read(end - start)
+    if len(data) < end - start:
+        raise RuntimeError("Truncated fasta file")
+    return data, end
+
+def writeVirtualChunk(chunk, openFile, outFileHandle):
+    """Write out a virtual chunk as a fasta file, where openFile(fileID)
+    gives a context manager for reading a file's bytes. Each file is read
+    once, front to back, so files that can't seek are read in one pass.
+    """
+    sequences = {}
+    segmentsByFile = {}
+    for segment in chunk.segments:
+        segmentsByFile.setdefault(segment.fileID, []).append(segment)
+    for fileID, segments in segmentsByFile.items():
+        ranges = dict((segment, (_byteOffset(segment.entry, segment.start),
+                                 _byteOffset(segment.entry, segment.end - 1) + 1)) for segment in segments)
+        # Overlapping ranges (the overlaps between chunks) are merged, so
+        # the file is read strictly forward
+        spans = []
+        for start, end in sorted(ranges.values()):
+            if spans and start <= spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], end)
+            else:
+                spans.append([start, end])
+        with openFile(fileID) as fileHandle:
+            position = 0
+            for span in spans:
+                data, position = _readRange(fileHandle, position, span[0], span[1])
+                span.append(data)
+        for segment, (start, end) in ranges.items():
+            spanStart, _, data = spans[bisect.bisect_right(spans, [start, float("inf")]) - 1]
+            sequences[segment] = data[start - spanStart:end - spanStart].replace("\n", "")
+    for segment in chunk.segments:
+        sequence = sequences[segment]
+        assert len(sequence) == segment.end - segment.start
+        outFileHandle.write(">%s|%i\n" % (segment.entry.name, segment.start))
+        for i in xrange(0, len(sequence), LINE_WIDTH):
+            outFileHandle.write(sequence[i:i + LINE_WIDTH] + "\n")
+
+def getChunks(fileStore, sequenceIDs, chunkSize, overlapSize, pack=False, virtual=False):
+    """Chunk up the fasta files in the file store, returning the IDs of the
+    chunk files, or virtual chunks if virtual is set and the files can be
+    indexed and read from the file store with seeks. Chunk files are
+    packed (see cactus.shared.packedFasta) if pack is set.
+    """
+    sequenceFiles = [fileStore.readGlobalFile(fileID) for fileID in sequenceIDs]
+    if virtual:
+        indexedFiles = []
+        for fileID, sequenceFile in zip(sequenceIDs, sequenceFiles):
+            with fileStore.readGlobalFileStream(fileID) as fileHandle:
+                seekable = isSeekable(fileHandle)
+            if not seekable:
+                logger.warning("Writing out chunk files, as the file store can't seek in %s" % sequenceFile)
+                break
+            with open(sequenceFile) as fileHandle:
+                index = indexFasta(fileHandle)
+            if index is None:
+                logger.warning("Writing out chunk files, as %s can't be indexed" % sequenceFile)
+                break
+            indexedFiles.append((fileID, index))
+        else:
+            return getVirtualChunks(indexedFiles, chunkSize, overlapSize)
+    chunks = runGetChunks(sequenceFiles=sequenceFiles,
+                          chunksDir=getTempDirectory(rootDir=fileStore.getLocalTempDir()),
+                          chunkSize=chunkSize, overlapSize=overlapSize)
+    return [writeFastaGlobalFile(fileStore, chunk, pack, cleanup=True) for chunk in chunks]
+
+def readChunk(fileStore, chunk):
+    """Read a chunk from getChunks to a local fasta file, returning its
+    path."""
+    if not isinstance(chunk, VirtualChunk):
+        return readFastaGlobalFile(fileStore, chunk)
+    chunkFile = fileStore.getLocalTempFile()
+    with open(chunkFile, 'w') as fileHandle:
+        writeVirtualChunk(chunk, fileStore.readGlobalFileStream, fileHandle)
+    return chunkFile
+
+def chunkFileSize(chunk):
+    """Estimate the size of a chunk from getChunks once read."""
+    # Virtual chunks and packed chunk files give their size once read,
+    # and plain chunk files are read as they are.
+    return chunk.size
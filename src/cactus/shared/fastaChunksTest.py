@@ -0,0 +1,126 @@
+import os
+import random
+import unittest
+from StringIO import StringIO
+
+from sonLib.bioio import TestStatus
+from sonLib.bioio import getTempDirectory
+from sonLib.bioio import system
+from sonLib.bioio import fastaRead
+from cactus.shared.common import runGetChunks
+from cactus.shared.fastaChunks import indexFasta, getVirtualChunks, writeVirtualChunk, isSeekable
+
+def writeRandomFasta(path, lineWidth):
+    sequences = {}
+    with open(path, 'w') as fastaFile:
+        for i in xrange(random.randint(1, 10)):
+            name = "seq%i" % i
+            sequences[name] = "".join(random.choice("ACGTNacgtn") for _ in
+                                      xrange(random.choice((0, random.randint(1, 1000), random.randint(1, 50000)))))
+            fastaFile.write(">%s some\tother tokens\n" % name)
+            for j in xrange(0, len(sequences[name]), lineWidth):
+                fastaFile.write(sequences[name][j:j + lineWidth] + "\n")
+    return sequences
+
+class UnseekableFile(object):
+    """A file that can only be read forward, like a file store stream."""
+    def __init__(self, path):
+        self.fileHandle = open(path)
+
+    def read(self, size):
+        return self.fileHandle.read(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.fileHandle.close()
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.testNo = TestStatus.getTestSetup(5, 20, 50, 100)
+        self.tempDir = getTempDirectory(os.getcwd())
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    def testIndexFasta(self):
+        index = indexFasta(StringIO(">a b\nACGT\nAC\n>b\n>c\tx\nACG\n\n"))
+        self.assertEquals([(entry.name, entry.length, entry.offset, entry.lineBases, entry.lineBytes)
+                           for entry in index],
+                          [("a", 6, 5, 4, 5), ("b", 0, 16, None, None), ("c", 3, 21, 3, 4)])
+        # Sequences with lines of different lengths, or spaces, can't be indexed
+        self.assertEquals(indexFasta(StringIO(">a\nAC\nACGT\n")), None)
+        self.assertEquals(indexFasta(StringIO(">a\nACGT\nAC\nAC\n")), None)
+        self.assertEquals(indexFasta(StringIO(">a\nAC GT\n")), None)
+        self.assertEquals(indexFasta(StringIO(">a\nACGT\n\nACGT\n")), None)
+
+    def testIsSeekable(self):
+        fastaFile = os.path.join(self.tempDir, "seqs.fa")
+        writeRandomFasta(fastaFile, 60)
+        with open(fastaFile) as fileHandle:
+            self.assertTrue(isSeekable(fileHandle))
+        with UnseekableFile(fastaFile) as fileHandle:
+            self.assertFalse(isSeekable(fileHandle))
+        readEnd, writeEnd = os.pipe()
+        with os.fdopen(readEnd) as fileHandle:
+            self.assertFalse(isSeekable(fileHandle))
+        os.close(writeEnd)
+
+    def testVirtualChunks(self):
+        """Each virtual chunk should hold the ranges of the sequences it
+        describes, whether the files can be seeked or not."""
+        for test in xrange(self.testNo):
+            fastaFiles = [os.path.join(self.tempDir, "seqs%i.fa" % i) for i in xrange(2)]
+            sequences = [writeRandomFasta(fastaFile, random.choice((50, 60, 80))) for fastaFile in fastaFiles]
+            indexedFiles = []
+            for fastaFile in fastaFiles:
+                with open(fastaFile) as fileHandle:
+                    indexedFiles.append((fastaFile, indexFasta(fileHandle)))
+            chunkSize = random.randint(100, 20000)
+            overlapSize = random.randint(0, chunkSize)
+            chunks = getVirtualChunks(indexedFiles, chunkSize, overlapSize)
+            for chunk in chunks:
+                for openFile in (open, UnseekableFile):
+                    chunkFile = StringIO()
+                    writeVirtualChunk(chunk, openFile, chunkFile)
+                    chunkFile.seek(0)
+                    chunkSequences = list(fastaRead(chunkFile))
+                    self.assertEquals(len(chunkSequences), len(chunk.segments))
+                    for (header, sequence), segment in zip(chunkSequences, chunk.segments):
+                        self.assertEquals(header, "%s|%i" % (segment.entry.name, segment.start))
+                        originalSequence = sequences[fastaFiles.index(segment.fileID)][segment.entry.name]
+                        self.assertEquals(sequence, originalSequence[segment.start:segment.end])
+            # Every base is in a chunk
+            for fastaFile, fileSequences in zip(fastaFiles, sequences):
+                for name, sequence in fileSequences.items():
+                    covered = set()
+                    for chunk in chunks:
+                        for segment in chunk.segments:
+                            if segment.fileID == fastaFile and segment.entry.name == name:
+                                covered.update(xrange(segment.start, segment.end))
+                    self.assertEquals(covered, set(xrange(len(sequence))))
+
+    def testVirtualChunksMatchChunkFiles(self):
+        """Virtual chunks should be laid out just like the chunk files of
+        cactus_blast_chunkSequences."""
+        for test in xrange(self.testNo):
+            fastaFile = os.path.join(self.tempDir, "seqs.fa")
+            writeRandomFasta(fastaFile, 60)
+            chunkSize = random.randint(100, 20000)
+            overlapSize = random.randint(0, chunkSize)
+            chunksDir = getTempDirectory(self.tempDir)
+            chunkFiles = runGetChunks([fastaFile], chunksDir, chunkSize, overlapSize)
+            with open(fastaFile) as fileHandle:
+                chunks = getVirtualChunks([(fastaFile, indexFasta(fileHandle))], chunkSize, overlapSize)
+            self.assertEquals(len(chunks), len(chunkFiles))
+            for chunk, chunkFile in zip(chunks, chunkFiles):
+                virtualChunkFile = StringIO()
+                writeVirtualChunk(chunk, open, virtualChunkFile)
+                virtualChunkFile.seek(0)
+                self.assertEquals(list(fastaRead(virtualChunkFile)), list(fastaRead(chunkFile)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""Packing of flowers into jobs by their predicted cost.
+
+The flower groupings made by cactus_workflow_getFlowers and
+cactus_workflow_extendFlowers only bound the total number of bases in
+a group, which gives very uneven job runtimes: the cost of most jobs
+grows faster than linearly in flower size, and a group of many tiny
+flowers is dominated by per-job overhead. Here flowers are instead
+packed so that each group's predicted runtime is close to a target
+and its predicted memory fits the nodes it will run on.
+"""
+import heapq
+
+def flowerGroupFeatures(flowerSizes):
+    """The size features of a group of flowers that cactus jobs use to
+    predict their resource usage."""
+    return {'flowerGroupSize': sum(flowerSizes),
+            'maxFlowerSize': max(flowerSizes),
+            'numFlowers': len(flowerSizes)}
+
+class FlowerGroup(object):
+    """A group of flowers being packed, with its running cost and size
+    features."""
+    def __init__(self, jobOverhead):
+        self.flowers = []
+        self.cost = jobOverhead
+        self.totalSize = 0
+        self.maxSize = 0
+
+    def featuresWith(self, size):
+        """The size features the group would have with another flower of
+        the given size added."""
+        return {'flowerGroupSize': self.totalSize + size,
+                'maxFlowerSize': max(self.maxSize, size),
+                'numFlowers': len(self.flowers) + 1}
+
+    def add(self, name, size, cost):
+        self.flowers.append((name, size))
+        self.cost += cost
+        self.totalSize += size
+        self.maxSize = max(self.maxSize, size)
+
+def packFlowers(flowers, costFn, maxCost, jobOverhead=0.0,
+                memoryFn=None, maxMemory=None):
+    """Pack (name, size) flowers into groups whose predicted cost (the
+    jobOverhead plus costFn(size) for each flower) is at most maxCost,
+    and whose predicted memory memoryFn(features) is at most maxMemory,
+    where features are as given by flowerGroupFeatures.
+
+    Flowers are placed largest first into the group with the lowest
+    cost so far ("worst fit decreasing"), which keeps the runtimes of
+    the groups even, and a new group is only started when the flower
+    doesn't fit there. A flower that can't fit even in an empty group
+    gets a group of its own. Returns a list of groups, each a list of
+    (name, size) sorted by name.
+    """
+    costs = sorted(((costFn(size), name, size) for name, size in flowers), reverse=True)
+    groups = []
+    # Heap of (cost, index) of the groups
+    heap = []
+    for cost, name, size in costs:
+        if len(heap) > 0:
+            groupCost, index = heap[0]
+            group = groups[index]
+            if groupCost + cost <= maxCost and \
+               (memoryFn is None or memoryFn(group.featuresWith(size)) <= maxMemory):
+                group.add(name, size, cost)
+                heapq.heapreplace(heap, (group.cost, index))
+                continue
+        group = FlowerGroup(jobOverhead)
+        group.add(name, size, cost)
+        groups.append(group)
+        heapq.heappush(heap, (group.cost, len(groups) - 1))
+    return sorted(sorted(group.flowers) for group in groups)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+#Released under the MIT license, see LICENSE.txt
+import unittest
+import random
+
+from cactus.shared.flowerGrouping import packFlowers
+from cactus.shared.flowerGrouping import flowerGroupFeatures
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.flowers = [(i, random.choice([random.randint(1, 100),
+                                           random.randint(1, 100000)]))
+                        for i in xrange(500)]
+
+    def checkAllFlowersPacked(self, groups):
+        self.assertEqual(sorted(flower for group in groups for flower in group),
+                         sorted(self.flowers))
+
+    def testCostCap(self):
+        costFn = lambda size: 1e-4 * size**1.5
+        groups = packFlowers(self.flowers, costFn, maxCost=5000.0, jobOverhead=10.0)
+        self.checkAllFlowersPacked(groups)
+        for group in groups:
+            cost = 10.0 + sum(costFn(size) for _, size in group)
+            self.assertTrue(cost <= 5000.0 or len(group) == 1)
+        # Packing by cost shouldn't be much worse than the lower bound
+        totalCost = sum(costFn(size) for _, size in self.flowers)
+        self.assertTrue(len(groups) <= 2 * (totalCost / 5000.0) + 1)
+
+    def testMemoryCap(self):
+        memoryFn = lambda features: 1000 + 2 * features['flowerGroupSize'] + 10 * features['maxFlowerSize']
+        groups = packFlowers(self.flowers, lambda size: size, maxCost=10**9,
+                             memoryFn=memoryFn, maxMemory=10**6)
+        self.checkAllFlowersPacked(groups)
+        for group in groups:
+            memory = memoryFn(flowerGroupFeatures([size for _, size in group]))
+            self.assertTrue(memory <= 10**6 or len(group) == 1)
+
+    def testOversizeFlowers(self):
+        self.flowers = [(0, 10), (1, 1000), (2, 20), (3, 2000)]
+        groups = packFlowers(self.flowers, lambda size: size, maxCost=500)
+        self.checkAllFlowersPacked(groups)
+        self.assertTrue([(1, 1000)] in groups)
+        self.assertTrue([(3, 2000)] in groups)
+        self.assertTrue([(0, 10), (2, 20)] in groups)
+
+    def testBalanced(self):
+        # Many equally-sized flowers should be spread evenly over the groups.
+        self.flowers = [(i, 10) for i in xrange(100)]
+        groups = packFlowers(self.flowers, lambda size: size, maxCost=250)
+        self.checkAllFlowersPacked(groups)
+        self.assertEqual(len(groups), 4)
+        for group in groups:
+            self.assertEqual(len(group), 25)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""Fasta files packed at 2 bits per base, for moving sequence chunks
+through the file store.
+
+The chunks of the blast and preprocessing phases are read by many jobs
+each, so they cross the network many times. Packed, the A, C, G and T
+of a sequence take 2 bits each. Runs of any other character (usually
+N) and the soft-masked (lower case) intervals are kept in separate
+lists. This makes a chunk about a quarter of its fasta size. Jobs
+unpack their chunks to plain fasta on the worker before running the
+tools on them.
+
+A packed file is PACKED_MAGIC followed by a record for each sequence,
+in which all numbers are little-endian:
+    - the header (uint32 length, then the header line without the '>')
+    - the sequence length and the fasta line width (uint64, uint32),
+      where a width of 0 means the sequence was on a single line
+    - the runs of other characters (uint32 count, then for each its
+      start and length (uint64s) and the character)
+    - the soft-masked intervals (uint32 count, then for each its start
+      and length (uint64s))
+    - the bases, 4 to a byte with the first in the high bits, where
+      A, C, G and T are 0, 1, 2 and 3, and other characters are 0.
+"""
+import os
+import re
+import struct
+import string
+import binascii
+
+PACKED_MAGIC = "\x89C2B"
+
+# Packed chunks unpack to about this many times their size, for
+# estimating the disk and memory needed by the jobs that read them.
+UNPACKED_SIZE_RATIO = 4
+
+HEADER_SIZE = struct.Struct("<I")
+SEQUENCE_SIZE = struct.Struct("<QI")
+COUNT = struct.Struct("<I")
+RUN = struct.Struct("<QQc")
+INTERVAL = struct.Struct("<QQ")
+
+# The base-4 digit of each base, with every other character 0
+_digits = string.maketrans("ACGT" + "".join(chr(i) for i in xrange(256) if chr(i) not in "ACGT"),
+                           "0123" + "0" * 252)
+# The 4 bases of each packed byte
+_bytes = ["".join("ACGT"[(byte >> shift) & 3] for shift in (6, 4, 2, 0)) for byte in xrange(256)]
+
+_otherRun = re.compile(r"([^ACGT])\1*")
+_masked = re.compile(r"[a-z]+")
+
+def isPackedFasta(path):
+    """Is the file a packed fasta file?"""
+    with open(path) as f:
+        return f.read(len(PACKED_MAGIC)) == PACKED_MAGIC
+
+def readFasta(fileHandle):
+    """Yield the (header, sequence, line width) of each sequence in a
+    fasta file."""
+    header = None
+    lines = []
+    for line in fileHandle:
+        line = line.rstrip("\r\n")
+        if line.startswith(">"):
+            if header is not None:
+                yield header, "".join(lines), len(lines[0]) if len(lines) > 1 else 0
+            header = line[1:]
+            lines = []
+        elif line != "":
+            lines.append(line)
+    if header is not None:
+        yield header, "".join(lines), len(lines[0]) if len(lines) > 1 else 0
+
+def packSequence(sequence):
+    """Get the runs of other characters, the soft-masked intervals and
+    the packed bases of a sequence."""
+    upperSequence = sequence.upper()
+    runs = [(match.start(), match.end() - match.start(), match.group(1))
+            for match in _otherRun.finditer(upperSequence)]
+    masked = [(match.start(), match.end() - match.start())
+              for match in _masked.finditer(sequence)]
+    digits = upperSequence.translate(_digits)
+    digits += "0" * (-len(digits) % 4)
+    if len(digits) == 0:
+        return runs, masked, ""
+    # Reading the digits as one base-4 number and writing it out in hex
+    # gives 2 bases per hex digit, in linear time.
+    return runs, masked, binascii.unhexlify("%0*x" % (len(digits) / 2, int(digits, 4)))
+
+def unpackSequence(length, runs, masked, packedBases):
+    """The inverse of packSequence."""
+    sequence = bytearray("".join(map(_bytes.__getitem__, bytearray(packedBases)))[:length])
+    for start, runLength, character in runs:
+        sequence[start:start + runLength] = character * runLength
+    for start, maskedLength in masked:
+        sequence[start:start + maskedLength] = sequence[start:start + maskedLength].lower()
+    return str(sequence)
+
+def packFasta(fastaPath, packedPath):
+    """Pack a fasta file."""
+    with open(fastaPath) as fastaFile, open(packedPath, 'w') as packedFile:
+        packedFile.write(PACKED_MAGIC)
+        for header, sequence, lineWidth in readFasta(fastaFile):
+            runs, masked, packedBases = packSequence(sequence)
+            parts = [HEADER_SIZE.pack(len(header)), header,
+                     SEQUENCE_SIZE.pack(len(sequence), lineWidth),
+                     COUNT.pack(len(runs))]
+            parts.extend(RUN.pack(*run) for run in runs)
+            parts.append(COUNT.pack(len(masked)))
+            parts.extend(INTERVAL.pack(*interval) for interval in masked)
+            parts.append(packedBases)
+            packedFile.write("".join(parts))
+
+def _read(fileHandle, size):
+    data = fileHandle.read(size)
+    if len(data) < size:
+        raise RuntimeError("Truncated packed fasta file")
+    return data
+
+def unpackFasta(packedPath, fastaPath):
+    """Unpack a packed fasta file."""
+    with open(packedPath) as packedFile, open(fastaPath, 'w') as fastaFile:
+        if packedFile.read(len(PACKED_MAGIC)) != PACKED_MAGIC:
+            raise RuntimeError("%s is not a packed fasta file" % packedPath)
+        while True:
+            headerSize = packedFile.read(HEADER_SIZE.size)
+            if headerSize == "":
+                return
+            if len(headerSize) < HEADER_SIZE.size:
+                raise RuntimeError("Truncated packed fasta file")
+            header = _read(packedFile, HEADER_SIZE.unpack(headerSize)[0])
+            length, lineWidth = SEQUENCE_SIZE.unpack(_read(packedFile, SEQUENCE_SIZE.size))
+            numRuns = COUNT.unpack(_read(packedFile, COUNT.size))[0]
+            runs = [RUN.unpack(_read(packedFile, RUN.size)) for _ in xrange(numRuns)]
+            numMasked = COUNT.unpack(_read(packedFile, COUNT.size))[0]
+            masked = [INTERVAL.unpack(_read(packedFile, INTERVAL.size)) for _ in xrange(numMasked)]
+            sequence = unpackSequence(length, runs, masked, _read(packedFile, (length + 3) / 4))
+            fastaFile.write(">%s\n" % header)
+            lineWidth = lineWidth or max(length, 1)
+            for i in xrange(0, length, lineWidth):
+                fastaFile.write("%s\n" % sequence[i:i + lineWidth])
+
+class PackedFastaID(object):
+    """The file store ID of a packed fasta file, which tells it apart
+    from that of a plain one.
+    """
+    def __init__(self, fileID):
+        self.fileID = fileID
+
+    @property
+    def size(self):
+        """The approximate size of the file once unpacked."""
+        return self.fileID.size * UNPACKED_SIZE_RATIO
+
+    def __str__(self):
+        return str(self.fileID)
+
+    def __repr__(self):
+        return "PackedFastaID(%r)" % self.fileID
+
+def writeFastaGlobalFile(fileStore, fastaPath, pack, cleanup=False):
+    """Write a fasta file to the file store, packing it first if pack is
+    set. Files that packing doesn't shrink (with very many short
+    soft-masked intervals, say) are written as they are. Returns a
+    PackedFastaID if the file was packed, and the plain file ID if not.
+    """
+    if pack:
+        packedPath = fileStore.getLocalTempFile()
+        packFasta(fastaPath, packedPath)
+        if os.path.getsize(packedPath) < os.path.getsize(fastaPath):
+            return PackedFastaID(fileStore.writeGlobalFile(packedPath, cleanup=cleanup))
+    return fileStore.writeGlobalFile(fastaPath, cleanup=cleanup)
+
+def readFastaGlobalFile(fileStore, fileID):
+    """Read a fasta file written by writeFastaGlobalFile from the file
+    store, unpacking it if it was packed. Returns the path to the fasta
+    file."""
+    if not isinstance(fileID, PackedFastaID):
+        return fileStore.readGlobalFile(fileID)
+    fastaPath = fileStore.getLocalTempFile()
+    unpackFasta(fileStore.readGlobalFile(fileID.fileID), fastaPath)
+    return fastaPath
@@ -0,0 +1,124 @@
+import os
+import random
+import shutil
+import unittest
+
+from sonLib.bioio import TestStatus
+from sonLib.bioio import getTempDirectory
+from sonLib.bioio import system
+from sonLib.bioio import getTempFile
+from cactus.shared.packedFasta import packFasta, unpackFasta, isPackedFasta, \
+                                      packSequence, unpackSequence, writeFastaGlobalFile, \
+                                      readFastaGlobalFile, PackedFastaID, UNPACKED_SIZE_RATIO
+
+def randomSequence(length):
+    """A sequence with soft-masked stretches and runs of N and other
+    IUPAC characters."""
+    sequence = []
+    while len(sequence) < length:
+        runLength = random.randint(1, 50)
+        kind = random.random()
+        if kind < 0.1:
+            sequence.extend(random.choice("NnRYKM-") * runLength)
+        elif kind < 0.3:
+            sequence.extend(random.choice("acgtn") for _ in xrange(runLength))
+        else:
+            sequence.extend(random.choice("ACGT") for _ in xrange(runLength))
+    return "".join(sequence[:length])
+
+class FileID(str):
+    """A file store ID that knows its file's size, as Toil's do."""
+    def __new__(cls, fileID, size):
+        return super(FileID, cls).__new__(cls, fileID)
+
+    def __init__(self, fileID, size):
+        self.size = size
+
+class LocalFileStore(object):
+    """Just enough of a file store, kept in a local directory."""
+    def __init__(self, tempDir):
+        self.tempDir = tempDir
+
+    def getLocalTempFile(self):
+        return getTempFile(rootDir=self.tempDir)
+
+    def writeGlobalFile(self, path, cleanup=False):
+        fileID = self.getLocalTempFile()
+        shutil.copyfile(path, fileID)
+        return FileID(fileID, os.path.getsize(fileID))
+
+    def readGlobalFile(self, fileID):
+        return fileID
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.testNo = TestStatus.getTestSetup(5, 20, 50, 100)
+        self.tempDir = getTempDirectory(os.getcwd())
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    def testPackSequence(self):
+        for sequence in ["", "A", "ACGTACGTA", "nnnNNNacgtRRr", "a" * 1001]:
+            runs, masked, packedBases = packSequence(sequence)
+            self.assertEquals(len(packedBases), (len(sequence) + 3) / 4)
+            self.assertEquals(unpackSequence(len(sequence), runs, masked, packedBases), sequence)
+        self.assertEquals(packSequence("ACGTTGCA")[2], "\x1b\xe4")
+        self.assertEquals(packSequence("acNNtN")[:2], ([(2, 2, 'N'), (5, 1, 'N')], [(0, 2), (4, 1)]))
+
+    def testPackFasta(self):
+        """Packing then unpacking a fasta file should give the same file,
+        about a quarter of the size when packed."""
+        fastaPath = os.path.join(self.tempDir, "seqs.fa")
+        packedPath = os.path.join(self.tempDir, "seqs.packed")
+        unpackedPath = os.path.join(self.tempDir, "unpacked.fa")
+        for test in xrange(self.testNo):
+            lineWidth = random.choice((50, 80, None))
+            with open(fastaPath, 'w') as fastaFile:
+                for i in xrange(random.randint(0, 10)):
+                    sequence = randomSequence(random.choice((0, random.randint(1, 100000))))
+                    fastaFile.write(">id=%i|seq%i some other tokens\n" % (test, i))
+                    width = lineWidth or max(len(sequence), 1)
+                    for j in xrange(0, len(sequence), width):
+                        fastaFile.write(sequence[j:j + width] + "\n")
+            packFasta(fastaPath, packedPath)
+            self.assertTrue(isPackedFasta(packedPath))
+            self.assertFalse(isPackedFasta(fastaPath))
+            unpackFasta(packedPath, unpackedPath)
+            self.assertEquals(open(unpackedPath).read(), open(fastaPath).read())
+
+        with open(fastaPath, 'w') as fastaFile:
+            for i in xrange(10):
+                fastaFile.write(">seq%i\n" % i)
+                sequence = "".join(random.choice("ACGT") for _ in xrange(100000))
+                for j in xrange(0, len(sequence), 80):
+                    fastaFile.write(sequence[j:j + 80] + "\n")
+        packFasta(fastaPath, packedPath)
+        self.assertTrue(os.path.getsize(packedPath) < 0.26 * os.path.getsize(fastaPath))
+        self.assertRaises(RuntimeError, unpackFasta, fastaPath, unpackedPath)
+
+    def testFastaGlobalFiles(self):
+        """Only the files that were packed should be unpacked, and have
+        their size scaled up, when read."""
+        fileStore = LocalFileStore(self.tempDir)
+        fastaPath = os.path.join(self.tempDir, "seqs.fa")
+        with open(fastaPath, 'w') as fastaFile:
+            fastaFile.write(">seq\n%s\n" % randomSequence(10000).upper())
+        # Soft-masking every other base makes packing grow the file
+        maskedPath = os.path.join(self.tempDir, "masked.fa")
+        with open(maskedPath, 'w') as fastaFile:
+            fastaFile.write(">seq\n%s\n" % "".join("Aa"[i % 2] for i in xrange(10000)))
+        for path, pack, packed in [(fastaPath, False, False), (fastaPath, True, True),
+                                   (maskedPath, True, False)]:
+            fileID = writeFastaGlobalFile(fileStore, path, pack)
+            self.assertEquals(isinstance(fileID, PackedFastaID), packed)
+            if packed:
+                self.assertEquals(fileID.size, UNPACKED_SIZE_RATIO * fileID.fileID.size)
+            else:
+                self.assertEquals(fileID.size, os.path.getsize(path))
+            self.assertEquals(open(readFastaGlobalFile(fileStore, fileID)).read(), open(path).read())
+
+if __name__ == '__main__':
+    unittest.main()
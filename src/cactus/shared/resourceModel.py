@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""Learned memory model for cactus jobs.
+
+When running in docker mode, cactus_call logs the peak memory used by
+each tool together with the features (input sizes) of the job that ran
+it, as lines in the Toil leader's log like:
+
+    Max memory used for job CactusBarWrapper (tool cactus_bar) on JSON
+    features {"flowerGroupSize": 123, ...}: 456789
+
+This module gathers those data points into a local JSON model store,
+refits a polynomial per job type, and embeds the fits into the cactus
+config XML, where CactusJob uses them instead of the hand-written
+memoryPoly coefficients.
+"""
+
+import re
+import json
+import os
+import xml.etree.ElementTree as ET
+from argparse import ArgumentParser
+
+from cactus.shared.common import getOptionalAttrib
+
+memoryUsageRegex = re.compile(r"Max memory used for job (\S+) \(tool (\S+)\) on JSON features (\{.*\}): (\d+)")
+
+def parseMemoryUsage(line):
+    """Get (jobName, tool, features, memory) from a memory usage log line,
+    or None if the line isn't one."""
+    match = memoryUsageRegex.search(line)
+    if match is None:
+        return None
+    jobName, tool, features, memory = match.groups()
+    return jobName, tool, json.loads(features), int(memory)
+
+def evaluatePoly(poly, x):
+    """Evaluate a polynomial given as coefficients, highest degree first."""
+    ret = 0
+    for coefficient in poly:
+        ret = ret * x + coefficient
+    return ret
+
+def fitPoly(xs, ys, degree=1):
+    """Least-squares fit of a polynomial to the points, returned as
+    coefficients with the highest degree first (the same order as the
+    memoryPoly attributes)."""
+    n = degree + 1
+    # Build and solve the normal equations by Gaussian elimination
+    # with partial pivoting. x is rescaled to keep them well
+    # conditioned for large inputs.
+    scale = float(max([abs(x) for x in xs] + [1]))
+    sums = [sum((x / scale)**k for x in xs) for k in xrange(2*n - 1)]
+    matrix = [[sums[i + j] for j in xrange(n)] + [sum(y * (x / scale)**i for x, y in zip(xs, ys))]
+              for i in xrange(n)]
+    for col in xrange(n):
+        pivot = max(xrange(col, n), key=lambda row: abs(matrix[row][col]))
+        matrix[col], matrix[pivot] = matrix[pivot], matrix[col]
+        if matrix[col][col] == 0:
+            # Degenerate (e.g. too few distinct x values): leave the
+            # higher-order coefficient at zero.
+            continue
+        for row in xrange(n):
+            if row != col:
+                factor = matrix[row][col] / matrix[col][col]
+                matrix[row] = [a - factor * b for a, b in zip(matrix[row], matrix[col])]
+    coefficients = [matrix[i][n] / matrix[i][i] if matrix[i][i] != 0 else 0.0 for i in xrange(n)]
+    # Undo the rescaling and put the highest degree first
+    return list(reversed([coefficient / scale**i for i, coefficient in enumerate(coefficients)]))
+
+class ResourceModelStore(object):
+    """The memory data points seen so far, and the polynomials fit to
+    them, kept in a JSON file."""
+    def __init__(self, path):
+        self.path = path
+        self.dataPoints = {}
+        self.fits = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                stored = json.load(f)
+            self.dataPoints = stored.get('dataPoints', {})
+            self.fits = stored.get('fits', {})
+
+    def save(self):
+        tempPath = self.path + ".tmp"
+        with open(tempPath, 'w') as f:
+            json.dump({'dataPoints': self.dataPoints, 'fits': self.fits}, f)
+        os.rename(tempPath, self.path)
+
+    def addDataPoint(self, jobName, tool, features, memory):
+        self.dataPoints.setdefault(jobName, []).append([tool, features, memory])
+
+    def addLogFile(self, logFile):
+        """Add every memory usage data point in a log file. Returns the
+        number added."""
+        numAdded = 0
+        for line in logFile:
+            dataPoint = parseMemoryUsage(line)
+            if dataPoint is not None:
+                self.addDataPoint(*dataPoint)
+                numAdded += 1
+        return numAdded
+
+    def refit(self, degree=1, minPoints=10):
+        """Refit the polynomial for every job type with enough data.
+
+        A job has to hold the memory of the largest tool it runs, so
+        the points are first reduced to the maximum over tools for
+        each distinct set of features. The fit is then made against
+        whichever feature explains the memory usage best, and shifted
+        up to cover every observed point.
+        """
+        for jobName, dataPoints in self.dataPoints.items():
+            maxMemory = {}
+            for tool, features, memory in dataPoints:
+                key = json.dumps(features, sort_keys=True)
+                maxMemory[key] = max(maxMemory.get(key, 0), memory)
+            points = [(json.loads(key), memory) for key, memory in maxMemory.items()]
+            if len(points) < minPoints:
+                continue
+            bestFit = None
+            for feature in points[0][0]:
+                if not all(isinstance(features.get(feature), (int, long, float)) for features, _ in points):
+                    continue
+                xs = [features[feature] for features, _ in points]
+                ys = [memory for _, memory in points]
+                poly = fitPoly(xs, ys, degree)
+                residuals = [y - evaluatePoly(poly, x) for x, y in zip(xs, ys)]
+                error = sum(r**2 for r in residuals)
+                poly[-1] += max(residuals)
+                if bestFit is None or error < bestFit[0]:
+                    bestFit = (error, feature, poly)
+            if bestFit is not None:
+                self.fits[jobName] = {'feature': bestFit[1], 'poly': bestFit[2],
+                                      'numPoints': len(points)}
+
+def addResourceModelToConfig(configNode, store, safetyMargin):
+    """Embed the fitted polynomials in the config XML, so that every
+    worker sees the same model and reruns are reproducible."""
+    for node in configNode.findall("resourceModel"):
+        configNode.remove(node)
+    modelNode = ET.SubElement(configNode, "resourceModel")
+    modelNode.attrib["safetyMargin"] = str(safetyMargin)
+    for jobName, fit in sorted(store.fits.items()):
+        ET.SubElement(modelNode, "job", {"name": jobName,
+                                         "feature": fit['feature'],
+                                         "poly": " ".join(map(repr, fit['poly'])),
+                                         "numPoints": str(fit['numPoints'])})
+
+def getFittedMemoryModel(configNode, jobName):
+    """Get (feature, poly, safetyMargin) for the given job type from the
+    config XML, or None if there is no fitted model for it."""
+    if configNode is None:
+        return None
+    modelNode = configNode.find("resourceModel")
+    if modelNode is None:
+        return None
+    for jobNode in modelNode.findall("job"):
+        if jobNode.attrib["name"] == jobName:
+            return (jobNode.attrib["feature"], map(float, jobNode.attrib["poly"].split()),
+                    getOptionalAttrib(modelNode, "safetyMargin", float, 0.0))
+    return None
+
+def main():
+    parser = ArgumentParser(description="Fit a memory model for cactus jobs "
+                            "from the memory usage logged in previous runs")
+    parser.add_argument("modelStore", help="JSON file holding the data points and "
+                        "fitted model (created if it doesn't exist)")
+    parser.add_argument("logFiles", nargs="*", help="Toil leader logs to add data points from")
+    parser.add_argument("--degree", type=int, default=1,
+                        help="Degree of the polynomials to fit")
+    parser.add_argument("--minPoints", type=int, default=10,
+                        help="Minimum number of data points needed to fit a job type")
+    options = parser.parse_args()
+
+    store = ResourceModelStore(options.modelStore)
+    for logFile in options.logFiles:
+        with open(logFile) as f:
+            print "Added %d data points from %s" % (store.addLogFile(f), logFile)
+    store.refit(degree=options.degree, minPoints=options.minPoints)
+    store.save()
+    for jobName, fit in sorted(store.fits.items()):
+        print "%s: memory = poly(%s) %s, from %d points" % (jobName, fit['feature'], fit['poly'], fit['numPoints'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+#Released under the MIT license, see LICENSE.txt
+import unittest
+import os
+import json
+import random
+import shutil
+import xml.etree.ElementTree as ET
+
+from sonLib.bioio import getTempDirectory
+from cactus.shared.resourceModel import ResourceModelStore
+from cactus.shared.resourceModel import parseMemoryUsage
+from cactus.shared.resourceModel import fitPoly
+from cactus.shared.resourceModel import evaluatePoly
+from cactus.shared.resourceModel import addResourceModelToConfig
+from cactus.shared.resourceModel import getFittedMemoryModel
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tempDir = getTempDirectory(os.getcwd())
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tempDir)
+
+    def testFitPoly(self):
+        xs = [random.randint(0, 10**9) for _ in xrange(50)]
+        ys = [3.5 * x**2 + 2.0 * x + 4e8 for x in xs]
+        poly = fitPoly(xs, ys, degree=2)
+        for x, y in zip(xs, ys):
+            self.assertAlmostEqual(evaluatePoly(poly, x) / y, 1.0, places=6)
+
+    def testFitFromLogs(self):
+        # A job running two tools on varying input, where only one of
+        # the features matters and the second tool dominates memory usage.
+        lines = ["INFO:toil.leader:Got message from job at time 01-01-2018 "
+                 "00:00:00: some other message"]
+        for _ in xrange(20):
+            features = {"flowerGroupSize": random.randint(1, 10**8),
+                        "numFlowers": random.randint(1, 1000)}
+            memory = 3 * features["flowerGroupSize"] + 10**8
+            lines.append("Max memory used for job CactusBarWrapper (tool cactus_bar) "
+                         "on JSON features %s: %d" % (json.dumps(features), memory))
+            lines.append("Max memory used for job CactusBarWrapper (tool cactus_secondaryDatabase) "
+                         "on JSON features %s: %d" % (json.dumps(features), memory / 2))
+        self.assertEqual(parseMemoryUsage(lines[1])[:2], ("CactusBarWrapper", "cactus_bar"))
+        self.assertEqual(parseMemoryUsage(lines[0]), None)
+
+        storePath = os.path.join(self.tempDir, "model.json")
+        store = ResourceModelStore(storePath)
+        self.assertEqual(store.addLogFile(lines), 40)
+        store.refit(minPoints=100)
+        self.assertEqual(store.fits, {})
+        store.refit()
+        store.save()
+
+        # The model should survive a round trip through the store and config
+        configNode = ET.Element("cactusWorkflowConfig")
+        addResourceModelToConfig(configNode, ResourceModelStore(storePath), 0.1)
+        self.assertEqual(getFittedMemoryModel(configNode, "CactusBarPhase"), None)
+        feature, poly, safetyMargin = getFittedMemoryModel(configNode, "CactusBarWrapper")
+        self.assertEqual(feature, "flowerGroupSize")
+        self.assertEqual(safetyMargin, 0.1)
+        self.assertAlmostEqual(poly[0], 3.0, places=3)
+        # The fit should cover every observed point
+        for _, features, memory in store.dataPoints["CactusBarWrapper"]:
+            self.assertTrue(evaluatePoly(poly, features["flowerGroupSize"]) >= memory - 1)
+
+if __name__ == '__main__':
+    unittest.main()